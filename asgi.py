@@ -0,0 +1,5 @@
+# ASGI entrypoint, serving the sync pulls natively and the rest with the Flask app.
+# Run it with `uvicorn asgi:app`. See hikmahealth/server/asgi.py
+from hikmahealth.server.asgi import App
+
+app = App()
@@ -0,0 +1,6 @@
+"""
+Utilities to dump the contents of the database into portable archives (and to read them back).
+
+The archive layout is a single `manifest.json` describing the dump, plus one file per table,
+written in the order the tables depend on one another.
+"""
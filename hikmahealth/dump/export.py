@@ -0,0 +1,362 @@
+"""
+Streaming export of the database into a `zip` or `tar.gz` archive.
+
+Each table is read with `COPY ... TO STDOUT`, so rows are never materialized as python
+objects. The chunks returned by postgres are compressed and written into the archive as they
+arrive, which keeps memory usage constant regardless of the size of the database.
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import datetime
+import io
+import json
+import tarfile
+import tempfile
+import time
+import uuid
+import zipfile
+from dataclasses import dataclass
+from typing import IO, Callable, Iterable, Iterator, Tuple
+
+from psycopg import Connection, IsolationLevel, sql
+
+from hikmahealth.dump.tables import TABLES
+from hikmahealth.utils.datetime import utc
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_CSV = 'csv'
+
+ARCHIVE_ZIP = 'zip'
+ARCHIVE_TAR = 'tar'
+
+MODE_FULL = 'full'
+MODE_INCREMENTAL = 'incremental'
+
+SCHEMA_VERSION = '2.0'
+"""Version of the archive layout. `1.0` is the single JSON document format"""
+
+MANIFEST_NAME = 'manifest.json'
+
+COMPRESS_LEVEL = 1
+"""Compression is done on the fly; a low level keeps the export bounded by the database
+instead of by zlib, with only a slightly larger archive."""
+
+OUTPUT_CHUNK_SIZE = 64 * 1024
+"""Minimum number of bytes to buffer before handing a chunk to the caller"""
+
+MIMETYPES = {
+    ARCHIVE_ZIP: 'application/zip',
+    ARCHIVE_TAR: 'application/gzip',
+}
+
+EXTENSIONS = {
+    ARCHIVE_ZIP: 'zip',
+    ARCHIVE_TAR: 'tar.gz',
+}
+
+
+def get_supported_formats():
+    return (FORMAT_NDJSON, FORMAT_CSV)
+
+
+def get_supported_archives():
+    return (ARCHIVE_ZIP, ARCHIVE_TAR)
+
+
+# `row_to_json` never outputs raw newlines, so by picking a quote and delimiter characters that
+# can't show up in the JSON, the CSV format outputs each document as-is (the `text` format
+# would escape the backslashes).
+NDJSON_COPY_OPTIONS = "(FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+
+# same conditions used to pick the records to send on a sync pull (see `SyncToClient`),
+# so deleted records are included as tombstones
+CHANGED_SINCE = (
+    'WHERE t.server_created_at > %(since)s'
+    ' OR t.last_modified > %(since)s'
+    ' OR t.deleted_at > %(since)s'
+)
+
+
+@dataclass
+class TableManifest:
+    name: str
+    filename: str
+    columns: list[str]
+    rows: int = 0
+    bytes: int = 0
+
+
+@dataclass
+class ExportManifest:
+    """Describes the contents of the archive. Written last, as `manifest.json`"""
+
+    export_id: str
+    format: str
+    exported_at: str
+    schema_version: str = SCHEMA_VERSION
+    mode: str = MODE_FULL
+    since: str | None = None
+    """For incremental exports, the records changed after this time are included"""
+    until: str | None = None
+    """Time of the snapshot the export was read from. The watermark for the next export"""
+    target: str | None = None
+    """Name used to keep track of the watermark, between incremental exports"""
+    tables: list[TableManifest] = dataclasses.field(default_factory=list)
+    duration_seconds: float | None = None
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+
+def get_table_columns(conn: Connection, table: str) -> list[str]:
+    """Returns the column names of the table, in the order `SELECT *` would return them"""
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('SELECT * FROM {} LIMIT 0').format(sql.Identifier(table)))
+        assert cur.description is not None
+        return [c.name for c in cur.description]
+
+
+def build_copy_query(table: str, fmt: str, incremental: bool = False):
+    """Builds the `COPY ... TO STDOUT` statement to read all rows of a table.
+
+    With `incremental`, only the rows changed after the `since` parameter are read."""
+    where = sql.SQL(CHANGED_SINCE if incremental else '')
+
+    if fmt == FORMAT_NDJSON:
+        return sql.SQL(
+            'COPY (SELECT row_to_json(t) FROM {} t {}) TO STDOUT WITH ' + NDJSON_COPY_OPTIONS
+        ).format(sql.Identifier(table), where)
+
+    if fmt == FORMAT_CSV:
+        return sql.SQL(
+            'COPY (SELECT * FROM {} t {}) TO STDOUT WITH (FORMAT csv, HEADER true)'
+        ).format(sql.Identifier(table), where)
+
+    raise ValueError(f"unsupported export format '{fmt}'")
+
+
+def iter_copy_chunks(
+    conn: Connection, query, table: TableManifest, params: dict | None = None
+) -> Iterator[bytes]:
+    """Yields the raw output of a `COPY ... TO STDOUT` query, keeping count of the
+    rows and bytes read into `table`"""
+    with conn.cursor() as cur:
+        with cur.copy(query, params) as copy:
+            for data in copy:
+                table.bytes += len(data)
+                yield bytes(data)
+
+        table.rows = max(cur.rowcount, 0)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, unseekable stream that holds on to whatever was written to it,
+    until it's drained."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b) -> int:
+        self._buffer += b
+        return len(b)
+
+    def drain(self, min_size: int = 0) -> bytes:
+        if len(self._buffer) < max(min_size, 1):
+            return b''
+
+        out = bytes(self._buffer)
+        self._buffer.clear()
+        return out
+
+
+ArchiveEntry = Tuple[str, Iterable[bytes]]
+
+
+def write_archive(
+    entries: Iterable[ArchiveEntry],
+    archive: str = ARCHIVE_ZIP,
+    chunk_size: int = OUTPUT_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """Writes the `(filename, chunks)` entries into an archive, yielding the archive
+    as it's being written.
+
+    The entries are consumed lazily, so an entry can be built from what the previous ones
+    have read (ex. the manifest)."""
+    sink = _ChunkSink()
+
+    if archive == ARCHIVE_ZIP:
+        with zipfile.ZipFile(
+            sink, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL
+        ) as zf:
+            for name, chunks in entries:
+                # force_zip64, since the size of the member isn't known in advance
+                with zf.open(name, 'w', force_zip64=True) as member:
+                    for chunk in chunks:
+                        member.write(chunk)
+                        out = sink.drain(chunk_size)
+                        if out:
+                            yield out
+
+    elif archive == ARCHIVE_TAR:
+        # tar headers need the size of a member before its data, so each member is
+        # spooled to a temporary file (and not memory) before being added
+        with tarfile.open(
+            fileobj=sink, mode='w|gz', compresslevel=COMPRESS_LEVEL
+        ) as tf:
+            for name, chunks in entries:
+                with tempfile.TemporaryFile() as spool:
+                    for chunk in chunks:
+                        spool.write(chunk)
+
+                    info = tarfile.TarInfo(name)
+                    info.size = spool.tell()
+                    info.mtime = int(time.time())
+                    spool.seek(0)
+                    tf.addfile(info, spool)
+
+                out = sink.drain(chunk_size)
+                if out:
+                    yield out
+    else:
+        raise ValueError(f"unsupported archive type '{archive}'")
+
+    out = sink.drain()
+    if out:
+        yield out
+
+
+def stream_database_export(
+    conn: Connection,
+    fmt: str = FORMAT_NDJSON,
+    archive: str = ARCHIVE_ZIP,
+    tables: Iterable[str] = TABLES,
+    on_table: Callable[[TableManifest], None] | None = None,
+    since: datetime.datetime | None = None,
+    target: str | None = None,
+    on_complete: Callable[[ExportManifest], None] | None = None,
+) -> Iterator[bytes]:
+    """Streams an archive with the contents of `tables`.
+
+    The tables are read within a single `REPEATABLE READ` transaction, so the dump is a
+    consistent snapshot of the database. When `since` is set, only the rows created,
+    updated or deleted after it are included.
+
+    `on_table` is called once each table is read, and `on_complete` once the whole archive
+    is written."""
+    if fmt not in get_supported_formats():
+        raise ValueError(f"unsupported export format '{fmt}'")
+
+    started = time.monotonic()
+    manifest = ExportManifest(
+        export_id=str(uuid.uuid4()),
+        format=fmt,
+        exported_at=utc.now().isoformat(),
+        mode=MODE_FULL if since is None else MODE_INCREMENTAL,
+        since=since.isoformat() if since is not None else None,
+        target=target,
+    )
+    params = {'since': since} if since is not None else None
+
+    def entries() -> Iterator[ArchiveEntry]:
+        for table in tables:
+            t = TableManifest(
+                name=table,
+                filename=f'{table}.{fmt}',
+                columns=get_table_columns(conn, table),
+            )
+            manifest.tables.append(t)
+
+            query = build_copy_query(table, fmt, incremental=since is not None)
+            yield t.filename, iter_copy_chunks(conn, query, t, params)
+
+            # the archive has consumed all the chunks of the table by now
+            if on_table is not None:
+                on_table(t)
+
+        manifest.duration_seconds = round(time.monotonic() - started, 3)
+        yield MANIFEST_NAME, (json.dumps(manifest.to_dict(), indent=2).encode(),)
+
+    conn.isolation_level = IsolationLevel.REPEATABLE_READ
+    conn.read_only = True
+    with conn.transaction():
+        # the snapshot is taken on the first statement of the transaction
+        with conn.cursor() as cur:
+            (until,) = cur.execute('SELECT now()').fetchone()
+            manifest.until = until.isoformat()
+
+        yield from write_archive(entries(), archive)
+
+    if on_complete is not None:
+        on_complete(manifest)
+
+
+def stream_json_document(
+    conn: Connection,
+    tables: Iterable[str] = TABLES,
+    chunk_size: int = OUTPUT_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """Streams the dump as the single JSON document used by the schema version `1.0`
+    (ex. `{"exported_at": ..., "schema_version": "1.0", "data": {"<table>": [...]}}`)"""
+    conn.isolation_level = IsolationLevel.REPEATABLE_READ
+    conn.read_only = True
+
+    head = {'exported_at': utc.now().isoformat(), 'schema_version': '1.0'}
+    buffer = bytearray(json.dumps(head)[:-1].encode() + b', "data": {')
+
+    with conn.transaction():
+        for ix, table in enumerate(tables):
+            buffer += (b', ' if ix else b'') + json.dumps(table).encode() + b': ['
+
+            t = TableManifest(name=table, filename=table, columns=[])
+            query = build_copy_query(table, FORMAT_NDJSON)
+            for jx, chunk in enumerate(iter_copy_chunks(conn, query, t)):
+                # each line of the output is a JSON document
+                if jx:
+                    buffer += b', '
+                buffer += chunk.rstrip(b'\n').replace(b'\n', b', ')
+
+                if len(buffer) >= chunk_size:
+                    yield bytes(buffer)
+                    buffer.clear()
+
+            buffer += b']'
+
+    buffer += b'}}'
+    yield bytes(buffer)
+
+
+def export_database_to_file(
+    conn: Connection,
+    file: IO[bytes],
+    fmt: str = FORMAT_NDJSON,
+    archive: str = ARCHIVE_ZIP,
+    on_table: Callable[[TableManifest], None] | None = None,
+    since: datetime.datetime | None = None,
+    target: str | None = None,
+    on_complete: Callable[[ExportManifest], None] | None = None,
+) -> int:
+    """Writes the archive to a file object, returning the number of bytes written"""
+    size = 0
+    for chunk in stream_database_export(
+        conn,
+        fmt,
+        archive,
+        on_table=on_table,
+        since=since,
+        target=target,
+        on_complete=on_complete,
+    ):
+        file.write(chunk)
+        size += len(chunk)
+
+    return size
+
+
+def archive_filename(archive: str, at: str | None = None) -> str:
+    stamp = (at or utc.now().strftime('%Y%m%dT%H%M%SZ')).replace(':', '')
+    return f'hikma-export-{stamp}.{EXTENSIONS[archive]}'
@@ -0,0 +1,354 @@
+"""
+Restores an archive created by `hikmahealth.dump.export` into the database.
+
+Each table is loaded with `COPY ... FROM STDIN` into an `UNLOGGED` staging table of its own,
+then merged into the live table with a single `INSERT ... SELECT ... ON CONFLICT` statement.
+The tables are restored (and committed) one at a time in the order of their dependencies, and
+the progress is saved as a server variable, so a restore that dies half way can pick up from
+the first table that wasn't committed.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import tarfile
+import uuid
+import zipfile
+from typing import IO, Callable, Iterable
+
+from psycopg import Connection, sql
+
+from hikmahealth.dump import export
+from hikmahealth.dump.tables import PRIMARY_KEYS, TABLES
+from hikmahealth.utils.datetime import utc
+
+SPOOL_CHUNK_SIZE = 1024 * 1024
+COPY_CHUNK_SIZE = 256 * 1024
+
+STATUS_RUNNING = 'running'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+
+
+class ArchiveError(Exception):
+    """The uploaded file isn't an archive that can be restored"""
+
+
+def spool_stream(stream: IO[bytes], file: IO[bytes], max_size: int | None = None) -> int:
+    """Copies the stream (ex. the body of a request) to `file`, in chunks. Returns the
+    number of bytes copied"""
+    size = 0
+    while True:
+        chunk = stream.read(SPOOL_CHUNK_SIZE)
+        if not chunk:
+            break
+
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise ArchiveError(f'archive is larger than {max_size} bytes')
+
+        file.write(chunk)
+
+    file.flush()
+    file.seek(0)
+    return size
+
+
+class ArchiveReader:
+    """Reads the members of a `zip` or `tar.gz` export"""
+
+    def __init__(self, file: IO[bytes]):
+        self._zip: zipfile.ZipFile | None = None
+        self._tar: tarfile.TarFile | None = None
+
+        file.seek(0)
+        if zipfile.is_zipfile(file):
+            file.seek(0)
+            self._zip = zipfile.ZipFile(file)
+        else:
+            file.seek(0)
+            try:
+                self._tar = tarfile.open(fileobj=file, mode='r:*')
+            except tarfile.TarError as err:
+                raise ArchiveError('file is neither a zip nor a tar archive') from err
+
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self) -> dict:
+        try:
+            with self.open(export.MANIFEST_NAME) as f:
+                manifest = json.load(f)
+        except KeyError as err:
+            raise ArchiveError(f"archive is missing '{export.MANIFEST_NAME}'") from err
+
+        if manifest.get('format') not in export.get_supported_formats():
+            raise ArchiveError(f"unsupported format '{manifest.get('format')}'")
+
+        return manifest
+
+    def open(self, name: str) -> IO[bytes]:
+        if self._zip is not None:
+            return self._zip.open(name)
+
+        assert self._tar is not None
+        member = self._tar.extractfile(name)
+        if member is None:
+            raise KeyError(name)
+
+        return member
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        if self._tar is not None:
+            self._tar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_column_types(conn: Connection, table: str) -> dict[str, str]:
+    """Returns the columns of `table`, mapped to their SQL type"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT attname, format_type(atttypid, atttypmod)
+            FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum
+            """,
+            (table,),
+        )
+        return {name: typ for name, typ in cur.fetchall()}
+
+
+def staging_table_name(table: str, suffix: str) -> str:
+    return f'_hh_restore_{table}_{suffix}'
+
+
+def build_upsert_query(
+    table: str,
+    staging: str,
+    columns: Iterable[str],
+    fmt: str,
+    primary_keys: Iterable[str] | None = None,
+    only_newer: bool = False,
+):
+    """Builds the statement merging the staging table into `table`.
+
+    For `ndjson`, the staging table holds one JSON document per row, which is expanded with
+    `jsonb_populate_record` into a row of the target table. With `only_newer`, existing rows
+    are only updated when the incoming row was modified after them."""
+    columns = list(columns)
+    keys = list(primary_keys if primary_keys is not None else PRIMARY_KEYS[table])
+
+    column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+    if fmt == export.FORMAT_NDJSON:
+        source = sql.SQL(
+            'SELECT {columns} FROM {staging} s, jsonb_populate_record(NULL::{table}, s.doc) r'
+        ).format(
+            columns=sql.SQL(', ').join(sql.Identifier('r', c) for c in columns),
+            staging=sql.Identifier(staging),
+            table=sql.Identifier(table),
+        )
+    elif fmt == export.FORMAT_CSV:
+        source = sql.SQL('SELECT {columns} FROM {staging}').format(
+            columns=column_list, staging=sql.Identifier(staging)
+        )
+    else:
+        raise ValueError(f"unsupported export format '{fmt}'")
+
+    updates = [c for c in columns if c not in keys]
+    if updates:
+        conflict = sql.SQL('DO UPDATE SET {}').format(
+            sql.SQL(', ').join(
+                sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(c)) for c in updates
+            )
+        )
+    else:
+        conflict = sql.SQL('DO NOTHING')
+
+    if updates and only_newer and 'last_modified' in columns:
+        conflict = sql.SQL(
+            '{} WHERE {table}.last_modified IS NULL'
+            ' OR {table}.last_modified <= EXCLUDED.last_modified'
+        ).format(conflict, table=sql.Identifier(table))
+
+    return sql.SQL(
+        'INSERT INTO {table} ({columns}) {source} ON CONFLICT ({keys}) {conflict}'
+    ).format(
+        table=sql.Identifier(table),
+        columns=column_list,
+        source=source,
+        keys=sql.SQL(', ').join(map(sql.Identifier, keys)),
+        conflict=conflict,
+    )
+
+
+def _create_staging_table(
+    conn: Connection, table: str, fmt: str, columns: list[str], types: dict[str, str]
+) -> str:
+    # of its own, so restores running at once (a route and a job, or a job reclaimed
+    # from a worker still running it) don't load into each other's staging tables. it's
+    # created in the transaction of the table, so a restore dying leaves none behind
+    staging = staging_table_name(table, uuid.uuid4().hex[:12])
+
+    if fmt == export.FORMAT_NDJSON:
+        definition = sql.SQL('doc jsonb')
+    else:
+        # columns that no longer exist in the target table are read, and then ignored
+        definition = sql.SQL(', ').join(
+            sql.SQL('{} {}').format(sql.Identifier(c), sql.SQL(types.get(c, 'text')))
+            for c in columns
+        )
+
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(staging)))
+        cur.execute(
+            sql.SQL('CREATE UNLOGGED TABLE {} ({})').format(
+                sql.Identifier(staging), definition
+            )
+        )
+
+    return staging
+
+
+def _copy_into_staging(
+    conn: Connection, staging: str, fmt: str, columns: list[str], data: IO[bytes]
+) -> int:
+    if fmt == export.FORMAT_NDJSON:
+        query = sql.SQL('COPY {} (doc) FROM STDIN WITH ' + export.NDJSON_COPY_OPTIONS).format(
+            sql.Identifier(staging)
+        )
+    else:
+        query = sql.SQL('COPY {} ({}) FROM STDIN WITH (FORMAT csv, HEADER true)').format(
+            sql.Identifier(staging), sql.SQL(', ').join(map(sql.Identifier, columns))
+        )
+
+    with conn.cursor() as cur:
+        with cur.copy(query) as copy:
+            while chunk := data.read(COPY_CHUNK_SIZE):
+                copy.write(chunk)
+
+        return max(cur.rowcount, 0)
+
+
+def restore_table(conn: Connection, reader: ArchiveReader, table: dict) -> dict:
+    """Restores a single table described by its entry in the manifest, within one
+    transaction. Returns the number of rows read and written"""
+    fmt = reader.manifest['format']
+    name = table['name']
+    types = get_column_types(conn, name)
+    if not types:
+        raise ArchiveError(f"table '{name}' doesn't exist in the database")
+
+    columns = [c for c in table['columns'] if c in types]
+    ignored = [c for c in table['columns'] if c not in types]
+    if ignored:
+        logging.warning(f'restore: ignoring columns {ignored} missing from {name}')
+
+    with conn.transaction():
+        staging = _create_staging_table(conn, name, fmt, table['columns'], types)
+        try:
+            with reader.open(table['filename']) as data:
+                read = _copy_into_staging(conn, staging, fmt, table['columns'], data)
+
+            with conn.cursor() as cur:
+                cur.execute(
+                    build_upsert_query(
+                        name,
+                        staging,
+                        columns,
+                        fmt,
+                        only_newer=reader.manifest.get('mode') == export.MODE_INCREMENTAL,
+                    )
+                )
+                written = max(cur.rowcount, 0)
+        finally:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL('DROP TABLE IF EXISTS {}').format(sql.Identifier(staging)))
+
+    return {'rows': read, 'written': written}
+
+
+def progress_key(export_id: str) -> str:
+    return f'HH_IMPORT_PROGRESS_{export_id}'
+
+
+def new_progress(manifest: dict) -> dict:
+    return {
+        'export_id': manifest['export_id'],
+        'status': STATUS_RUNNING,
+        'started_at': utc.now().isoformat(),
+        'updated_at': utc.now().isoformat(),
+        'error': None,
+        'tables': {
+            t['name']: {'rows': t.get('rows'), 'written': None, 'done': False}
+            for t in manifest['tables']
+        },
+    }
+
+
+def restore_archive(
+    conn: Connection,
+    reader: ArchiveReader,
+    progress: dict | None = None,
+    on_progress: Callable[[dict], None] | None = None,
+) -> dict:
+    """Restores all the tables in the archive, in order of dependencies.
+
+    Tables marked as done in `progress` (from an earlier attempt of the same export) are
+    skipped. `on_progress` is called after each table is committed, and on failure."""
+    manifest = reader.manifest
+    # each table is committed on its own
+    conn.autocommit = True
+
+    if progress is None or progress.get('export_id') != manifest['export_id']:
+        progress = new_progress(manifest)
+
+    progress['status'] = STATUS_RUNNING
+    progress['error'] = None
+
+    def report():
+        progress['updated_at'] = utc.now().isoformat()
+        if on_progress is not None:
+            on_progress(progress)
+
+    entries = {t['name']: t for t in manifest['tables']}
+    order = [t for t in TABLES if t in entries]
+    order += [t for t in entries if t not in order]
+
+    try:
+        for name in order:
+            state = progress['tables'].setdefault(
+                name, {'rows': None, 'written': None, 'done': False}
+            )
+            if state['done']:
+                continue
+
+            state.update(restore_table(conn, reader, entries[name]), done=True)
+            report()
+    except Exception as err:
+        progress['status'] = STATUS_FAILED
+        progress['error'] = str(err)
+        report()
+        raise
+
+    progress['status'] = STATUS_COMPLETED
+    report()
+    return progress
+
+
+def restore_file(
+    conn: Connection,
+    file: IO[bytes],
+    progress: dict | None = None,
+    on_progress: Callable[[dict], None] | None = None,
+) -> dict:
+    with ArchiveReader(file) as reader:
+        return restore_archive(conn, reader, progress, on_progress)
+
@@ -0,0 +1,47 @@
+"""Tables included in a database dump, and how they relate to one another"""
+
+TABLES = (
+    'clinics',
+    'users',
+    'patients',
+    'patient_additional_attributes',
+    'event_forms',
+    'visits',
+    'events',
+    'patient_registration_forms',
+    'appointments',
+    'string_ids',
+    'string_content',
+    'prescriptions',
+)
+"""Tables to include in a dump, in order of their dependencies. Restoring them in this
+order makes sure referenced rows exist before the rows that reference them."""
+
+PRIMARY_KEYS = {
+    'clinics': ('id',),
+    'users': ('id',),
+    'patients': ('id',),
+    'patient_additional_attributes': ('patient_id', 'attribute_id'),
+    'event_forms': ('id',),
+    'visits': ('id',),
+    'events': ('id',),
+    'patient_registration_forms': ('id',),
+    'appointments': ('id',),
+    'string_ids': ('id',),
+    'string_content': ('id', 'language'),
+    'prescriptions': ('id',),
+}
+"""Columns used to resolve conflicts when restoring a table. For `string_content`, this is
+the unique index on `(id, language)`."""
+
+JSON_COLUMNS = {
+    'events': ('form_data', 'metadata'),
+    'prescriptions': ('items', 'metadata'),
+    'event_forms': ('metadata',),
+    'patient_registration_forms': ('fields', 'metadata'),
+    'patients': ('additional_data', 'metadata'),
+    'patient_additional_attributes': ('metadata',),
+    'visits': ('metadata',),
+    'appointments': ('metadata',),
+}
+"""Columns holding JSON documents, for each table"""
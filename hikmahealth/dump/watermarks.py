@@ -0,0 +1,152 @@
+"""Keeps track of incremental exports and imports, as server variables.
+
+An export made for a `target` records the time of its snapshot. The next incremental
+export for that target starts from there, with a small overlap. On the receiving server,
+the last applied archive is recorded the same way, and an incremental archive is only
+applied if it starts before the last applied one ended. Otherwise, changes made in between
+would be missing."""
+
+from __future__ import annotations
+
+import datetime
+import re
+
+from hikmahealth.dump.export import MODE_FULL, MODE_INCREMENTAL, ExportManifest
+from hikmahealth.dump.restore import ArchiveError
+from hikmahealth.server.client.keeper import Keeper
+from hikmahealth.utils.datetime import utc
+
+INCREMENTAL_OVERLAP = datetime.timedelta(minutes=5)
+"""Re-exported window before the last watermark. Covers the transactions that were still
+running when the previous snapshot was taken, but stamped their rows before it"""
+
+_TARGET_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class IncrementalGapError(ArchiveError):
+    """The incremental archive doesn't continue from the last applied archive"""
+
+
+def validate_target(target: str) -> str:
+    if not _TARGET_PATTERN.match(target):
+        raise ValueError(
+            f"invalid target '{target}'. use up to 64 letters, numbers, '-' or '_'"
+        )
+
+    return target
+
+
+def export_key(target: str) -> str:
+    return f'HH_EXPORT_WATERMARK_{validate_target(target)}'
+
+
+def import_key(target: str) -> str:
+    return f'HH_IMPORT_WATERMARK_{validate_target(target)}'
+
+
+def get_export_since(
+    kp: Keeper, target: str, overlap: datetime.timedelta = INCREMENTAL_OVERLAP
+) -> datetime.datetime | None:
+    """Returns the point from which the next incremental export of `target` starts, or
+    `None` if there was never an export for the target"""
+    watermark = kp.get(export_key(target))
+    if watermark is None:
+        return None
+
+    return utc.from_iso8601(watermark['until']) - overlap
+
+
+def resolve_export_since(
+    kp: Keeper, mode: str | None, since: str | None = None, target: str | None = None
+) -> datetime.datetime | None:
+    """Returns where an export should start from. `None` for a full export, which is also
+    what the first incremental export of a target falls back to"""
+    if mode is None or mode == MODE_FULL:
+        return None
+
+    if mode != MODE_INCREMENTAL:
+        raise ValueError(
+            f"unsupported mode '{mode}'. expected '{MODE_FULL}' or '{MODE_INCREMENTAL}'"
+        )
+
+    if since is not None:
+        return utc.from_iso8601(since)
+
+    if target is None:
+        raise ValueError('incremental exports need either a `since` or a `target`')
+
+    return get_export_since(kp, target)
+
+
+def save_export_watermark(kp: Keeper, manifest: ExportManifest):
+    if manifest.target is None:
+        return
+
+    kp.set_json(
+        export_key(manifest.target),
+        {
+            'export_id': manifest.export_id,
+            'mode': manifest.mode,
+            'since': manifest.since,
+            'until': manifest.until,
+        },
+    )
+
+
+def check_can_apply(manifest: dict, applied: dict | None, force: bool = False):
+    """Makes sure an incremental archive continues from the last applied archive of
+    the same target. Full archives can always be applied."""
+    if force or manifest.get('mode') != MODE_INCREMENTAL:
+        return
+
+    if manifest.get('target') is None:
+        raise IncrementalGapError(
+            'incremental archives exported without a target can only be forced'
+        )
+
+    if applied is None:
+        raise IncrementalGapError(
+            'no archive was applied for target {}. apply a full export first'.format(
+                manifest.get('target')
+            )
+        )
+
+    if utc.from_iso8601(manifest['since']) > utc.from_iso8601(applied['until']):
+        raise IncrementalGapError(
+            'archive starts at {}, but the last applied archive ends at {}'.format(
+                manifest['since'], applied['until']
+            )
+        )
+
+
+def get_import_watermark(kp: Keeper, manifest: dict) -> dict | None:
+    if manifest.get('target') is None:
+        return None
+
+    return kp.get(import_key(manifest['target']))
+
+
+def save_import_watermark(kp: Keeper, manifest: dict):
+    if manifest.get('target') is None or manifest.get('until') is None:
+        return
+
+    applied = get_import_watermark(kp, manifest)
+    # an older archive applied late doesn't move the watermark back
+    if applied is not None and utc.from_iso8601(applied['until']) > utc.from_iso8601(
+        manifest['until']
+    ):
+        return
+
+    kp.set_json(
+        import_key(manifest['target']),
+        {
+            'export_id': manifest['export_id'],
+            'mode': manifest.get('mode', MODE_FULL),
+            'until': manifest['until'],
+        },
+    )
+
+
+def prepare_restore(kp: Keeper, manifest: dict, force: bool = False):
+    """Checks the archive can be applied, before restoring it"""
+    check_can_apply(manifest, get_import_watermark(kp, manifest), force)
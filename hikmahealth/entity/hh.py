@@ -2,11 +2,11 @@ from __future__ import annotations
 from collections import defaultdict
 import logging
 
-from psycopg import Connection
+from psycopg import Connection, sql
 from psycopg.cursor import Cursor
 
 from hikmahealth import sync
-from hikmahealth.entity import core, fields, helpers
+from hikmahealth.entity import core, fields, helpers, softdelete, transform
 from .sync import (
     SyncToClient,
     SyncToServer,
@@ -21,15 +21,14 @@ from datetime import date
 import itertools
 
 from hikmahealth.server.client import db
-from typing import Any
 
 from psycopg.rows import class_row, dict_row
 import dataclasses
 import json
 from urllib import parse as urlparse
 
-from hikmahealth.utils.misc import is_valid_uuid, safe_json_dumps
-from hikmahealth.entity.helpers import SimpleCRUD, get_from_dict
+from hikmahealth.utils.misc import safe_json_dumps
+from hikmahealth.entity.helpers import SimpleCRUD
 import uuid
 
 
@@ -48,9 +47,25 @@ import uuid
 # TODO: 👇🏽 that one
 
 
+def _additional_data_json(additional_data):
+    """Serializes the `additional_data` pushed with a patient, `'{}'` if it's invalid"""
+    if additional_data == '':
+        return '{}'
+    if isinstance(additional_data, (dict, list)):
+        return safe_json_dumps(additional_data)
+    if isinstance(additional_data, str):
+        try:
+            json.loads(additional_data)
+        except json.JSONDecodeError:
+            return '{}'
+
+    return additional_data
+
+
 @core.dataentity
 class Patient(SyncToClient, SyncToServer, helpers.SimpleCRUD):
     TABLE_NAME = 'patients'
+    SYNC_SCOPE_COLUMN = 'id'
 
     id: str
     given_name: str | None = None
@@ -90,7 +105,36 @@ class Patient(SyncToClient, SyncToServer, helpers.SimpleCRUD):
                     external_patient_id = EXCLUDED.external_patient_id,
                     created_at = EXCLUDED.created_at,
                     updated_at = EXCLUDED.updated_at,
-                    last_modified = EXCLUDED.last_modified;
+                    last_modified = EXCLUDED.last_modified
+                WHERE (
+                    patients.given_name,
+                    patients.surname,
+                    patients.date_of_birth,
+                    patients.citizenship,
+                    patients.hometown,
+                    patients.sex,
+                    patients.phone,
+                    patients.camp,
+                    patients.additional_data::jsonb,
+                    patients.government_id,
+                    patients.external_patient_id,
+                    patients.created_at,
+                    patients.updated_at
+                ) IS DISTINCT FROM (
+                    EXCLUDED.given_name,
+                    EXCLUDED.surname,
+                    EXCLUDED.date_of_birth,
+                    EXCLUDED.citizenship,
+                    EXCLUDED.hometown,
+                    EXCLUDED.sex,
+                    EXCLUDED.phone,
+                    EXCLUDED.camp,
+                    EXCLUDED.additional_data::jsonb,
+                    EXCLUDED.government_id,
+                    EXCLUDED.external_patient_id,
+                    EXCLUDED.created_at,
+                    EXCLUDED.updated_at
+                );
             """,
             data,
         )
@@ -101,106 +145,23 @@ class Patient(SyncToClient, SyncToServer, helpers.SimpleCRUD):
 
     @classmethod
     def delete_from_delta(cls, ctx, cur: Cursor, id: str):
-        cur.execute(
-            """INSERT INTO patients
-                  (id, is_deleted, given_name, surname, date_of_birth, citizenship, hometown, sex, phone, camp, additional_data, image_timestamp, photo_url, government_id, external_patient_id, created_at, updated_at, last_modified, deleted_at)
-                VALUES
-                  (%s::uuid, true, '', '', NULL, '', '', '', '', '', '{}', NULL, '', NULL, NULL, %s, %s, %s, %s)
-                ON CONFLICT (id) DO UPDATE
-                SET is_deleted = true,
-                    deleted_at = EXCLUDED.deleted_at,
-                    updated_at = EXCLUDED.updated_at,
-                    last_modified = EXCLUDED.last_modified;
-            """,
-            (id, utc.now(), utc.now(), utc.now(), utc.now()),
-        )
-
-        # Soft delete patient_additional_attributes for deleted patients
-        cur.execute(
-            """
-            UPDATE patient_additional_attributes
-            SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE patient_id = %s::uuid;
-            """,
-            (utc.now(), utc.now(), utc.now(), id),
-        )
-
-        # Soft delete visits for deleted patients
-        cur.execute(
-            """
-            UPDATE visits
-            SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE patient_id = %s::uuid;
-            """,
-            (utc.now(), utc.now(), utc.now(), id),
-        )
-
-        # Soft delete events for deleted patients
-        cur.execute(
-            """
-            UPDATE events
-            SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE patient_id = %s::uuid;
-            """,
-            (utc.now(), utc.now(), utc.now(), id),
-        )
-
-        # Soft delete appointments for deleted patients
-        cur.execute(
-            """
-            UPDATE appointments
-            SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE patient_id = %s::uuid;
-            """,
-            (utc.now(), utc.now(), utc.now(), id),
-        )
+        cls.delete_many_from_delta(ctx, cur, [id])
 
     @classmethod
-    def transform_delta(cls, ctx, action: str, data: Any):
-        if action == sync.ACTION_CREATE or action == sync.ACTION_UPDATE:
-            patient = dict(data)
-
-            additional_data = patient.get('additional_data', None)
-            # Handle additional_data
-            if additional_data is None or additional_data == '':
-                additional_data = '{}'  # Empty JSON object
-            elif isinstance(additional_data, (dict, list)):
-                additional_data = safe_json_dumps(additional_data)
-            elif isinstance(patient.get('additional_data', None), str):
-                try:
-                    json.loads(additional_data)
-                except json.JSONDecodeError:
-                    # Empty JSON object if invalid
-                    additional_data = '{}'
-
-            patient.update(
-                additional_data=additional_data,
-                created_at=helpers.get_from_dict(
-                    patient, 'created_at', utc.from_unixtimestamp
-                ),
-                updated_at=helpers.get_from_dict(
-                    patient, 'updated_at', utc.from_unixtimestamp
-                ),
-                image_timestamp=helpers.get_from_dict(
-                    patient, 'image_timestamp', utc.from_unixtimestamp
-                ),
-                photo_url='',
-                last_modified=utc.now(),
-            )
-
-            return patient
+    def delete_many_from_delta(cls, ctx, cur: Cursor, ids: list[str]):
+        softdelete.soft_delete_patients(cur, ids, create_missing=True)
+
+    PUSH_COLUMNS = (
+        transform.Column('id', required=True),
+        transform.Column(
+            'additional_data', _additional_data_json, default='{}'
+        ),
+        transform.Column('created_at', transform.timestamp),
+        transform.Column('updated_at', transform.timestamp),
+        transform.Column('image_timestamp', transform.timestamp),
+        transform.Computed('photo_url', ''),
+        transform.Computed('last_modified', utc.now),
+    )
 
     # @classmethod
     # def apply_delta_changes(cls, deltadata, last_pushed_at, conn):
@@ -442,23 +403,87 @@ class Patient(SyncToClient, SyncToServer, helpers.SimpleCRUD):
 
             return patients
 
+    CHART_SECTIONS = {
+        'attributes': ('patient_additional_attributes', 'attribute'),
+        'visits': ('visits', 'check_in_timestamp DESC'),
+        'events': ('events', 'created_at DESC'),
+        'appointments': ('appointments', 'timestamp DESC'),
+        'prescriptions': ('prescriptions', 'prescribed_at DESC'),
+    }
+    """Records included in the patient chart, with the table they're read from and
+    their ordering"""
+
+    @classmethod
+    def get_chart(
+        cls,
+        conn: Connection,
+        id: str,
+        projection: dict[str, list[str] | None] | None = None,
+    ) -> str | None:
+        """Returns the patient with all their records as a JSON document, built with a
+        single query. Returns `None` if the patient doesn't exist.
+
+        `projection` maps each section (`patient`, or one of `CHART_SECTIONS`) to the columns to
+        include, or to `None` to include all of them. Sections missing from `projection` are
+        left out of the document, and not queried."""
+        if projection is None:
+            projection = {section: None for section in ('patient', *cls.CHART_SECTIONS)}
+
+        def row(alias: str, columns: list[str] | None):
+            if columns is None:
+                return sql.SQL('to_jsonb({})').format(sql.Identifier(alias))
+
+            return sql.SQL('jsonb_build_object({})').format(
+                sql.SQL(', ').join(
+                    sql.SQL('{}, {}').format(sql.Literal(c), sql.Identifier(alias, c))
+                    for c in columns
+                )
+            )
+
+        parts = []
+        for section, columns in projection.items():
+            if section == 'patient':
+                value = row('p', columns)
+            else:
+                table, order = cls.CHART_SECTIONS[section]
+                value = sql.SQL(
+                    """COALESCE((
+                        SELECT jsonb_agg({row} ORDER BY {order}) FROM {table} x
+                        WHERE x.patient_id = p.id AND x.is_deleted = false
+                    ), '[]'::jsonb)"""
+                ).format(
+                    row=row('x', columns),
+                    order=sql.SQL(order),
+                    table=sql.Identifier(table),
+                )
+
+            parts.append(sql.SQL('{}, {}').format(sql.Literal(section), value))
+
+        query = sql.SQL(
+            """
+            SELECT jsonb_build_object({})::text FROM patients p
+            WHERE p.id = %s AND p.is_deleted = false
+            """
+        ).format(sql.SQL(', ').join(parts))
+
+        with conn.cursor() as cur:
+            record = cur.execute(query, [id]).fetchone()
+
+        return record[0] if record is not None else None
+
 
 @core.dataentity
 class PatientAttribute(SyncToClient, SyncToServer):
     TABLE_NAME = 'patient_additional_attributes'
+    SYNC_SCOPE_COLUMN = 'patient_id'
 
-    @classmethod
-    def transform_delta(cls, ctx, action: str, data: Any):
-        if action == sync.ACTION_CREATE or action == sync.ACTION_UPDATE:
-            pattr = dict(data)
-            pattr.update(
-                date_value=get_from_dict(pattr, 'date_value', utc.from_unixtimestamp),
-                created_at=get_from_dict(pattr, 'created_at', utc.from_unixtimestamp),
-                updated_at=get_from_dict(pattr, 'updated_at', utc.from_unixtimestamp),
-                metadata=safe_json_dumps(pattr.get('metadata')),
-            )
-
-            return pattr
+    PUSH_COLUMNS = (
+        transform.Column('id', required=True),
+        transform.Column('date_value', transform.timestamp),
+        transform.Column('created_at', transform.timestamp),
+        transform.Column('updated_at', transform.timestamp),
+        transform.Column('metadata', transform.json_text, default='null'),
+    )
 
     @classmethod
     def create_from_delta(cls, ctx, cur: Cursor, data: dict):
@@ -478,7 +503,25 @@ class PatientAttribute(SyncToClient, SyncToServer):
                 boolean_value = EXCLUDED.boolean_value,
                 metadata = EXCLUDED.metadata,
                 updated_at = EXCLUDED.updated_at,
-                last_modified = EXCLUDED.last_modified;""",
+                last_modified = EXCLUDED.last_modified
+            WHERE (
+                patient_additional_attributes.attribute,
+                patient_additional_attributes.number_value,
+                patient_additional_attributes.string_value,
+                patient_additional_attributes.date_value,
+                patient_additional_attributes.boolean_value,
+                patient_additional_attributes.metadata::jsonb,
+                patient_additional_attributes.updated_at
+            ) IS DISTINCT FROM (
+                EXCLUDED.attribute,
+                EXCLUDED.number_value,
+                EXCLUDED.string_value,
+                EXCLUDED.date_value,
+                EXCLUDED.boolean_value,
+                EXCLUDED.metadata::jsonb,
+                EXCLUDED.updated_at
+            );
+            """,
             data,
         )
 
@@ -497,6 +540,7 @@ class PatientAttribute(SyncToClient, SyncToServer):
 @core.dataentity
 class Event(SyncToClient, SyncToServer):
     TABLE_NAME = 'events'
+    SYNC_SCOPE_COLUMN = 'patient_id'
 
     id: str
     patient_id: str | None = None
@@ -506,24 +550,18 @@ class Event(SyncToClient, SyncToServer):
     form_data: dict | None = None
     metadata: dict | None = None
 
-    @classmethod
-    def transform_delta(cls, ctx, action: str, data: Any):
-        if action == sync.ACTION_CREATE or action == sync.ACTION_UPDATE:
-            event = dict(data)
-
-            event.update(
-                created_at=get_from_dict(event, 'created_at', utc.from_unixtimestamp),
-                updated_at=get_from_dict(event, 'updated_at', utc.from_unixtimestamp),
-                metadata=get_from_dict(event, 'metadata', safe_json_dumps, '{}'),
-                form_data=get_from_dict(event, 'form_data', safe_json_dumps, '{}'),
-                visit_id=data.get('visit_id'),
-                patient_id=data.get('patient_id'),
-                last_modified=data.get('last_modified', utc.now()),
-                form_id=data.get('form_id'),
-                event_type=data.get('event_type'),
-            )
-
-            return event
+    PUSH_COLUMNS = (
+        transform.Column('id', required=True),
+        transform.Column('created_at', transform.timestamp),
+        transform.Column('updated_at', transform.timestamp),
+        transform.Column('metadata', transform.json_text, default='{}'),
+        transform.Column('form_data', transform.json_text, default='{}'),
+        transform.Column('visit_id', nullable=True),
+        transform.Column('patient_id', nullable=True),
+        transform.Column('last_modified', nullable=True, default_factory=utc.now),
+        transform.Column('form_id', nullable=True),
+        transform.Column('event_type', nullable=True),
+    )
 
     @classmethod
     def create_from_delta(cls, ctx, cur: Cursor, data: dict):
@@ -560,8 +598,6 @@ class Event(SyncToClient, SyncToServer):
             """,
                 (patient_id, placeholder_metadata),
             )
-
-            ctx.conn.commit()
         # --------------------------------------
 
         vid = data.get('visit_id')
@@ -634,7 +670,26 @@ class Event(SyncToClient, SyncToServer):
                 metadata=EXCLUDED.metadata,
                 created_at=EXCLUDED.created_at,
                 updated_at=EXCLUDED.updated_at,
-                last_modified=EXCLUDED.last_modified;
+                last_modified=EXCLUDED.last_modified
+            WHERE (
+                events.patient_id,
+                events.form_id,
+                events.visit_id,
+                events.event_type,
+                events.form_data::jsonb,
+                events.metadata::jsonb,
+                events.created_at,
+                events.updated_at
+            ) IS DISTINCT FROM (
+                EXCLUDED.patient_id,
+                EXCLUDED.form_id,
+                EXCLUDED.visit_id,
+                EXCLUDED.event_type,
+                EXCLUDED.form_data::jsonb,
+                EXCLUDED.metadata::jsonb,
+                EXCLUDED.created_at,
+                EXCLUDED.updated_at
+            );
             """,
             data,
         )
@@ -950,6 +1005,7 @@ class Event(SyncToClient, SyncToServer):
 @core.dataentity
 class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
     TABLE_NAME = 'visits'
+    SYNC_SCOPE_COLUMN = 'patient_id'
 
     check_in_timestamp: fields.UTCDateTime
     clinic_id: str
@@ -981,6 +1037,25 @@ class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
                 created_at=EXCLUDED.created_at,
                 updated_at=EXCLUDED.updated_at,
                 last_modified=EXCLUDED.last_modified
+            WHERE (
+                visits.patient_id,
+                visits.clinic_id,
+                visits.provider_id,
+                visits.provider_name,
+                visits.check_in_timestamp,
+                visits.metadata::jsonb,
+                visits.created_at,
+                visits.updated_at
+            ) IS DISTINCT FROM (
+                EXCLUDED.patient_id,
+                EXCLUDED.clinic_id,
+                EXCLUDED.provider_id,
+                EXCLUDED.provider_name,
+                EXCLUDED.check_in_timestamp,
+                EXCLUDED.metadata::jsonb,
+                EXCLUDED.created_at,
+                EXCLUDED.updated_at
+            )
             """,
             data,
         )
@@ -992,81 +1067,21 @@ class Visit(SyncToClient, SyncToServer, helpers.SimpleCRUD):
     @classmethod
     def delete_from_delta(cls, ctx, cur: Cursor, id: str):
         now = utc.now()
-
-        # Soft delete visit and related records
-        cur.execute(
-            """
-            UPDATE visits
-            SET is_deleted = true,
-                deleted_at = %s,
-                updated_at = %s,
-                last_modified = %s
-            WHERE id = %s::uuid
-            RETURNING id;
-            """,
-            (now, now, now, id),
-        )
-
-        updated_visit_ids = [row[0] for row in cur.fetchall()]
-
-        if updated_visit_ids:
-            cur.execute(
-                """
-                UPDATE events
-                SET is_deleted = true,
-                    deleted_at = %s,
-                    updated_at = %s,
-                    last_modified = %s
-                WHERE visit_id = ANY(%s);
-                """,
-                (now, now, now, updated_visit_ids),
-            )
-
-            cur.execute(
-                """
-                UPDATE appointments
-                SET is_deleted = true,
-                    deleted_at = %s,
-                    updated_at = %s,
-                    last_modified = %s
-                WHERE current_visit_id = ANY(%s) OR fulfilled_visit_id = ANY(%s);
-                """,
-                (now, now, now, updated_visit_ids, updated_visit_ids),
-            )
-
-            # TODO: Soft delete prescriptions for deleted visits
-            cur.execute(
-                """
-                UPDATE prescriptions
-                SET is_deleted = true,
-                    deleted_at = %s,
-                    updated_at = %s,
-                    last_modified = %s
-                WHERE visit_id = ANY(%s);
-                """,
-                (now, now, now, updated_visit_ids),
-            )
-
+        softdelete.soft_delete_visits(cur, [id], now)
         return now
 
     @classmethod
-    def transform_delta(cls, ctx, action: str, data: Any):
-        if action == sync.ACTION_CREATE or action == sync.ACTION_UPDATE:
-            visit = dict(data)
-            visit.update(
-                check_in_timestamp=helpers.get_from_dict(
-                    visit, 'check_in_timestamp', utc.from_unixtimestamp
-                ),
-                created_at=helpers.get_from_dict(
-                    visit, 'created_at', utc.from_unixtimestamp
-                ),
-                updated_at=helpers.get_from_dict(
-                    visit, 'updated_at', utc.from_unixtimestamp
-                ),
-                metadata=helpers.get_from_dict(visit, 'metadata', safe_json_dumps),
-                last_modified=utc.now(),
-            )
-            return visit
+    def delete_many_from_delta(cls, ctx, cur: Cursor, ids: list[str]):
+        softdelete.soft_delete_visits(cur, ids)
+
+    PUSH_COLUMNS = (
+        transform.Column('id', required=True),
+        transform.Column('check_in_timestamp', transform.timestamp),
+        transform.Column('created_at', transform.timestamp),
+        transform.Column('updated_at', transform.timestamp),
+        transform.Column('metadata', transform.json_text),
+        transform.Computed('last_modified', utc.now),
+    )
 
 
 @core.dataentity
@@ -1127,6 +1142,7 @@ class StringContent(SyncToClient):
 @core.dataentity
 class Appointment(SyncToClient, SyncToServer):
     TABLE_NAME = 'appointments'
+    SYNC_SCOPE_COLUMN = 'patient_id'
 
     id: str
     timestamp: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
@@ -1146,55 +1162,42 @@ class Appointment(SyncToClient, SyncToServer):
     last_modified: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
     server_created_at: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
 
-    @classmethod
-    def transform_delta(cls, ctx, action: str, data: Any):
-        if action == sync.ACTION_CREATE or action == sync.ACTION_UPDATE:
-            appointment = cls(id=data['id']).to_dict() | dict(data)
-            appointment.update(
-                notes=data.get('notes', ''),
-                reason=data.get('reason', ''),
-                timestamp=get_from_dict(
-                    appointment, 'timestamp', utc.from_unixtimestamp
-                ),
-                created_at=get_from_dict(
-                    appointment, 'created_at', utc.from_unixtimestamp
-                ),
-                updated_at=get_from_dict(
-                    appointment, 'updated_at', utc.from_unixtimestamp
-                ),
-                metadata=safe_json_dumps(appointment.get('metadata')),
-                last_modified=utc.now(),
-                clinic_id=data.get('clinic_id'),
-                user_id=data.get('user_id'),
-                provider_name=data.get('provider_name'),
-                is_deleted=data.get('is_deleted', False),
-                deleted_at=get_from_dict(
-                    appointment, 'deleted_at', utc.from_unixtimestamp
-                ),
-            )
-
-            if action == sync.ACTION_CREATE:
-                appointment.update(
-                    server_created_at=utc.now(),
-                )
-
-            provider_id = appointment.get('provider_id')
-            if not provider_id or not is_valid_uuid(provider_id):
-                appointment['provider_id'] = None
-
-            patient_id = appointment.get('patient_id')
-            if not patient_id or not is_valid_uuid(patient_id):
-                appointment['patient_id'] = None
-
-            current_visit_id = appointment.get('current_visit_id')
-            if not current_visit_id or not is_valid_uuid(current_visit_id):
-                appointment['current_visit_id'] = None
-
-            fulfilled_visit_id = appointment.get('fulfilled_visit_id')
-            if not fulfilled_visit_id or not is_valid_uuid(fulfilled_visit_id):
-                appointment['fulfilled_visit_id'] = None
-
-            return appointment
+    PUSH_COLUMNS = (
+        transform.Column('id', required=True),
+        transform.Column(
+            'timestamp', transform.timestamp, nullable=True, default_factory=utc.now
+        ),
+        transform.Column('duration', nullable=True),
+        transform.Column('reason', nullable=True, default=''),
+        transform.Column('notes', nullable=True, default=''),
+        transform.Column('provider_id', transform.uuid_or_none),
+        transform.Column('clinic_id', nullable=True),
+        transform.Column('patient_id', transform.uuid_or_none),
+        transform.Column('user_id', nullable=True),
+        transform.Column('provider_name', nullable=True),
+        transform.Column('status', nullable=True),
+        transform.Column('current_visit_id', transform.uuid_or_none),
+        transform.Column('fulfilled_visit_id', transform.uuid_or_none),
+        transform.Column('metadata', transform.json_text, default='null'),
+        transform.Column('is_deleted', nullable=True, default=False),
+        transform.Column('deleted_at', transform.timestamp),
+        transform.Column(
+            'created_at', transform.timestamp, nullable=True, default_factory=utc.now
+        ),
+        transform.Column(
+            'updated_at', transform.timestamp, nullable=True, default_factory=utc.now
+        ),
+        transform.Computed('last_modified', utc.now),
+        transform.Computed(
+            'server_created_at', utc.now, actions=(sync.ACTION_CREATE,)
+        ),
+        transform.Column(
+            'server_created_at',
+            nullable=True,
+            default_factory=utc.now,
+            actions=(sync.ACTION_UPDATE,),
+        ),
+    )
 
     @classmethod
     def create_from_delta(cls, ctx, cur: Cursor, data: dict):
@@ -1217,7 +1220,7 @@ class Appointment(SyncToClient, SyncToServer):
 
         curr_vid = data.get('current_visit_id')
         if curr_vid is not None:
-            visit_exists = row_exists('visits', curr_vid)
+            visit_exists = row_exists('visits', curr_vid, ctx.conn)
 
             if not visit_exists:
                 data['current_visit_id'] = curr_vid
@@ -1235,11 +1238,12 @@ class Appointment(SyncToClient, SyncToServer):
             data.get('provider_name', ''),
             data.get('check_in_timestamp', utc.now()),
             with_server_metadata,
+            conn=ctx.conn,
         )
 
         fulfilled_vid = data.get('fulfilled_visit_id')
         if fulfilled_vid is not None:
-            visit_exists = row_exists('visits', fulfilled_vid)
+            visit_exists = row_exists('visits', fulfilled_vid, ctx.conn)
 
             if not visit_exists:
                 data['fulfilled_visit_id'] = fulfilled_vid
@@ -1255,6 +1259,7 @@ class Appointment(SyncToClient, SyncToServer):
                 data.get('provider_name', ''),
                 data.get('check_in_timestamp', utc.now()),
                 with_server_metadata,
+                conn=ctx.conn,
             )
 
         cur.execute(
@@ -1282,6 +1287,41 @@ class Appointment(SyncToClient, SyncToServer):
                 last_modified=EXCLUDED.last_modified,
                 is_deleted=EXCLUDED.is_deleted,
                 deleted_at=EXCLUDED.deleted_at
+            WHERE (
+                appointments.timestamp,
+                appointments.duration,
+                appointments.reason,
+                appointments.notes,
+                appointments.provider_id,
+                appointments.clinic_id,
+                appointments.patient_id,
+                appointments.user_id,
+                appointments.status,
+                appointments.current_visit_id,
+                appointments.fulfilled_visit_id,
+                appointments.metadata::jsonb,
+                appointments.created_at,
+                appointments.updated_at,
+                appointments.is_deleted,
+                appointments.deleted_at
+            ) IS DISTINCT FROM (
+                EXCLUDED.timestamp,
+                EXCLUDED.duration,
+                EXCLUDED.reason,
+                EXCLUDED.notes,
+                EXCLUDED.provider_id,
+                EXCLUDED.clinic_id,
+                EXCLUDED.patient_id,
+                EXCLUDED.user_id,
+                EXCLUDED.status,
+                EXCLUDED.current_visit_id,
+                EXCLUDED.fulfilled_visit_id,
+                EXCLUDED.metadata::jsonb,
+                EXCLUDED.created_at,
+                EXCLUDED.updated_at,
+                EXCLUDED.is_deleted,
+                EXCLUDED.deleted_at
+            )
             """,
             data,
         )
@@ -1527,6 +1567,7 @@ class Appointment(SyncToClient, SyncToServer):
 @core.dataentity
 class Prescription(SyncToClient, SyncToServer, SimpleCRUD):
     TABLE_NAME = 'prescriptions'
+    SYNC_SCOPE_COLUMN = 'patient_id'
 
     id: str
     patient_id: str
@@ -1548,46 +1589,34 @@ class Prescription(SyncToClient, SyncToServer, SimpleCRUD):
     last_modified: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
     server_created_at: fields.UTCDateTime = fields.UTCDateTime(default_factory=utc.now)
 
-    @classmethod
-    def transform_delta(cls, ctx, action, data):
-        if action == sync.ACTION_CREATE or action == sync.ACTION_UPDATE:
-            prescription = dict(data)
-            prescription.update(
-                prescribed_at=get_from_dict(
-                    data, 'prescribed_at', utc.from_unixtimestamp, utc.now()
-                ),
-                filled_by=data.get('filled_by', None),
-                notes=data.get('notes', ''),
-                status=data.get('status', 'pending'),
-                priority=data.get('priority', None),
-                expiration_date=get_from_dict(
-                    data, 'expiration_date', utc.from_unixtimestamp
-                ),
-                visit_id=data.get('visit_id'),
-                filled_at=get_from_dict(data, 'filled_at', utc.from_unixtimestamp),
-                created_at=get_from_dict(
-                    data, 'created_at', utc.from_unixtimestamp, utc.now()
-                ),
-                updated_at=get_from_dict(
-                    data, 'updated_at', utc.from_unixtimestamp, utc.now()
-                ),
-                deleted_at=get_from_dict(data, 'deleted_at', utc.from_unixtimestamp),
-                last_modified=get_from_dict(
-                    data, 'last_modified', utc.from_unixtimestamp, utc.now()
-                ),
-                is_deleted=data.get('is_deleted', False),
-                items=safe_json_dumps(data.get('items')),
-                metadata=safe_json_dumps(data.get('metadata')),
-            )
-
-            if action == sync.ACTION_CREATE:
-                prescription.update(
-                    server_created_at=get_from_dict(
-                        data, 'server_created_at', utc.from_unixtimestamp, utc.now()
-                    ),
-                )
-
-            return prescription
+    PUSH_COLUMNS = (
+        transform.Column('id', required=True),
+        transform.Column(
+            'prescribed_at', transform.timestamp, default_factory=utc.now
+        ),
+        transform.Column('filled_by', nullable=True),
+        transform.Column('notes', nullable=True, default=''),
+        transform.Column('status', nullable=True, default='pending'),
+        transform.Column('priority', nullable=True),
+        transform.Column('expiration_date', transform.timestamp),
+        transform.Column('visit_id', nullable=True),
+        transform.Column('filled_at', transform.timestamp),
+        transform.Column('created_at', transform.timestamp, default_factory=utc.now),
+        transform.Column('updated_at', transform.timestamp, default_factory=utc.now),
+        transform.Column('deleted_at', transform.timestamp),
+        transform.Column(
+            'last_modified', transform.timestamp, default_factory=utc.now
+        ),
+        transform.Column('is_deleted', nullable=True, default=False),
+        transform.Column('items', transform.json_text, default='null'),
+        transform.Column('metadata', transform.json_text, default='null'),
+        transform.Column(
+            'server_created_at',
+            transform.timestamp,
+            default_factory=utc.now,
+            actions=(sync.ACTION_CREATE,),
+        ),
+    )
 
     @classmethod
     def create_from_delta(cls, ctx, cur: Cursor, data: dict):
@@ -1619,6 +1648,43 @@ class Prescription(SyncToClient, SyncToServer, SimpleCRUD):
                 updated_at=EXCLUDED.updated_at,
                 deleted_at=EXCLUDED.deleted_at,
                 last_modified=EXCLUDED.last_modified
+            WHERE (
+                prescriptions.patient_id,
+                prescriptions.provider_id,
+                prescriptions.filled_by,
+                prescriptions.pickup_clinic_id,
+                prescriptions.visit_id,
+                prescriptions.priority,
+                prescriptions.expiration_date,
+                prescriptions.prescribed_at,
+                prescriptions.filled_at,
+                prescriptions.status,
+                prescriptions.items::jsonb,
+                prescriptions.notes,
+                prescriptions.metadata::jsonb,
+                prescriptions.is_deleted,
+                prescriptions.created_at,
+                prescriptions.updated_at,
+                prescriptions.deleted_at
+            ) IS DISTINCT FROM (
+                EXCLUDED.patient_id,
+                EXCLUDED.provider_id,
+                EXCLUDED.filled_by,
+                EXCLUDED.pickup_clinic_id,
+                EXCLUDED.visit_id,
+                EXCLUDED.priority,
+                EXCLUDED.expiration_date,
+                EXCLUDED.prescribed_at,
+                EXCLUDED.filled_at,
+                EXCLUDED.status,
+                EXCLUDED.items::jsonb,
+                EXCLUDED.notes,
+                EXCLUDED.metadata::jsonb,
+                EXCLUDED.is_deleted,
+                EXCLUDED.created_at,
+                EXCLUDED.updated_at,
+                EXCLUDED.deleted_at
+            )
             """,
             data,
         )
@@ -1703,10 +1769,14 @@ def upsert_visit(
     check_in_timestamp: datetime,
     metadata: dict | None = None,
     is_deleted: bool = False,
+    conn: Connection | None = None,
 ):
     """
     Upsert a visit into the table.
     This makes sure a visit exists and handles conflicts of primary keys (visit_id)
+
+    With `conn`, the visit is written within its current transaction, otherwise it's
+    committed on a connection of its own.
     """
     vid = visit_id
     if vid is None:
@@ -1714,55 +1784,67 @@ def upsert_visit(
 
     current_time = utc.now()
 
-    with db.get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO visits (
-                    id, patient_id, clinic_id, provider_id, provider_name,
-                    check_in_timestamp, is_deleted, metadata,
-                    created_at, updated_at, last_modified
-                ) VALUES (
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-                )
-                ON CONFLICT (id) DO UPDATE SET
-                    patient_id = EXCLUDED.patient_id,
-                    clinic_id = EXCLUDED.clinic_id,
-                    provider_id = EXCLUDED.provider_id,
-                    provider_name = EXCLUDED.provider_name,
-                    check_in_timestamp = EXCLUDED.check_in_timestamp,
-                    is_deleted = EXCLUDED.is_deleted,
-                    metadata = EXCLUDED.metadata,
-                    updated_at = EXCLUDED.updated_at,
-                    last_modified = EXCLUDED.last_modified
-                RETURNING id;
-                """,
-                (
-                    vid,
-                    patient_id,
-                    clinic_id,
-                    provider_id,
-                    provider_name,
-                    check_in_timestamp,
-                    is_deleted,
-                    safe_json_dumps(metadata or {}),
-                    current_time,
-                    current_time,
-                    current_time,
-                ),
+    if conn is None:
+        with db.get_connection() as conn:
+            return upsert_visit(
+                vid,
+                patient_id,
+                clinic_id,
+                provider_id,
+                provider_name,
+                check_in_timestamp,
+                metadata,
+                is_deleted,
+                conn,
             )
 
-            result = cur.fetchone()
-            conn.commit()
-            return vid  # Return the visit_id
+    with conn.transaction(), conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO visits (
+                id, patient_id, clinic_id, provider_id, provider_name,
+                check_in_timestamp, is_deleted, metadata,
+                created_at, updated_at, last_modified
+            ) VALUES (
+                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+            )
+            ON CONFLICT (id) DO UPDATE SET
+                patient_id = EXCLUDED.patient_id,
+                clinic_id = EXCLUDED.clinic_id,
+                provider_id = EXCLUDED.provider_id,
+                provider_name = EXCLUDED.provider_name,
+                check_in_timestamp = EXCLUDED.check_in_timestamp,
+                is_deleted = EXCLUDED.is_deleted,
+                metadata = EXCLUDED.metadata,
+                updated_at = EXCLUDED.updated_at,
+                last_modified = EXCLUDED.last_modified
+            RETURNING id;
+            """,
+            (
+                vid,
+                patient_id,
+                clinic_id,
+                provider_id,
+                provider_name,
+                check_in_timestamp,
+                is_deleted,
+                safe_json_dumps(metadata or {}),
+                current_time,
+                current_time,
+                current_time,
+            ),
+        )
+
+        return vid  # Return the visit_id
 
 
 def insert_placeholder_patient(conn, patient_id, is_deleted=False):
     # Fixed timestamp for June 1, 2010
     fixed_timestamp = datetime(2010, 6, 1, 0, 0, 0)
 
-    with conn.cursor() as cur:
-        try:
+    # a savepoint, when the connection is already in a transaction
+    try:
+        with conn.transaction(), conn.cursor() as cur:
             placeholder_data = {
                 'id': patient_id,
                 'given_name': 'Placeholder',
@@ -1802,39 +1884,42 @@ def insert_placeholder_patient(conn, patient_id, is_deleted=False):
                 placeholder_data,
             )
 
-            conn.commit()
-            print(f'Placeholder patient with ID {patient_id} inserted successfully.')
-        except Exception as e:
-            conn.rollback()
-            print(f'Error inserting placeholder patient: {str(e)}')
+        print(f'Placeholder patient with ID {patient_id} inserted successfully.')
+    except Exception as e:
+        print(f'Error inserting placeholder patient: {str(e)}')
 
 
 # Check if a row exists in a table given its id
-def row_exists(table_name: str, id: str) -> bool:
+def row_exists(table_name: str, id: str, conn: Connection | None = None) -> bool:
     """
     Check if a row exists in a table given its id.
 
     Args:
     table_name (str): The name of the table to check.
     id (str): The id of the row to check for.
+    conn (Connection): Connection to check with, to see its uncommitted rows. A new
+        connection is used if missing.
 
     Returns:
     bool: True if the row exists, False otherwise.
     """
-    with db.get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                SELECT EXISTS(
-                    SELECT 1 FROM {table_name}
-                    WHERE id = %s
-                )
-                """,
-                (id,),
+    if conn is None:
+        with db.get_connection() as conn:
+            return row_exists(table_name, id, conn)
+
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT EXISTS(
+                SELECT 1 FROM {table_name}
+                WHERE id = %s
             )
+            """,
+            (id,),
+        )
 
-            val = cur.fetchone()
-            if val is None:
-                return False
+        val = cur.fetchone()
+        if val is None:
+            return False
 
-            return val[0]
+        return val[0]
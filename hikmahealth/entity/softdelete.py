@@ -0,0 +1,124 @@
+"""Cascading soft deletes, shared by the sync push and the admin routes.
+
+Each function takes the whole list of ids being deleted, and runs a single `UPDATE` per
+table (`... WHERE patient_id = ANY(%s)`), all stamped with the same time."""
+
+from __future__ import annotations
+
+import datetime
+from typing import Iterable
+
+from psycopg import Cursor, sql
+
+from hikmahealth.utils.datetime import utc
+
+PATIENT_CHILD_TABLES = (
+    'patient_additional_attributes',
+    'visits',
+    'events',
+    'appointments',
+    'prescriptions',
+)
+"""Tables holding the records of a patient, by their `patient_id`"""
+
+
+def _soft_delete_where(
+    cur: Cursor, table: str, condition: sql.Composable, params: list, now: datetime.datetime
+) -> int:
+    cur.execute(
+        sql.SQL(
+            """
+            UPDATE {}
+            SET is_deleted = true,
+                deleted_at = %s,
+                updated_at = %s,
+                last_modified = %s
+            WHERE {}
+            """
+        ).format(sql.Identifier(table), condition),
+        [now, now, now, *params],
+    )
+    return cur.rowcount
+
+
+def soft_delete_patients(
+    cur: Cursor,
+    ids: Iterable[str],
+    now: datetime.datetime | None = None,
+    create_missing: bool = False,
+) -> dict[str, int]:
+    """Soft deletes the patients and all of their records. Returns the number of rows
+    deleted in each table.
+
+    With `create_missing`, patients unknown to the server are inserted as deleted
+    placeholders, so the deletion still syncs to the other devices."""
+    ids = list(ids)
+    if not ids:
+        return dict()
+
+    now = now or utc.now()
+    counts = dict()
+
+    if create_missing:
+        cur.execute(
+            """
+            INSERT INTO patients
+                (id, is_deleted, given_name, surname, date_of_birth, citizenship, hometown, sex, phone, camp, additional_data, image_timestamp, photo_url, government_id, external_patient_id, created_at, updated_at, last_modified, deleted_at)
+            SELECT
+                id, true, '', '', NULL, '', '', '', '', '', '{}', NULL, '', NULL, NULL, %(now)s, %(now)s, %(now)s, %(now)s
+            FROM unnest(%(ids)s::uuid[]) AS id
+            ON CONFLICT (id) DO UPDATE
+            SET is_deleted = true,
+                deleted_at = EXCLUDED.deleted_at,
+                updated_at = EXCLUDED.updated_at,
+                last_modified = EXCLUDED.last_modified;
+            """,
+            dict(ids=ids, now=now),
+        )
+        counts['patients'] = cur.rowcount
+    else:
+        counts['patients'] = _soft_delete_where(
+            cur, 'patients', sql.SQL('id = ANY(%s::uuid[])'), [ids], now
+        )
+
+    for table in PATIENT_CHILD_TABLES:
+        counts[table] = _soft_delete_where(
+            cur, table, sql.SQL('patient_id = ANY(%s::uuid[])'), [ids], now
+        )
+
+    return counts
+
+
+def soft_delete_visits(
+    cur: Cursor, ids: Iterable[str], now: datetime.datetime | None = None
+) -> dict[str, int]:
+    """Soft deletes the visits, with their events, appointments and prescriptions.
+    Returns the number of rows deleted in each table."""
+    ids = list(ids)
+    if not ids:
+        return dict()
+
+    now = now or utc.now()
+    counts = dict()
+
+    counts['visits'] = _soft_delete_where(
+        cur, 'visits', sql.SQL('id = ANY(%s::uuid[])'), [ids], now
+    )
+    if counts['visits'] == 0:
+        return counts
+
+    counts['events'] = _soft_delete_where(
+        cur, 'events', sql.SQL('visit_id = ANY(%s::uuid[])'), [ids], now
+    )
+    counts['appointments'] = _soft_delete_where(
+        cur,
+        'appointments',
+        sql.SQL('current_visit_id = ANY(%s::uuid[]) OR fulfilled_visit_id = ANY(%s::uuid[])'),
+        [ids, ids],
+        now,
+    )
+    counts['prescriptions'] = _soft_delete_where(
+        cur, 'prescriptions', sql.SQL('visit_id = ANY(%s::uuid[])'), [ids], now
+    )
+
+    return counts
@@ -2,20 +2,21 @@ from __future__ import annotations
 
 from abc import abstractmethod
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Mapping
 
-from psycopg import Cursor
+from psycopg import Cursor, sql
 from psycopg.connection import Connection
 from psycopg.rows import dict_row
 
 from hikmahealth import sync
-from hikmahealth.entity import core
+from hikmahealth.entity import core, transform
 from hikmahealth.sync.errors import SyncPushError
 from hikmahealth.sync.operation import ISyncPull, ISyncPush
 from hikmahealth.utils.datetime import local as dtutils
 
 import datetime
-from hikmahealth.sync import DeltaData
+from hikmahealth.sync import DeltaData, bundle
+from hikmahealth.sync.scope import SyncScope, is_first_sync
 
 
 # should be moved to a different structure since it depends on psycopg to
@@ -23,6 +24,10 @@ from hikmahealth.sync import DeltaData
 class SyncToClient(ISyncPull[Connection], core.Entity):
     """For entity that expects to apply changes from server to client"""
 
+    SYNC_SCOPE_COLUMN: str | None = None
+    """Column with the id of the patient a record belongs to. Records of the entities
+    without one are sent to every client, whatever its scope"""
+
     @classmethod
     def get_delta_records(cls, last_sync_time: datetime.datetime, conn: Connection):
         with conn.cursor(row_factory=dict_row) as cur:
@@ -62,6 +67,266 @@ class SyncToClient(ISyncPull[Connection], core.Entity):
             deleted=[row['id'] for row in deleterecords],
         )
 
+    @classmethod
+    def get_delta_records_since_change(
+        cls, last_change_seq: int, last_sync_time: datetime.datetime, conn: Connection
+    ):
+        """Same as `get_delta_records`, but picks the changed records with the `change_seq`
+        cursor returned by `get_change_seq_cursor`, in a single query.
+
+        `last_sync_time` only decides whether a record is sent as created or updated."""
+        with conn.cursor(row_factory=dict_row) as cur:
+            records = cur.execute(
+                f"""
+                SELECT * FROM {cls.TABLE_NAME}
+                WHERE change_seq >= %s
+                """,
+                (last_change_seq,),
+            ).fetchall()
+
+        return bundle.split_changes(records, last_sync_time)
+
+    @classmethod
+    def get_changed_records(
+        cls,
+        since: datetime.datetime,
+        since_change_seq: int | None,
+        conn: Connection,
+    ) -> list[dict]:
+        """Returns every record changed after `since`, or with a `change_seq` from
+        `since_change_seq`. The pulls of the clients synced after them can be cut out of
+        these records, with `hikmahealth.sync.bundle`."""
+        query, params = cls.get_changed_records_query(since, since_change_seq)
+        with conn.cursor(row_factory=dict_row) as cur:
+            return cur.execute(query, params).fetchall()
+
+    @classmethod
+    def get_changed_records_query(
+        cls,
+        since: datetime.datetime | None,
+        since_change_seq: int | None,
+    ) -> tuple[sql.Composable, dict]:
+        """Returns the query of `get_changed_records`, with its parameters, to run on
+        any connection (like an `AsyncConnection`)"""
+        query = sql.SQL(
+            """
+            SELECT * FROM {}
+            WHERE server_created_at > %(since)s
+               OR last_modified > %(since)s
+               OR deleted_at > %(since)s
+               OR change_seq >= %(since_change_seq)s
+            """
+        ).format(sql.Identifier(cls.TABLE_NAME))
+        return query, dict(since=since, since_change_seq=since_change_seq)
+
+    @classmethod
+    def get_scoped_delta_records(
+        cls,
+        scope: SyncScope,
+        last_sync_time: datetime.datetime,
+        last_change_seq: int | None,
+        conn: Connection,
+    ) -> DeltaData:
+        """Same as `get_delta_records` (or `get_delta_records_since_change` with a
+        `last_change_seq`), for the patients in the scope of a client only. Records of
+        patients that joined the scope since the last sync are sent too, changed or not."""
+        if cls.SYNC_SCOPE_COLUMN is None or scope.is_unscoped:
+            if last_change_seq is not None:
+                return cls.get_delta_records_since_change(
+                    last_change_seq, last_sync_time, conn
+                )
+            return cls.get_delta_records(last_sync_time, conn)
+
+        query, params = cls.get_pull_query(scope, last_sync_time, last_change_seq)
+        with conn.cursor(row_factory=dict_row) as cur:
+            records = cur.execute(query, params).fetchall()
+
+        return cls.split_pulled_records(records, scope, last_sync_time, last_change_seq)
+
+    @classmethod
+    def get_pull_query(
+        cls,
+        scope: SyncScope,
+        last_sync_time: datetime.datetime,
+        last_change_seq: int | None,
+    ) -> tuple[sql.Composable, dict]:
+        """Returns the single query reading the records of a pull, with its parameters,
+        to run on any connection (like an `AsyncConnection`). The records it returns are
+        split with `split_pulled_records`."""
+        table = sql.Identifier(cls.TABLE_NAME)
+        if cls.SYNC_SCOPE_COLUMN is not None and not scope.is_unscoped:
+            condition, params = get_scope_condition(
+                scope,
+                sql.Identifier('t', cls.SYNC_SCOPE_COLUMN),
+                last_sync_time,
+                last_change_seq,
+            )
+            query = sql.SQL('SELECT t.* FROM {} t WHERE {}')
+            return query.format(table, condition), params
+
+        if last_change_seq is not None:
+            query = sql.SQL('SELECT * FROM {} WHERE change_seq >= %(last_change_seq)s')
+            return query.format(table), dict(last_change_seq=last_change_seq)
+
+        return sql.SQL(
+            """
+            SELECT * FROM {}
+            WHERE server_created_at > %(since)s
+               OR last_modified > %(since)s
+               OR deleted_at > %(since)s
+            """
+        ).format(table), dict(since=last_sync_time)
+
+    @classmethod
+    def split_pulled_records(
+        cls,
+        records: list[dict],
+        scope: SyncScope,
+        last_sync_time: datetime.datetime,
+        last_change_seq: int | None,
+    ) -> DeltaData:
+        """Splits the records read by the query of `get_pull_query`."""
+        scoped = cls.SYNC_SCOPE_COLUMN is not None and not scope.is_unscoped
+        if scoped or last_change_seq is not None:
+            return bundle.split_changes(records, last_sync_time)
+
+        return bundle.filter_since_time(records, last_sync_time)
+
+
+def get_scope_condition(
+    scope: SyncScope,
+    patient_id: sql.Composable,
+    last_sync_time: datetime.datetime,
+    last_change_seq: int | None = None,
+) -> tuple[sql.Composable, dict]:
+    """Returns the condition on the records of table `t` a scoped pull sends, with its
+    parameters. `patient_id` is the column of `t` with the id of the patient."""
+    params: dict[str, Any] = dict(since=last_sync_time, last_change_seq=last_change_seq)
+    first_sync = is_first_sync(last_sync_time, last_change_seq)
+
+    in_clinics = sql.SQL('TRUE')
+    if scope.clinic_ids is not None:
+        in_clinics = sql.SQL('pc.clinic_id = ANY(%(clinic_ids)s::uuid[])')
+        params['clinic_ids'] = list(scope.clinic_ids)
+
+    if last_change_seq is not None:
+        changed = sql.SQL('t.change_seq >= %(last_change_seq)s')
+        joined = sql.SQL('pc.change_seq >= %(last_change_seq)s')
+    else:
+        changed = sql.SQL(
+            't.server_created_at > %(since)s OR t.last_modified > %(since)s OR t.deleted_at > %(since)s'
+        )
+        joined = sql.SQL('pc.first_seen_at > %(since)s')
+
+    if scope.clinic_ids is None:
+        # every patient is in the scope, none can join it
+        joined = sql.SQL('FALSE')
+
+    seen = sql.SQL('TRUE')
+    if scope.recency is not None:
+        params['recency'] = scope.recency
+        if first_sync:
+            seen = sql.SQL('pc.last_seen_at >= now() - %(recency)s')
+        else:
+            # patients coming back after a longer gap weren't sent on the first sync
+            joined = sql.SQL(
+                '{} OR (pc.last_seen_at > %(since)s AND pc.previous_seen_at < pc.last_seen_at - %(recency)s)'
+            ).format(joined)
+
+    unlinked = sql.SQL('TRUE')
+    if first_sync and scope.recency is not None:
+        unlinked = sql.SQL(
+            'EXISTS (SELECT 1 FROM patients p WHERE p.id = {} AND p.last_modified >= now() - %(recency)s)'
+        ).format(patient_id)
+
+    # the first sync gets every record in scope, the joins don't matter
+    if first_sync:
+        changes = changed
+    else:
+        changes = sql.SQL(
+            """
+            {changed}
+            OR (
+                t.is_deleted = false AND t.deleted_at IS NULL
+                AND EXISTS (
+                    SELECT 1 FROM patient_clinics pc
+                    WHERE pc.patient_id = {patient_id} AND {in_clinics} AND ({joined})
+                )
+            )
+            """
+        ).format(
+            changed=changed, patient_id=patient_id, in_clinics=in_clinics, joined=joined
+        )
+
+    condition = sql.SQL(
+        """
+        ({changes})
+        AND (
+            EXISTS (
+                SELECT 1 FROM patient_clinics pc
+                WHERE pc.patient_id = {patient_id} AND {in_clinics} AND {seen}
+            )
+            OR (
+                NOT EXISTS (SELECT 1 FROM patient_clinics pc WHERE pc.patient_id = {patient_id})
+                AND {unlinked}
+            )
+        )
+        """
+    ).format(
+        changes=changes,
+        patient_id=patient_id,
+        in_clinics=in_clinics,
+        seen=seen,
+        unlinked=unlinked,
+    )
+
+    return condition, params
+
+
+def get_max_change_seqs(
+    conn: Connection, entities: Mapping[str, type[SyncToClient]]
+) -> dict[str, int | None]:
+    """Returns the highest `change_seq` of each entity's table, in a single query. It
+    changes whenever a table is written to."""
+    if not entities:
+        return dict()
+
+    with conn.cursor() as cur:
+        row = cur.execute(get_max_change_seqs_query(entities)).fetchone()
+
+    return dict(zip(entities.keys(), row))
+
+
+def get_max_change_seqs_query(
+    entities: Mapping[str, type[SyncToClient]],
+) -> sql.Composable:
+    """The query of `get_max_change_seqs`, a row with a column per entity"""
+    return sql.SQL('SELECT {}').format(
+        sql.SQL(', ').join(
+            sql.SQL('(SELECT max(change_seq) FROM {})').format(
+                sql.Identifier(entity.TABLE_NAME)
+            )
+            for entity in entities.values()
+        )
+    )
+
+
+CHANGE_SEQ_CURSOR_QUERY = 'SELECT txid_snapshot_xmin(txid_current_snapshot())'
+"""The query of `get_change_seq_cursor`"""
+
+
+def get_change_seq_cursor(conn: Connection) -> int:
+    """Returns the cursor for the next `get_delta_records_since_change`. Must be read
+    before the records.
+
+    All the transactions older than the `xmin` of the snapshot have ended, so every row
+    written with a `change_seq` below it is already visible. Rows at or above it might be
+    sent twice, but never skipped."""
+    with conn.cursor() as cur:
+        (cursor,) = cur.execute(CHANGE_SEQ_CURSOR_QUERY).fetchone()
+
+    return cursor
+
 
 @dataclass
 class SyncContext:
@@ -72,12 +337,31 @@ class SyncContext:
 class SyncToServer(ISyncPush[Connection]):
     """Abstract for entities that expect to apply changes from client to server"""
 
+    PUSH_COLUMNS: tuple[transform.ColumnSpec, ...] | None = None
+    """Columns of the pushed rows to convert, see `hikmahealth.entity.transform`. The
+    `transform_delta` of the entity is generated from them"""
+
+    _push_transforms: dict[str, transform.Transform] = dict()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.__dict__.get('PUSH_COLUMNS', None) is not None:
+            cls._push_transforms = transform.compile_transform(
+                cls.PUSH_COLUMNS, cls.__name__.lower()
+            )
+
     @classmethod
-    @abstractmethod
     def transform_delta(
         cls, ctx: SyncContext, action: str, data: Any
     ) -> dict | str | None:
-        raise NotImplementedError()
+        if cls.PUSH_COLUMNS is None:
+            raise NotImplementedError()
+
+        fn = cls._push_transforms.get(action, None)
+        if fn is None:
+            return None
+
+        return fn(data)
 
     @classmethod
     @abstractmethod
@@ -94,6 +378,13 @@ class SyncToServer(ISyncPush[Connection]):
     def delete_from_delta(cls, ctx: SyncContext, cur: Cursor, id: str):
         raise NotImplementedError()
 
+    @classmethod
+    def delete_many_from_delta(cls, ctx: SyncContext, cur: Cursor, ids: list[str]):
+        """Deletes all the records deleted by the client in a push. Override this to
+        delete them with a few statements, instead of one `delete_from_delta` per id"""
+        for id in ids:
+            cls.delete_from_delta(ctx, cur, id)
+
     @classmethod
     def apply_delta_changes(
         cls,
@@ -103,8 +394,11 @@ class SyncToServer(ISyncPush[Connection]):
     ):
         ctx = SyncContext(last_pushed_at, conn)
 
-        with conn.cursor() as cur:
-            try:
+        # commits when the connection is idle. inside an outer transaction (a push applied
+        # as a whole) it's a savepoint instead, and the outer transaction commits
+        try:
+            with conn.transaction(), conn.cursor() as cur:
+                deleted_ids = []
                 for action, data in deltadata:
                     try:
                         tdata = cls.transform_delta(ctx, action, data)
@@ -126,10 +420,11 @@ class SyncToServer(ISyncPush[Connection]):
                         assert isinstance(transformed_data, str), (
                             f"Expected transformed data to be a string, got {type(transformed_data)}"
                         )
-                        cls.delete_from_delta(ctx, cur, transformed_data)
+                        deleted_ids.append(transformed_data)
 
-                conn.commit()
-            except Exception as e:
-                print(f"{cls.__name__} sync errors: {str(e)}")
-                conn.rollback()
-                raise SyncPushError(*e.args)
+                # deletes come last in `deltadata`, so they can all be applied at once
+                if deleted_ids:
+                    cls.delete_many_from_delta(ctx, cur, deleted_ids)
+        except Exception as e:
+            print(f"{cls.__name__} sync errors: {str(e)}")
+            raise SyncPushError(*e.args)
@@ -0,0 +1,164 @@
+"""Declarative conversion of the rows pushed by the mobile app.
+
+An entity lists the columns of a pushed row that need converting, as `Column` and
+`Computed` specs, in its `PUSH_COLUMNS`. `compile_transform` turns them into a function
+per action, generated once when the entity is defined, so that converting a row takes a
+single copy and a lookup per column instead of interpreting the conversions on each row.
+
+    PUSH_COLUMNS = (
+        Column('id', required=True),
+        Column('created_at', timestamp),
+        Column('metadata', json_text, default='{}'),
+        Column('notes', nullable=True, default=''),
+        Computed('last_modified', utc.now),
+    )
+
+The columns that aren't listed are passed through as sent."""
+
+from __future__ import annotations
+
+import dataclasses
+from typing import Any, Callable, Mapping
+
+from hikmahealth.sync.data import ACTION_CREATE, ACTION_UPDATE
+from hikmahealth.utils.datetime import utc
+from hikmahealth.utils.misc import is_valid_uuid, safe_json_dumps
+
+ACTIONS = (ACTION_CREATE, ACTION_UPDATE)
+
+MISSING = object()
+"""Stands for a column missing from the pushed row"""
+
+Transform = Callable[[Mapping[str, Any]], dict]
+
+
+@dataclasses.dataclass(frozen=True)
+class Column:
+    """Column of a pushed row. `convert` is applied to the value sent, unless it's null.
+    A missing or null value takes the default instead, not converted."""
+
+    name: str
+    convert: Callable[[Any], Any] | None = None
+    default: Any = None
+    default_factory: Callable[[], Any] | None = None
+    nullable: bool = False
+    """Keeps a null sent by the app, so only a missing value takes the default"""
+    required: bool = False
+    """Rejects the row when the value is missing or null"""
+    actions: tuple[str, ...] = ACTIONS
+
+
+@dataclasses.dataclass(frozen=True)
+class Computed:
+    """Column set by the server, whatever the app sent. `value` is called per row if
+    it's callable."""
+
+    name: str
+    value: Any = None
+    actions: tuple[str, ...] = ACTIONS
+
+
+ColumnSpec = Column | Computed
+
+
+timestamp = utc.from_unixtimestamp
+"""Converts a unix timestamp in milliseconds, as sent by the app"""
+
+json_text = safe_json_dumps
+
+
+def uuid_or_none(value):
+    """Drops the values that aren't UUIDs"""
+    return value if value and is_valid_uuid(value) else None
+
+
+def _default_expr(
+    spec: Column, index: int, namespace: dict[str, Any], params: list[str]
+) -> str:
+    if spec.default_factory is not None:
+        namespace[f'_f{index}'] = spec.default_factory
+        params.append(f'_f{index}')
+        return f'_f{index}()'
+
+    if spec.default is None or isinstance(spec.default, (bool, int, str)):
+        return repr(spec.default)
+
+    namespace[f'_d{index}'] = spec.default
+    params.append(f'_d{index}')
+    return f'_d{index}'
+
+
+def generate_source(
+    columns: tuple[ColumnSpec, ...], action: str, name: str = 'transform'
+) -> tuple[str, dict[str, Any]]:
+    """Returns the source of the transform of an action, with the names it uses.
+
+    The helpers are bound as default arguments, so they're looked up as locals."""
+    namespace: dict[str, Any] = dict(_MISSING=MISSING)
+    params = ['_MISSING']
+    body = ['row = dict(data)', 'get = data.get']
+
+    for index, spec in enumerate(columns):
+        if action not in spec.actions:
+            continue
+
+        key = repr(spec.name)
+        if isinstance(spec, Computed):
+            namespace[f'_v{index}'] = spec.value
+            params.append(f'_v{index}')
+            call = '()' if callable(spec.value) else ''
+            body.append(f'row[{key}] = _v{index}{call}')
+            continue
+
+        converted = 'value'
+        if spec.convert is not None:
+            namespace[f'_c{index}'] = spec.convert
+            params.append(f'_c{index}')
+            converted = f'_c{index}(value)'
+
+        if spec.required:
+            message = f'missing {spec.name!r} from the pushed row'
+            body += [
+                f'value = get({key})',
+                'if value is None:',
+                f'    raise ValueError({message!r})',
+                f'row[{key}] = {converted}',
+            ]
+        elif spec.nullable:
+            # values sent, null or not, are already in the copy
+            body += [
+                f'value = get({key}, _MISSING)',
+                'if value is _MISSING:',
+                f'    row[{key}] = {_default_expr(spec, index, namespace, params)}',
+            ]
+            if spec.convert is not None:
+                body += ['elif value is not None:', f'    row[{key}] = {converted}']
+        else:
+            default = _default_expr(spec, index, namespace, params)
+            body += [
+                f'value = get({key})',
+                f'row[{key}] = {default} if value is None else {converted}',
+            ]
+
+    body.append('return row')
+
+    signature = ', '.join(['data'] + [f'{param}={param}' for param in params])
+    source = f'def {name}({signature}):\n' + '\n'.join(
+        f'    {line}' for line in body
+    )
+    return source, namespace
+
+
+def compile_transform(
+    columns: tuple[ColumnSpec, ...], name: str = 'transform'
+) -> dict[str, Transform]:
+    """Returns the transform of each action, generated from the columns."""
+    transforms = dict()
+    for action in ACTIONS:
+        fn_name = f'{name}_{action.lower()}'
+        source, namespace = generate_source(columns, action, fn_name)
+        exec(compile(source, f'<transform {fn_name}>', 'exec'), namespace)
+        transforms[action] = namespace[fn_name]
+        transforms[action].__source__ = source
+
+    return transforms
@@ -0,0 +1,7 @@
+"""
+Background jobs, for the admin operations that take longer than a request should
+(ex. database exports and imports).
+
+Jobs are enqueued in the `jobs` table by the web server, and run by the worker processes
+started with `python worker.py`.
+"""
@@ -0,0 +1,133 @@
+"""Handlers for the jobs run by the workers. Files produced by a job are saved with the
+`ResourceManager`, and referenced in the result of the job by their resource id."""
+
+from __future__ import annotations
+
+import datetime
+import tempfile
+
+from hikmahealth.dump import export as dumpexport
+from hikmahealth.dump import restore as dumprestore
+from hikmahealth.dump import watermarks
+from hikmahealth.jobs.registry import JobContext, register
+from hikmahealth.server.client import db
+from hikmahealth.server.client.keeper import new_keeper
+from hikmahealth.server.client.resources import ResourceManager
+from hikmahealth.server.helpers import column_changes
+
+KIND_DATABASE_EXPORT = 'database_export'
+KIND_DATABASE_IMPORT = 'database_import'
+KIND_PRUNE_COLUMN_CHANGES = 'prune_sync_column_changes'
+KIND_SET_COLUMN_CHANGES = 'set_sync_column_changes'
+
+
+@register(KIND_DATABASE_EXPORT)
+def export_database(ctx: JobContext):
+    """Exports the database into an archive, saved in the resource store"""
+    fmt = ctx.params.get('format', dumpexport.FORMAT_NDJSON)
+    archive = ctx.params.get('archive', dumpexport.ARCHIVE_ZIP)
+    target = ctx.params.get('target', None)
+
+    kp = new_keeper()
+    rmgr = ResourceManager(kp)
+    since = watermarks.resolve_export_since(
+        kp, ctx.params.get('mode', None), ctx.params.get('since', None), target
+    )
+    filename = dumpexport.archive_filename(archive)
+    manifests: list[dumpexport.ExportManifest] = []
+
+    def on_table(t: dumpexport.TableManifest):
+        tables = ctx.progress.setdefault('tables', dict())
+        tables[t.name] = {'rows': t.rows, 'bytes': t.bytes}
+        ctx.update_progress()
+
+    with tempfile.TemporaryFile() as file:
+        with db.get_connection() as conn:
+            size = dumpexport.export_database_to_file(
+                conn,
+                file,
+                fmt,
+                archive,
+                on_table=on_table,
+                since=since,
+                target=target,
+                on_complete=manifests.append,
+            )
+
+        ctx.update_progress(stage='uploading', bytes=size)
+        (resource,) = rmgr.put_resources([
+            (
+                file,
+                lambda id: f'hh_exports/{id}/{filename}',
+                dumpexport.MIMETYPES[archive],
+            )
+        ])
+
+    # only once the archive is safely stored
+    watermarks.save_export_watermark(kp, manifests[0])
+
+    return {
+        'resource_id': str(resource['Id']),
+        'filename': filename,
+        'mimetype': resource['Mimetype'],
+        'bytes': size,
+    }
+
+
+@register(KIND_DATABASE_IMPORT)
+def import_database(ctx: JobContext):
+    """Restores an archive previously uploaded to the resource store"""
+    kp = new_keeper()
+    rmgr = ResourceManager(kp)
+
+    with tempfile.TemporaryFile() as file:
+        rmgr.download_resource_to_file(ctx.params['resource_id'], file)
+        file.seek(0)
+
+        with dumprestore.ArchiveReader(file) as reader:
+            key = dumprestore.progress_key(reader.manifest['export_id'])
+            watermarks.prepare_restore(
+                kp, reader.manifest, force=ctx.params.get('force', False)
+            )
+
+            def on_progress(progress: dict):
+                kp.set_json(key, progress)
+                ctx.update_progress(**progress)
+
+            with db.get_connection() as conn:
+                progress = dumprestore.restore_archive(
+                    conn, reader, kp.get(key), on_progress=on_progress
+                )
+
+            watermarks.save_import_watermark(kp, reader.manifest)
+
+    return {'export_id': progress['export_id'], 'tables': progress['tables']}
+
+
+@register(KIND_PRUNE_COLUMN_CHANGES)
+def prune_column_changes(ctx: JobContext):
+    """Deletes the changed columns logged for the sync pulls past the retention. Takes
+    an optional `retention_days`"""
+    retention = column_changes.RETENTION
+    if ctx.params.get('retention_days', None) is not None:
+        retention = datetime.timedelta(days=float(ctx.params['retention_days']))
+
+    with db.get_connection() as conn:
+        deleted = column_changes.prune(conn, retention)
+
+    return {'deleted': deleted}
+
+
+@register(KIND_SET_COLUMN_CHANGES)
+def set_column_changes(ctx: JobContext):
+    """Enables or disables the triggers logging the changed columns for the sync pulls,
+    by the `enabled` param. Run once the patches are turned on or off by
+    `SYNC_PATCH_MIN_SCHEMA_VERSION`, rather than by each process"""
+    enabled = ctx.params.get('enabled', None)
+    if not isinstance(enabled, bool):
+        raise ValueError('`enabled` must be true or false')
+
+    with db.get_connection() as conn:
+        tables = column_changes.set_logging(conn, enabled)
+
+    return {'enabled': enabled, 'tables': tables}
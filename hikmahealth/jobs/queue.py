@@ -0,0 +1,226 @@
+"""Postgres backed queue for the jobs, stored in the `jobs` table.
+
+Workers claim jobs with `SELECT ... FOR UPDATE SKIP LOCKED`, so any number of worker
+processes can poll the same table without handing the same job out twice."""
+
+from __future__ import annotations
+
+import datetime
+import uuid
+from dataclasses import asdict, dataclass
+from typing import Any, Iterable
+
+from psycopg import Connection
+from psycopg.rows import class_row
+from psycopg.types.json import Jsonb
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+
+STALE_AFTER = datetime.timedelta(minutes=5)
+"""Running jobs without a heartbeat within this window are considered abandoned (ex. the
+worker was killed), and are given back to the queue"""
+
+
+@dataclass
+class Job:
+    id: uuid.UUID
+    kind: str
+    status: str
+    params: dict
+    progress: dict
+    result: dict | None
+    error: str | None
+    attempts: int
+    max_attempts: int
+    created_by: uuid.UUID | None
+    worker_id: str | None
+    run_after: datetime.datetime
+    heartbeat_at: datetime.datetime | None
+    started_at: datetime.datetime | None
+    finished_at: datetime.datetime | None
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+
+    def to_dict(self):
+        d = asdict(self)
+        for k, v in d.items():
+            if isinstance(v, datetime.datetime):
+                d[k] = v.isoformat()
+            elif isinstance(v, uuid.UUID):
+                d[k] = str(v)
+
+        return d
+
+
+def enqueue(
+    conn: Connection,
+    kind: str,
+    params: dict[str, Any] | None = None,
+    created_by: str | None = None,
+    max_attempts: int = 1,
+) -> Job:
+    with conn.cursor(row_factory=class_row(Job)) as cur:
+        cur.execute(
+            """
+            INSERT INTO jobs (id, kind, params, created_by, max_attempts)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING *
+            """,
+            (uuid.uuid4(), kind, Jsonb(params or {}), created_by, max_attempts),
+        )
+        job = cur.fetchone()
+
+    assert job is not None
+    return job
+
+
+def get(conn: Connection, job_id: str) -> Job | None:
+    with conn.cursor(row_factory=class_row(Job)) as cur:
+        cur.execute('SELECT * FROM jobs WHERE id = %s::uuid', (job_id,))
+        return cur.fetchone()
+
+
+def claim(conn: Connection, worker_id: str, kinds: Iterable[str]) -> Job | None:
+    """Marks the oldest queued job (of one of the `kinds`) as running, and returns it"""
+    with conn.cursor(row_factory=class_row(Job)) as cur:
+        cur.execute(
+            """
+            UPDATE jobs
+            SET status = %(running)s,
+                worker_id = %(worker_id)s,
+                attempts = attempts + 1,
+                started_at = now(),
+                heartbeat_at = now(),
+                updated_at = now()
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE status = %(queued)s
+                    AND run_after <= now()
+                    AND kind = ANY(%(kinds)s)
+                ORDER BY run_after, created_at
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING *
+            """,
+            dict(
+                running=STATUS_RUNNING,
+                queued=STATUS_QUEUED,
+                worker_id=worker_id,
+                kinds=list(kinds),
+            ),
+        )
+        job = cur.fetchone()
+
+    conn.commit()
+    return job
+
+
+def heartbeat(
+    conn: Connection,
+    job_id: uuid.UUID,
+    worker_id: str,
+    progress: dict | None = None,
+) -> bool:
+    """Marks the job run by the worker as alive, with its progress. Returns `False` if
+    the worker no longer holds the job"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE jobs
+            SET heartbeat_at = now(),
+                progress = COALESCE(%s, progress),
+                updated_at = now()
+            WHERE id = %s AND status = %s AND worker_id = %s
+            """,
+            (
+                Jsonb(progress) if progress is not None else None,
+                job_id,
+                STATUS_RUNNING,
+                worker_id,
+            ),
+        )
+        updated = cur.rowcount > 0
+
+    conn.commit()
+    return updated
+
+
+def complete(
+    conn: Connection, job_id: uuid.UUID, worker_id: str, result: dict | None
+) -> bool:
+    """Marks the job run by the worker as completed. Returns `False` if the worker no
+    longer holds the job, as when it was given back to the queue as abandoned"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE jobs
+            SET status = %s, result = %s, error = NULL,
+                finished_at = now(), updated_at = now()
+            WHERE id = %s AND status = %s AND worker_id = %s
+            """,
+            (STATUS_COMPLETED, Jsonb(result or {}), job_id, STATUS_RUNNING, worker_id),
+        )
+        updated = cur.rowcount > 0
+
+    conn.commit()
+    return updated
+
+
+def fail(
+    conn: Connection,
+    job_id: uuid.UUID,
+    worker_id: str,
+    error: str,
+    retry_after: int = 30,
+) -> bool:
+    """Marks the job run by the worker as failed, or puts it back in the queue if it has
+    attempts left. Returns `False` if the worker no longer holds the job"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN attempts < max_attempts THEN %s ELSE %s END,
+                run_after = now() + make_interval(secs => %s),
+                error = %s,
+                finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE now() END,
+                updated_at = now()
+            WHERE id = %s AND status = %s AND worker_id = %s
+            """,
+            (
+                STATUS_QUEUED,
+                STATUS_FAILED,
+                retry_after,
+                error,
+                job_id,
+                STATUS_RUNNING,
+                worker_id,
+            ),
+        )
+        updated = cur.rowcount > 0
+
+    conn.commit()
+    return updated
+
+
+def requeue_stale(conn: Connection, stale_after: datetime.timedelta = STALE_AFTER) -> int:
+    """Gives back abandoned jobs to the queue (or fails them, if out of attempts)"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN attempts < max_attempts THEN %s ELSE %s END,
+                error = 'job was abandoned by worker ' || COALESCE(worker_id, ''),
+                finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE now() END,
+                updated_at = now()
+            WHERE status = %s AND heartbeat_at < now() - %s
+            """,
+            (STATUS_QUEUED, STATUS_FAILED, STATUS_RUNNING, stale_after),
+        )
+        count = cur.rowcount
+
+    conn.commit()
+    return count
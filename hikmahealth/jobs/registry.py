@@ -0,0 +1,66 @@
+"""Keeps track of the functions able to run each kind of job"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import threading
+import uuid
+
+
+class JobCancelled(Exception):
+    """Raised in a running job once its worker no longer holds it"""
+
+
+@dataclass
+class JobContext:
+    """Passed to the job handler while it runs"""
+
+    job_id: uuid.UUID
+    params: dict[str, Any]
+    progress: dict[str, Any] = field(default_factory=dict)
+    report: Callable[[dict[str, Any]], None] = lambda progress: None
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    """Set once the job is no longer held by its worker, as when it was given back to
+    the queue as abandoned"""
+
+    def update_progress(self, **values):
+        """Saves the progress of the job. Raises `JobCancelled` if the job was taken
+        from its worker, so that it stops"""
+        if self.cancelled.is_set():
+            raise JobCancelled(f'job {self.job_id} is no longer held by its worker')
+
+        self.progress.update(values)
+        self.report(self.progress)
+
+
+JobHandler = Callable[[JobContext], 'dict[str, Any] | None']
+
+_handlers: dict[str, JobHandler] = dict()
+
+
+def register(kind: str):
+    """Registers the decorated function as the handler of `kind` jobs. The handler returns
+    the result of the job, as a JSON serializable dictionary"""
+
+    def decorator(fn: JobHandler):
+        if kind in _handlers:
+            raise ValueError(f"job handler for '{kind}' is already registered")
+
+        _handlers[kind] = fn
+        return fn
+
+    return decorator
+
+
+def get_handler(kind: str) -> JobHandler | None:
+    return _handlers.get(kind)
+
+
+def get_kinds():
+    return tuple(_handlers.keys())
+
+
+class UnknownJobKind(Exception):
+    """Raised when enqueueing a job that has no handler"""
@@ -0,0 +1,153 @@
+"""Runs the queued jobs, outside of the web server processes"""
+
+from __future__ import annotations
+
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from typing import Iterable
+
+from hikmahealth.jobs import queue
+from hikmahealth.jobs.registry import JobContext, get_handler, get_kinds
+from hikmahealth.server.client import db
+
+POLL_INTERVAL = 2.0
+HEARTBEAT_INTERVAL = 30.0
+
+
+class _Heartbeat(threading.Thread):
+    """Keeps the claimed job marked as alive, and saves its latest progress. Sets
+    `lost`, and stops, once the worker no longer holds the job"""
+
+    def __init__(self, job_id: uuid.UUID, worker_id: str, interval: float):
+        super().__init__(daemon=True, name=f'heartbeat-{job_id}')
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = interval
+        self.lost = threading.Event()
+        self._progress: dict | None = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def report(self, progress: dict):
+        with self._lock:
+            self._progress = dict(progress)
+        self._wake.set()
+
+    def run(self):
+        with db.get_connection() as conn:
+            while not self._stopped.is_set() and not self.lost.is_set():
+                self._wake.wait(self.interval)
+                self._wake.clear()
+                self._flush(conn)
+
+            if not self.lost.is_set():
+                self._flush(conn)
+
+    def _flush(self, conn):
+        with self._lock:
+            progress, self._progress = self._progress, None
+
+        try:
+            held = queue.heartbeat(conn, self.job_id, self.worker_id, progress)
+        except Exception as err:
+            conn.rollback()
+            logging.warning(f'failed to save heartbeat of job {self.job_id}: {err}')
+            return
+
+        if not held:
+            # the job stops at its next progress, see `JobContext.update_progress`
+            logging.warning(f'job {self.job_id} is no longer held, cancelling it')
+            self.lost.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        self.join()
+
+
+class Worker:
+    def __init__(
+        self,
+        kinds: Iterable[str] | None = None,
+        worker_id: str | None = None,
+        poll_interval: float = POLL_INTERVAL,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+    ):
+        self.kinds = tuple(kinds or get_kinds())
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self._stopped = threading.Event()
+
+    def run_once(self) -> bool:
+        """Claims and runs a single job. Returns `False` if the queue was empty"""
+        with db.get_connection() as conn:
+            queue.requeue_stale(conn)
+            job = queue.claim(conn, self.worker_id, self.kinds)
+
+        if job is None:
+            return False
+
+        logging.info(f'[{self.worker_id}] running job {job.id} ({job.kind})')
+        started = time.monotonic()
+
+        heartbeat = _Heartbeat(job.id, self.worker_id, self.heartbeat_interval)
+        heartbeat.start()
+
+        ctx = JobContext(
+            job_id=job.id,
+            params=job.params,
+            report=heartbeat.report,
+            cancelled=heartbeat.lost,
+        )
+        try:
+            handler = get_handler(job.kind)
+            if handler is None:
+                raise LookupError(f"no handler for job of kind '{job.kind}'")
+
+            result = handler(ctx)
+        except Exception as err:
+            heartbeat.stop()
+            logging.error(f'[{self.worker_id}] job {job.id} failed: {err}')
+            error = ''.join(traceback.format_exception(err))
+            with db.get_connection() as conn:
+                held = queue.fail(conn, job.id, self.worker_id, error)
+        else:
+            heartbeat.stop()
+            with db.get_connection() as conn:
+                held = queue.complete(conn, job.id, self.worker_id, result)
+
+            if held:
+                elapsed = time.monotonic() - started
+                logging.info(
+                    f'[{self.worker_id}] job {job.id} completed in {elapsed:.1f}s'
+                )
+
+        if not held:
+            # given back to the queue meanwhile, and maybe run by another worker
+            logging.warning(
+                f'[{self.worker_id}] job {job.id} is no longer held, outcome dropped'
+            )
+
+        return True
+
+    def run_forever(self):
+        logging.info(f'[{self.worker_id}] waiting for jobs: {", ".join(self.kinds)}')
+        while not self._stopped.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception as err:
+                # ex. the database is unreachable. try again on the next poll
+                logging.error(f'[{self.worker_id}] failed to poll for jobs: {err}')
+
+            self._stopped.wait(self.poll_interval)
+
+    def stop(self):
+        self._stopped.set()
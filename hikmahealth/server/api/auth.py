@@ -1,16 +1,36 @@
 from __future__ import annotations
+import asyncio
 import bcrypt
 
 from hikmahealth.server.client import db
+from hikmahealth.utils import metrics
 from hikmahealth.utils.errors import WebError
 
 from hikmahealth.entity import core
 
 import bcrypt
+from psycopg import AsyncConnection
 from psycopg.rows import dict_row
 
 import uuid
 
+LOGINS = metrics.counter(
+    'hh_auth_logins_total', 'Email and password verifications, by result', ['result']
+)
+BCRYPT_SECONDS = metrics.histogram(
+    'hh_auth_bcrypt_seconds',
+    'Time verifying a password',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0),
+)
+
+
+def _check_password(password: str, hashed_password: str) -> bool:
+    with BCRYPT_SECONDS.time():
+        matches = bcrypt.checkpw(password.encode(), hashed_password.encode())
+
+    LOGINS.inc(result='ok' if matches else 'wrong_password')
+    return matches
+
 
 @core.dataentity
 class User(core.Entity):
@@ -76,14 +96,37 @@ def get_user_from_email(email: str, password: str) -> User:
 
         # Handle the case where the user does not exist
         if row is None:
+            LOGINS.inc(result='unknown_user')
             raise WebError('User not found', status_code=404)
 
-        if not bcrypt.checkpw(password.encode(), row['hashed_password'].encode()):
+        if not _check_password(password, row['hashed_password']):
             raise WebError('password incorrect', status_code=401)
 
         return User(**row)
 
 
+async def get_user_from_email_async(
+    conn: AsyncConnection, email: str, password: str
+) -> User:
+    """Same as `get_user_from_email`, on an async connection. The password is checked in
+    a thread, so that bcrypt doesn't hold the event loop"""
+    async with conn.cursor(row_factory=dict_row) as cur:
+        await cur.execute(
+            'SELECT * FROM users WHERE lower(email) = lower(%s)', (email,)
+        )
+        row = await cur.fetchone()
+
+    if row is None:
+        LOGINS.inc(result='unknown_user')
+        raise WebError('User not found', status_code=404)
+
+    matches = await asyncio.to_thread(_check_password, password, row['hashed_password'])
+    if not matches:
+        raise WebError('password incorrect', status_code=401)
+
+    return User(**row)
+
+
 def reset_password(user: User, new_password: str):
     """Updates the password of the user object"""
     with db.get_connection().cursor() as cur:
@@ -2,7 +2,9 @@ from flask import Blueprint, request, Request, jsonify
 
 from typing import Callable, Any
 from functools import wraps
+import hmac
 
+from hikmahealth.server import config
 from hikmahealth.utils.errors import WebError
 from hikmahealth.server.api import auth
 from hikmahealth.server.helpers import web as webhelpers
@@ -36,6 +38,30 @@ def authenticated_admin(f):
     return func
 
 
+def authenticated_admin_or_metrics_token(f):
+    """
+    Middleware for the routes read by the metrics scrapers.
+    Accepts the `METRICS_TOKEN` of the server, sent as `Authorization: Bearer <token>`,
+    or the token of an admin. The user passed is `None` for the metrics token.
+    """
+    admin_f = authenticated_admin(f)
+
+    @wraps(f)
+    def func(*args, **kwargs):
+        token = request.headers.get('Authorization', None)
+
+        if token is not None and config.METRICS_TOKEN is not None:
+            scheme, _, value = token.partition(' ')
+            if scheme.lower() == 'bearer' and hmac.compare_digest(
+                value.strip().encode(), config.METRICS_TOKEN.encode()
+            ):
+                return f(None, *args, **kwargs)
+
+        return admin_f(*args, **kwargs)
+
+    return func
+
+
 def authenticated_provider(f):
     """
     Middleware for "provider" role routes
@@ -0,0 +1,500 @@
+"""ASGI app, serving the sync pulls of the mobile app natively with async psycopg.
+
+The pulls (`GET /v1/api/sync`, and `/api/v2/sync` for backcompat) hold a connection of
+the async pool (`db.get_async_connection_pool`) only while reading, and run the CPU heavy
+work (bcrypt, JSON encoding) in threads, so a process can hold many slow tablet
+connections at once without blocking the event loop.
+
+Every other route, the sync pushes and resources included, is the Flask app, run on a
+pool of `ASGI_WSGI_THREADS` threads by `WsgiBridge`. Run it with:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000 --no-access-log
+
+The monkeypatched gevent server (pywsgi.py) and gunicorn (app.py) keep working as before."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Mapping
+from urllib.parse import parse_qsl
+
+from psycopg.rows import dict_row
+
+from hikmahealth.entity.sync import CHANGE_SEQ_CURSOR_QUERY
+from hikmahealth.server import config, routes_mobile
+from hikmahealth.server.api import auth
+from hikmahealth.server.client import db, instrument
+from hikmahealth.server.client.keeper import new_keeper
+from hikmahealth.server.server import app as flask_app
+from hikmahealth.server.helpers import (
+    column_changes,
+    delta_cache,
+    sync_admission,
+    sync_bundle,
+    sync_metrics,
+    sync_scope,
+    sync_sessions,
+)
+from hikmahealth.utils.datetime import utc
+from hikmahealth.utils.errors import WebError
+
+Scope = Mapping[str, Any]
+Receive = Callable[[], Awaitable[dict]]
+Send = Callable[[dict], Awaitable[None]]
+
+PULL_PATHS = frozenset(['/v1/api/sync', '/api/v2/sync'])
+"""Paths of the sync pulls served natively, as routed by the Flask app"""
+
+PULL_ENDPOINT = 'api-mobile.sync_v2_pull'
+"""Endpoint of the Flask route the native pulls stand for, in the query stats"""
+
+SPOOL_MAX_SIZE = 1024 * 1024
+"""Bytes of a request body kept in memory before it's spooled to disk"""
+
+MAX_BODY_SIZE = max(config.SYNC_PUSH_MAX_BODY_BYTES, config.IMPORT_MAX_BODY_BYTES)
+"""Bytes of a request body read at most, the most any route takes. The routes check
+their own limit once they run"""
+
+
+class BodyTooLarge(Exception):
+    """The body of a request is larger than the bridge reads"""
+
+
+class Headers:
+    """Case insensitive headers of an ASGI request"""
+
+    def __init__(self, raw: list[tuple[bytes, bytes]]):
+        self._headers: dict[str, str] = dict()
+        for name, value in raw:
+            key = name.decode('latin1').lower()
+            if key in self._headers:
+                self._headers[key] += ',' + value.decode('latin1')
+            else:
+                self._headers[key] = value.decode('latin1')
+
+    def get(self, name: str, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._headers
+
+
+class Request:
+    """The parts of an ASGI request read by the sync helpers, with the same `args` and
+    `headers` as a Flask request."""
+
+    def __init__(self, scope: Scope):
+        self.method: str = scope['method']
+        self.path: str = scope['path']
+        self.args: dict[str, str] = dict(
+            parse_qsl(scope.get('query_string', b'').decode('latin1'))
+        )
+        self.headers = Headers(scope.get('headers', []))
+        client = scope.get('client', None)
+        self.remote_addr: str | None = client[0] if client else None
+
+
+async def _read_body(receive: Receive, max_size: int = MAX_BODY_SIZE):
+    """Reads the body of the request into a spooled file, rewound. Raises `BodyTooLarge`
+    once more than `max_size` bytes are sent, chunked or not"""
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > max_size:
+            body.close()
+            raise BodyTooLarge(f'The request body is larger than {max_size} bytes')
+
+        body.write(chunk)
+        if not message.get('more_body', False):
+            break
+
+    body.seek(0)
+    return body
+
+
+def _to_wsgi_str(value: str) -> str:
+    # WSGI strings are bytes decoded as latin1
+    return value.encode('utf8').decode('latin1')
+
+
+def build_environ(scope: Scope, body) -> dict[str, Any]:
+    """Returns the WSGI environ of an ASGI http request."""
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path) :]
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': _to_wsgi_str(root_path),
+        'PATH_INFO': _to_wsgi_str(path),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': str(client[0]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # the whole body is read, chunked or not
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+
+        value = value.decode('latin1')
+        if key in environ:
+            environ[key] += ',' + value
+        else:
+            environ[key] = value
+
+    return environ
+
+
+class WsgiBridge:
+    """Serves a WSGI app to ASGI requests, each run on a thread of the executor. The
+    request body is read before the app runs, and the response sent as it's written.
+    Bodies larger than `max_body_size` are answered with a 413, without running the
+    app, and without reading past the limit."""
+
+    def __init__(
+        self,
+        wsgi_app,
+        executor: ThreadPoolExecutor,
+        max_body_size: int = MAX_BODY_SIZE,
+    ):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        headers = Headers(scope.get('headers', []))
+        try:
+            content_length = int(headers.get('content-length', 0))
+        except ValueError:
+            content_length = 0
+
+        try:
+            if content_length > self.max_body_size:
+                raise BodyTooLarge(
+                    f'The request body is larger than {self.max_body_size} bytes'
+                )
+            body = await _read_body(receive, self.max_body_size)
+        except BodyTooLarge as err:
+            return await _send_json(send, 413, {'ok': False, 'message': str(err)})
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                self.executor, self.run, build_environ(scope, body), send, loop
+            )
+        finally:
+            body.close()
+
+    def run(self, environ: dict, send: Send, loop: asyncio.AbstractEventLoop):
+        """Runs the app in the current thread, sending the response on the loop"""
+        response: dict[str, Any] = dict()
+        started = False
+
+        def send_sync(message: dict):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status: str, headers, exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1'))
+                for name, value in headers
+            ]
+
+        def start():
+            nonlocal started
+            if not started:
+                started = True
+                send_sync({
+                    'type': 'http.response.start',
+                    'status': response['status'],
+                    'headers': response['headers'],
+                })
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    start()
+                    send_sync({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+
+            start()
+            send_sync({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+async def _send_json(send: Send, status: int, payload: dict):
+    body = _dumps(payload)
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _pull_from_bundle(
+    last_synced_at, last_change_seq
+) -> tuple[dict, float, int] | None:
+    """Returns the changes of a pull from the shared bundle, as the Flask route does,
+    or `None` if the bundle doesn't cover it. The bundle is built, once for all the
+    pulls, on a connection of the pool of the Flask app"""
+    entities = routes_mobile.ENTITIES_TO_PUSH_TO_MOBILE
+    bundle = sync_bundle.get_bundle(entities)
+    if bundle is None or not bundle.covers(last_synced_at, last_change_seq):
+        return None
+
+    changes = {
+        key: bundle.get_delta(key, last_synced_at, last_change_seq).to_dict()
+        for key in entities.keys()
+    }
+    return changes, bundle.timestamp.timestamp() * 1000, bundle.change_seq
+
+
+async def _pull_from_shared(
+    scope: sync_scope.SyncScope, last_synced_at, last_change_seq
+) -> tuple[dict, float, int] | None:
+    """Returns the changes of a pull from the shared bundle or the cached records, as
+    the Flask route does, or `None` if the pull can't share them. The cached records
+    are read on a connection of the async pool."""
+    entities = routes_mobile.ENTITIES_TO_PUSH_TO_MOBILE
+    if not scope.is_unscoped:
+        return None
+
+    shared = await asyncio.to_thread(_pull_from_bundle, last_synced_at, last_change_seq)
+    if shared is not None:
+        return shared
+
+    if delta_cache.cache.enabled and entities:
+        pool = await db.get_async_connection_pool()
+        async with pool.connection() as conn:
+            changes, pulled_at, change_seq = await delta_cache.get_deltas_async(
+                conn, entities, last_synced_at, last_change_seq
+            )
+        return changes, pulled_at.timestamp() * 1000, change_seq
+
+    return None
+
+
+async def _pull_from_database(
+    scope: sync_scope.SyncScope, last_synced_at, last_change_seq
+) -> tuple[dict, float, int]:
+    """Returns the changes of a pull, read on a connection of the async pool"""
+    changes = dict()
+    pool = await db.get_async_connection_pool()
+    async with pool.connection() as conn:
+        # read before the records, so nothing committed in between is skipped. see
+        # `get_change_seq_cursor`
+        async with conn.cursor() as cur:
+            await cur.execute(CHANGE_SEQ_CURSOR_QUERY)
+            (change_seq,) = await cur.fetchone()
+
+        for key, c in routes_mobile.ENTITIES_TO_PUSH_TO_MOBILE.items():
+            query, params = c.get_pull_query(scope, last_synced_at, last_change_seq)
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(query, params)
+                records = await cur.fetchall()
+
+            changes[key] = c.split_pulled_records(
+                records, scope, last_synced_at, last_change_seq
+            ).to_dict()
+
+    return changes, routes_mobile._get_timestamp_now(), change_seq
+
+
+def _patch_changes(changes: dict, last_change_seq) -> dict:
+    with db.get_pooled_connection() as conn:
+        return column_changes.patch_changes(
+            conn, routes_mobile.ENTITIES_TO_PUSH_TO_MOBILE, changes, last_change_seq
+        )
+
+
+def _record_pull(user_id, device_id, timestamp, change_seq, size, elapsed_ms, agent):
+    with db.get_pooled_connection() as conn:
+        sync_sessions.record_pull(
+            conn,
+            user_id,
+            device_id,
+            utc.from_unixtimestamp(int(timestamp)),
+            change_seq,
+            size,
+            elapsed_ms,
+            agent,
+        )
+
+
+async def sync_pull(request: Request) -> bytes:
+    """Same as `routes_mobile.sync_v2_pull`. Returns the body of the response."""
+    email, password = routes_mobile._get_credentials_from(request)
+    device_id = sync_sessions.get_device_id(request.headers)
+    last_synced_at = routes_mobile._get_last_pulled_at_from(request)
+    schemaVersion = request.args.get('schemaVersion', None)
+    last_change_seq = routes_mobile._get_last_change_seq_from(request)
+
+    if last_synced_at is None:
+        raise WebError('missing last_pulled_at from request query', 400)
+
+    started = time.monotonic()
+    pool = await db.get_async_connection_pool()
+    async with pool.connection() as conn:
+        user = await auth.get_user_from_email_async(conn, email, password)
+
+    scope = await asyncio.to_thread(sync_scope.get_scope, new_keeper(), user)
+
+    shared = await _pull_from_shared(scope, last_synced_at, last_change_seq)
+    if shared is not None:
+        changes, timestamp, change_seq = shared
+    else:
+        changes, timestamp, change_seq = await _pull_from_database(
+            scope, last_synced_at, last_change_seq
+        )
+
+    if scope.is_unscoped and column_changes.supports_patches(schemaVersion):
+        changes = await asyncio.to_thread(_patch_changes, changes, last_change_seq)
+
+    body = await asyncio.to_thread(
+        _dumps,
+        {'changes': changes, 'timestamp': timestamp, 'change_seq': change_seq},
+    )
+
+    sync_metrics.record_pull(changes, len(body), time.monotonic() - started)
+
+    if device_id is not None:
+        await asyncio.to_thread(
+            _record_pull,
+            user.id,
+            device_id,
+            timestamp,
+            change_seq,
+            len(body),
+            int((time.monotonic() - started) * 1000),
+            request.headers.get('User-Agent'),
+        )
+
+    return body
+
+
+def _dumps(payload) -> bytes:
+    # encoded as `jsonify` does
+    return (flask_app.json.dumps(payload) + '\n').encode()
+
+
+class App:
+    """The ASGI app. Serves the sync pulls natively, and the rest with the Flask app."""
+
+    def __init__(
+        self,
+        wsgi_app=None,
+        threads: int | None = None,
+        max_body_size: int = MAX_BODY_SIZE,
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, threads or config.ASGI_WSGI_THREADS),
+            thread_name_prefix='asgi-wsgi',
+        )
+        self.wsgi = WsgiBridge(wsgi_app or flask_app, self.executor, max_body_size)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] != 'http':
+            raise NotImplementedError(f'unsupported ASGI scope: {scope["type"]}')
+
+        if scope['method'] == 'GET' and self.is_native(scope['path']):
+            return await self.serve_pull(scope, send)
+
+        return await self.wsgi(scope, receive, send)
+
+    @staticmethod
+    def is_native(path: str) -> bool:
+        # the Flask app doesn't use strict slashes
+        return path.rstrip('/') in PULL_PATHS
+
+    async def serve_pull(self, scope: Scope, send: Send):
+        request = Request(scope)
+        retry_after = None
+        # the threads of `asyncio.to_thread` run in a copy of the context, so their
+        # statements are collected too
+        with instrument.collect() as stats:
+            try:
+                client = sync_admission.get_client(request.headers, request.remote_addr)
+                async with sync_admission.PULLS.admit_async(client):
+                    status, body = 200, await sync_pull(request)
+            except sync_admission.Rejected as err:
+                status, body = err.status_code, _dumps(err.to_dict())
+                retry_after = err.retry_after
+            except WebError as err:
+                logging.error(f'WebError: {err}')
+                status, body = err.status_code, _dumps(err.to_dict())
+            except Exception:
+                logging.exception('failed to serve the sync pull')
+                status, body = 500, _dumps({'message': 'Internal Server Error'})
+
+        instrument.report(stats, PULL_ENDPOINT, status, testing=False)
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'server-timing', stats.server_timing().encode()),
+        ]
+        if retry_after is not None:
+            headers.append((b'retry-after', str(retry_after).encode()))
+        if 'Origin' in request.headers:
+            headers.append((b'access-control-allow-origin', b'*'))
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers,
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive: Receive, send: Send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # the pool is opened on the first pull, so the app starts without the
+                # database
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await db.close_async_connection_pool()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
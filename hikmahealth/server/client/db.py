@@ -1,45 +1,115 @@
+import asyncio
 import psycopg
 
-# from psycopg.pool import ConnectionPool
-from psycopg_pool import ConnectionPool
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 from hikmahealth.server import config
+from hikmahealth.server.client import instrument
+from hikmahealth.utils import metrics
 import logging
+import threading
 
-# _pool = None
-
-
-# def get_connection_pool():
-#     global _pool
-#     if _pool is None:
-#         try:
-#             _pool = ConnectionPool(
-#                 min_size=1,
-#                 max_size=10,
-#                 conninfo=dict(
-#                     host=config.PG_HOST,
-#                     port=config.PG_PORT,
-#                     dbname=config.PG_DB,
-#                     user=config.PG_USER,
-#                     password=config.PG_PASSWORD,
-#                     connect_timeout=10
-#                 )
-#             )
-#         except Exception as e:
-#             logging.error(f"Failed to create connection pool: {e}")
-#             raise
-
-#     return _pool
-
-
-# def get_connection():
-#     """Get a database connection from the pool with automatic reconnection"""
-#     try:
-#         pool = get_connection_pool()
-#         return pool.getconn()
-#     except Exception as e:
-#         logging.error(f"Database connection error: {e}")
-#         raise psycopg.OperationalError(
-#             "Failed to establish database connection")
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+_async_pool: AsyncConnectionPool | None = None
+_async_pool_lock: asyncio.Lock | None = None
+
+CONNECTIONS_OPENED = metrics.counter(
+	'hh_db_connections_opened_total', 'Connections opened by `get_connection`'
+)
+POOL_CONNECTIONS = metrics.gauge(
+	'hh_db_pool_connections',
+	'Connections of the pools, by state (size, available, waiting)',
+	['pool', 'state'],
+)
+
+
+@metrics.on_collect
+def _collect_pool_stats():
+	for name, pool in (('sync', _pool), ('async', _async_pool)):
+		if pool is None:
+			continue
+
+		stats = pool.get_stats()
+		POOL_CONNECTIONS.set(stats.get('pool_size', 0), pool=name, state='size')
+		POOL_CONNECTIONS.set(
+			stats.get('pool_available', 0), pool=name, state='available'
+		)
+		POOL_CONNECTIONS.set(
+			stats.get('requests_waiting', 0), pool=name, state='waiting'
+		)
+
+
+def _connection_kwargs(is_async: bool = False):
+	return dict(
+		host=config.PG_HOST,
+		port=config.PG_PORT,
+		dbname=config.PG_DB,
+		user=config.PG_USER,
+		password=config.PG_PASSWORD,
+		connect_timeout=10,
+		**instrument.connection_kwargs(is_async),
+	)
+
+
+def get_connection_pool() -> ConnectionPool:
+	"""pool of connections, for the sync routes and the readiness probe.
+	the pool is opened on first use"""
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			try:
+				_pool = ConnectionPool(
+					min_size=1,
+					max_size=max(1, config.DB_POOL_MAX_SIZE),
+					kwargs=_connection_kwargs(),
+					open=True,
+				)
+			except Exception as e:
+				logging.error(f"Failed to create connection pool: {e}")
+				raise
+
+	return _pool
+
+
+async def get_async_connection_pool() -> AsyncConnectionPool:
+	"""pool of async connections, for the endpoints served natively by the ASGI app.
+	the pool is opened on first use, in the event loop of the app"""
+	global _async_pool, _async_pool_lock
+	if _async_pool_lock is None:
+		_async_pool_lock = asyncio.Lock()
+
+	async with _async_pool_lock:
+		if _async_pool is None:
+			pool = AsyncConnectionPool(
+				min_size=1,
+				max_size=max(1, config.DB_ASYNC_POOL_MAX_SIZE),
+				kwargs=_connection_kwargs(is_async=True),
+				open=False,
+			)
+			try:
+				await pool.open()
+			except Exception as e:
+				logging.error(f"Failed to create async connection pool: {e}")
+				raise
+
+			_async_pool = pool
+
+	return _async_pool
+
+
+async def close_async_connection_pool():
+	global _async_pool
+	if _async_pool is not None:
+		pool, _async_pool = _async_pool, None
+		await pool.close()
+
+
+def get_pooled_connection(timeout: float | None = None):
+	"""connection of the pool, for the sync routes, that don't open one per request.
+	used as `with db.get_pooled_connection() as conn:`, it's committed (or rolled back)
+	and given back to the pool"""
+	return get_connection_pool().connection(timeout=timeout)
 
 
 def get_connection():
@@ -50,13 +120,15 @@ def get_connection():
 		dbname=config.PG_DB,
 		user=config.PG_USER,
 		password=config.PG_PASSWORD,
+		**instrument.connection_kwargs(),
 	)
+	CONNECTIONS_OPENED.inc()
 
 	return conn
 
 
-# Running this on test only
-if config.APP_ENV == config.EnvironmentType.Local:
+# Running this on test only, when starting eagerly (see `startup`)
+if config.APP_ENV == config.EnvironmentType.Local and config.HH_STARTUP_MODE == 'eager':
 	# fun test connection to see it fail
 	with get_connection() as conn:
 		print('test connection happened')
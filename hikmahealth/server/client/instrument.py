@@ -0,0 +1,333 @@
+"""Counting and timing of the SQL statements of each request.
+
+The connections of `db.get_connection` and of the pools create `InstrumentedCursor`s,
+which add every statement to the `QueryStats` being collected in the current context, if
+any. `register_instrumentation` collects them for each Flask request, and sends them back
+in a `Server-Timing` header:
+
+    Server-Timing: db;dur=12.4;desc="9 queries", db-max;dur=3.1
+
+A request issuing more statements than the budget of its endpoint (`QUERY_BUDGETS`) is
+logged, and fails when the app is testing. Tests can also hold any block of code to a
+budget, with `query_budget`."""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import dataclasses
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterator
+
+import psycopg
+from flask import Flask, g, request
+from psycopg import pq
+
+from hikmahealth.server.client import slow_queries
+from hikmahealth.utils import metrics
+
+ENABLED = os.environ.get('DB_INSTRUMENT', '1') not in ('0', 'false', '')
+
+BUDGETS: dict[str, int] = {
+    # pulls issue a bounded number of statements, whatever the number of records
+    'api-mobile.sync_v2_pull': 60,
+    'api-mobile-backcompat.sync_v2_pull': 60,
+    'api-mobile.login': 5,
+    'api-mobile-backcompat.login': 5,
+}
+"""Most statements issued by a request to each endpoint, by name"""
+
+BUDGETS.update(json.loads(os.environ.get('QUERY_BUDGETS', '{}')))
+
+SIZE_SAMPLE = 256
+
+LOG_LIMIT = 500
+"""Most statements kept by the stats logging them"""
+
+LOG_SQL_LENGTH = 2000
+
+log = logging.getLogger('hikmahealth.queries')
+
+STATEMENTS = metrics.counter(
+    'hh_db_statements_total', 'SQL statements issued by the requests', ['endpoint']
+)
+DB_SECONDS = metrics.counter(
+    'hh_db_seconds_total',
+    'Seconds spent executing the SQL statements of the requests',
+    ['endpoint'],
+)
+
+
+@dataclasses.dataclass
+class QueryStats:
+    statements: int = 0
+    db_time: float = 0.0
+    """Seconds spent executing the statements"""
+    max_time: float = 0.0
+    rows: int = 0
+    """Rows returned by the statements"""
+    bytes: int = 0
+    """Size of the values returned, as sent by the server"""
+    log: list[dict] | None = None
+    """The statements executed, in order, when set to a list"""
+
+    _lock: threading.Lock = dataclasses.field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
+
+    def record(
+        self,
+        elapsed: float,
+        statements: int = 1,
+        result=None,
+        query: str | None = None,
+    ):
+        rows, size = _measure(result)
+        # statements run on the threads of a push count towards the same request
+        with self._lock:
+            self.statements += statements
+            self.db_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            self.rows += rows
+            self.bytes += size
+
+            if self.log is not None and len(self.log) < LOG_LIMIT:
+                self.log.append(
+                    dict(
+                        sql=query,
+                        ms=round(elapsed * 1000, 2),
+                        statements=statements,
+                        rows=rows,
+                    )
+                )
+
+    def server_timing(self) -> str:
+        return (
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.statements} queries", '
+            f'db-max;dur={self.max_time * 1000:.1f}'
+        )
+
+    def to_dict(self) -> dict:
+        return dict(
+            statements=self.statements,
+            db_ms=round(self.db_time * 1000, 1),
+            max_ms=round(self.max_time * 1000, 1),
+            rows=self.rows,
+            bytes=self.bytes,
+        )
+
+
+_current: contextvars.ContextVar[QueryStats | None] = contextvars.ContextVar(
+    'query_stats', default=None
+)
+
+
+def get_stats() -> QueryStats | None:
+    """Returns the stats collected in the current context, if any"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def collect() -> Iterator[QueryStats]:
+    """Collects the statements executed in the block, and in the threads started with a
+    copy of its context"""
+    stats = QueryStats()
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextlib.contextmanager
+def query_budget(statements: int) -> Iterator[QueryStats]:
+    """Fails when the block executes more than the given number of statements"""
+    with collect() as stats:
+        yield stats
+
+    if stats.statements > statements:
+        raise QueryBudgetExceeded(
+            f'{stats.statements} statements executed, over the budget of {statements}'
+        )
+
+
+def _measure(result: pq.abc.PGresult | None) -> tuple[int, int]:
+    """Returns the rows of a result, and their size. The size of large results is
+    estimated from `SIZE_SAMPLE` of their rows."""
+    if result is None or result.status != pq.ExecStatus.TUPLES_OK:
+        return 0, 0
+
+    rows, fields = result.ntuples, result.nfields
+    step = max(1, rows // SIZE_SAMPLE)
+    size = 0
+    for row in range(0, rows, step):
+        for field in range(fields):
+            size += result.get_length(row, field)
+
+    return rows, size * step
+
+
+def query_text(query, context) -> str:
+    """Text of a query, as given to `execute`"""
+    try:
+        if isinstance(query, bytes):
+            return query.decode()
+        if isinstance(query, str):
+            return query
+
+        return query.as_string(context)
+    except Exception:
+        return repr(query)
+
+
+def _query_text(stats: QueryStats, query, context) -> str | None:
+    """Text of the query, when the stats log the statements"""
+    if stats.log is None:
+        return None
+
+    return ' '.join(query_text(query, context).split())[:LOG_SQL_LENGTH]
+
+
+def _check_slow(elapsed: float, query, params, context):
+    if slow_queries.ENABLED and elapsed >= slow_queries.THRESHOLD:
+        slow_queries.capture(query_text(query, context), params, elapsed)
+
+
+class InstrumentedCursor(psycopg.Cursor):
+    """Cursor adding its statements to the stats of the current context, and handing
+    the slow ones to `slow_queries`"""
+
+    def execute(self, query, params=None, **kwargs):
+        stats = _current.get()
+        if stats is None and not slow_queries.ENABLED:
+            return super().execute(query, params, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            if stats is not None:
+                stats.record(
+                    elapsed,
+                    result=self.pgresult,
+                    query=_query_text(stats, query, self),
+                )
+            _check_slow(elapsed, query, params, self)
+
+    def executemany(self, query, params_seq, **kwargs):
+        stats = _current.get()
+        if stats is None and not slow_queries.ENABLED:
+            return super().executemany(query, params_seq, **kwargs)
+
+        params_seq = list(params_seq)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            if stats is not None:
+                stats.record(
+                    elapsed,
+                    statements=len(params_seq),
+                    query=_query_text(stats, query, self),
+                )
+            # explained with the parameters of the first statement
+            _check_slow(elapsed, query, params_seq[0] if params_seq else None, self)
+
+
+class InstrumentedAsyncCursor(psycopg.AsyncCursor):
+    """Same as `InstrumentedCursor`, for the async connections"""
+
+    async def execute(self, query, params=None, **kwargs):
+        stats = _current.get()
+        if stats is None and not slow_queries.ENABLED:
+            return await super().execute(query, params, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            if stats is not None:
+                stats.record(
+                    elapsed,
+                    result=self.pgresult,
+                    query=_query_text(stats, query, self),
+                )
+            _check_slow(elapsed, query, params, self)
+
+
+def connection_kwargs(is_async: bool = False) -> dict:
+    """Arguments of `psycopg.connect` making its cursors instrumented"""
+    if not ENABLED:
+        return dict()
+
+    if is_async:
+        return dict(cursor_factory=InstrumentedAsyncCursor)
+
+    return dict(cursor_factory=InstrumentedCursor)
+
+
+def report(stats: QueryStats, endpoint: str | None, status: int, testing: bool):
+    """Logs the stats of a request, and fails testing requests over their budget"""
+    budget = BUDGETS.get(endpoint, None) if endpoint is not None else None
+    over = budget is not None and stats.statements > budget
+    STATEMENTS.inc(stats.statements, endpoint=endpoint or '')
+    DB_SECONDS.inc(stats.db_time, endpoint=endpoint or '')
+    log.log(
+        logging.WARNING if over else logging.INFO,
+        json.dumps(
+            dict(
+                event='request_queries',
+                endpoint=endpoint,
+                status=status,
+                budget=budget,
+                **stats.to_dict(),
+            )
+        ),
+    )
+
+    if over and testing:
+        raise QueryBudgetExceeded(
+            f'{endpoint} executed {stats.statements} statements, '
+            f'over its budget of {budget}'
+        )
+
+
+def register_instrumentation(app: Flask):
+    """Collects the statements of each request of the app"""
+    if not ENABLED:
+        return
+
+    @app.before_request
+    def start_collecting():
+        g.query_stats = QueryStats()
+        g.query_stats_token = _current.set(g.query_stats)
+
+    @app.after_request
+    def send_stats(response):
+        stats = g.get('query_stats', None)
+        if stats is not None:
+            response.headers.add('Server-Timing', stats.server_timing())
+            report(stats, request.endpoint, response.status_code, app.testing)
+
+        return response
+
+    @app.teardown_request
+    def stop_collecting(_err):
+        token = g.pop('query_stats_token', None)
+        if token is not None:
+            try:
+                _current.reset(token)
+            except ValueError:
+                # torn down in another context
+                _current.set(None)
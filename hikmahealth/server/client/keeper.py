@@ -11,8 +11,15 @@ from flask.app import Flask
 from flask.ctx import has_app_context
 from psycopg.rows import dict_row
 from hikmahealth.server.client import db
+from hikmahealth.utils import metrics
 import hashlib
 
+LOOKUPS = metrics.histogram(
+    'hh_keeper_lookup_seconds',
+    'Time reading a server variable from the database',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
 VALUE_TYPE_STRING = 'string'
 VALUE_TYPE_NUMBER = 'number'
 VALUE_TYPE_BOOLEAN = 'boolean'
@@ -44,7 +51,7 @@ class Keeper:
         raise ValueError('no such value')
 
     def get_primitive(self, key: str):
-        with db.get_connection() as conn:
+        with LOOKUPS.time(), db.get_connection() as conn:
             with conn.cursor(row_factory=dict_row) as cur:
                 row = cur.execute(
                     """
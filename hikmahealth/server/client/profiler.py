@@ -0,0 +1,303 @@
+"""Sampling profiler of the requests, for finding out where slow requests spend their
+time in production.
+
+Off by default. With `PROFILE_SAMPLE_RATE` or `PROFILE_SLOW_MS` set, `register_profiler`
+profiles a fraction of the requests, or all of them while keeping only the ones slower
+than the threshold. A background thread samples the stacks of the requests profiled
+every `PROFILE_INTERVAL_MS`. The stacks are sampled whether the request is running or
+waiting, so the time spent waiting on the database shows too.
+
+Each profile kept is written to `PROFILE_DIR` as JSON: the request, its timing, the SQL
+statements it executed (see `instrument.QueryStats.log`) and its stacks, collapsed one
+per line as `outer;inner;innermost <samples>`. That's the input of `flamegraph.pl`, and
+of speedscope.
+
+Under gevent (`pywsgi.py`), the requests are greenlets of a single thread. The sampler
+then runs on a real thread, and reads the frames of the greenlets."""
+
+from __future__ import annotations
+
+import _thread
+import collections
+import dataclasses
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+import uuid
+
+from flask import Flask, g, request
+
+from hikmahealth.server import config
+from hikmahealth.server.client import instrument
+from hikmahealth.utils.datetime import utc
+
+IDLE_INTERVAL = 0.25
+"""Seconds between two checks for requests to profile, while there are none"""
+
+MAX_DEPTH = 128
+
+PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+log = logging.getLogger('hikmahealth.profiler')
+
+
+def _primitives():
+    """The thread primitives, as they were before gevent patched them"""
+    start_new_thread, sleep = _thread.start_new_thread, time.sleep
+    allocate_lock, get_ident = _thread.allocate_lock, _thread.get_ident
+    if 'gevent' in sys.modules:
+        from gevent import monkey
+
+        if monkey.is_module_patched('threading'):
+            start_new_thread = monkey.get_original('_thread', 'start_new_thread')
+            allocate_lock = monkey.get_original('_thread', 'allocate_lock')
+            get_ident = monkey.get_original('_thread', 'get_ident')
+            sleep = monkey.get_original('time', 'sleep')
+
+    return start_new_thread, sleep, allocate_lock, get_ident
+
+
+def _current_greenlet():
+    if 'greenlet' not in sys.modules:
+        return None
+
+    import greenlet
+
+    current = greenlet.getcurrent()
+    # the main greenlet runs on the frames of its thread
+    return current if current.parent is not None else None
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get('__name__', None) or os.path.basename(code.co_filename)
+    return f'{module}:{getattr(code, "co_qualname", code.co_name)}'
+
+
+@dataclasses.dataclass
+class Profile:
+    thread_id: int
+    greenlet: object = None
+    samples: int = 0
+    stacks: collections.Counter = dataclasses.field(default_factory=collections.Counter)
+
+    def add(self, frame):
+        names = []
+        while frame is not None and len(names) < MAX_DEPTH:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+
+        self.samples += 1
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def collapsed(self) -> str:
+        """The stacks, one per line as `outer;inner <samples>`, most sampled first"""
+        return ''.join(f'{s} {n}\n' for s, n in self.stacks.most_common())
+
+
+class Sampler:
+    """Samples the stacks of the requests being profiled, from a background thread"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        (self._start_new_thread, self._sleep, allocate_lock, self._get_ident) = (
+            _primitives()
+        )
+        self._lock = allocate_lock()
+        self._active: dict[int, Profile] = {}
+        self._started = False
+
+    def _key(self) -> int:
+        current = _current_greenlet()
+        return id(current) if current is not None else self._get_ident()
+
+    def start(self) -> Profile:
+        """Starts profiling the current request"""
+        profile = Profile(self._get_ident(), _current_greenlet())
+        with self._lock:
+            self._active[self._key()] = profile
+            if not self._started:
+                self._started = True
+                self._start_new_thread(self._run, ())
+
+        return profile
+
+    def stop(self) -> Profile | None:
+        """Stops profiling the current request, and returns its profile"""
+        with self._lock:
+            return self._active.pop(self._key(), None)
+
+    def sample(self):
+        with self._lock:
+            if not self._active:
+                return False
+
+            frames = sys._current_frames()
+            for profile in self._active.values():
+                frame = None
+                if profile.greenlet is not None:
+                    # the frame of a greenlet is kept while it's switched out
+                    frame = getattr(profile.greenlet, 'gr_frame', None)
+                if frame is None:
+                    frame = frames.get(profile.thread_id, None)
+                if frame is not None:
+                    profile.add(frame)
+
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                busy = self.sample()
+            except Exception as err:
+                log.warning(f'failed to sample the requests: {err}')
+                busy = False
+
+            self._sleep(self.interval if busy else IDLE_INTERVAL)
+
+
+def _modified_at(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        # removed by another worker
+        return 0.0
+
+
+def save_profile(directory: str, profile: Profile, details: dict, keep: int) -> str:
+    """Writes the profile, and removes the oldest profiles over `keep`. Returns its id"""
+    os.makedirs(directory, exist_ok=True)
+    profile_id = uuid.uuid4().hex
+    path = os.path.join(directory, f'{profile_id}.json')
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(
+            dict(
+                id=profile_id,
+                **details,
+                samples=profile.samples,
+                collapsed=profile.collapsed(),
+            ),
+            f,
+        )
+    os.replace(f'{path}.tmp', path)
+
+    paths = [os.path.join(directory, p) for p in os.listdir(directory)]
+    paths = sorted((p for p in paths if p.endswith('.json')), key=_modified_at)
+    for old in paths[: max(0, len(paths) - keep)]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+    return profile_id
+
+
+def list_profiles(directory: str) -> list[dict]:
+    """The profiles kept, without their statements and stacks, newest first"""
+    if not os.path.isdir(directory):
+        return []
+
+    profiles = []
+    for entry in os.listdir(directory):
+        if not entry.endswith('.json'):
+            continue
+
+        try:
+            with open(os.path.join(directory, entry)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        data.pop('statements', None)
+        data.pop('collapsed', None)
+        profiles.append(data)
+
+    return sorted(profiles, key=lambda p: p.get('started_at', ''), reverse=True)
+
+
+def get_profile(directory: str, profile_id: str) -> dict | None:
+    if PROFILE_ID.match(profile_id) is None:
+        return None
+
+    try:
+        with open(os.path.join(directory, f'{profile_id}.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def register_profiler(
+    app: Flask,
+    sample_rate: float | None = None,
+    slow_ms: int | None = None,
+    directory: str | None = None,
+):
+    """Profiles the requests of the app, as set by the `PROFILE_*` configuration. Must
+    be registered after `register_instrumentation`, to get the SQL statements"""
+    sample_rate = config.PROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+    slow_ms = config.PROFILE_SLOW_MS if slow_ms is None else slow_ms
+    directory = directory or config.PROFILE_DIR
+    if sample_rate <= 0 and slow_ms <= 0:
+        return
+
+    sampler = Sampler(max(1, config.PROFILE_INTERVAL_MS) / 1000)
+
+    @app.before_request
+    def start_profiling():
+        g.profile_sampled = random.random() < sample_rate
+        g.profile_started = time.perf_counter()
+        g.profile_started_at = utc.now().isoformat()
+        g.profile = sampler.start()
+
+        stats = instrument.get_stats()
+        if stats is not None:
+            stats.log = []
+
+    def finish(status: int):
+        profile = sampler.stop()
+        g.pop('profile', None)
+        if profile is None:
+            return
+
+        elapsed_ms = (time.perf_counter() - g.profile_started) * 1000
+        slow = slow_ms > 0 and elapsed_ms >= slow_ms
+        if not (g.profile_sampled or slow):
+            return
+
+        stats = instrument.get_stats()
+        try:
+            save_profile(
+                directory,
+                profile,
+                dict(
+                    method=request.method,
+                    path=request.path,
+                    endpoint=request.endpoint,
+                    status=status,
+                    started_at=g.profile_started_at,
+                    elapsed_ms=round(elapsed_ms, 1),
+                    reason='slow' if slow else 'sampled',
+                    queries=stats.to_dict() if stats is not None else None,
+                    statements=stats.log if stats is not None else None,
+                ),
+                config.PROFILE_KEEP,
+            )
+        except OSError as err:
+            log.warning(f'failed to save the profile of {request.path}: {err}')
+
+    @app.after_request
+    def stop_profiling(response):
+        if 'profile' in g:
+            finish(response.status_code)
+
+        return response
+
+    @app.teardown_request
+    def stop_failed_profiling(err):
+        # requests failing without a response
+        if 'profile' in g:
+            finish(500)
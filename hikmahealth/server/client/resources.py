@@ -4,19 +4,24 @@ respective stores"""
 
 from dataclasses import dataclass
 
+import io
+import logging
+import threading
+import time
 from io import BytesIO
-from typing import Callable, Iterable, Tuple
+from typing import BinaryIO, Callable, Iterable, Tuple
 from uuid import UUID, uuid1
 
-from botocore.client import ClientError
+from flask.app import Flask
 from flask.json import jsonify
 from psycopg.rows import dict_row
 
 from hikmahealth.server.client import db
 from hikmahealth.storage.adapters.base import BaseAdapter
+from hikmahealth.utils import metrics
 
 
-from .keeper import Keeper, get_keeper
+from .keeper import Keeper, new_keeper
 
 import datetime
 
@@ -26,6 +31,12 @@ from hikmahealth.storage.adapters import s3, gcp
 STORE_TYPE_AWS = s3.UNIQUE_STORE_NAME
 STORE_TYPE_GCP = gcp.UNIQUE_STORE_NAME
 
+TRANSFERRED_BYTES = metrics.counter(
+    'hh_resources_bytes_total',
+    'Bytes of the resources uploaded to, and downloaded from the store',
+    ['direction', 'store'],
+)
+
 
 def get_supported_stores():
     return (
@@ -84,11 +95,12 @@ class ResourceManager:
 
         config = get_config_from_keeper(kp)
 
-        try:
-            assert config is not None, (
+        if config is None:
+            raise ResourceStoreNotConfigured(
                 'missing configuration. maybe from using an unsupported type or it was never set'
             )
 
+        try:
             assert config.store_type in get_supported_stores(), (
                 "Store '{}' not supported.".format(config.store_type)
             )
@@ -128,7 +140,7 @@ class ResourceManager:
 
             if config.store_type == STORE_TYPE_AWS:
                 import boto3
-                from botocore.client import Config
+                from botocore.client import ClientError, Config
 
                 from hikmahealth.storage.adapters import s3 as s3
 
@@ -188,7 +200,7 @@ class ResourceManager:
         except AssertionError as aerr:
             raise ResourceManagerInitError(*aerr.args)
 
-    def get_resource(self, id: str):
+    def _get_resource_record(self, id: str):
         data = None
         with db.get_connection() as conn:
             with conn.cursor(row_factory=dict_row) as cur:
@@ -210,11 +222,30 @@ class ResourceManager:
         if data['store'] != self.store.NAME:
             raise ResourceStoreTypeMismatchError()
 
+        return data
+
+    def get_resource(self, id: str):
+        data = self._get_resource_record(id)
+
         mem = self.store.download_as_bytes(data['uri'])
+        TRANSFERRED_BYTES.inc(
+            mem.getbuffer().nbytes, direction='download', store=self.store.NAME
+        )
         return dict(Body=mem, Mimetype=data['mimetype'])
 
+    def download_resource_to_file(self, id: str, file: BinaryIO):
+        """Writes the resource to `file` (instead of memory, as in `get_resource`).
+        Returns the mimetype of the resource"""
+        data = self._get_resource_record(id)
+
+        self.store.download_to_file(data['uri'], file)
+        TRANSFERRED_BYTES.inc(
+            _size_of(file), direction='download', store=self.store.NAME
+        )
+        return data['mimetype']
+
     def put_resources(
-        self, resources: Iterable[Tuple[BytesIO, str | Callable[[UUID], str], str]]
+        self, resources: Iterable[Tuple[BinaryIO, str | Callable[[UUID], str], str]]
     ):
         resources_data = list()
         for b, destination, mimetype in resources:
@@ -225,12 +256,14 @@ class ResourceManager:
             else:
                 d = destination
 
+            size = _size_of(b)
             out = self.store.put(
                 b,
                 d,
                 mimetype=mimetype,
                 overwrite=True,
             )
+            TRANSFERRED_BYTES.inc(size, direction='upload', store=self.store.NAME)
 
             resources_data.append(
                 dict(
@@ -273,12 +306,29 @@ class ResourceManager:
             )
 
 
+def _size_of(file: BinaryIO) -> int:
+    """Size of the file, leaving its position where it was. 0 if it can't seek"""
+    try:
+        position = file.tell()
+        size = file.seek(0, io.SEEK_END)
+        file.seek(position)
+        return size
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
 class ResourceManagerInitError(Exception):
     """Generic error raised when the resource manager failed to initialize"""
 
     pass
 
 
+class ResourceStoreNotConfigured(ResourceManagerInitError):
+    """Error raised when no store was ever configured"""
+
+    pass
+
+
 class ResourceStoreTypeMismatchError(Exception):
     """Error thrown when the `store_type` of the resource stored, doesn't match
     with the currently set resource store type."""
@@ -298,38 +348,82 @@ class ResourceNotFound(Exception):
     pass
 
 
-from flask.app import Flask
-from flask import current_app, g, has_app_context
+REFRESH_SECONDS = 300
+"""Age after which the resource manager is initialized again, to pick up the store
+configuration changed through another process"""
+
+RETRY_SECONDS = 30
+"""Time after which a failed initialization is tried again"""
+
+_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+"""Held while the resource manager is initialized, so a single request does it"""
+_manager: ResourceManager | None = None
+_manager_error: Exception | None = None
+_initialized_at: float | None = None
+_refresh_failed = False
 
 
 def _try_create_resource_manager():
     try:
-        rmgr = ResourceManager(get_keeper())
+        rmgr = ResourceManager(new_keeper())
         return rmgr, None
     except Exception as err:
         return None, err
 
 
 def initialize_resource_manager():
-    g.resource_manager_state = 'not_ready'
+    """(Re)initializes the resource manager shared by the requests of the process. A
+    refresh failing keeps the manager already initialized, and is tried again after
+    `RETRY_SECONDS`"""
+    global _manager, _manager_error, _initialized_at, _refresh_failed
     print('[INFO] Initializing Resource Manager')
 
+    started = time.perf_counter()
     rmgr, err = _try_create_resource_manager()
     if err is not None:
         print('[ERROR]: failed to initialize `ResourceManager`: {}'.format(err))
-        g.resource_manager_error = err
     else:
-        print('[INFO] Resource Manager ready'.format())
+        print(
+            '[INFO] Resource Manager ready in {:.0f}ms'.format(
+                (time.perf_counter() - started) * 1000
+            )
+        )
+
+    with _lock:
+        _initialized_at = time.monotonic()
+        _refresh_failed = err is not None and _manager is not None
+        if _refresh_failed:
+            logging.error(f'failed to refresh the resource manager, keeping it: {err}')
+            return
+
+        _manager, _manager_error = rmgr, err
 
-    if rmgr is not None:
-        g.resource_manager = rmgr
-        g.resource_manager_state = 'ready'
-        g.resource_manager_error = None
+
+def reset_resource_manager():
+    """Drops the resource manager, to initialize it again on next use. Call after
+    changing the store configuration"""
+    global _manager, _manager_error, _initialized_at, _refresh_failed
+    with _lock:
+        _manager, _manager_error, _initialized_at = None, None, None
+        _refresh_failed = False
+
+
+def get_resource_manager_state() -> str:
+    """One of `not_initialized`, `ready`, `not_configured` or `error`"""
+    if _initialized_at is None:
+        return 'not_initialized'
+    if _manager is not None:
+        return 'ready'
+    if isinstance(_manager_error, ResourceStoreNotConfigured):
+        return 'not_configured'
+
+    return 'error'
 
 
 def register_resource_manager(app: Flask):
-    with app.app_context():
-        initialize_resource_manager()
+    """Sets the handler of the initialization errors. The resource manager itself is
+    initialized on first use, or as set by `HH_STARTUP_MODE` (see `startup`)"""
 
     @app.errorhandler(ResourceManagerInitError)
     def handle_resource_manager_init_error(error):
@@ -337,18 +431,31 @@ def register_resource_manager(app: Flask):
         return jsonify({'ok': False, 'message': ' '.join(error.args)}), 412
 
 
+def _is_stale() -> bool:
+    if _initialized_at is None:
+        return True
+
+    age = time.monotonic() - _initialized_at
+    failed = _manager is None or _refresh_failed
+    return age >= (RETRY_SECONDS if failed else REFRESH_SECONDS)
+
+
 def get_resource_manager() -> ResourceManager | None:
     """Attempts to fetch the resource manager
 
     Raises:
         Exception - When the resource isn't properly configured"""
 
-    if 'resource_manager' not in g:
-        if 'resource_manager_error' not in g:
-            # was never initiated
-            initialize_resource_manager()
+    if _is_stale():
+        with _refresh_lock:
+            # initialized by another request while waiting
+            if _is_stale():
+                initialize_resource_manager()
+
+    with _lock:
+        manager, error = _manager, _manager_error
 
-    if 'resource_manger_error' in g and g.resource_manger_error is not None:
-        raise g.resource_manger_error
+    if error is not None:
+        raise error
 
-    return g.resource_manager
+    return manager
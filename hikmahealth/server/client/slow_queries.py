@@ -0,0 +1,299 @@
+"""Recorder of the slow SQL statements, aggregated by fingerprint.
+
+The cursors of `instrument` hand every statement slower than `SLOW_QUERY_MS` to
+`capture`. Statements are aggregated by fingerprint: their SQL with the literals and the
+lists of parameters taken out, so the queries built from the same filters add up. Only
+the types of the parameters are kept, never their values.
+
+A sample of the slow SELECTs (`SLOW_QUERY_EXPLAIN_RATE`, at most once per fingerprint
+every `SLOW_QUERY_EXPLAIN_EVERY` seconds) is run again with `EXPLAIN (ANALYZE, BUFFERS)`,
+away from the request, on a connection of its own and in a read only transaction.
+
+The aggregates of each process are added to the `slow_query_stats` table every
+`SLOW_QUERY_FLUSH_SECONDS` by a thread started with the first capture, and when the
+process exits, so that the workers share them and they outlive restarts."""
+
+from __future__ import annotations
+
+import atexit
+import contextvars
+import dataclasses
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Mapping
+
+from psycopg import Connection
+from psycopg.rows import dict_row
+
+from hikmahealth.server import config
+from hikmahealth.utils.datetime import utc
+
+ENABLED = config.SLOW_QUERY_MS > 0
+THRESHOLD = config.SLOW_QUERY_MS / 1000
+"""Seconds over which a statement is recorded"""
+
+EXPLAIN_RATE = config.SLOW_QUERY_EXPLAIN_RATE
+EXPLAIN_EVERY = config.SLOW_QUERY_EXPLAIN_EVERY
+EXPLAIN_TIMEOUT_MS = 30_000
+FLUSH_SECONDS = config.SLOW_QUERY_FLUSH_SECONDS
+
+ORDERS = {
+    'total': 'total_ms',
+    'max': 'max_ms',
+    'calls': 'calls',
+    'recent': 'last_seen_at',
+}
+
+log = logging.getLogger('hikmahealth.slow_queries')
+
+_COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|\$\d+)'
+_LISTS = re.compile(rf'\(\s*{_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})+\s*\)')
+_WRITES = re.compile(r'\b(insert|update|delete|merge|truncate|copy)\b', re.I)
+
+
+@dataclasses.dataclass
+class SlowQuery:
+    fingerprint: str
+    query: str
+    first_seen_at: datetime.datetime
+    last_seen_at: datetime.datetime
+    calls: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    param_shapes: Any = None
+    plan: Any = None
+    plan_ms: float | None = None
+    plan_captured_at: datetime.datetime | None = None
+
+    def to_row(self) -> dict:
+        row = dataclasses.asdict(self)
+        for name in ('param_shapes', 'plan'):
+            row[name] = json.dumps(row[name]) if row[name] is not None else None
+        return row
+
+
+_lock = threading.Lock()
+_pending: dict[str, SlowQuery] = {}
+_explained_at: dict[str, float] = {}
+_flusher_pid: int | None = None
+"""Process the flushing thread was started in. Threads don't survive a fork"""
+
+# a single thread, so at most one EXPLAIN runs at a time
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-queries')
+
+# the recorder's own statements aren't recorded
+_recording: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    'slow_queries_recording', default=False
+)
+
+
+def fingerprint(sql: str) -> tuple[str, str]:
+    """Returns the fingerprint of the statement, and its SQL without the literals"""
+    normalized = _COMMENTS.sub(' ', sql)
+    normalized = _STRINGS.sub('?', normalized)
+    normalized = _NUMBERS.sub('?', normalized)
+    normalized = _LISTS.sub('(...)', normalized)
+    normalized = ' '.join(normalized.split())
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16], normalized
+
+
+def _shape(value) -> str:
+    if value is None:
+        return 'null'
+    if isinstance(value, (list, tuple)):
+        return f'{type(value).__name__}[{len(value)}]'
+
+    return type(value).__name__
+
+
+def param_shapes(params) -> Any:
+    """Types of the parameters, with the length of the lists"""
+    if params is None:
+        return None
+    if isinstance(params, Mapping):
+        return {str(k): _shape(v) for k, v in params.items()}
+
+    return [_shape(v) for v in params]
+
+
+def is_explainable(sql: str) -> bool:
+    """Whether the statement only reads, and can be run again to be explained"""
+    statement = _COMMENTS.sub(' ', sql).strip().lower()
+    if statement.startswith('select'):
+        return 'for update' not in statement and 'for share' not in statement
+
+    return statement.startswith('with') and _WRITES.search(statement) is None
+
+
+def _should_explain(key: str, sql: str) -> bool:
+    if EXPLAIN_RATE <= 0 or random.random() >= EXPLAIN_RATE:
+        return False
+
+    now = time.monotonic()
+    if now - _explained_at.get(key, -EXPLAIN_EVERY) < EXPLAIN_EVERY:
+        return False
+
+    if not is_explainable(sql):
+        return False
+
+    _explained_at[key] = now
+    return True
+
+
+def _flush_every(seconds: float, stopped: threading.Event):
+    while not stopped.wait(seconds):
+        flush()
+
+
+def _start_flusher():
+    """Starts the thread saving the statements periodically, and the save on exit"""
+    threading.Thread(
+        target=_flush_every,
+        args=(FLUSH_SECONDS, threading.Event()),
+        name='slow-queries-flush',
+        daemon=True,
+    ).start()
+    atexit.register(flush)
+
+
+def capture(sql: str, params, elapsed: float):
+    """Records a slow statement"""
+    global _flusher_pid
+    if _recording.get():
+        return
+
+    key, normalized = fingerprint(sql)
+    now = utc.now()
+    with _lock:
+        entry = _pending.get(key, None)
+        if entry is None:
+            entry = _pending[key] = SlowQuery(key, normalized, now, now)
+
+        entry.calls += 1
+        entry.total_ms += elapsed * 1000
+        entry.max_ms = max(entry.max_ms, elapsed * 1000)
+        entry.param_shapes = param_shapes(params)
+        entry.last_seen_at = now
+
+        explain = _should_explain(key, sql)
+        start_flusher = _flusher_pid != os.getpid()
+        if start_flusher:
+            _flusher_pid = os.getpid()
+
+    if start_flusher:
+        _start_flusher()
+    if explain:
+        _executor.submit(_explain, sql, params)
+
+
+def _connect():
+    # imported late, as the connections of `db` use the cursors of `instrument`, which
+    # use this module
+    from hikmahealth.server.client import db
+
+    return db.get_connection()
+
+
+def _explain(sql: str, params):
+    token = _recording.set(True)
+    try:
+        with _connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SET TRANSACTION READ ONLY')
+                cur.execute(f'SET LOCAL statement_timeout = {EXPLAIN_TIMEOUT_MS}')
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+                (plan,) = cur.fetchone()
+
+            conn.rollback()
+    except Exception as err:
+        log.warning(f'failed to explain a slow statement: {err}')
+        return
+    finally:
+        _recording.reset(token)
+
+    key, normalized = fingerprint(sql)
+    now = utc.now()
+    with _lock:
+        entry = _pending.get(key, None)
+        if entry is None:
+            # flushed since. the plan is added to the saved calls
+            entry = _pending[key] = SlowQuery(key, normalized, now, now)
+
+        entry.plan = plan
+        entry.plan_ms = plan[0].get('Execution Time', None) if plan else None
+        entry.plan_captured_at = now
+
+
+def flush():
+    """Adds the statements recorded by the process to the `slow_query_stats` table"""
+    with _lock:
+        entries = list(_pending.values())
+        _pending.clear()
+
+    if not entries:
+        return
+
+    token = _recording.set(True)
+    try:
+        with _connect() as conn:
+            with conn.cursor() as cur:
+                cur.executemany(
+                    """
+                    INSERT INTO slow_query_stats
+                        (fingerprint, query, calls, total_ms, max_ms, param_shapes, plan, plan_ms, plan_captured_at, first_seen_at, last_seen_at)
+                    VALUES
+                        (%(fingerprint)s, %(query)s, %(calls)s, %(total_ms)s, %(max_ms)s, %(param_shapes)s::jsonb, %(plan)s::jsonb, %(plan_ms)s, %(plan_captured_at)s, %(first_seen_at)s, %(last_seen_at)s)
+                    ON CONFLICT (fingerprint) DO UPDATE
+                    SET calls = slow_query_stats.calls + EXCLUDED.calls,
+                        total_ms = slow_query_stats.total_ms + EXCLUDED.total_ms,
+                        max_ms = GREATEST(slow_query_stats.max_ms, EXCLUDED.max_ms),
+                        param_shapes = COALESCE(EXCLUDED.param_shapes, slow_query_stats.param_shapes),
+                        plan = COALESCE(EXCLUDED.plan, slow_query_stats.plan),
+                        plan_ms = COALESCE(EXCLUDED.plan_ms, slow_query_stats.plan_ms),
+                        plan_captured_at = COALESCE(EXCLUDED.plan_captured_at, slow_query_stats.plan_captured_at),
+                        last_seen_at = GREATEST(slow_query_stats.last_seen_at, EXCLUDED.last_seen_at);
+                    """,
+                    [e.to_row() for e in entries],
+                )
+    except Exception as err:
+        log.warning(f'failed to save {len(entries)} slow statements: {err}')
+    finally:
+        _recording.reset(token)
+
+
+def list_slow_queries(conn: Connection, order: str = 'total', limit: int = 50) -> list:
+    """The slow statements recorded by all the processes, the worst first"""
+    with conn.cursor(row_factory=dict_row) as cur:
+        cur.execute(
+            f"""
+            SELECT fingerprint, query, calls, total_ms, max_ms,
+                total_ms / GREATEST(calls, 1) AS mean_ms,
+                param_shapes, plan, plan_ms, plan_captured_at, first_seen_at, last_seen_at
+            FROM slow_query_stats
+            ORDER BY {ORDERS[order]} DESC
+            LIMIT %s
+            """,
+            (limit,),
+        )
+        return cur.fetchall()
+
+
+def reset(conn: Connection):
+    """Forgets the slow statements recorded, as after fixing them"""
+    with _lock:
+        _pending.clear()
+        _explained_at.clear()
+
+    with conn.cursor() as cur:
+        cur.execute('DELETE FROM slow_query_stats')
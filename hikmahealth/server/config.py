@@ -90,3 +90,76 @@ if APP_ENV == EnvironmentType.Prod:
 PHOTOS_STORAGE_BUCKET = os.environ.get('PHOTOS_STORAGE_BUCKET')
 EXPORTS_STORAGE_BUCKET = os.environ.get('EXPORTS_STORAGE_BUCKET')
 LOCAL_PHOTO_STORAGE_DIR = os.environ.get('LOCAL_PHOTO_STORAGE_DIR', '/tmp/hikma_photos')
+
+# connections kept by the pool of the sync routes. above the sync pulls and pushes
+# let in at once (see below), so they don't wait on it
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '20'))
+
+# connections of the pool used by the endpoints served natively by the ASGI app (asgi.py)
+DB_ASYNC_POOL_MAX_SIZE = int(os.environ.get('DB_ASYNC_POOL_MAX_SIZE', '20'))
+# threads running the Flask routes served through the ASGI app
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '16'))
+
+# token the metrics scrapers send as `Authorization: Bearer <token>`, instead of an admin
+# session token. the directory of the metrics of the processes is read from `METRICS_DIR`
+# by `hikmahealth.utils.metrics`
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', None) or None
+
+# profiling of the requests (`hikmahealth.server.client.profiler`), off by default.
+# a fraction of the requests is profiled, and any request slower than the threshold
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_MS = int(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_INTERVAL_MS = int(os.environ.get('PROFILE_INTERVAL_MS', '10'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/hh_profiles')
+# profiles kept in `PROFILE_DIR`, the oldest ones are removed first
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '200'))
+
+# statements slower than this are recorded by `hikmahealth.server.client.slow_queries`.
+# 0 turns the recording off
+SLOW_QUERY_MS = int(os.environ.get('SLOW_QUERY_MS', '1000'))
+# fraction of the slow SELECTs run again with `EXPLAIN (ANALYZE, BUFFERS)`, at most once
+# per statement every `SLOW_QUERY_EXPLAIN_EVERY` seconds
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', '0.1'))
+SLOW_QUERY_EXPLAIN_EVERY = int(os.environ.get('SLOW_QUERY_EXPLAIN_EVERY', '600'))
+# seconds between two saves of the slow statements recorded by a process
+SLOW_QUERY_FLUSH_SECONDS = int(os.environ.get('SLOW_QUERY_FLUSH_SECONDS', '60'))
+
+# when the resource manager (database and cloud store) is initialized: `lazy` on first
+# use, `background` by a thread started with the app, or `eager` while the app is created.
+# see `hikmahealth.server.startup`
+HH_STARTUP_MODE = os.environ.get('HH_STARTUP_MODE', 'lazy').lower()
+
+# seconds the readiness probe waits for a database connection
+HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT', '2'))
+# requests waiting for a connection of the pool over which an instance isn't ready
+READY_MAX_POOL_WAITING = int(
+    os.environ.get('READY_MAX_POOL_WAITING', str(max(1, DB_POOL_MAX_SIZE)))
+)
+
+# admission control of the sync endpoints (`hikmahealth.server.helpers.sync_admission`).
+# pulls and pushes run at once per process, 0 turns the control of the endpoint off
+SYNC_MAX_CONCURRENT_PULLS = int(os.environ.get('SYNC_MAX_CONCURRENT_PULLS', '8'))
+SYNC_MAX_CONCURRENT_PUSHES = int(
+    os.environ.get(
+        'SYNC_MAX_CONCURRENT_PUSHES',
+        str(max(1, DB_POOL_MAX_SIZE // 4)),
+    )
+)
+# requests waiting their turn at each endpoint, and the seconds they wait at most
+SYNC_ADMISSION_QUEUE_SIZE = int(os.environ.get('SYNC_ADMISSION_QUEUE_SIZE', '32'))
+SYNC_ADMISSION_TIMEOUT = float(os.environ.get('SYNC_ADMISSION_TIMEOUT', '15'))
+# requests of a device (else a user) running or waiting at each endpoint. 0 for no limit
+SYNC_ADMISSION_PER_CLIENT = int(os.environ.get('SYNC_ADMISSION_PER_CLIENT', '2'))
+
+# limits of the sync pushes, read a batch of records at a time rather than decoded whole
+# (`hikmahealth.server.helpers.push_body`). larger pushes are answered with a 413
+SYNC_PUSH_MAX_BODY_BYTES = int(
+    os.environ.get('SYNC_PUSH_MAX_BODY_BYTES', str(512 * 1024 * 1024))
+)
+SYNC_PUSH_MAX_RECORDS = int(os.environ.get('SYNC_PUSH_MAX_RECORDS', '1000000'))
+# records of a table applied at once
+SYNC_PUSH_BATCH_SIZE = int(os.environ.get('SYNC_PUSH_BATCH_SIZE', '500'))
+# size of the JSON dumps and archives imported by `POST /v1/admin/database/import`
+IMPORT_MAX_BODY_BYTES = int(
+    os.environ.get('IMPORT_MAX_BODY_BYTES', str(4 * 1024 * 1024 * 1024))
+)
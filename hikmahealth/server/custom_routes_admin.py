@@ -25,7 +25,6 @@ import hikmahealth.entity.fields as f
 from hikmahealth.utils.misc import convert_dict_keys_to_snake_case, convert_operator
 from hikmahealth.utils.errors import WebError
 from psycopg import Error as PostgresError
-from sqlalchemy import select, func, case, text
 
 from datetime import datetime, date
 from dataclasses import dataclass, asdict
@@ -0,0 +1,236 @@
+"""Column level patches for the sync pulls of the clients supporting them.
+
+Clients sending a `schemaVersion` of at least `SYNC_PATCH_MIN_SCHEMA_VERSION` (unset by
+default, which sends whole rows to every client) get the updated records as patches, see
+`hikmahealth.sync.patches`. Only the pulls by `last_change_seq` do: a transaction that
+started before a pull by timestamp and committed after it has its columns logged before
+the pull's time, and sending its rows whole heals that. The log of the changed columns
+is kept for `SYNC_COLUMN_CHANGES_RETENTION_DAYS` days; clients that last pulled before
+its horizon get whole rows.
+
+The triggers writing the log are created disabled, unless the patches are enabled when
+the migration runs, so the writes of the tables aren't slowed down for nothing. They're
+enabled or disabled by the `set_sync_column_changes` job (`set_logging`), for every
+process at once, outside of the sync requests."""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import Mapping
+
+from psycopg import Connection, sql
+
+from hikmahealth.entity.sync import SyncToClient
+from hikmahealth.sync.patches import apply_patches
+
+_min_schema_version = os.environ.get('SYNC_PATCH_MIN_SCHEMA_VERSION', '')
+MIN_SCHEMA_VERSION = int(_min_schema_version) if _min_schema_version else None
+
+RETENTION = datetime.timedelta(
+    days=float(os.environ.get('SYNC_COLUMN_CHANGES_RETENTION_DAYS', 30))
+)
+
+PRUNE_EVERY = 3600
+"""Seconds between two prunings of the log, per process"""
+
+# tables with their changed columns logged, as in the `sync_column_changes` migration
+PATCHED_TABLES = frozenset([
+    'patients',
+    'patient_additional_attributes',
+    'events',
+    'visits',
+    'appointments',
+    'prescriptions',
+])
+
+LOCK_TIMEOUT = '5s'
+"""Time the triggers are waited for, when enabled or disabled"""
+
+_lock = threading.Lock()
+_last_prune = 0.0
+
+
+def supports_patches(schema_version: str | None) -> bool:
+    if MIN_SCHEMA_VERSION is None or schema_version is None:
+        return False
+
+    return schema_version.isnumeric() and int(schema_version) >= MIN_SCHEMA_VERSION
+
+
+def is_logged_since(conn: Connection, last_change_seq: int) -> bool:
+    """Whether every change since the last pull is still in the log. The log has no
+    horizon while its triggers are disabled."""
+    with conn.cursor() as cur:
+        row = cur.execute(
+            'SELECT change_seq FROM sync_column_changes_horizon'
+        ).fetchone()
+
+    return row is not None and last_change_seq >= row[0]
+
+
+def get_changed_columns(
+    conn: Connection,
+    rows: Mapping[str, list[str]],
+    last_change_seq: int,
+) -> dict[str, dict[str, frozenset[str] | None]]:
+    """Returns the columns changed since the last pull for the ids of each table, in a
+    single query. Rows inserted since map to `None`, and rows without changes logged are
+    left out."""
+    tables = [table for table, ids in rows.items() for _ in ids]
+    ids = [str(id) for table_ids in rows.values() for id in table_ids]
+    if not ids:
+        return dict()
+
+    with conn.cursor() as cur:
+        records = cur.execute(
+            """
+            SELECT
+                c.table_name,
+                c.row_id,
+                bool_or(c.columns IS NULL),
+                array_agg(DISTINCT col) FILTER (WHERE col IS NOT NULL)
+            FROM sync_column_changes c
+            LEFT JOIN LATERAL unnest(c.columns) AS col ON true
+            WHERE (c.table_name, c.row_id) IN (
+                SELECT * FROM unnest(%(tables)s::text[], %(ids)s::text[])
+            )
+              AND c.change_seq >= %(last_change_seq)s
+            GROUP BY c.table_name, c.row_id
+            """,
+            dict(tables=tables, ids=ids, last_change_seq=last_change_seq),
+        ).fetchall()
+
+    changed: dict[str, dict[str, frozenset[str] | None]] = dict()
+    for table, row_id, inserted, columns in records:
+        changed.setdefault(table, dict())[row_id] = (
+            None if inserted else frozenset(columns or [])
+        )
+
+    return changed
+
+
+def patch_changes(
+    conn: Connection,
+    entities: Mapping[str, type[SyncToClient]],
+    changes: dict[str, dict],
+    last_change_seq: int | None,
+) -> dict[str, dict]:
+    """Returns the changes of a pull, with the updated records sent as patches where
+    possible. Sends whole rows if the log can't tell what changed, or the pull isn't by
+    `last_change_seq`."""
+    if last_change_seq is None:
+        return changes
+
+    try:
+        if not is_logged_since(conn, last_change_seq):
+            return changes
+
+        rows = {
+            entities[key].TABLE_NAME: [row['id'] for row in delta.get('updated', [])]
+            for key, delta in changes.items()
+            if key in entities and entities[key].TABLE_NAME in PATCHED_TABLES
+        }
+        changed = get_changed_columns(conn, rows, last_change_seq)
+    except Exception as err:
+        conn.rollback()
+        logging.warning(f'failed to read the changed columns, sending whole rows: {err}')
+        return changes
+
+    patched = dict(changes)
+    for key, delta in changes.items():
+        if key in entities and entities[key].TABLE_NAME in rows:
+            patched[key] = apply_patches(
+                delta, changed.get(entities[key].TABLE_NAME, dict())
+            )
+
+    return patched
+
+
+def prune(conn: Connection, retention: datetime.timedelta = RETENTION) -> int:
+    """Deletes the changes older than the retention, and moves the horizon past them.
+    Returns the number deleted."""
+    with conn.cursor() as cur:
+        (count,) = cur.execute(
+            """
+            WITH deleted AS (
+                DELETE FROM sync_column_changes
+                WHERE changed_at < now() - %(retention)s
+                RETURNING change_seq
+            ), horizon AS (
+                UPDATE sync_column_changes_horizon
+                SET change_seq = greatest(change_seq, (SELECT max(change_seq) + 1 FROM deleted)),
+                    changed_at = greatest(changed_at, now() - %(retention)s)
+            )
+            SELECT count(*) FROM deleted
+            """,
+            dict(retention=retention),
+        ).fetchone()
+    conn.commit()
+    return count
+
+
+def set_logging(conn: Connection, enabled: bool) -> list[str]:
+    """Enables or disables the triggers logging the changed columns, where they aren't
+    already. Returns the tables whose trigger changed.
+
+    Enabling moves the horizon to now, as the writes before weren't logged. Disabling
+    removes it, so no patch is sent from a log missing writes."""
+    with conn.cursor() as cur:
+        triggers = cur.execute(
+            """
+            SELECT c.relname, t.tgenabled
+            FROM pg_trigger t
+            JOIN pg_class c ON c.oid = t.tgrelid
+            WHERE c.relname = ANY(%s) AND t.tgname = c.relname || '_column_changes_trg'
+            """,
+            (sorted(PATCHED_TABLES),),
+        ).fetchall()
+
+        tables = sorted(table for table, state in triggers if (state != 'D') != enabled)
+        if not tables:
+            conn.rollback()
+            return tables
+
+        cur.execute("SELECT set_config('lock_timeout', %s, true)", (LOCK_TIMEOUT,))
+        for table in tables:
+            cur.execute(
+                sql.SQL('ALTER TABLE {} {} TRIGGER {}').format(
+                    sql.Identifier(table),
+                    sql.SQL('ENABLE' if enabled else 'DISABLE'),
+                    sql.Identifier(f'{table}_column_changes_trg'),
+                )
+            )
+
+        if enabled:
+            cur.execute(
+                """
+                INSERT INTO sync_column_changes_horizon (change_seq, changed_at)
+                VALUES (txid_current(), now())
+                ON CONFLICT (id) DO UPDATE
+                SET change_seq = EXCLUDED.change_seq, changed_at = EXCLUDED.changed_at
+                """
+            )
+        else:
+            cur.execute('DELETE FROM sync_column_changes_horizon')
+
+    conn.commit()
+    return tables
+
+
+def maybe_prune(conn: Connection) -> None:
+    """Prunes the log, at most once every `PRUNE_EVERY` seconds in this process."""
+    global _last_prune
+    with _lock:
+        if time.monotonic() - _last_prune < PRUNE_EVERY:
+            return
+        _last_prune = time.monotonic()
+
+    try:
+        prune(conn)
+    except Exception as err:
+        conn.rollback()
+        logging.warning(f'failed to prune the sync column changes: {err}')
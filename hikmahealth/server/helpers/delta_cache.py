@@ -0,0 +1,169 @@
+"""Sharing the records read by concurrent sync pulls.
+
+Pulls are grouped in windows of `SYNC_DELTA_CACHE_BUCKET` seconds of their
+`last_pulled_at` (or of `last_change_seq`). The records changed since the start of a
+window are read once per entity, and each pull of the window is cut out of them. Entries
+are keyed by the highest `change_seq` of the table too, so a write to the table starts a
+new entry. They live for `SYNC_DELTA_CACHE_TTL` seconds (0 disables the cache), within
+`SYNC_DELTA_CACHE_ROWS` records in total, and are dropped once a push to them commits.
+
+A pull served from the cache gets the time and cursor the oldest of its entries was read
+at, so the changes made since come with the next pull.
+
+`get_deltas_async` reads on an `AsyncConnection`, for the pulls served by the ASGI app,
+sharing the entries and the loads in progress with `get_deltas`."""
+
+from __future__ import annotations
+
+import dataclasses
+import datetime
+import os
+from typing import Iterable, Mapping
+
+from psycopg import AsyncConnection, Connection
+from psycopg.rows import dict_row
+
+from hikmahealth.entity.sync import (
+    CHANGE_SEQ_CURSOR_QUERY,
+    SyncToClient,
+    get_change_seq_cursor,
+    get_max_change_seqs,
+    get_max_change_seqs_query,
+)
+from hikmahealth.sync.bundle import filter_since_change, filter_since_time
+from hikmahealth.sync.cache import DeltaCache
+from hikmahealth.utils.datetime import utc
+
+TTL = float(os.environ.get('SYNC_DELTA_CACHE_TTL', 10))
+MAX_ROWS = int(os.environ.get('SYNC_DELTA_CACHE_ROWS', 100_000))
+BUCKET_SECONDS = int(os.environ.get('SYNC_DELTA_CACHE_BUCKET', 300))
+CHANGE_SEQ_BUCKET = 1000
+
+MODE_TIME = 'time'
+MODE_CHANGE_SEQ = 'change_seq'
+
+
+@dataclasses.dataclass
+class CachedRecords:
+    rows: list[dict]
+    read_at: datetime.datetime
+    change_seq: int
+
+
+cache: DeltaCache[CachedRecords] = DeltaCache(
+    MAX_ROWS, TTL, getsizeof=lambda entry: len(entry.rows) + 1
+)
+
+
+def get_bucket(
+    last_sync_time: datetime.datetime, last_change_seq: int | None = None
+) -> tuple[str, datetime.datetime | int]:
+    """Returns the window of the pull, as its mode and start."""
+    if last_change_seq is not None:
+        return MODE_CHANGE_SEQ, last_change_seq - last_change_seq % CHANGE_SEQ_BUCKET
+
+    seconds = int(last_sync_time.timestamp())
+    return MODE_TIME, datetime.datetime.fromtimestamp(
+        seconds - seconds % BUCKET_SECONDS, tz=datetime.UTC
+    )
+
+
+def get_deltas(
+    conn: Connection,
+    entities: Mapping[str, type[SyncToClient]],
+    last_sync_time: datetime.datetime,
+    last_change_seq: int | None = None,
+) -> tuple[dict[str, dict], datetime.datetime, int]:
+    """Returns the changes of each entity, with the timestamp and cursor to send back."""
+    mode, start = get_bucket(last_sync_time, last_change_seq)
+    max_change_seqs = get_max_change_seqs(conn, entities)
+
+    changes = dict()
+    entries: list[CachedRecords] = []
+    for key, entity in entities.items():
+
+        def load(entity=entity):
+            # read before the records, so nothing committed in between is skipped
+            read_at = utc.now()
+            change_seq = get_change_seq_cursor(conn)
+            if mode == MODE_CHANGE_SEQ:
+                rows = entity.get_changed_records(None, start, conn)
+            else:
+                rows = entity.get_changed_records(start, None, conn)
+
+            return CachedRecords(rows, read_at, change_seq)
+
+        entry = cache.get_or_load((key, mode, start, max_change_seqs[key]), load)
+        entries.append(entry)
+        changes[key] = _cut(entry, mode, last_sync_time, last_change_seq)
+
+    return (
+        changes,
+        min(entry.read_at for entry in entries),
+        min(entry.change_seq for entry in entries),
+    )
+
+
+async def get_deltas_async(
+    conn: AsyncConnection,
+    entities: Mapping[str, type[SyncToClient]],
+    last_sync_time: datetime.datetime,
+    last_change_seq: int | None = None,
+) -> tuple[dict[str, dict], datetime.datetime, int]:
+    """Same as `get_deltas`, on an `AsyncConnection`"""
+    mode, start = get_bucket(last_sync_time, last_change_seq)
+    async with conn.cursor() as cur:
+        await cur.execute(get_max_change_seqs_query(entities))
+        max_change_seqs = dict(zip(entities.keys(), await cur.fetchone()))
+
+    changes = dict()
+    entries: list[CachedRecords] = []
+    for key, entity in entities.items():
+
+        async def load(entity=entity):
+            read_at = utc.now()
+            async with conn.cursor() as cur:
+                await cur.execute(CHANGE_SEQ_CURSOR_QUERY)
+                (change_seq,) = await cur.fetchone()
+
+            if mode == MODE_CHANGE_SEQ:
+                query, params = entity.get_changed_records_query(None, start)
+            else:
+                query, params = entity.get_changed_records_query(start, None)
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(query, params)
+                rows = await cur.fetchall()
+
+            return CachedRecords(rows, read_at, change_seq)
+
+        entry = await cache.get_or_load_async(
+            (key, mode, start, max_change_seqs[key]), load
+        )
+        entries.append(entry)
+        changes[key] = _cut(entry, mode, last_sync_time, last_change_seq)
+
+    return (
+        changes,
+        min(entry.read_at for entry in entries),
+        min(entry.change_seq for entry in entries),
+    )
+
+
+def _cut(
+    entry: CachedRecords,
+    mode: str,
+    last_sync_time: datetime.datetime,
+    last_change_seq: int | None,
+) -> dict:
+    """The changes of a pull, out of the records of its window"""
+    if mode == MODE_CHANGE_SEQ:
+        delta = filter_since_change(entry.rows, last_change_seq, last_sync_time)
+    else:
+        delta = filter_since_time(entry.rows, last_sync_time)
+
+    return delta.to_dict()
+
+
+def invalidate(keys: Iterable[str]) -> None:
+    """Drops the records cached for the entities. Called once a push commits."""
+    cache.invalidate(keys)
@@ -0,0 +1,185 @@
+"""Caching of the patient charts served to the admin app.
+
+Charts are cached per process, for a short while (`PATIENT_CHART_CACHE_TTL` seconds). A sync
+push invalidates the charts of the patients it touches in the process that handled it; the
+other processes serve their copy until it expires."""
+
+from __future__ import annotations
+
+import os
+import re
+import threading
+import uuid
+from typing import Iterable
+
+from cachetools import TTLCache
+from psycopg import Connection, sql
+
+from hikmahealth.entity import hh
+from hikmahealth.server.client import db
+
+CACHE_TTL = int(os.environ.get('PATIENT_CHART_CACHE_TTL', 30))
+CACHE_SIZE = int(os.environ.get('PATIENT_CHART_CACHE_SIZE', 1024))
+
+SECTIONS = ('patient', *hh.Patient.CHART_SECTIONS.keys())
+
+_IDENTIFIER = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+Projection = dict[str, 'list[str] | None']
+
+# the sync push uses the table names as keys
+_CHART_TABLES = frozenset(table for table, _ in hh.Patient.CHART_SECTIONS.values())
+
+
+def parse_fields(fields: str | None) -> Projection | None:
+    """Parses the `fields` query parameter into the projection of the chart.
+
+    Ex. `patient.given_name,patient.surname,visits` includes the name of the patient
+    and all the columns of the visits, and nothing else."""
+    if fields is None or fields.strip() == '':
+        return None
+
+    projection: dict[str, set[str] | None] = dict()
+    for field in fields.split(','):
+        section, _, column = field.strip().partition('.')
+        if section not in SECTIONS:
+            raise ValueError(
+                "unknown section '{}'. expected one of: {}".format(
+                    section, ', '.join(SECTIONS)
+                )
+            )
+
+        if column == '':
+            projection[section] = None
+            continue
+
+        if not _IDENTIFIER.match(column):
+            raise ValueError(f"invalid field '{field}'")
+
+        columns = projection.setdefault(section, set())
+        if columns is not None:
+            columns.add(column)
+
+    return {
+        section: sorted(columns) if columns is not None else None
+        for section, columns in projection.items()
+    }
+
+
+class PatientChartCache:
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        # incremented on invalidation. a chart read before an invalidation is not cached,
+        # since it might predate the change
+        self._generation = 0
+
+    @staticmethod
+    def key(patient_id: str, projection: Projection | None):
+        if projection is None:
+            return (patient_id, None)
+
+        return (
+            patient_id,
+            tuple(
+                (s, tuple(c) if c is not None else None)
+                for s, c in sorted(projection.items())
+            ),
+        )
+
+    def get_or_load(self, patient_id: str, projection: Projection | None, load):
+        key = self.key(patient_id, projection)
+        with self._lock:
+            chart = self._cache.get(key)
+            generation = self._generation
+
+        if chart is not None:
+            return chart
+
+        chart = load()
+        if chart is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._cache[key] = chart
+
+        return chart
+
+    def invalidate(self, patient_ids: Iterable[str]):
+        ids = set(str(i) for i in patient_ids)
+        if not ids:
+            return
+
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._cache.keys() if k[0] in ids]:
+                self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+
+cache = PatientChartCache()
+
+
+def get_patient_chart(patient_id: str, projection: Projection | None = None) -> str | None:
+    """Returns the chart of the patient as a JSON string, `None` if there's no such
+    patient"""
+    try:
+        # in the form of the ids the cache is invalidated with
+        patient_id = str(uuid.UUID(patient_id))
+    except ValueError:
+        return None
+
+    def load():
+        with db.get_connection() as conn:
+            return hh.Patient.get_chart(conn, patient_id, projection)
+
+    return cache.get_or_load(patient_id, projection, load)
+
+
+def has_deleted_records(body: dict) -> bool:
+    """Whether a sync push payload deletes records of the charts, other than patients.
+    Only those need a connection to find their patients"""
+    return any(
+        isinstance(delta, dict) and delta.get('deleted')
+        for key, delta in body.items()
+        if key in _CHART_TABLES
+    )
+
+
+def get_pushed_patient_ids(body: dict, conn: Connection | None = None) -> set[str]:
+    """Returns the ids of the patients whose records are in a sync push payload.
+
+    Deleted records only carry their id, so their patients are looked up with `conn`."""
+    ids: set[str] = set()
+    deleted: dict[str, list] = dict()
+
+    for key, delta in body.items():
+        if not isinstance(delta, dict):
+            continue
+
+        records = (delta.get('created') or []) + (delta.get('updated') or [])
+        if key == 'patients':
+            ids.update(r['id'] for r in records if r.get('id') is not None)
+            ids.update(delta.get('deleted') or [])
+        elif key in _CHART_TABLES:
+            ids.update(
+                r['patient_id'] for r in records if r.get('patient_id') is not None
+            )
+            if delta.get('deleted'):
+                deleted[key] = delta['deleted']
+
+    if conn is not None:
+        with conn.cursor() as cur:
+            for table, deleted_ids in deleted.items():
+                cur.execute(
+                    sql.SQL(
+                        'SELECT DISTINCT patient_id FROM {} WHERE id = ANY(%s::uuid[])'
+                    ).format(sql.Identifier(table)),
+                    [list(deleted_ids)],
+                )
+                ids.update(str(r[0]) for r in cur.fetchall() if r[0] is not None)
+
+    return set(str(i) for i in ids)
@@ -0,0 +1,193 @@
+"""Reading of the sync pushes, without decoding their body whole.
+
+The body (`{table: {created, updated, deleted}}`) is spooled to a temporary file, kept
+in memory while small, and hashed for `push_log` as it's read. Bodies larger than
+`SYNC_PUSH_MAX_BODY_BYTES` are turned away with a 413.
+
+It's then scanned once with `jsonstream`: the records are counted, against
+`SYNC_PUSH_MAX_RECORDS`, and the offsets of the `created`, `updated` and `deleted` of
+each table are noted. The changes of a table are read again when it's applied, in
+batches of `SYNC_PUSH_BATCH_SIZE` records (`SpooledDelta.batches`), so a push holds the
+batches being applied in memory, whatever its size.
+
+The scan keeps the number of records of each table, and a summary of the push with the
+ids of the patients of its records, to find the patients whose charts changed."""
+
+from __future__ import annotations
+
+import dataclasses
+import tempfile
+import threading
+from typing import IO, Iterator
+
+from hikmahealth.server.helpers import push_log
+from hikmahealth.sync import DeltaData
+from hikmahealth.utils import jsonstream
+from hikmahealth.utils.errors import WebError
+
+SPOOL_MAX_SIZE = 1024 * 1024
+"""Bytes of a body kept in memory before it's spooled to disk"""
+
+CHUNK_SIZE = 64 * 1024
+
+CHANGES = ('created', 'updated', 'deleted')
+
+
+class SpooledBody:
+    """The body of a request, spooled. Read by several readers at once, each from its
+    own offset, as the tables of a stage are applied concurrently"""
+
+    def __init__(self, file: IO[bytes], size: int, body_hash: str):
+        self._file = file
+        self._lock = threading.Lock()
+        self.size = size
+        self.body_hash = body_hash
+
+    def reader(self, offset: int = 0) -> jsonstream.Reader:
+        position = offset
+
+        def read(size: int) -> bytes:
+            nonlocal position
+            with self._lock:
+                self._file.seek(position)
+                chunk = self._file.read(size)
+
+            position += len(chunk)
+            return chunk
+
+        return jsonstream.Reader(read, CHUNK_SIZE)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> SpooledBody:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def spool(stream: IO[bytes], query: bytes, max_size: int) -> SpooledBody:
+    """Copies the body of a push to a temporary file, in chunks, hashing it"""
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    hasher = push_log.new_body_hasher(query)
+    size = 0
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+
+            size += len(chunk)
+            if size > max_size:
+                raise WebError(f'The push is larger than {max_size} bytes', 413)
+
+            hasher.update(chunk)
+            file.write(chunk)
+    except BaseException:
+        file.close()
+        raise
+
+    return SpooledBody(file, size, hasher.hexdigest())
+
+
+@dataclasses.dataclass
+class SpooledDelta:
+    """The changes pushed to a table, read from the spooled body when applied"""
+
+    body: SpooledBody
+    offsets: dict[str, int]
+    """Offset of the array of each change in the body"""
+    batch_size: int
+
+    def batches(self) -> Iterator[DeltaData]:
+        """The changes, `batch_size` records at a time, created then updated then
+        deleted"""
+        for change in CHANGES:
+            if change not in self.offsets:
+                continue
+
+            batch = []
+            for record in self.body.reader(self.offsets[change]).iter_array():
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    yield DeltaData(**{change: batch})
+                    batch = []
+
+            if batch:
+                yield DeltaData(**{change: batch})
+
+
+@dataclasses.dataclass
+class Push:
+    deltas: dict[str, SpooledDelta]
+    counts: dict[str, dict[str, int]]
+    """Records of each change, by table"""
+    summary: dict[str, dict[str, list]]
+    """The changes of each table, with the ids of the patients of the records only"""
+    records: int
+
+
+def _summarize(key: str, record) -> str | tuple[str, str] | None:
+    if not isinstance(record, dict):
+        # the id of a deleted record
+        return record if isinstance(record, str) else None
+
+    field = 'id' if key == 'patients' else 'patient_id'
+    value = record.get(field, None)
+    return (field, value) if isinstance(value, str) else None
+
+
+def scan(body: SpooledBody, max_records: int, batch_size: int) -> Push:
+    """Reads through the push, checking its structure and counting its records"""
+    reader = body.reader()
+    push = Push(dict(), dict(), dict(), 0)
+
+    try:
+        if reader.peek() != '{':
+            raise WebError('The push must be a JSON object', 400)
+
+        for key in reader.iter_object():
+            if reader.peek() != '{':
+                raise WebError(f'The changes to {key!r} must be an object', 400)
+
+            offsets: dict[str, int] = dict()
+            push.counts[key] = dict()
+            push.summary[key] = dict()
+            for change in reader.iter_object():
+                if change not in CHANGES or reader.peek() == 'n':
+                    # unknown, or null
+                    reader.skip_value()
+                    continue
+
+                if reader.peek() != '[':
+                    raise WebError(f'`{key}.{change}` must be an array', 400)
+
+                offsets[change] = reader.tell()
+                count = 0
+                # the records of a patient are summarized once
+                summaries: dict = dict()
+                for record in reader.iter_array():
+                    count += 1
+                    push.records += 1
+                    if push.records > max_records:
+                        raise WebError(
+                            f'The push has more than {max_records} records', 413
+                        )
+
+                    summary = _summarize(key, record)
+                    if summary is not None:
+                        summaries[summary] = None
+
+                push.counts[key][change] = count
+                push.summary[key][change] = [
+                    dict([s]) if isinstance(s, tuple) else s for s in summaries
+                ]
+
+            push.deltas[key] = SpooledDelta(body, offsets, batch_size)
+
+        reader.end()
+    except jsonstream.JSONStreamError as err:
+        raise WebError(f'The push is not valid JSON: {err}', 400)
+
+    return push
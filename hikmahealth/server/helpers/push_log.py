@@ -0,0 +1,186 @@
+"""Deduplication of the sync pushes retried by the app.
+
+A push is identified by its fingerprint: the `Idempotency-Key` header when the app sends
+one, otherwise a hash of the query and body of the request. The first push with a
+fingerprint claims it in `sync_push_log`, and its response is recorded once it's applied.
+The same push sent again within `SYNC_PUSH_DEDUP_WINDOW` seconds gets the recorded
+response back, without being applied again."""
+
+from __future__ import annotations
+
+import dataclasses
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from psycopg import Connection
+from psycopg.types.json import Jsonb
+
+from hikmahealth.utils.errors import WebError
+
+WINDOW = datetime.timedelta(seconds=int(os.environ.get('SYNC_PUSH_DEDUP_WINDOW', 86400)))
+"""How long a push is remembered for"""
+
+PENDING_TIMEOUT = datetime.timedelta(minutes=10)
+"""Age of a claim after which its push is assumed dead, and the claim is taken over"""
+
+PRUNE_EVERY = 600
+"""Seconds between two prunings of the log, per process"""
+
+MAX_KEY_LENGTH = 100
+
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+
+_lock = threading.Lock()
+_last_prune = 0.0
+
+
+@dataclasses.dataclass
+class Claim:
+    fingerprint: str
+    owned: bool
+    """Whether this request applies the push"""
+    response: dict | None = None
+    """Response recorded for the push, when it was already applied"""
+
+    @property
+    def in_progress(self) -> bool:
+        """Whether the push is being applied by another request"""
+        return not self.owned and self.response is None
+
+
+def new_body_hasher(query: bytes):
+    """Hasher of a body read in chunks, giving the same hash as `hash_body`"""
+    return hashlib.sha256(query + b'\n')
+
+
+def hash_body(query: bytes, body: bytes) -> str:
+    hasher = new_body_hasher(query)
+    hasher.update(body)
+    return hasher.hexdigest()
+
+
+def get_fingerprint(
+    query: bytes, body: bytes, idempotency_key: str | None = None
+) -> tuple[str, str]:
+    """Returns the fingerprint of a push, with the hash of its content."""
+    return get_fingerprint_from_hash(hash_body(query, body), idempotency_key)
+
+
+def get_fingerprint_from_hash(
+    body_hash: str, idempotency_key: str | None = None
+) -> tuple[str, str]:
+    """Same as `get_fingerprint`, given the hash of the content of the push"""
+    if idempotency_key:
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            raise WebError(f'Idempotency-Key is longer than {MAX_KEY_LENGTH}', 400)
+        return f'key:{idempotency_key}', body_hash
+
+    return f'sha256:{body_hash}', body_hash
+
+
+def claim(conn: Connection, fingerprint: str, body_hash: str) -> Claim:
+    """Claims the push, unless it was already applied or is being applied. Entries past
+    the retention window, and claims left behind by dead requests, are taken over."""
+    with conn.cursor() as cur:
+        row = cur.execute(
+            """
+            INSERT INTO sync_push_log (fingerprint, body_hash, status)
+            VALUES (%(fingerprint)s, %(body_hash)s, %(pending)s)
+            ON CONFLICT (fingerprint) DO UPDATE
+            SET body_hash = EXCLUDED.body_hash,
+                status = EXCLUDED.status,
+                response = NULL,
+                created_at = now(),
+                completed_at = NULL
+            WHERE sync_push_log.created_at < now() - %(window)s
+                OR (sync_push_log.status = %(pending)s AND sync_push_log.created_at < now() - %(timeout)s)
+            RETURNING fingerprint
+            """,
+            dict(
+                fingerprint=fingerprint,
+                body_hash=body_hash,
+                pending=STATUS_PENDING,
+                window=WINDOW,
+                timeout=PENDING_TIMEOUT,
+            ),
+        ).fetchone()
+
+        existing = None
+        if row is None:
+            existing = cur.execute(
+                'SELECT body_hash, status, response FROM sync_push_log WHERE fingerprint = %s',
+                (fingerprint,),
+            ).fetchone()
+
+    conn.commit()
+
+    if row is not None:
+        return Claim(fingerprint, owned=True)
+
+    # released by a failed push in the meantime
+    if existing is None:
+        return Claim(fingerprint, owned=False)
+
+    stored_hash, status, response = existing
+    if stored_hash != body_hash:
+        raise WebError('Idempotency-Key was already used for a different push', 422)
+
+    if status == STATUS_DONE:
+        return Claim(fingerprint, owned=False, response=response)
+
+    return Claim(fingerprint, owned=False)
+
+
+def complete(conn: Connection, fingerprint: str, response: dict) -> None:
+    """Records the response of an applied push."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE sync_push_log
+            SET status = %s, response = %s, completed_at = now()
+            WHERE fingerprint = %s
+            """,
+            (STATUS_DONE, Jsonb(response), fingerprint),
+        )
+    conn.commit()
+
+
+def release(conn: Connection, fingerprint: str) -> None:
+    """Forgets a push that failed, so that it's applied again when retried."""
+    with conn.cursor() as cur:
+        cur.execute(
+            'DELETE FROM sync_push_log WHERE fingerprint = %s AND status = %s',
+            (fingerprint, STATUS_PENDING),
+        )
+    conn.commit()
+
+
+def prune(conn: Connection) -> int:
+    """Deletes the entries past the retention window. Returns the number deleted."""
+    with conn.cursor() as cur:
+        cur.execute(
+            'DELETE FROM sync_push_log WHERE created_at < now() - %s',
+            (max(WINDOW, PENDING_TIMEOUT),),
+        )
+        count = cur.rowcount
+    conn.commit()
+    return count
+
+
+def maybe_prune(conn: Connection) -> None:
+    """Prunes the log, at most once every `PRUNE_EVERY` seconds in this process."""
+    global _last_prune
+    with _lock:
+        if time.monotonic() - _last_prune < PRUNE_EVERY:
+            return
+        _last_prune = time.monotonic()
+
+    try:
+        prune(conn)
+    except Exception as err:
+        logging.warning(f'failed to prune the sync push log: {err}')
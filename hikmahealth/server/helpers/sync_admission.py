@@ -0,0 +1,359 @@
+"""Admission control of the sync pulls and pushes, so that a district's tablets syncing
+at once queue up, instead of each holding a connection and its payload in memory.
+
+A gate (`PULLS`, `PUSHES`) lets at most `limit` requests of a process run at once. The
+next ones wait their turn in a queue of at most `queue_size`, for at most `timeout`
+seconds. Requests are turned away, without waiting:
+
+- with a 429, when their client (the device, else the user) already has `per_client`
+  requests running or waiting at the gate. The retries of one tablet don't take the
+  places of the others
+- with a 503, when the queue is full, or the wait expected from its depth is longer
+  than the timeout. Requests that would time out aren't kept waiting for nothing
+
+The `Retry-After` of the responses is estimated from the depth of the queue and the
+recent time of the requests, with some jitter, so the tablets turned away don't all come
+back at once. When a place frees, it goes to the waiting client with the fewest requests
+running, the oldest first."""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import functools
+import math
+import random
+import threading
+import time
+from base64 import b64decode
+from typing import AsyncIterator, Callable, Iterator
+
+from flask import jsonify, request
+
+from hikmahealth.server import config
+from hikmahealth.server.helpers import sync_sessions
+from hikmahealth.utils import metrics
+
+INITIAL_SECONDS = 1.0
+"""Time of a request assumed by a gate, until it has timed some"""
+
+SMOOTHING = 0.2
+"""Weight of the last request in the moving mean of the time of the requests"""
+
+MAX_RETRY_AFTER = 120
+
+ADMITTED = metrics.counter(
+    'hh_sync_admitted_total', 'Sync requests let in by the admission control', ['gate']
+)
+REJECTED = metrics.counter(
+    'hh_sync_rejected_total',
+    'Sync requests turned away by the admission control, by reason',
+    ['gate', 'reason'],
+)
+WAIT_SECONDS = metrics.histogram(
+    'hh_sync_admission_wait_seconds',
+    'Time the sync requests let in waited in the queue',
+    ['gate'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+REQUESTS = metrics.gauge(
+    'hh_sync_admission_requests',
+    'Sync requests at the admission control, by state (running, waiting)',
+    ['gate', 'state'],
+)
+
+
+class Rejected(Exception):
+    """A request turned away by a gate"""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(f'sync request rejected: {reason}')
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_dict(self) -> dict:
+        return {'ok': False, 'message': MESSAGES[self.reason], 'reason': self.reason}
+
+
+MESSAGES = {
+    'client': 'Too many sync requests from this device, retry later',
+    'queue_full': 'The server is busy, retry later',
+    'overloaded': 'The server is busy, retry later',
+    'timeout': 'The server is busy, retry later',
+}
+
+
+@dataclasses.dataclass(eq=False)
+class _Waiter:
+    client: str
+    wake: Callable[[], None]
+    queued_at: float
+    admitted: bool = False
+
+
+class Gate:
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        queue_size: int,
+        timeout: float,
+        per_client: int,
+    ):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.per_client = per_client
+
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting: list[_Waiter] = []
+        # requests running or waiting, and requests running, by client
+        self._clients: collections.Counter = collections.Counter()
+        self._running_by_client: collections.Counter = collections.Counter()
+        self._mean_seconds = INITIAL_SECONDS
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit > 0
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def expected_wait(self, position: int) -> float:
+        """Seconds the request at `position` in the queue is expected to wait"""
+        return math.ceil(position / self.limit) * self._mean_seconds
+
+    def _reject(self, status_code: int, reason: str) -> Rejected:
+        REJECTED.inc(gate=self.name, reason=reason)
+        seconds = max(1.0, self.expected_wait(len(self._waiting) + 1))
+        seconds *= random.uniform(1.0, 1.5)
+        return Rejected(status_code, reason, min(MAX_RETRY_AFTER, math.ceil(seconds)))
+
+    def _admit(self, client: str):
+        self._running += 1
+        self._running_by_client[client] += 1
+
+    def _enter(self, client: str, wake: Callable[[], None]) -> _Waiter | None:
+        """Takes a place at the gate. Returns `None` when let in right away, else the
+        place taken in the queue, woken once let in"""
+        with self._lock:
+            if self.per_client > 0 and self._clients[client] >= self.per_client:
+                raise self._reject(429, 'client')
+
+            if self._running < self.limit and not self._waiting:
+                self._admit(client)
+                self._clients[client] += 1
+                return None
+
+            position = len(self._waiting) + 1
+            if position > self.queue_size:
+                raise self._reject(503, 'queue_full')
+            if self.expected_wait(position) > self.timeout:
+                raise self._reject(503, 'overloaded')
+
+            waiter = _Waiter(client, wake, time.monotonic())
+            self._waiting.append(waiter)
+            self._clients[client] += 1
+            return waiter
+
+    def _admit_next(self):
+        while self._running < self.limit and self._waiting:
+            waiter = min(self._waiting, key=lambda w: self._running_by_client[w.client])
+            self._waiting.remove(waiter)
+            self._admit(waiter.client)
+            waiter.admitted = True
+            waiter.wake()
+
+    def _settle(self, waiter: _Waiter) -> bool:
+        """Whether the request waiting was let in. Leaves the queue if it wasn't"""
+        with self._lock:
+            if waiter.admitted:
+                waited = time.monotonic() - waiter.queued_at
+                WAIT_SECONDS.observe(waited, gate=self.name)
+                return True
+
+            self._waiting.remove(waiter)
+            self._forget(waiter.client)
+            return False
+
+    def _forget(self, client: str):
+        self._clients[client] -= 1
+        if self._clients[client] <= 0:
+            del self._clients[client]
+
+    def _leave(self, client: str, elapsed: float | None):
+        with self._lock:
+            self._running -= 1
+            self._running_by_client[client] -= 1
+            if self._running_by_client[client] <= 0:
+                del self._running_by_client[client]
+            self._forget(client)
+
+            if elapsed is not None:
+                self._mean_seconds += SMOOTHING * (elapsed - self._mean_seconds)
+
+            self._admit_next()
+
+    def _timed_out(self) -> Rejected:
+        with self._lock:
+            return self._reject(503, 'timeout')
+
+    @contextlib.contextmanager
+    def admit(self, client: str) -> Iterator[None]:
+        """Runs the block once let in by the gate. Raises `Rejected` if turned away"""
+        if not self.enabled:
+            yield
+            return
+
+        event = threading.Event()
+        waiter = self._enter(client, event.set)
+        if waiter is not None:
+            try:
+                event.wait(self.timeout)
+            except BaseException:
+                # killed while waiting
+                if self._settle(waiter):
+                    self._leave(client, None)
+                raise
+
+            if not self._settle(waiter):
+                raise self._timed_out()
+
+        ADMITTED.inc(gate=self.name)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._leave(client, time.monotonic() - started)
+
+    @contextlib.asynccontextmanager
+    async def admit_async(self, client: str) -> AsyncIterator[None]:
+        """Same as `admit`, waiting on the event loop"""
+        if not self.enabled:
+            yield
+            return
+
+        loop = asyncio.get_running_loop()
+        admitted_future = loop.create_future()
+
+        def wake():
+            # from the thread of the request leaving
+            try:
+                loop.call_soon_threadsafe(_resolve, admitted_future)
+            except RuntimeError:
+                # the loop is closed, the place is given back once the waiting stops
+                pass
+
+        waiter = self._enter(client, wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(admitted_future), self.timeout)
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # cancelled, as when the client is gone
+                if self._settle(waiter):
+                    self._leave(client, None)
+                raise
+
+            if not self._settle(waiter):
+                raise self._timed_out()
+
+        ADMITTED.inc(gate=self.name)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._leave(client, time.monotonic() - started)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(True)
+
+
+PULLS = Gate(
+    'pull',
+    config.SYNC_MAX_CONCURRENT_PULLS,
+    config.SYNC_ADMISSION_QUEUE_SIZE,
+    config.SYNC_ADMISSION_TIMEOUT,
+    config.SYNC_ADMISSION_PER_CLIENT,
+)
+PUSHES = Gate(
+    'push',
+    config.SYNC_MAX_CONCURRENT_PUSHES,
+    config.SYNC_ADMISSION_QUEUE_SIZE,
+    config.SYNC_ADMISSION_TIMEOUT,
+    config.SYNC_ADMISSION_PER_CLIENT,
+)
+
+
+@metrics.on_collect
+def _collect_gates():
+    for gate in (PULLS, PUSHES):
+        REQUESTS.set(gate.running, gate=gate.name, state='running')
+        REQUESTS.set(gate.waiting, gate=gate.name, state='waiting')
+
+
+def _get_basic_auth_email(headers) -> str | None:
+    auth_header = headers.get('Authorization', None) or ''
+    scheme, _, encoded = auth_header.partition(' ')
+    if scheme.lower() != 'basic':
+        return None
+
+    try:
+        email, _, _ = b64decode(encoded).decode().partition(':')
+    except ValueError:
+        return None
+
+    return email or None
+
+
+def get_client(headers, remote_addr: str | None) -> str:
+    """The client a sync request is counted against: its device, else the user of its
+    credentials, else its address. Read before the credentials are checked, so a checked
+    user isn't needed to be turned away"""
+    device_id = sync_sessions.get_device_id(headers)
+    if device_id is not None:
+        return f'device:{device_id}'
+
+    email = _get_basic_auth_email(headers)
+    if email is not None:
+        return f'user:{email.lower()}'
+
+    return f'addr:{remote_addr}'
+
+
+def rejected_response(err: Rejected):
+    response = jsonify(err.to_dict())
+    response.status_code = err.status_code
+    response.headers['Retry-After'] = str(err.retry_after)
+    return response
+
+
+def admitted(gate: Gate):
+    """Serves the Flask route once let in by the gate, or answers with a 429 or 503"""
+
+    def decorator(f):
+        @functools.wraps(f)
+        def func(*args, **kwargs):
+            client = get_client(request.headers, request.remote_addr)
+            try:
+                with gate.admit(client):
+                    return f(*args, **kwargs)
+            except Rejected as err:
+                return rejected_response(err)
+
+        return func
+
+    return decorator
@@ -0,0 +1,111 @@
+"""Cache of the delta bundle shared by the sync pulls.
+
+When enabled (`SYNC_BUNDLE_TTL` seconds, off by default), the records changed since the
+oldest watermark of the devices that pulled within `SYNC_BUNDLE_HORIZON_HOURS` are read
+once, and every pull they cover is cut out of them for the next `SYNC_BUNDLE_TTL`
+seconds. When 50 tablets sync as the clinic opens, the first pull reads the bundle while
+the others wait for it.
+
+The bundle is kept per process. A pull served from it gets the bundle's timestamp and
+cursor, so the changes made since it was read come with the next pull."""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import Callable, Mapping
+
+from psycopg import Connection
+
+from hikmahealth.entity.sync import SyncToClient, get_change_seq_cursor
+from hikmahealth.server.client import db
+from hikmahealth.server.helpers import sync_sessions
+from hikmahealth.sync.bundle import Bundle
+from hikmahealth.utils.datetime import utc
+
+TTL = float(os.environ.get('SYNC_BUNDLE_TTL', 0))
+HORIZON = datetime.timedelta(hours=float(os.environ.get('SYNC_BUNDLE_HORIZON_HOURS', 24)))
+
+
+class BundleCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._bundle: Bundle | None = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def _is_fresh(self) -> bool:
+        return time.monotonic() - self._built_at < self.ttl
+
+    def get_or_build(self, build: Callable[[], Bundle | None]) -> Bundle | None:
+        """Returns the bundle, building it if it expired. Concurrent callers wait for
+        the one building it."""
+        if self._is_fresh():
+            return self._bundle
+
+        with self._lock:
+            if not self._is_fresh():
+                try:
+                    self._bundle = build()
+                except Exception:
+                    # a failed build isn't retried before the ttl either
+                    self._bundle = None
+                    raise
+                finally:
+                    self._built_at = time.monotonic()
+
+            return self._bundle
+
+    def clear(self):
+        with self._lock:
+            self._bundle = None
+            self._built_at = 0.0
+
+
+cache = BundleCache(TTL)
+
+
+def build_bundle(
+    conn: Connection,
+    entities: Mapping[str, type[SyncToClient]],
+    horizon: datetime.timedelta = HORIZON,
+) -> Bundle | None:
+    """Reads the records changed since the oldest watermark of the devices that pulled
+    within the horizon. Returns `None` if no device did."""
+    since, since_change_seq = sync_sessions.get_scheduled_watermarks(conn, horizon)
+    if since is None:
+        return None
+
+    # read before the records, so nothing committed in between is skipped
+    timestamp = utc.now()
+    change_seq = get_change_seq_cursor(conn)
+
+    return Bundle(
+        since=since,
+        since_change_seq=since_change_seq,
+        timestamp=timestamp,
+        change_seq=change_seq,
+        records={
+            key: entity.get_changed_records(since, since_change_seq, conn)
+            for key, entity in entities.items()
+        },
+    )
+
+
+def get_bundle(entities: Mapping[str, type[SyncToClient]]) -> Bundle | None:
+    """Returns the shared bundle, or `None` if it's disabled or can't be built."""
+    if cache.ttl <= 0:
+        return None
+
+    def build():
+        with db.get_pooled_connection() as conn:
+            return build_bundle(conn, entities)
+
+    try:
+        return cache.get_or_build(build)
+    except Exception as err:
+        logging.warning(f'failed to build the sync bundle: {err}')
+        return None
@@ -0,0 +1,59 @@
+"""Metrics of the sync pulls and pushes, by entity. See `hikmahealth.utils.metrics`."""
+
+from __future__ import annotations
+
+from typing import Mapping
+
+from hikmahealth.utils import metrics
+
+RECORDS = metrics.counter(
+    'hh_sync_records_total',
+    'Records sent by the sync pulls, and received by the pushes',
+    ['direction', 'entity', 'change'],
+)
+REQUESTS = metrics.counter(
+    'hh_sync_requests_total', 'Sync pulls and pushes served', ['direction']
+)
+BYTES = metrics.counter(
+    'hh_sync_bytes_total',
+    'Size of the bodies of the pull responses, and of the push requests',
+    ['direction'],
+)
+DURATION = metrics.histogram(
+    'hh_sync_duration_seconds',
+    'Time serving the sync pulls and pushes',
+    ['direction'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+PUSH_FAILURES = metrics.counter(
+    'hh_sync_push_failures_total', 'Sync pushes that failed to be applied'
+)
+
+
+def _count_records(direction: str, changes: Mapping[str, Mapping]):
+    for entity, delta in changes.items():
+        if not isinstance(delta, Mapping):
+            continue
+
+        for change in ('created', 'updated', 'deleted'):
+            records = delta.get(change, None) or ()
+            count = records if isinstance(records, int) else len(records)
+            if count:
+                RECORDS.inc(count, direction=direction, entity=entity, change=change)
+
+
+def record_pull(changes: Mapping[str, Mapping], size: int, elapsed: float):
+    """Counts a pull, given the `changes` sent and the size of the response"""
+    REQUESTS.inc(direction='pull')
+    BYTES.inc(size, direction='pull')
+    DURATION.observe(elapsed, direction='pull')
+    _count_records('pull', changes)
+
+
+def record_push(changes: Mapping[str, Mapping], size: int, elapsed: float):
+    """Counts a push applied, given the `changes` received (the records, or their
+    number) and the size of the request"""
+    REQUESTS.inc(direction='push')
+    BYTES.inc(size, direction='push')
+    DURATION.observe(elapsed, direction='push')
+    _count_records('push', changes)
@@ -0,0 +1,51 @@
+"""Applying a sync push, in a single transaction, in the order of its dependencies.
+
+The tables are applied in the stages given by `Sink.get_stages`, the tables referenced
+by another one first (the patients before their visits). The push is all or nothing:
+the tables are applied on a single connection, each batch in a savepoint.
+
+The tables aren't applied concurrently on connections of their own. Every pushed table
+references the patients (and most the visits) with foreign keys, and the rows of
+another uncommitted transaction aren't seen by them. So a push with its patients can't
+be split, and one without them only rarely."""
+
+from __future__ import annotations
+
+import datetime
+from typing import Mapping, Union
+
+from psycopg import Connection
+
+from hikmahealth.server.client import db
+from hikmahealth.server.helpers.push_body import SpooledDelta
+from hikmahealth.sync import DeltaData, Sink
+
+Changes = Union[DeltaData, SpooledDelta]
+
+
+def push_changes(
+    sink: Sink[Connection],
+    key: str,
+    delta: Changes,
+    last_synced_at: datetime.datetime,
+    conn: Connection,
+) -> None:
+    """Pushes the changes to a table. Changes read from a spooled body are pushed a
+    batch at a time, within the same transaction"""
+    batches = [delta] if isinstance(delta, DeltaData) else delta.batches()
+    for batch in batches:
+        sink.push(key, batch, last_synced_at, conn)
+
+
+def apply_push(
+    sink: Sink[Connection],
+    deltas: Mapping[str, Changes],
+    last_synced_at: datetime.datetime,
+) -> None:
+    """Applies the changes pushed by the app."""
+    with db.get_pooled_connection() as conn, conn.transaction():
+        for stage in sink.get_stages(deltas.keys()):
+            for key in stage:
+                push_changes(sink, key, deltas[key], last_synced_at, conn)
+
+    sink.committed(deltas.keys())
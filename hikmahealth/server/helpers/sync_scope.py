@@ -0,0 +1,55 @@
+"""Scope of the sync pulls of a user, from the `sync_scope` server variable.
+
+See `hikmahealth.sync.scope` for the configuration. It's read at most once every
+`SYNC_SCOPE_CONFIG_TTL` seconds per process, rather than on every pull."""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+
+from cachetools import TTLCache
+
+from hikmahealth.server.api.auth import User
+from hikmahealth.server.client.keeper import Keeper
+from hikmahealth.sync.scope import UNSCOPED, SyncScope, resolve
+
+KEY = 'sync_scope'
+CONFIG_TTL = float(os.environ.get('SYNC_SCOPE_CONFIG_TTL', 60))
+
+_config: TTLCache = TTLCache(maxsize=1, ttl=CONFIG_TTL)
+_lock = threading.Lock()
+
+
+def get_config(kp: Keeper) -> dict | None:
+    with _lock:
+        try:
+            return _config[KEY]
+        except KeyError:
+            pass
+
+    config = kp.get(KEY)
+    if config is not None and not isinstance(config, dict):
+        logging.warning(f'ignored the `{KEY}` server variable, expected a json object')
+        config = None
+
+    with _lock:
+        _config[KEY] = config
+
+    return config
+
+
+def get_scope(kp: Keeper, user: User) -> SyncScope:
+    """Returns the scope of the user's pulls. An invalid configuration is logged, and
+    leaves the pulls unscoped."""
+    try:
+        return resolve(get_config(kp), user.role, getattr(user, 'clinic_id', None))
+    except ValueError as err:
+        logging.warning(f'ignored the `{KEY}` server variable: {err}')
+        return UNSCOPED
+
+
+def clear():
+    with _lock:
+        _config.clear()
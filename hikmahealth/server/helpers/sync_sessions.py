@@ -0,0 +1,156 @@
+"""Registry of the devices syncing with the server.
+
+A session is kept per user and device (the `X-Device-Id` header sent by the app), with
+the watermarks, sizes and durations of its last pull and push. Recording is best effort:
+a failure is logged, and never fails the sync."""
+
+from __future__ import annotations
+
+import datetime
+import logging
+
+from psycopg import Connection
+from psycopg.rows import dict_row
+
+from hikmahealth.utils.errors import WebError
+
+DEVICE_ID_HEADER = 'X-Device-Id'
+MAX_DEVICE_ID_LENGTH = 128
+
+STALE_AFTER = datetime.timedelta(days=3)
+"""Time without a pull after which a device is reported as stale"""
+
+
+def get_device_id(headers) -> str | None:
+    device_id = headers.get(DEVICE_ID_HEADER, None)
+    if device_id is None or device_id.strip() == '':
+        return None
+
+    if len(device_id) > MAX_DEVICE_ID_LENGTH:
+        raise WebError(f'{DEVICE_ID_HEADER} is longer than {MAX_DEVICE_ID_LENGTH}', 400)
+
+    return device_id.strip()
+
+
+def record_pull(
+    conn: Connection,
+    user_id: str,
+    device_id: str,
+    pulled_until: datetime.datetime,
+    change_seq: int | None,
+    size: int,
+    duration_ms: int,
+    user_agent: str | None = None,
+) -> None:
+    """Records a pull, with the watermarks handed back to the device."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO sync_sessions
+                    (user_id, device_id, user_agent, last_pull_at, pulled_until, pulled_change_seq, last_pull_bytes, last_pull_ms, pull_count)
+                VALUES
+                    (%(user_id)s, %(device_id)s, %(user_agent)s, now(), %(pulled_until)s, %(change_seq)s, %(size)s, %(duration_ms)s, 1)
+                ON CONFLICT (user_id, device_id) DO UPDATE
+                SET user_agent = EXCLUDED.user_agent,
+                    last_pull_at = EXCLUDED.last_pull_at,
+                    pulled_until = EXCLUDED.pulled_until,
+                    pulled_change_seq = EXCLUDED.pulled_change_seq,
+                    last_pull_bytes = EXCLUDED.last_pull_bytes,
+                    last_pull_ms = EXCLUDED.last_pull_ms,
+                    pull_count = sync_sessions.pull_count + 1
+                """,
+                dict(
+                    user_id=user_id,
+                    device_id=device_id,
+                    user_agent=user_agent,
+                    pulled_until=pulled_until,
+                    change_seq=change_seq,
+                    size=size,
+                    duration_ms=duration_ms,
+                ),
+            )
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        logging.warning(f'failed to record the pull of device {device_id}: {err}')
+
+
+def record_push(
+    conn: Connection,
+    device_id: str,
+    last_pulled_at: datetime.datetime,
+    size: int,
+    duration_ms: int,
+) -> None:
+    """Records a push. Pushes aren't authenticated, so it goes to the session of the
+    device that pulled last."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE sync_sessions
+                SET last_push_at = now(),
+                    pushed_last_pulled_at = %(last_pulled_at)s,
+                    last_push_bytes = %(size)s,
+                    last_push_ms = %(duration_ms)s,
+                    push_count = push_count + 1
+                WHERE (user_id, device_id) = (
+                    SELECT user_id, device_id FROM sync_sessions
+                    WHERE device_id = %(device_id)s
+                    ORDER BY last_pull_at DESC NULLS LAST
+                    LIMIT 1
+                )
+                """,
+                dict(
+                    device_id=device_id,
+                    last_pulled_at=last_pulled_at,
+                    size=size,
+                    duration_ms=duration_ms,
+                ),
+            )
+        conn.commit()
+    except Exception as err:
+        conn.rollback()
+        logging.warning(f'failed to record the push of device {device_id}: {err}')
+
+
+def list_sessions(
+    conn: Connection, stale_after: datetime.timedelta = STALE_AFTER
+) -> list[dict]:
+    """Returns the sessions, the ones that haven't pulled for the longest first."""
+    with conn.cursor(row_factory=dict_row) as cur:
+        return cur.execute(
+            """
+            SELECT s.*, u.name AS user_name,
+                (s.last_pull_at IS NULL OR s.last_pull_at < now() - %s) AS is_stale
+            FROM sync_sessions s
+            LEFT JOIN users u ON u.id = s.user_id
+            ORDER BY s.last_pull_at ASC NULLS FIRST
+            """,
+            (stale_after,),
+        ).fetchall()
+
+
+def get_scheduled_watermarks(
+    conn: Connection, horizon: datetime.timedelta
+) -> tuple[datetime.datetime | None, int | None]:
+    """Returns the oldest watermarks handed to the devices that pulled within the
+    horizon, as the time and `change_seq` they'll pull from next."""
+    with conn.cursor() as cur:
+        row = cur.execute(
+            """
+            SELECT
+                count(*),
+                greatest(min(pulled_until), now() - %(horizon)s),
+                min(pulled_change_seq)
+            FROM sync_sessions
+            WHERE last_pull_at > now() - %(horizon)s
+            """,
+            dict(horizon=horizon),
+        ).fetchone()
+
+    if row is None or row[0] == 0:
+        return None, None
+
+    return row[1], row[2]
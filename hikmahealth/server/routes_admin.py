@@ -1,22 +1,40 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta
 import logging
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, send_file, stream_with_context
 
 
+from hikmahealth.server import config
 from hikmahealth.server.api import middleware, auth
-from hikmahealth.server.client import db
+from hikmahealth.server.client import db, profiler, slow_queries
+from hikmahealth.server.client.keeper import get_keeper
+from hikmahealth.server.client.resources import (
+    ResourceNotFound,
+    ResourceStoreTypeMismatchError,
+    get_resource_manager,
+)
+from hikmahealth.dump import export as dumpexport
+from hikmahealth.dump import restore as dumprestore
+from hikmahealth.dump import tables as dumptables
+from hikmahealth.dump import watermarks
+from hikmahealth.jobs import handlers as jobhandlers
+from hikmahealth.jobs import queue as jobqueue
+from hikmahealth.jobs import registry as jobregistry
 from hikmahealth.server.helpers import web as webhelper
+from hikmahealth.server.helpers import patient_chart, sync_sessions
 
-from hikmahealth.entity import hh
+from hikmahealth.entity import hh, softdelete
 import hikmahealth.entity.fields as f
 
+from hikmahealth.utils import jsonstream, metrics
 from hikmahealth.utils.misc import convert_dict_keys_to_snake_case, convert_operator
 from hikmahealth.utils.errors import WebError
 from psycopg import Error as PostgresError
 
 from dataclasses import dataclass, asdict
 
+import itertools
 import json
+import tempfile
 
 import uuid
 import bcrypt
@@ -405,6 +423,26 @@ def get_single_patient(_, id: str):
     return jsonify({'patient': patient})
 
 
+@api.get('/patients/<id>/chart')
+@middleware.authenticated_admin
+def get_patient_chart(_, id: str):
+    """Returns the patient, with their attributes, visits, events, appointments and
+    prescriptions. Use `?fields=patient.given_name,visits` to only include some of them"""
+    try:
+        projection = patient_chart.parse_fields(request.args.get('fields', None))
+        chart = patient_chart.get_patient_chart(id, projection)
+    except ValueError as err:
+        raise WebError(str(err), 400)
+    except psycopg.errors.UndefinedColumn as err:
+        raise WebError(str(err).splitlines()[0], 400)
+
+    if chart is None:
+        return jsonify({'ok': False, 'message': 'Patient not found'}), 404
+
+    # the chart is already a JSON document
+    return Response(chart, mimetype='application/json')
+
+
 @api.route('/patients/<id>', methods=['DELETE'])
 @middleware.authenticated_admin
 def delete_patient(_, id: str):
@@ -422,31 +460,13 @@ def delete_patient(_, id: str):
                     return jsonify({'ok': False, 'message': 'Patient not found'}), 404
 
                 # Soft delete the patient and related data
-                tables = [
-                    'patients',
-                    'visits',
-                    'events',
-                    'appointments',
-                    'patient_additional_attributes',
-                    'prescriptions',
-                ]
-                deleted_counts = {}
-
-                for table in tables:
-                    cur.execute(
-                        f"""
-                        UPDATE {table}
-                        SET is_deleted = true, deleted_at = current_timestamp
-                        WHERE {'id' if table == 'patients' else 'patient_id'} = %s
-                        RETURNING id
-                        """,
-                        [id],
-                    )
-                    deleted_counts[table] = cur.rowcount
+                deleted_counts = softdelete.soft_delete_patients(cur, [id])
 
                 # Commit the transaction
                 cur.execute('COMMIT')
 
+            patient_chart.cache.invalidate([id])
+
             logging.info(
                 f'Patient {id} and related data soft deleted successfully: {deleted_counts}'
             )
@@ -1640,121 +1660,257 @@ def explore_data(_):
 @api.get('/database/export')
 @middleware.authenticated_admin
 def export_full_database(_):
-    """Downloads all data from the database in JSON format"""
-    try:
+    """Downloads all data from the database.
+
+    Without a `format`, the data is streamed as a single JSON document (schema version `1.0`).
+    With `?format=ndjson|csv&archive=zip|tar`, it's streamed as an archive holding one file per
+    table and a `manifest.json`.
+
+    With `?mode=incremental`, the archive only holds the rows changed after `since`, or after
+    the last export made for `target`."""
+    fmt = request.args.get('format', None)
+    archive = request.args.get('archive', dumpexport.ARCHIVE_ZIP)
+    mode = request.args.get('mode', None)
+    target = request.args.get('target', None)
+
+    if fmt is None and mode is None and target is None:
+        return Response(
+            stream_with_context(_stream_export(dumpexport.stream_json_document)),
+            mimetype='application/json',
+        )
+
+    fmt = fmt or dumpexport.FORMAT_NDJSON
+    _assert_export_options(fmt, archive)
+    kp = get_keeper()
+    since = _resolve_export_since(kp, mode, request.args.get('since', None), target)
+
+    return Response(
+        stream_with_context(
+            _stream_export(
+                dumpexport.stream_database_export,
+                fmt,
+                archive,
+                since=since,
+                target=target,
+                on_complete=lambda m: watermarks.save_export_watermark(kp, m),
+            )
+        ),
+        mimetype=dumpexport.MIMETYPES[archive],
+        headers={
+            'Content-Disposition': 'attachment; filename="{}"'.format(
+                dumpexport.archive_filename(archive)
+            )
+        },
+    )
+
+
+@api.post('/database/export')
+@middleware.authenticated_admin
+def export_full_database_to_store(_):
+    """Writes the database archive to the configured resource store, instead of
+    returning it in the response"""
+    options = request.get_json(silent=True) or dict()
+    fmt = options.get('format', dumpexport.FORMAT_NDJSON)
+    archive = options.get('archive', dumpexport.ARCHIVE_ZIP)
+    target = options.get('target', None)
+
+    _assert_export_options(fmt, archive)
+    kp = get_keeper()
+    since = _resolve_export_since(
+        kp, options.get('mode', None), options.get('since', None), target
+    )
+
+    rmgr = get_resource_manager()
+    if rmgr is None:
+        raise WebError('ResourceManager instance missing', status_code=412)
+
+    manifests = []
+    with tempfile.TemporaryFile() as file:
         with db.get_connection() as conn:
-            with conn.cursor(row_factory=dict_row) as cur:
-                # Define tables to export in order of dependencies
-                tables = [
-                    'clinics',
-                    'users',
-                    'patients',
-                    'patient_additional_attributes',
-                    'visits',
-                    'events',
-                    'event_forms',
-                    'patient_registration_forms',
-                    'appointments',
-                    'string_ids',
-                    'string_content',
-                    'prescriptions',
-                ]
-
-                data = {}
-
-                for table in tables:
-                    cur.execute(
-                        f"""
-                        SELECT *
-                        FROM {table}
-                        """
-                    )
-                    results = cur.fetchall()
-                    data[table] = results
+            size = dumpexport.export_database_to_file(
+                conn,
+                file,
+                fmt,
+                archive,
+                since=since,
+                target=target,
+                on_complete=manifests.append,
+            )
 
-                return jsonify({
-                    'exported_at': datetime.now(timezone.utc).isoformat(),
-                    'schema_version': '1.0',
-                    'data': data,
-                })
+        filename = dumpexport.archive_filename(archive)
+        results = rmgr.put_resources([
+            (
+                file,
+                lambda id: f'hh_exports/{id}/{filename}',
+                dumpexport.MIMETYPES[archive],
+            )
+        ])
+
+    # only once the archive is safely stored
+    watermarks.save_export_watermark(kp, manifests[0])
+
+    return jsonify({'ok': True, 'id': results[0]['Id'], 'bytes': size}), 201
+
+
+@api.get('/database/export/<rid>')
+@middleware.authenticated_admin
+def download_database_export(_, rid: str):
+    """Downloads an archive previously written to the resource store"""
+    rmgr = get_resource_manager()
+    if rmgr is None:
+        raise WebError('ResourceManager instance missing', status_code=412)
+
+    # spooled to disk, and sent from there, instead of held in memory
+    file = tempfile.TemporaryFile()
+    try:
+        mimetype = rmgr.download_resource_to_file(rid, file)
+    except (ResourceNotFound, ResourceStoreTypeMismatchError):
+        file.close()
+        return jsonify({'ok': False, 'message': 'Export not found'}), 404
+    except BaseException:
+        file.close()
+        raise
+    file.seek(0)
+
+    # the file is closed by the response once it's sent
+    return send_file(file, download_name=rid, mimetype=mimetype, as_attachment=True)
+
+
+def _assert_export_options(fmt: str, archive: str):
+    if fmt not in dumpexport.get_supported_formats():
+        raise WebError(
+            "unsupported format '{}'. expected one of: {}".format(
+                fmt, ', '.join(dumpexport.get_supported_formats())
+            ),
+            400,
+        )
+
+    if archive not in dumpexport.get_supported_archives():
+        raise WebError(
+            "unsupported archive '{}'. expected one of: {}".format(
+                archive, ', '.join(dumpexport.get_supported_archives())
+            ),
+            400,
+        )
 
+
+def _resolve_export_since(kp, mode: str | None, since: str | None, target: str | None):
+    try:
+        if target is not None:
+            watermarks.validate_target(target)
+
+        return watermarks.resolve_export_since(kp, mode, since, target)
+    except ValueError as err:
+        raise WebError(str(err), 400)
+
+
+def _stream_export(stream_fn, *args, **kwargs):
+    # the connection is held for as long as the response is being streamed
+    try:
+        with db.get_connection() as conn:
+            yield from stream_fn(conn, *args, **kwargs)
     except Exception as e:
+        # headers are already sent at this point, the client sees a truncated download
         logging.error(f'Error during database export: {str(e)}')
-        return jsonify({'error': 'An error occurred during export'}), 500
+        raise
 
 
 @api.post('/database/import')
 @middleware.authenticated_admin
 def import_full_database(_):
-    """Imports a full database dump, with transaction rollback on failure"""
+    """Imports a full database dump.
+
+    Archives created by the export (`zip` or `tar.gz`, sent as the raw request body) are
+    restored one table at a time, and can be resumed by uploading the same archive again.
+    JSON documents (schema version `1.0`) are imported within a single transaction."""
 
     if not request.is_json:
-        return jsonify({'error': 'Request must be JSON'}), 400
+        return _import_database_archive()
+
+    return _import_database_json()
+
+
+def _index_json_dump(file) -> tuple[dict[str, int | None], dict[str, int]] | None:
+    """Reads through a JSON dump. Returns the offset of the records of each table, and
+    their count, or `None` if it has no `data`"""
+    reader = jsonstream.Reader(file.read)
+    offsets: dict[str, int | None] | None = None
+    counts: dict[str, int] = dict()
+    for key in reader.iter_object():
+        if key != 'data' or reader.peek() != '{':
+            reader.skip_value()
+            continue
+
+        offsets = dict()
+        for table_name in reader.iter_object():
+            if reader.peek() != '[':
+                # no records
+                offsets[table_name] = None
+                counts[table_name] = 0
+                reader.skip_value()
+                continue
+
+            offsets[table_name] = reader.tell()
+            counts[table_name] = sum(1 for _ in reader.iter_array())
+
+    reader.end()
+    return (offsets, counts) if offsets is not None else None
+
+
+def _import_database_json():
+    """Imports a JSON dump, spooled then read a record at a time, as dumps are too large
+    to be decoded whole"""
+    too_large = f'The dump is larger than {config.IMPORT_MAX_BODY_BYTES} bytes'
+    if (request.content_length or 0) > config.IMPORT_MAX_BODY_BYTES:
+        return jsonify({'error': too_large}), 413
+
+    with tempfile.TemporaryFile() as file:
+        try:
+            dumprestore.spool_stream(request.stream, file, config.IMPORT_MAX_BODY_BYTES)
+        except dumprestore.ArchiveError:
+            return jsonify({'error': too_large}), 413
 
-    data = request.get_json()
+        try:
+            index = _index_json_dump(file)
+        except jsonstream.JSONStreamError as err:
+            return jsonify({'error': f'Invalid JSON: {err}'}), 400
+
+        if index is None:
+            return jsonify({'error': 'Missing data field'}), 400
+
+        offsets, counts = index
+        return _import_json_tables(file, offsets, counts)
 
-    if 'data' not in data:
-        return jsonify({'error': 'Missing data field'}), 400
 
-    tables = data['data']
+def _read_json_records(file, offset: int):
+    file.seek(offset)
+    return jsonstream.Reader(file.read).iter_array()
 
+
+def _import_json_tables(file, offsets: dict[str, int | None], counts: dict[str, int]):
     # Define columns that should be treated as JSON
-    json_columns = {
-        'events': ['form_data', 'metadata'],
-        'prescriptions': ['items', 'metadata'],
-        # "prescriptions": ["metadata"],
-        'event_forms': ['metadata'],
-        'patient_registration_forms': ['fields', 'metadata'],
-        'patients': ['additional_data', 'metadata'],
-        'patient_additional_attributes': ['metadata'],
-        'visits': ['metadata'],
-        'appointments': ['metadata'],
-    }
+    json_columns = dumptables.JSON_COLUMNS
 
     # Define primary key constraints for each table
-    table_primary_keys = {
-        'clinics': ['id'],
-        'users': ['id'],
-        'patients': ['id'],
-        # composite key
-        'prescriptions': ['id'],
-        'patient_additional_attributes': ['patient_id', 'attribute_id'],
-        'event_forms': ['id'],
-        'visits': ['id'],
-        'events': ['id'],
-        'patient_registration_forms': ['id'],
-        'appointments': ['id'],
-        'string_ids': ['id'],
-        'string_content': None,  # No UPSERT for this table
-    }
+    table_primary_keys = dumptables.PRIMARY_KEYS
 
     try:
         with db.get_connection() as conn:
             with conn.cursor() as cur:
                 cur.execute('BEGIN')
 
-                for table_name in [
-                    'clinics',
-                    'users',
-                    'patients',
-                    'patient_additional_attributes',
-                    'event_forms',
-                    'visits',
-                    'events',
-                    'patient_registration_forms',
-                    'appointments',
-                    'string_ids',
-                    'string_content',
-                    'prescriptions',
-                ]:
-                    if table_name not in tables:
+                for table_name in dumptables.TABLES:
+                    if table_name not in offsets:
                         raise Exception(f'Table {table_name} not found in data')
 
-                    records = tables[table_name]
-                    if not records:
+                    if offsets[table_name] is None or not counts[table_name]:
                         continue
 
-                    columns = records[0].keys()
+                    records = _read_json_records(file, offsets[table_name])
+                    first = next(records)
+                    records = itertools.chain([first], records)
+
+                    columns = first.keys()
                     column_str = ', '.join(f'"{col}"' for col in columns)
                     value_str = ', '.join(f'%({col})s' for col in columns)
 
@@ -1815,9 +1971,7 @@ def import_full_database(_):
                 return jsonify({
                     'ok': True,
                     'message': 'Database import completed successfully',
-                    'records_imported': {
-                        table: len(records) for table, records in tables.items()
-                    },
+                    'records_imported': counts,
                 })
 
     except Exception as e:
@@ -1830,11 +1984,271 @@ def import_full_database(_):
         }), 500
 
 
+def _import_database_archive():
+    too_large = f'The archive is larger than {config.IMPORT_MAX_BODY_BYTES} bytes'
+    if (request.content_length or 0) > config.IMPORT_MAX_BODY_BYTES:
+        return jsonify({'error': too_large}), 413
+
+    with tempfile.TemporaryFile() as file:
+        try:
+            dumprestore.spool_stream(request.stream, file, config.IMPORT_MAX_BODY_BYTES)
+        except dumprestore.ArchiveError:
+            return jsonify({'error': too_large}), 413
+
+        try:
+            reader = dumprestore.ArchiveReader(file)
+        except dumprestore.ArchiveError as err:
+            return jsonify({'error': str(err)}), 400
+
+        with reader:
+            kp = get_keeper()
+            key = dumprestore.progress_key(reader.manifest['export_id'])
+            progress = kp.get(key)
+
+            try:
+                watermarks.prepare_restore(
+                    kp, reader.manifest, force=request.args.get('force') == 'true'
+                )
+            except watermarks.IncrementalGapError as err:
+                return jsonify({'error': str(err)}), 409
+
+            try:
+                with db.get_connection() as conn:
+                    progress = dumprestore.restore_archive(
+                        conn,
+                        reader,
+                        progress,
+                        on_progress=lambda p: kp.set_json(key, p),
+                    )
+
+                watermarks.save_import_watermark(kp, reader.manifest)
+            except Exception as e:
+                logging.error(f'Error during database import: {str(e)}')
+                return jsonify({
+                    'error': 'An error occurred during import',
+                    'details': str(e),
+                    'progress': kp.get(key),
+                }), 500
+
+    return jsonify({
+        'ok': True,
+        'message': 'Database import completed successfully',
+        'progress': progress,
+    })
+
+
+@api.get('/database/import/<export_id>')
+@middleware.authenticated_admin
+def get_database_import_progress(_, export_id: str):
+    """Returns the progress of the restore of an exported archive"""
+    progress = get_keeper().get(dumprestore.progress_key(export_id))
+    if progress is None:
+        return jsonify({'ok': False, 'message': 'No import found for the export'}), 404
+
+    return jsonify({'ok': True, 'progress': progress})
+
+
+@api.post('/jobs')
+@middleware.authenticated_admin
+def enqueue_job(admin_user):
+    """Queues a job to be run by a worker.
+
+    Takes a JSON body `{"kind": ..., "params": {...}}`. For `database_import`, the archive
+    can instead be sent as the raw body (with `?kind=database_import`); it's saved to the
+    resource store before the job is queued."""
+    if request.is_json:
+        body = request.get_json()
+        kind = body.get('kind', None)
+        params = body.get('params', None) or dict()
+    else:
+        kind = request.args.get('kind', None)
+        params = dict()
+
+    if kind not in jobregistry.get_kinds():
+        raise WebError(
+            "unknown job kind '{}'. expected one of: {}".format(
+                kind, ', '.join(jobregistry.get_kinds())
+            ),
+            400,
+        )
+
+    if kind == jobhandlers.KIND_DATABASE_IMPORT and not request.is_json:
+        too_large = f'The archive is larger than {config.IMPORT_MAX_BODY_BYTES} bytes'
+        if (request.content_length or 0) > config.IMPORT_MAX_BODY_BYTES:
+            return jsonify({'error': too_large}), 413
+
+        rmgr = get_resource_manager()
+        if rmgr is None:
+            raise WebError('ResourceManager instance missing', status_code=412)
+
+        with tempfile.TemporaryFile() as file:
+            try:
+                dumprestore.spool_stream(
+                    request.stream, file, config.IMPORT_MAX_BODY_BYTES
+                )
+            except dumprestore.ArchiveError:
+                return jsonify({'error': too_large}), 413
+
+            (resource,) = rmgr.put_resources([
+                (
+                    file,
+                    lambda id: f'hh_imports/{id}',
+                    request.mimetype or 'application/octet-stream',
+                )
+            ])
+
+        params['resource_id'] = str(resource['Id'])
+
+    with db.get_connection() as conn:
+        job = jobqueue.enqueue(conn, kind, params, created_by=admin_user.id)
+
+    return jsonify({'ok': True, 'job': job.to_dict()}), 202
+
+
+@api.get('/jobs/<job_id>')
+@middleware.authenticated_admin
+def get_job(_, job_id: str):
+    """Returns the status and progress of a job"""
+    with db.get_connection() as conn:
+        job = jobqueue.get(conn, job_id)
+
+    if job is None:
+        return jsonify({'ok': False, 'message': 'Job not found'}), 404
+
+    return jsonify({'ok': True, 'job': job.to_dict()})
+
+
+@api.get('/jobs/<job_id>/result')
+@middleware.authenticated_admin
+def get_job_result(_, job_id: str):
+    """Returns the result of a completed job. If the job produced a file, the file is
+    downloaded instead"""
+    with db.get_connection() as conn:
+        job = jobqueue.get(conn, job_id)
+
+    if job is None:
+        return jsonify({'ok': False, 'message': 'Job not found'}), 404
+
+    if job.status != jobqueue.STATUS_COMPLETED:
+        return jsonify({
+            'ok': False,
+            'message': f'Job is {job.status}',
+            'job': job.to_dict(),
+        }), 409
+
+    result = job.result or dict()
+    if 'resource_id' not in result:
+        return jsonify({'ok': True, 'result': result})
+
+    rmgr = get_resource_manager()
+    if rmgr is None:
+        raise WebError('ResourceManager instance missing', status_code=412)
+
+    file = tempfile.TemporaryFile()
+    mimetype = rmgr.download_resource_to_file(result['resource_id'], file)
+    file.seek(0)
+
+    # the file is closed by the response once it's sent
+    return send_file(
+        file,
+        download_name=result.get('filename', result['resource_id']),
+        mimetype=mimetype,
+        as_attachment=True,
+    )
+
+
 # =============================================================================
 # END OF DATABASE IMPORT & EXPORT ENDPOINTS
 # =============================================================================
 
 
+@api.get('/sync/sessions')
+@middleware.authenticated_admin
+def get_sync_sessions(_):
+    """Returns the devices syncing with the server, the ones that haven't pulled for the
+    longest first. Use `?stale_after_hours=` to change when a device counts as stale"""
+    stale_after = sync_sessions.STALE_AFTER
+    if request.args.get('stale_after_hours', None) is not None:
+        try:
+            stale_after = timedelta(hours=float(request.args['stale_after_hours']))
+        except ValueError:
+            raise WebError('`stale_after_hours` must be a number', 400)
+
+    with db.get_connection() as conn:
+        sessions = sync_sessions.list_sessions(conn, stale_after)
+
+    return jsonify({'ok': True, 'sessions': sessions})
+
+
+@api.get('/metrics')
+@middleware.authenticated_admin_or_metrics_token
+def get_metrics(_):
+    """Returns the metrics of the server, of all its worker processes, in the Prometheus
+    text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@api.get('/profiles')
+@middleware.authenticated_admin
+def get_profiles(_):
+    """Returns the request profiles kept, newest first. See `PROFILE_SAMPLE_RATE` and
+    `PROFILE_SLOW_MS`"""
+    return jsonify({'ok': True, 'profiles': profiler.list_profiles(config.PROFILE_DIR)})
+
+
+@api.get('/profiles/<profile_id>')
+@middleware.authenticated_admin
+def get_profile(_, profile_id: str):
+    """Returns a request profile, with its SQL statements and stacks. Use
+    `?format=collapsed` to download the stacks alone, as read by flamegraph tools"""
+    profile = profiler.get_profile(config.PROFILE_DIR, profile_id)
+    if profile is None:
+        raise WebError('profile not found', 404)
+
+    if request.args.get('format', None) == 'collapsed':
+        return Response(
+            profile['collapsed'],
+            mimetype='text/plain',
+            headers={
+                'Content-Disposition': f'attachment; filename={profile_id}.collapsed'
+            },
+        )
+
+    return jsonify({'ok': True, 'profile': profile})
+
+
+@api.get('/slow_queries')
+@middleware.authenticated_admin
+def get_slow_queries(_):
+    """Returns the statements slower than `SLOW_QUERY_MS`, by fingerprint, with their
+    sampled plans. Use `?order=` (total, max, calls or recent) and `?limit=`"""
+    order = request.args.get('order', 'total')
+    if order not in slow_queries.ORDERS:
+        raise WebError(f'`order` must be one of {", ".join(slow_queries.ORDERS)}', 400)
+
+    try:
+        limit = min(int(request.args.get('limit', 50)), 500)
+    except ValueError:
+        raise WebError('`limit` must be a number', 400)
+
+    # the statements recorded by this process since its last save
+    slow_queries.flush()
+    with db.get_connection() as conn:
+        statements = slow_queries.list_slow_queries(conn, order, limit)
+
+    return jsonify({'ok': True, 'slow_queries': statements})
+
+
+@api.delete('/slow_queries')
+@middleware.authenticated_admin
+def reset_slow_queries(_):
+    """Forgets the slow statements recorded, as after adding an index"""
+    with db.get_connection() as conn:
+        slow_queries.reset(conn)
+
+    return jsonify({'ok': True})
+
+
 # AHR Specific Analysis Routes - used for experimenting with analysis endpoints
 # Required outputs:
 # 1. Patients breakdown by sex and age (age uses the date_of_birth field combined with the "age" dynamic field in patient_additional_attributes table)
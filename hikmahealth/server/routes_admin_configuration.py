@@ -5,7 +5,10 @@ from flask import Blueprint, jsonify, request
 
 from hikmahealth.server.api import middleware
 from hikmahealth.server.client.keeper import get_keeper
-from hikmahealth.server.client.resources import get_config_from_keeper
+from hikmahealth.server.client.resources import (
+    get_config_from_keeper,
+    reset_resource_manager,
+)
 from hikmahealth.utils.errors import WebError
 from hikmahealth.utils.textparse import parse_config
 
@@ -192,4 +195,7 @@ def set_storage_configuration(_):
         for key, value in var_map.items():
             keeper.set_str(key, value)
 
+    # the store is set up again with the new configuration on next use
+    reset_resource_manager()
+
     return jsonify(ok=True), 201
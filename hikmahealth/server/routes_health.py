@@ -0,0 +1,234 @@
+"""Probes of the instance, for the load balancers and orchestrators.
+
+- `GET /health/live`: the process serves requests. Never touches the database
+- `GET /health/ready`: the instance can take traffic. 503 until the warm-up is done,
+  or while the database is unreachable, its pool saturated or its schema behind the
+  revision of the code. A schema ahead of it, as migrated for the next release during
+  a rolling deploy, leaves the instances of the running release ready
+
+The warm-up runs once per process, as set by `HH_STARTUP_MODE` (see `startup`), or in
+the background from the first readiness probe, which only reports its state. It opens
+the connection pool of the sync routes, initializes the resource manager, primes the
+cached server variables, and plans the pull queries on a connection of the pool."""
+
+from __future__ import annotations
+
+import functools
+import logging
+import os
+import threading
+
+from flask import Blueprint, jsonify
+from psycopg import sql
+
+from hikmahealth.server import config, startup
+from hikmahealth.server.client import db
+from hikmahealth.server.client.keeper import new_keeper
+from hikmahealth.server.client.resources import (
+    get_resource_manager,
+    get_resource_manager_state,
+)
+from hikmahealth.server.helpers import sync_scope
+from hikmahealth.sync.scope import UNSCOPED
+from hikmahealth.utils.datetime import utc
+
+api = Blueprint('health', __name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_warm_up_lock = threading.Lock()
+_warmed_up = False
+_warm_up_state = 'pending'
+"""One of `pending`, `running`, `failed` or `done`"""
+_warm_up_thread: threading.Thread | None = None
+_warm_up_start_lock = threading.Lock()
+
+
+@functools.cache
+def get_schema_revisions() -> tuple[tuple[str, ...], frozenset[str]] | None:
+    """Head revisions of the migrations shipped with the code, and all of their
+    revisions. `None` if unknown"""
+    try:
+        from alembic.config import Config
+        from alembic.script import ScriptDirectory
+
+        alembic_config = Config()
+        alembic_config.set_main_option(
+            'script_location', os.path.join(ROOT, 'migrations')
+        )
+        script = ScriptDirectory.from_config(alembic_config)
+        known = frozenset(r.revision for r in script.walk_revisions())
+        return tuple(script.get_heads()), known
+    except Exception as err:
+        logging.warning(f'failed to read the migration heads: {err}')
+        return None
+
+
+def get_schema_heads() -> tuple[str, ...] | None:
+    """Head revisions of the migrations shipped with the code, `None` if unknown"""
+    revisions = get_schema_revisions()
+    return None if revisions is None else revisions[0]
+
+
+def get_schema_state(
+    revisions: list[str], heads: tuple[str, ...], known: frozenset[str]
+) -> str:
+    """`current` when the database is at the heads of the code, `ahead` when it's at
+    revisions the code doesn't ship, as migrated by a newer release, else `behind`"""
+    if not revisions or any(r in known and r not in heads for r in revisions):
+        return 'behind'
+
+    if all(r in known for r in revisions):
+        return 'current' if set(revisions) == set(heads) else 'behind'
+
+    return 'ahead'
+
+
+def _plan_pull_queries(conn):
+    """Plans the pull query of each entity. Warms the catalog caches of the connection,
+    and the building of the queries"""
+    from hikmahealth.server.routes_mobile import ENTITIES_TO_PUSH_TO_MOBILE
+
+    since = utc.from_unixtimestamp(0)
+    for entity in ENTITIES_TO_PUSH_TO_MOBILE.values():
+        query, params = entity.get_pull_query(UNSCOPED, since, None)
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL('EXPLAIN {}').format(query), params)
+
+
+def warm_up() -> bool:
+    """Gets the instance ready for traffic. Returns whether it is. Steps failing are
+    logged, and the warm-up is tried again by the next readiness probe if the database
+    wasn't reached."""
+    global _warmed_up, _warm_up_state
+    with _warm_up_lock:
+        if _warmed_up:
+            return True
+
+        _warm_up_state = 'running'
+        try:
+            with startup.timed('warm_up.pool'):
+                pool = db.get_connection_pool()
+                pool.wait(timeout=config.HEALTH_CHECK_TIMEOUT * 5)
+        except Exception as err:
+            logging.warning(f'warm up: the database pool failed to open: {err}')
+            _warm_up_state = 'failed'
+            return False
+
+        steps = {
+            'warm_up.resource_manager': _init_resource_manager,
+            'warm_up.server_variables': lambda: sync_scope.get_config(new_keeper()),
+            'warm_up.schema_heads': get_schema_revisions,
+            'warm_up.pull_queries': lambda: _with_pool_connection(_plan_pull_queries),
+        }
+        for step, run in steps.items():
+            try:
+                with startup.timed(step):
+                    run()
+            except Exception as err:
+                logging.warning(f'warm up: {step} failed: {err}')
+
+        _warmed_up = True
+        _warm_up_state = 'done'
+        return True
+
+
+def start_warm_up():
+    """Runs the warm-up on a thread, unless it's done or already running"""
+    global _warm_up_thread
+    with _warm_up_start_lock:
+        if _warmed_up or _warm_up_lock.locked():
+            return
+        if _warm_up_thread is not None and _warm_up_thread.is_alive():
+            return
+
+        _warm_up_thread = threading.Thread(
+            target=warm_up, name='hh-warm-up', daemon=True
+        )
+        _warm_up_thread.start()
+
+
+def _init_resource_manager():
+    try:
+        get_resource_manager()
+    except Exception:
+        # reported by its state
+        pass
+
+
+def _with_pool_connection(f):
+    with db.get_pooled_connection(config.HEALTH_CHECK_TIMEOUT) as conn:
+        f(conn)
+        conn.rollback()
+
+
+def _check_database() -> dict:
+    pool = db.get_connection_pool()
+    with pool.connection(timeout=config.HEALTH_CHECK_TIMEOUT) as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+            try:
+                revisions = [
+                    r[0] for r in cur.execute('SELECT version_num FROM alembic_version')
+                ]
+            except Exception:
+                # not migrated with alembic
+                revisions = None
+        conn.rollback()
+
+    stats = pool.get_stats()
+    waiting = stats.get('requests_waiting', 0)
+    schema = get_schema_revisions()
+    heads = None if schema is None else schema[0]
+
+    state = None
+    if schema is not None and revisions is not None:
+        state = get_schema_state(revisions, *schema)
+
+    schema_ok = state != 'behind'
+    return dict(
+        ok=schema_ok and waiting < config.READY_MAX_POOL_WAITING,
+        pool=dict(
+            size=stats.get('pool_size', 0),
+            available=stats.get('pool_available', 0),
+            waiting=waiting,
+        ),
+        schema=dict(ok=schema_ok, state=state, revisions=revisions, expected=heads),
+    )
+
+
+def check_readiness() -> tuple[bool, dict]:
+    """Returns whether the instance is ready, and the result of each check. Never waits
+    on the warm-up: it's started if needed, and its state reported"""
+    if not _warmed_up:
+        state = _warm_up_state
+        start_warm_up()
+        return False, dict(warm_up=dict(ok=False, state=state))
+
+    checks = dict()
+    try:
+        checks['database'] = _check_database()
+    except Exception as err:
+        checks['database'] = dict(ok=False, error=str(err))
+
+    # the store isn't needed by the sync. a store failing or never configured is
+    # reported, but leaves the instance ready
+    if get_resource_manager_state() == 'not_initialized':
+        # reset since the warm-up, by a change of the store configuration
+        _init_resource_manager()
+
+    state = get_resource_manager_state()
+    checks['storage'] = dict(ok=state != 'not_initialized', state=state)
+
+    return all(c['ok'] for c in checks.values()), checks
+
+
+@api.get('/live')
+def live():
+    return jsonify({'ok': True})
+
+
+@api.get('/ready')
+def ready():
+    is_ready, checks = check_readiness()
+    return jsonify({'ok': is_ready, 'checks': checks}), 200 if is_ready else 503
@@ -2,12 +2,12 @@ from io import BytesIO
 import logging
 import os
 from uuid import uuid1
-from boto3 import resource
 from flask import Blueprint, request, Request, jsonify, abort, send_file
 from psycopg import Connection
 from psycopg.rows import dict_row
 
-from hikmahealth.entity.sync import SyncToClient
+from hikmahealth.entity.sync import SyncToClient, get_change_seq_cursor
+from hikmahealth.server import config
 from hikmahealth.server.client.keeper import get_keeper
 from hikmahealth.server.client.resources import (
     ResourceManager,
@@ -16,6 +16,19 @@ from hikmahealth.server.client.resources import (
     get_resource_manager,
 )
 from hikmahealth.server.helpers import web as webhelper
+from hikmahealth.server.helpers import (
+    column_changes,
+    delta_cache,
+    patient_chart,
+    push_body,
+    push_log,
+    sync_admission,
+    sync_bundle,
+    sync_push,
+    sync_metrics,
+    sync_scope,
+    sync_sessions,
+)
 
 from hikmahealth.server.api.auth import User
 from hikmahealth.server.api import auth as auth
@@ -33,7 +46,6 @@ from hikmahealth import sync
 from datetime import datetime
 
 from typing import Iterable
-from collections import defaultdict
 import traceback
 
 
@@ -63,7 +75,8 @@ def reset_password():
     })
 
 
-def _get_authenticated_user_from_request(request: Request) -> User:
+def _get_credentials_from(request: Request) -> tuple[str, str]:
+    """Returns the email and password of the basic `Authorization` header"""
     auth_header = request.headers.get('Authorization')
     encoded_username_password = auth_header.split(' ')[1]
 
@@ -72,6 +85,11 @@ def _get_authenticated_user_from_request(request: Request) -> User:
 
     # Split the decoded string into email and password
     email, password = decoded_username_password.split(':')
+    return email, password
+
+
+def _get_authenticated_user_from_request(request: Request) -> User:
+    email, password = _get_credentials_from(request)
 
     u = auth.get_user_from_email(email, password)
     return u
@@ -103,6 +121,19 @@ def _get_last_pulled_at_from(request: Request) -> datetime | None:
     return None
 
 
+def _get_last_change_seq_from(request: Request) -> int | None:
+    """Uses the `last_change_seq` part of the request query, as returned by the last pull"""
+    last_change_seq = request.args.get('last_change_seq', None)
+
+    if last_change_seq is None or last_change_seq == '':
+        return None
+
+    if not last_change_seq.isnumeric():
+        raise WebError('`last_change_seq` must be a number', 400)
+
+    return int(last_change_seq)
+
+
 # list of entities to get the diff from
 ENTITIES_TO_PUSH_TO_MOBILE: dict[str, SyncToClient] = {
     'events': hh.Event,
@@ -121,32 +152,105 @@ ENTITIES_TO_PUSH_TO_MOBILE: dict[str, SyncToClient] = {
 
 @backcompatapi.route('/v2/sync', methods=['GET'])
 @api.route('/sync', methods=['GET'])
+@sync_admission.admitted(sync_admission.PULLS)
 def sync_v2_pull():
-    _get_authenticated_user_from_request(request)
+    user = _get_authenticated_user_from_request(request)
+    device_id = sync_sessions.get_device_id(request.headers)
     last_synced_at = _get_last_pulled_at_from(request)
     schemaVersion = request.args.get('schemaVersion', None)
     migration = request.args.get('migration', None)
 
+    last_change_seq = _get_last_change_seq_from(request)
+
     if last_synced_at is None:
         raise WebError('missing last_pulled_at from request query', 400)
 
+    started = time.monotonic()
     changes_to_push_to_client = dict()
 
-    with db.get_connection() as conn:
-        for changekey, c in ENTITIES_TO_PUSH_TO_MOBILE.items():
-            # getNthTimeSyncData
-            # --------
-            deltadata = c.get_delta_records(last_synced_at, conn)
+    # users scoped to some clinics get their own records, so their pulls don't share
+    # the bundle or the cached records
+    scope = sync_scope.get_scope(get_keeper(), user)
 
-            # if not deltadata.is_empty:
-            # formatGETSyncResponse
-            # --------
-            changes_to_push_to_client[changekey] = deltadata.to_dict()
+    # pulls covered by the shared bundle are cut out of it, without querying
+    bundle = (
+        sync_bundle.get_bundle(ENTITIES_TO_PUSH_TO_MOBILE) if scope.is_unscoped else None
+    )
+    if bundle is not None and bundle.covers(last_synced_at, last_change_seq):
+        for changekey in ENTITIES_TO_PUSH_TO_MOBILE.keys():
+            changes_to_push_to_client[changekey] = bundle.get_delta(
+                changekey, last_synced_at, last_change_seq
+            ).to_dict()
+
+        change_seq = bundle.change_seq
+        timestamp = bundle.timestamp.timestamp() * 1000
+    elif scope.is_unscoped and delta_cache.cache.enabled and ENTITIES_TO_PUSH_TO_MOBILE:
+        # concurrent pulls from the same window share the records read
+        with db.get_pooled_connection() as conn:
+            changes_to_push_to_client, pulled_at, change_seq = delta_cache.get_deltas(
+                conn, ENTITIES_TO_PUSH_TO_MOBILE, last_synced_at, last_change_seq
+            )
+
+        timestamp = pulled_at.timestamp() * 1000
+    else:
+        with db.get_pooled_connection() as conn:
+            # read before the records, so nothing committed in between is skipped
+            change_seq = get_change_seq_cursor(conn)
+
+            for changekey, c in ENTITIES_TO_PUSH_TO_MOBILE.items():
+                # getNthTimeSyncData
+                # --------
+                deltadata = c.get_scoped_delta_records(
+                    scope, last_synced_at, last_change_seq, conn
+                )
 
-    # server generated timestamp for the current data changes
-    timestamp = _get_timestamp_now()
+                # if not deltadata.is_empty:
+                # formatGETSyncResponse
+                # --------
+                changes_to_push_to_client[changekey] = deltadata.to_dict()
+
+        # server generated timestamp for the current data changes
+        timestamp = _get_timestamp_now()
+
+    # records joining a scope are sent whole, without being changed, so scoped pulls
+    # don't get patches
+    if scope.is_unscoped and column_changes.supports_patches(schemaVersion):
+        with db.get_pooled_connection() as conn:
+            changes_to_push_to_client = column_changes.patch_changes(
+                conn,
+                ENTITIES_TO_PUSH_TO_MOBILE,
+                changes_to_push_to_client,
+                last_change_seq,
+            )
+
+    response = jsonify({
+        'changes': changes_to_push_to_client,
+        'timestamp': timestamp,
+        # clients sending it back as `last_change_seq` get the changes by sequence
+        # instead of by timestamp
+        'change_seq': change_seq,
+    })
 
-    return jsonify({'changes': changes_to_push_to_client, 'timestamp': timestamp})
+    sync_metrics.record_pull(
+        changes_to_push_to_client,
+        response.content_length or 0,
+        time.monotonic() - started,
+    )
+
+    if device_id is not None:
+        with db.get_pooled_connection() as conn:
+            sync_sessions.record_pull(
+                conn,
+                user.id,
+                device_id,
+                utc.from_unixtimestamp(int(timestamp)),
+                change_seq,
+                response.content_length or 0,
+                int((time.monotonic() - started) * 1000),
+                request.headers.get('User-Agent'),
+            )
+
+    return response
 
 
 def _get_timestamp_now():
@@ -159,12 +263,16 @@ sink = sync.Sink[Connection]()
 
 # queues the syncing operation and checks
 # if the arguments are implement the right stuff
+# the tables referenced by another table are listed in its `depends_on`, so they are
+# applied first
 sink.add('patients', hh.Patient)
-sink.add('patient_additional_attributes', hh.PatientAttribute)
-sink.add('visits', hh.Visit)
-sink.add('events', hh.Event)
-sink.add('appointments', hh.Appointment)
-sink.add('prescriptions', hh.Prescription)
+sink.add('patient_additional_attributes', hh.PatientAttribute, depends_on=['patients'])
+sink.add('visits', hh.Visit, depends_on=['patients'])
+sink.add('events', hh.Event, depends_on=['patients', 'visits'])
+sink.add('appointments', hh.Appointment, depends_on=['patients', 'visits'])
+sink.add('prescriptions', hh.Prescription, depends_on=['patients', 'visits'])
+# the pulls stop serving the records cached for the tables written
+sink.add_listener(delta_cache.invalidate)
 # To make a new table syncable, be sure to include it here
 # Ex.
 #   class NewTableEntity:
@@ -172,11 +280,12 @@ sink.add('prescriptions', hh.Prescription)
 #           # sync logic here
 #           pass
 #
-#   sink.add('<table_id>', NewTableEntity)
+#   sink.add('<table_id>', NewTableEntity, depends_on=['patients'])
 
 
 @backcompatapi.route('/v2/sync', methods=['POST'])
 @api.route('/sync', methods=['POST'])
+@sync_admission.admitted(sync_admission.PUSHES)
 def sync_v2_push():
     # _get_authenticated_user_from_request(request)
     last_synced_at = _get_last_pulled_at_from(request)
@@ -186,33 +295,103 @@ def sync_v2_push():
     if last_synced_at is None:
         raise WebError('missing `last_pulled_at` from request query', 400)
 
+    device_id = sync_sessions.get_device_id(request.headers)
+    started = time.monotonic()
+
     # expected body structure
     # { [s in 'events' | 'patients' | ....]: { "created": Array<dict[str, any]>, "updated": Array<dict[str, any]>, deleted: []str }}
-    body = dict(request.get_json())
+    # the body is spooled and read a batch of records at a time, rather than decoded
+    # whole, as the pushes of tablets long offline get large
+    if (request.content_length or 0) > config.SYNC_PUSH_MAX_BODY_BYTES:
+        raise WebError(
+            f'The push is larger than {config.SYNC_PUSH_MAX_BODY_BYTES} bytes', 413
+        )
+
+    with push_body.spool(
+        request.stream, request.query_string, config.SYNC_PUSH_MAX_BODY_BYTES
+    ) as spooled:
+        push = push_body.scan(
+            spooled, config.SYNC_PUSH_MAX_RECORDS, config.SYNC_PUSH_BATCH_SIZE
+        )
+        return _apply_push(push, spooled, last_synced_at, device_id, started)
+
+
+def _apply_push(
+    push: push_body.Push,
+    spooled: push_body.SpooledBody,
+    last_synced_at: datetime,
+    device_id: str | None,
+    started: float,
+):
+    # a retried push is answered with the response recorded the first time
+    fingerprint, body_hash = push_log.get_fingerprint_from_hash(
+        spooled.body_hash, request.headers.get('Idempotency-Key')
+    )
+    with db.get_pooled_connection() as conn:
+        push_log.maybe_prune(conn)
+        column_changes.maybe_prune(conn)
+        claim = push_log.claim(conn, fingerprint, body_hash)
+
+    if claim.response is not None:
+        response = jsonify(claim.response)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    if claim.in_progress:
+        response = jsonify({'message': 'The same push is already being applied'})
+        response.status_code = 409
+        response.headers['Retry-After'] = '5'
+        return response
 
-    with db.get_connection() as conn:
-        try:
-            for key, newdeltajson in body.items():
-                # get the entity delta values
-                deltadata = defaultdict(None, newdeltajson)
-
-                # package delta data
-                deltadata = sync.DeltaData(
-                    created=deltadata.get('created'),
-                    updated=deltadata.get('updated'),
-                    # deleted=[{"id": id } for id in deltadata.get("deleted")] if deltadata.get("deleted") is not None else None,
-                    deleted=deltadata.get('deleted'),
-                )
+    try:
+        sync_push.apply_push(sink, push.deltas, last_synced_at)
+    except Exception as err:
+        _release_push(fingerprint)
+        sync_metrics.PUSH_FAILURES.inc()
+        print(err)
+        print(traceback.format_exc())
+        abort(500, description='An internal error occurred')
+
+    _invalidate_patient_charts(push.summary)
+    sync_metrics.record_push(push.counts, spooled.size, time.monotonic() - started)
+
+    result = {'ok': True, 'timestamp': utc.now().isoformat()}
+    with db.get_pooled_connection() as conn:
+        push_log.complete(conn, fingerprint, result)
+
+        if device_id is not None:
+            sync_sessions.record_push(
+                conn,
+                device_id,
+                last_synced_at,
+                spooled.size,
+                int((time.monotonic() - started) * 1000),
+            )
+
+    return jsonify(result)
+
+
+def _release_push(fingerprint: str):
+    try:
+        with db.get_pooled_connection() as conn:
+            push_log.release(conn, fingerprint)
+    except Exception as err:
+        # the claim is taken over once it times out
+        logging.warning(f'failed to release the sync push {fingerprint}: {err}')
 
-                sink.push(key, deltadata, last_synced_at, conn)
-            # after leaving the `with` context, there's an implied db.commit()
-        except Exception as err:
-            conn.close()
-            print(err)
-            print(traceback.format_exc())
-            abort(500, description='An internal error occurred')
 
-    return jsonify({'ok': True, 'timestamp': utc.now().isoformat()})
+def _invalidate_patient_charts(body: dict):
+    try:
+        if patient_chart.has_deleted_records(body):
+            with db.get_pooled_connection() as conn:
+                ids = patient_chart.get_pushed_patient_ids(body, conn)
+        else:
+            ids = patient_chart.get_pushed_patient_ids(body)
+
+        patient_chart.cache.invalidate(ids)
+    except Exception as err:
+        logging.warning(f'failed to find the patients in the push, clearing cache: {err}')
+        patient_chart.cache.clear()
 
 
 @api.route('/forms/resources', methods=['PUT'])
@@ -2,15 +2,21 @@ from flask import Flask, jsonify
 from flask_cors import CORS
 import logging
 
+# first, to time the import of the rest of the app
+from hikmahealth.server import startup
+
 from hikmahealth.server import (
     custom_routes_admin,
     routes_admin_configuration,
     routes_mobile,
     routes_admin,
+    routes_health,
     test_routes,
 )
 
+from hikmahealth.server.client.instrument import register_instrumentation
 from hikmahealth.server.client.keeper import register_keeper
+from hikmahealth.server.client.profiler import register_profiler
 from hikmahealth.server.client.resources import register_resource_manager
 from hikmahealth.utils.errors import WebError
 
@@ -22,6 +28,8 @@ CORS(app)
 
 register_keeper(app)
 register_resource_manager(app)
+register_instrumentation(app)
+register_profiler(app)
 
 
 # for backcompat
@@ -35,10 +43,14 @@ app.register_blueprint(
 )
 app.register_blueprint(routes_mobile.api, url_prefix='/v1/api')
 app.register_blueprint(test_routes.api, url_prefix='/v1/test')
+app.register_blueprint(routes_health.api, url_prefix='/health')
 # user admin extension routes
 # app.register_blueprint(custom_routes_admin.api, url_prefix="/v1/admin")
 
 
+startup.start({'warm_up': routes_health.warm_up})
+
+
 @app.route('/')
 def hello_world():
     return jsonify({'message': 'Welcome to the Hikma Health backend.', 'status': 'OK'})
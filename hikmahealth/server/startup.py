@@ -0,0 +1,88 @@
+"""Startup of the server: when the external services are first reached, and how long the
+steps took.
+
+`HH_STARTUP_MODE` sets when the resource manager (the database, then the cloud store) is
+initialized:
+
+- `lazy`, the default: on first use, by the first request needing it
+- `background`: by a thread started with the app, so instances scaling from zero take
+  requests right away
+- `eager`: while the app is created, failing loudly at startup
+
+The cloud SDKs are only imported for the store type configured. The time of each step is
+logged, and set in the `hh_startup_seconds` metric."""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import threading
+import time
+from typing import Callable, Iterator
+
+from hikmahealth.server import config
+from hikmahealth.utils import metrics
+
+_imported_at = time.perf_counter()
+
+MODE_LAZY = 'lazy'
+MODE_BACKGROUND = 'background'
+MODE_EAGER = 'eager'
+
+TIMINGS: dict[str, float] = {}
+"""Seconds spent in each startup step, by name"""
+
+STARTUP_SECONDS = metrics.gauge(
+    'hh_startup_seconds', 'Seconds spent in each step of the startup', ['step']
+)
+
+log = logging.getLogger('hikmahealth.startup')
+
+
+def get_mode() -> str:
+    mode = config.HH_STARTUP_MODE
+    if mode not in (MODE_LAZY, MODE_BACKGROUND, MODE_EAGER):
+        log.warning(f'unknown HH_STARTUP_MODE {mode!r}, using {MODE_LAZY!r}')
+        return MODE_LAZY
+
+    return mode
+
+
+def record(step: str, elapsed: float):
+    TIMINGS[step] = elapsed
+    STARTUP_SECONDS.set(elapsed, step=step)
+    log.info(f'startup: {step} took {elapsed * 1000:.0f}ms')
+
+
+@contextlib.contextmanager
+def timed(step: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(step, time.perf_counter() - started)
+
+
+def start(initializers: dict[str, Callable[[], None]]):
+    """Runs the initializers of the external services, as set by `HH_STARTUP_MODE`.
+    Called once the app is created, so the time since this module was imported is
+    recorded as the import of the app."""
+    record('import', time.perf_counter() - _imported_at)
+
+    mode = get_mode()
+    if mode == MODE_LAZY:
+        return
+
+    def run():
+        for step, initialize in initializers.items():
+            try:
+                with timed(step):
+                    initialize()
+            except Exception as err:
+                # left to be retried on first use
+                log.warning(f'startup: {step} failed: {err}')
+
+    if mode == MODE_EAGER:
+        run()
+    else:
+        threading.Thread(target=run, name='hh-warm-up', daemon=True).start()
@@ -1,6 +1,7 @@
 import dataclasses
 from abc import abstractmethod
 from io import BytesIO
+from typing import BinaryIO
 
 from hikmahealth.storage.objects import PutOutput
 
@@ -70,6 +71,11 @@ class BaseAdapter:
     def download_as_bytes(self, name: str, *args, **kwargs) -> BytesIO:
         raise NotImplementedError()
 
+    def download_to_file(self, name: str, file: BinaryIO, *args, **kwargs):
+        """Writes the contents of the object to `file`. Stores should override this to
+        avoid holding the whole object in memory"""
+        file.write(self.download_as_bytes(name, *args, **kwargs).getbuffer())
+
     @abstractmethod
-    def put(self, data: BytesIO, destination: str, *args, **kwargs) -> PutOutput:
+    def put(self, data: BinaryIO, destination: str, *args, **kwargs) -> PutOutput:
         raise NotImplementedError()
@@ -1,12 +1,17 @@
 from dataclasses import dataclass
 import dataclasses
+import io
 from io import BytesIO
-from google.cloud import storage
+from typing import TYPE_CHECKING, BinaryIO
 
 from hikmahealth.server.client.keeper import Keeper
 from hikmahealth.storage.objects import PutOutput
 from .base import BaseAdapter, BaseConfig
 
+if TYPE_CHECKING:
+    # the SDK is slow to import, and only needed once the store is configured
+    from google.cloud import storage
+
 
 # NOTE: might change this into a usuful function
 @dataclass
@@ -57,7 +62,7 @@ UNIQUE_STORE_NAME = 'gcp'
 class GCPStore(BaseAdapter):
     """Adapter that makes storage possible on the Google Cloud Platform (GCP) Cloud Storage"""
 
-    def __init__(self, bucket: storage.Bucket):
+    def __init__(self, bucket: 'storage.Bucket'):
         super().__init__(UNIQUE_STORE_NAME, '202503.01')
         self.bucket = bucket
 
@@ -65,17 +70,21 @@ class GCPStore(BaseAdapter):
         blob = self.bucket.blob(uri)
         return BytesIO(blob.download_as_bytes())
 
+    def download_to_file(self, uri: str, file: BinaryIO, *args, **kwargs):
+        blob = self.bucket.blob(uri)
+        blob.download_to_file(file)
+
     def put(
         self,
-        data: BytesIO,
+        data: BinaryIO,
         destination: str,
         mimetype: str | None = None,
         *args,
         **kwargs,
     ):
         """saves the data to a destination"""
-        assert isinstance(data, BytesIO), (
-            'data argument needs to be a type `BytesIO`. instead got {}'.format(
+        assert isinstance(data, io.IOBase), (
+            'data argument needs to be a binary file object. instead got {}'.format(
                 type(data)
             )
         )
@@ -84,7 +93,8 @@ class GCPStore(BaseAdapter):
         blob = self.bucket.blob(destination)
         assert blob.name is not None, 'name is create from the bucket name'
 
-        blob.upload_from_file(data, checksum='md5')
+        data.seek(0)
+        blob.upload_from_file(data, content_type=mimetype, checksum='md5')
 
         # maybe us @dataclass later
         return PutOutput(uri=blob.name, hash=('md5', blob.md5_hash))
@@ -3,7 +3,9 @@ from hikmahealth.storage.adapters import base
 """Providing adapters and resource support S3-compatible storages"""
 
 import dataclasses
+import io
 from io import BytesIO
+from typing import BinaryIO
 
 from hikmahealth.server.client.keeper import Keeper
 from hikmahealth.storage.adapters.base import BaseAdapter
@@ -92,22 +94,27 @@ class S3Store(BaseAdapter):
 
         return BytesIO(response['Body'].read())
 
+    def download_to_file(self, name: str, file: BinaryIO, *args, **kwargs):
+        self.s3.download_fileobj(self.bucket_name, name, file)
+
     def put(
-        self, data: BytesIO, destination: str, mimetype: str | None = None, **kwargs
+        self, data: BinaryIO, destination: str, mimetype: str | None = None, **kwargs
     ):
-        assert isinstance(data, BytesIO), (
-            'data argument needs to be a type `BytesIO`. instead got {}'.format(
+        assert isinstance(data, io.IOBase), (
+            'data argument needs to be a binary file object. instead got {}'.format(
                 type(data)
             )
         )
 
+        # passing the file object (as opposed to its contents) lets
+        # boto stream large files, like database exports
         data.seek(0)
         response = self.s3.put_object(
             ACL='private',
             Bucket=self.bucket_name,
             Key=destination,
             ContentType=mimetype,
-            Body=data.read(),
+            Body=data,
         )
 
         return PutOutput(uri=destination, hash=('md5', response['ETag']))
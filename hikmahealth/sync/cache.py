@@ -0,0 +1,195 @@
+"""Short lived cache of the records read for the sync pulls.
+
+Keys are tuples starting with the entity they hold records of, so that the records of an
+entity can be invalidated once a push to it commits. Identical loads running at the same
+time are coalesced: the first one reads, the others wait for its result. Loads run on a
+thread (`get_or_load`) and on an event loop (`get_or_load_async`) share the entries and
+the loads in progress."""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+from collections import defaultdict
+from typing import Awaitable, Callable, Generic, Hashable, Iterable, TypeVar
+
+from cachetools import TTLCache
+
+V = TypeVar('V')
+
+WAIT_TIMEOUT = 60
+"""Seconds to wait on another load before loading anyway"""
+
+
+class _Flight(Generic[V]):
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.value: V | None = None
+        self.error: BaseException | None = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: list[Callable[[], None]] = []
+
+    def finish(self, value: V | None = None, error: BaseException | None = None):
+        self.value = value
+        self.error = error
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            callback()
+
+    def wait(self, timeout: float) -> bool:
+        return self._done.wait(timeout)
+
+    async def wait_async(self, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def wake():
+            # from the thread finishing the load
+            try:
+                loop.call_soon_threadsafe(_resolve, done)
+            except RuntimeError:
+                # the loop is closed
+                pass
+
+        with self._lock:
+            if self._done.is_set():
+                return True
+            self._callbacks.append(wake)
+
+        try:
+            await asyncio.wait_for(done, timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(True)
+
+
+class DeltaCache(Generic[V]):
+    """LRU cache, with entries expiring after `ttl` seconds. `maxsize` bounds the sum of
+    `getsizeof` over the entries (their number by default)."""
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        getsizeof: Callable[[V], int] | None = None,
+    ):
+        self.ttl = ttl
+        self._entries: TTLCache = TTLCache(maxsize, ttl, getsizeof=getsizeof)
+        self._flights: dict[Hashable, _Flight[V]] = dict()
+        self._generations: dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self._entries.maxsize > 0
+
+    def _join(self, key: tuple) -> tuple[bool, V | None, _Flight[V] | None, bool]:
+        """Returns whether the key is cached, its value, else the load in progress and
+        whether it was started by this call"""
+        with self._lock:
+            try:
+                return True, self._entries[key], None, False
+            except KeyError:
+                pass
+
+            flight = self._flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(self._generations[key[0]])
+
+        return False, None, flight, leader
+
+    def _failed(self, key: tuple, flight: _Flight[V], err: BaseException):
+        with self._lock:
+            if self._flights.get(key, None) is flight:
+                del self._flights[key]
+        flight.finish(error=err)
+
+    def _loaded(self, key: tuple, flight: _Flight[V], value: V):
+        with self._lock:
+            if self._flights.get(key, None) is flight:
+                del self._flights[key]
+
+            # records read before an invalidation aren't kept
+            if self._generations[key[0]] == flight.generation:
+                try:
+                    self._entries[key] = value
+                except ValueError:
+                    # larger than the whole cache
+                    pass
+
+        flight.finish(value)
+
+    def get_or_load(self, key: tuple, load: Callable[[], V]) -> V:
+        cached, value, flight, leader = self._join(key)
+        if cached:
+            return value
+
+        if not leader:
+            if flight.wait(WAIT_TIMEOUT) and flight.error is None:
+                return flight.value
+            return load()
+
+        try:
+            value = load()
+        except BaseException as err:
+            self._failed(key, flight, err)
+            raise
+
+        self._loaded(key, flight, value)
+        return value
+
+    async def get_or_load_async(
+        self, key: tuple, load: Callable[[], Awaitable[V]]
+    ) -> V:
+        """Same as `get_or_load`, waiting on the event loop"""
+        cached, value, flight, leader = self._join(key)
+        if cached:
+            return value
+
+        if not leader:
+            if await flight.wait_async(WAIT_TIMEOUT) and flight.error is None:
+                return flight.value
+            return await load()
+
+        try:
+            value = await load()
+        except BaseException as err:
+            self._failed(key, flight, err)
+            raise
+
+        self._loaded(key, flight, value)
+        return value
+
+    def invalidate(self, entities: Iterable[str]) -> None:
+        """Drops the records of the entities, including the ones being read."""
+        entities = set(entities)
+        with self._lock:
+            for entity in entities:
+                self._generations[entity] += 1
+
+            for key in list(self._entries.keys()):
+                if key[0] in entities:
+                    del self._entries[key]
+
+            # loads started from now on don't join the ones already running
+            for key in list(self._flights.keys()):
+                if key[0] in entities:
+                    del self._flights[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            for entity in list(self._generations.keys()):
+                self._generations[entity] += 1
+            self._entries.clear()
+            self._flights.clear()
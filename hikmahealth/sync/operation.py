@@ -6,13 +6,23 @@ To contain entity that's separate and testable.
 from abc import ABC, abstractmethod
 from collections import OrderedDict
 import datetime
-from typing import Callable, Dict, Generic, TypeVar
+import time
+from typing import Callable, Dict, Generic, Iterable, Mapping, TypeVar
+
+from hikmahealth.utils import metrics
 
 from .data import DeltaData
 from .errors import SyncPushError
 
 TArgs = TypeVar('TArgs')
 
+PUSH_SECONDS = metrics.histogram(
+    'hh_sync_push_apply_seconds', 'Time applying the changes pushed to a key', ['key']
+)
+PUSH_ERRORS = metrics.counter(
+    'hh_sync_push_errors_total', 'Pushes to a key failing with a SyncPushError', ['key']
+)
+
 # Define the function signature for sync push functions
 SyncPushFunction = Callable[[DeltaData, datetime.datetime, TArgs], None]
 """Function signature to facilitate data synchronization upon receiving changes / `DeltaData`."""
@@ -52,11 +62,28 @@ class Sink(Generic[TArgs]):
     def __init__(self) -> None:
         # Holds operations (either callable functions or classes implementing ISyncPush)
         self._ops: Dict[str, SyncPushFunction | type[ISyncPush[TArgs]]] = OrderedDict()
+        # keys each operation reads from, and must be applied after
+        self._deps: Dict[str, tuple[str, ...]] = dict()
+        # called with the keys written by a committed push
+        self._listeners: list[Callable[[set[str]], None]] = []
+
+    def add(
+        self,
+        key: str,
+        sync_operation,
+        depends_on: Iterable[str] = (),
+    ) -> None:
+        """Adds a sync operation for the given key.
 
-    def add(self, key: str, sync_operation) -> None:
-        """Adds a sync operation for the given key."""
+        `depends_on` lists the keys whose changes must be applied before this one's, like
+        the patients before their visits. They must already be added, which keeps the
+        dependencies free of cycles."""
         assert key not in self._ops, f"Key '{key}' already added to sink."
 
+        depends_on = tuple(depends_on)
+        for dep in depends_on:
+            assert dep in self._ops, f"Key '{key}' depends on '{dep}', which isn't added."
+
         if isinstance(sync_operation, type):
             # Ensure the class has and properly implements `apply_delta_changes`.
             assert hasattr(sync_operation, 'apply_delta_changes'), (
@@ -72,11 +99,71 @@ class Sink(Generic[TArgs]):
             )
 
         self._ops[key] = sync_operation
+        self._deps[key] = depends_on
 
     def remove(self, key: str) -> None:
-        """Removes the sync operation registered under the given key."""
-        if key in self._ops:
-            del self._ops[key]
+        """Removes the sync operation registered under the given key, along with the
+        operations depending on it."""
+        if key not in self._ops:
+            return
+
+        del self._ops[key]
+        del self._deps[key]
+        for other, deps in list(self._deps.items()):
+            if key in deps:
+                self.remove(other)
+
+    def get_stages(self, keys: Iterable[str]) -> list[list[str]]:
+        """Groups the keys into stages, to be applied one after the other. Keys within a
+        stage don't depend on each other, and can be applied concurrently.
+
+        Dependencies on keys outside of `keys` are ignored, and unknown keys are left out."""
+        keys = set(keys)
+        levels: Dict[str, int] = dict()
+
+        # keys are added after their dependencies, so the levels fill in a single pass
+        for key, deps in self._deps.items():
+            if key not in keys:
+                continue
+            levels[key] = 1 + max((levels[d] for d in deps if d in levels), default=-1)
+
+        for key in keys.difference(levels):
+            print(f'WARN: Skipping sync for unknown key={key}')
+
+        stages: list[list[str]] = [[] for _ in range(max(levels.values(), default=-1) + 1)]
+        for key, level in levels.items():
+            stages[level].append(key)
+
+        return stages
+
+    def add_listener(self, listener: Callable[[set[str]], None]) -> None:
+        """Adds a function called with the keys written, once a push commits."""
+        self._listeners.append(listener)
+
+    def get_written_keys(self, keys: Iterable[str]) -> set[str]:
+        """Returns the keys, with the keys they depend on. An operation may write to its
+        dependencies, like the placeholder patients of the events."""
+        written = set()
+        pending = [key for key in keys if key in self._deps]
+        while pending:
+            key = pending.pop()
+            if key not in written:
+                written.add(key)
+                pending.extend(self._deps[key])
+
+        return written
+
+    def committed(self, keys: Iterable[str]) -> None:
+        """Tells the listeners that the changes pushed to the keys were committed."""
+        written = self.get_written_keys(keys)
+        if not written:
+            return
+
+        for listener in self._listeners:
+            try:
+                listener(written)
+            except Exception as err:
+                print(f'WARN: sync listener failed: {err}')
 
     def push(
         self,
@@ -86,6 +173,7 @@ class Sink(Generic[TArgs]):
         args: TArgs,
     ) -> None:
         """Pushes the delta operations to the available nodes using their keys."""
+        started = time.perf_counter()
         try:
             operation = self._ops[key]
 
@@ -100,4 +188,18 @@ class Sink(Generic[TArgs]):
             print(f'WARN: Skipping sync for unknown key={key}')
             return
         except Exception as err:
+            PUSH_ERRORS.inc(key=key)
             raise SyncPushError('Failed to perform sync operation', *err.args)
+
+        PUSH_SECONDS.observe(time.perf_counter() - started, key=key)
+
+    def push_all(
+        self,
+        deltas: Mapping[str, DeltaData],
+        last_synced_at: datetime.datetime,
+        args: TArgs,
+    ) -> None:
+        """Pushes the changes of every key, in the order of their dependencies."""
+        for stage in self.get_stages(deltas.keys()):
+            for key in stage:
+                self.push(key, deltas[key], last_synced_at, args)
@@ -0,0 +1,48 @@
+"""Sending the updated records of a pull as patches of the columns that changed.
+
+The columns written by each update are logged by the database (`sync_column_changes`).
+A record updated since the last pull of a client is sent as a patch, with its id and the
+columns changed since, instead of the whole row. Patches are sent in a `patched` list,
+next to the `created`, `updated` and `deleted` ones.
+
+A record is only sent as a patch when its changes are known for sure: at least one
+update since the last pull is logged, and the record wasn't inserted since. Any other
+record stays in `updated`, whole."""
+
+from __future__ import annotations
+
+from typing import Iterable, Mapping
+
+ALWAYS_SENT = ('id', 'change_seq', 'last_modified', 'updated_at')
+"""Columns included in every patch, as they change with any update"""
+
+
+def make_patch(row: Mapping, columns: Iterable[str]) -> dict:
+    """Returns the columns of the row that changed, with the ones in `ALWAYS_SENT`."""
+    patch = {column: row[column] for column in ALWAYS_SENT if column in row}
+    for column in columns:
+        if column in row:
+            patch[column] = row[column]
+
+    return patch
+
+
+def apply_patches(
+    changes: dict, changed_columns: Mapping[str, frozenset[str] | None]
+) -> dict:
+    """Moves the records of `changes['updated']` whose changed columns are known into
+    `changes['patched']`, as patches.
+
+    `changed_columns` maps the id of a record to the columns changed since the last pull,
+    or `None` if it was inserted since."""
+    updated = []
+    patched = []
+    for row in changes.get('updated', []):
+        columns = changed_columns.get(str(row['id']), None)
+        if columns is None:
+            updated.append(row)
+        else:
+            patched.append(make_patch(row, columns))
+
+    return dict(changes, updated=updated, patched=patched)
+
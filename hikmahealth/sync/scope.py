@@ -0,0 +1,107 @@
+"""Limiting the patients a sync pull sends to the ones of the user's clinics.
+
+The scope is set with the `sync_scope` server variable, as JSON:
+
+    {
+        "mode": "clinic",
+        "clinic_groups": {"north": ["<clinic id>", "<clinic id>"]},
+        "recency_days": 365,
+        "unscoped_roles": ["super_admin"]
+    }
+
+- `mode`: `all` (the default) sends every patient. `clinic` sends the patients of the
+  user's clinic, and `clinic_group` the ones of every clinic grouped with it.
+- `recency_days`: the first sync of a device only gets the patients seen within it.
+- `unscoped_roles`: users with these roles always get every patient.
+
+A patient belongs to the clinics they had a visit, appointment or prescription at (the
+`patient_clinics` table). Patients not seen at any clinic yet are sent to everyone, so
+that one registered on another tablet can be found before their first visit.
+
+Changing the scope of a user only applies to the records changed from then on. Devices
+needing the records of a clinic added to their scope have to be synced from scratch."""
+
+from __future__ import annotations
+
+import dataclasses
+import datetime
+from typing import Any, Mapping
+
+MODE_ALL = 'all'
+MODE_CLINIC = 'clinic'
+MODE_CLINIC_GROUP = 'clinic_group'
+
+MODES = (MODE_ALL, MODE_CLINIC, MODE_CLINIC_GROUP)
+
+DEFAULT_UNSCOPED_ROLES = ('super_admin',)
+
+
+@dataclasses.dataclass(frozen=True)
+class SyncScope:
+    clinic_ids: tuple[str, ...] | None = None
+    """Clinics whose patients are sent. `None` sends the patients of every clinic"""
+    recency: datetime.timedelta | None = None
+    """The first sync of a device only gets the patients seen within it"""
+
+    @property
+    def is_unscoped(self) -> bool:
+        return self.clinic_ids is None and self.recency is None
+
+
+UNSCOPED = SyncScope()
+
+
+def is_first_sync(last_sync_time: datetime.datetime, last_change_seq: int | None = None):
+    """Whether the pull is the first one of a device, which asks for every record."""
+    return last_change_seq is None and last_sync_time.timestamp() <= 0
+
+
+def get_group_clinic_ids(
+    clinic_groups: Mapping[str, list[str]], clinic_id: str
+) -> tuple[str, ...]:
+    """Returns the clinic and every clinic sharing a group with it, sorted."""
+    clinic_id = str(clinic_id)
+    clinic_ids = {clinic_id}
+    for members in clinic_groups.values():
+        members = [str(member) for member in members]
+        if clinic_id in members:
+            clinic_ids.update(members)
+
+    return tuple(sorted(clinic_ids))
+
+
+def resolve(
+    config: Mapping[str, Any] | None, role: str | None, clinic_id: str | None
+) -> SyncScope:
+    """Returns the scope of a user, for the `sync_scope` configuration.
+
+    Raises a `ValueError` if the configuration is invalid."""
+    if not config:
+        return UNSCOPED
+
+    mode = config.get('mode', MODE_ALL)
+    if mode not in MODES:
+        raise ValueError(f'unknown sync scope mode {mode!r}, expected one of {MODES}')
+
+    if role in config.get('unscoped_roles', DEFAULT_UNSCOPED_ROLES):
+        return UNSCOPED
+
+    recency = None
+    recency_days = config.get('recency_days', None)
+    if recency_days is not None:
+        if not isinstance(recency_days, (int, float)) or recency_days <= 0:
+            raise ValueError('`recency_days` must be a positive number')
+        recency = datetime.timedelta(days=recency_days)
+
+    # users without a clinic can't be scoped to one
+    if mode == MODE_ALL or clinic_id is None:
+        return SyncScope(recency=recency)
+
+    if mode == MODE_CLINIC_GROUP:
+        clinic_groups = config.get('clinic_groups', dict())
+        if not isinstance(clinic_groups, Mapping):
+            raise ValueError('`clinic_groups` must map group names to clinic ids')
+
+        return SyncScope(get_group_clinic_ids(clinic_groups, clinic_id), recency)
+
+    return SyncScope((str(clinic_id),), recency)
@@ -0,0 +1,209 @@
+"""Incremental reader of JSON documents, for bodies too large to be decoded at once.
+
+`Reader` walks a document from a stream of bytes: the members of its objects and the
+elements of its arrays are read one at a time with `json.JSONDecoder.raw_decode`, so
+only the value being read is held in memory, with a chunk of the stream.
+
+    reader = Reader(file.read)
+    for key in reader.iter_object():
+        for record in reader.iter_array():
+            ...
+    reader.end()
+
+The value of each key yielded by `iter_object` must be read (or skipped) before the next
+key is asked for. `tell` gives the offset of the next value in the stream, so a value
+can be read again later by a reader started at that offset."""
+
+from __future__ import annotations
+
+import codecs
+import json
+import re
+from typing import Any, Callable, Iterator
+
+CHUNK_SIZE = 64 * 1024
+
+MAX_VALUE_SIZE = 64 * 1024 * 1024
+"""Characters of a single value read whole, past which the stream is rejected rather
+than buffered"""
+
+_CUT_TOKEN_SIZE = 6
+"""Characters of a literal or escape that may be cut by the end of the buffer
+(`fals`, `\\u12`)"""
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+_decoder = json.JSONDecoder()
+
+
+class JSONStreamError(ValueError):
+    """The stream isn't the JSON document expected"""
+
+
+class Reader:
+    def __init__(
+        self,
+        read: Callable[[int], bytes],
+        chunk_size: int = CHUNK_SIZE,
+        max_value_size: int = MAX_VALUE_SIZE,
+    ):
+        self._read = read
+        self._chunk_size = chunk_size
+        self._max_value_size = max_value_size
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._consumed = 0
+        """Bytes of the stream before the buffer"""
+        self._eof = False
+
+    def _fill(self, size: int | None = None) -> bool:
+        """Reads more of the stream into the buffer. Returns whether any was read"""
+        if self._eof:
+            return False
+
+        if self._pos > 0:
+            self._consumed += len(self._buffer[: self._pos].encode())
+            self._buffer = self._buffer[self._pos :]
+            self._pos = 0
+
+        chunk = self._read(size or self._chunk_size)
+        try:
+            if not chunk:
+                self._eof = True
+                self._buffer += self._text.decode(b'', final=True)
+                return False
+
+            self._buffer += self._text.decode(chunk)
+        except UnicodeDecodeError as err:
+            raise JSONStreamError(f'invalid UTF-8: {err}')
+
+        return True
+
+    def tell(self) -> int:
+        """Offset in bytes of the next value, from the start of the stream"""
+        self.peek()
+        return self._consumed + len(self._buffer[: self._pos].encode())
+
+    def peek(self) -> str:
+        """The next character that isn't whitespace, `''` at the end of the stream"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise self._error(f'expected {char!r}, found {found or "the end"!r}')
+
+        self._pos += 1
+
+    def _error(self, message: str) -> JSONStreamError:
+        return JSONStreamError(f'{message} at byte {self.tell()}')
+
+    def read_value(self) -> Any:
+        """Decodes the next value whole"""
+        if self.peek() == '':
+            raise self._error('expected a value, found the end')
+
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError as err:
+                # possibly cut by the end of the buffer: the error is at its end, or the
+                # string isn't closed yet. reads as much again as is buffered, so large
+                # values are decoded a few times at most
+                if self._is_cut(err) and self._grow():
+                    continue
+                raise JSONStreamError(f'invalid JSON: {err.msg} at byte {self.tell()}')
+
+            # a number near the end of the buffer might go on in the stream, cut after
+            # its dot or exponent (`1.`, `1e+`)
+            is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+            if is_number and end + 2 >= len(self._buffer) and not self._eof:
+                # decoded again, as the buffer moves
+                self._grow()
+                continue
+
+            self._pos = end
+            return value
+
+    def _is_cut(self, err: json.JSONDecodeError) -> bool:
+        return (
+            err.pos + _CUT_TOKEN_SIZE >= len(self._buffer)
+            or err.msg.startswith('Unterminated string')
+        )
+
+    def _grow(self) -> bool:
+        """Reads more of the value being decoded. Returns whether any was read"""
+        if len(self._buffer) - self._pos > self._max_value_size:
+            raise self._error(f'value larger than {self._max_value_size} characters')
+
+        return self._fill(max(self._chunk_size, len(self._buffer)))
+
+    def iter_object(self) -> Iterator[str]:
+        """Yields the keys of the next value, an object. The value of each key must be
+        read before the next key"""
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            if self.peek() != '"':
+                raise self._error('expected a key')
+
+            key = self.read_value()
+            self.expect(':')
+            yield key
+
+            found = self.peek()
+            if found == '}':
+                self._pos += 1
+                return
+            if found != ',':
+                raise self._error(f"expected ',' or '}}', found {found or 'the end'!r}")
+            self._pos += 1
+
+    def iter_array(self) -> Iterator[Any]:
+        """Yields the elements of the next value, an array, decoded one at a time"""
+        return self._iter_elements(self.read_value)
+
+    def skip_value(self):
+        """Reads past the next value, a member or element at a time"""
+        found = self.peek()
+        if found == '{':
+            for _ in self.iter_object():
+                self.skip_value()
+        elif found == '[':
+            for _ in self._iter_elements(self.skip_value):
+                pass
+        else:
+            self.read_value()
+
+    def _iter_elements(self, read: Callable[[], Any]) -> Iterator[Any]:
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            yield read()
+
+            found = self.peek()
+            if found == ']':
+                self._pos += 1
+                return
+            if found != ',':
+                raise self._error(f"expected ',' or ']', found {found or 'the end'!r}")
+            self._pos += 1
+
+    def end(self):
+        """Checks that nothing but whitespace is left"""
+        found = self.peek()
+        if found != '':
+            raise self._error(f'expected the end, found {found!r}')
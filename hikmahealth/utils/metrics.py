@@ -0,0 +1,370 @@
+"""Counters, gauges and histograms kept in process, rendered in the Prometheus text
+format.
+
+    PULLED = metrics.counter('hh_sync_pull_records_total', 'Records pulled', ['entity'])
+    PULLED.inc(12, entity='patients')
+
+With `METRICS_DIR` set, as for the gunicorn workers, each process also writes its
+metrics to its own file of the directory, at most every `METRICS_FLUSH_SECONDS` and when
+it exits. `render` then merges the metrics of all the processes: counters and histograms
+are summed, and so are the gauges of the processes still running. The directory should
+be emptied before the server starts, like for the multi-process mode of
+`prometheus_client`."""
+
+from __future__ import annotations
+
+import atexit
+import bisect
+import contextlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Callable, Iterator, Sequence
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+FILE_PREFIX = 'metrics-'
+
+
+class Metric:
+    kind = ''
+
+    def __init__(
+        self, name: str, documentation: str, labels: Sequence[str] = (), registry=None
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.registry: Registry | None = registry
+        self._values: dict[tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        if len(labels) != len(self.labels) or not all(k in labels for k in self.labels):
+            raise ValueError(f'{self.name} takes the labels {self.labels}, got {labels}')
+
+        return tuple(str(labels[k]) for k in self.labels)
+
+    def _changed(self):
+        if self.registry is not None:
+            self.registry.maybe_flush()
+
+    def samples(self) -> list:
+        """Label values and value of each of the series"""
+        with self._lock:
+            return [[list(k), v] for k, v in self._values.items()]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError('counters only go up')
+
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+        self._changed()
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+        self._changed()
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+        self._changed()
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        registry=None,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # values of a bucket are counted in it only, and summed up when rendered
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, None) or (
+                [0] * (len(self.buckets) + 1),
+                0,
+            )
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+        self._changed()
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observes the seconds spent in the block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list:
+        with self._lock:
+            return [[list(k), [list(c), t]] for k, (c, t) in self._values.items()]
+
+
+class Registry:
+    def __init__(self, directory: str | None = None, flush_seconds: float = 5.0):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.metrics: dict[str, Metric] = {}
+        self._collectors: list[Callable[[], None]] = []
+        self._flush_lock = threading.Lock()
+        self._flushed_at = 0.0
+
+    def register(self, metric: Metric) -> Metric:
+        """Adds the metric. A metric of the same name and kind already registered is
+        returned instead, so that reloaded modules keep their series."""
+        existing = self.metrics.get(metric.name, None)
+        if existing is not None:
+            if existing.kind != metric.kind or existing.labels != metric.labels:
+                raise ValueError(f'metric {metric.name} is already registered')
+            return existing
+
+        metric.registry = self
+        self.metrics[metric.name] = metric
+        return metric
+
+    def on_collect(self, f: Callable[[], None]) -> Callable[[], None]:
+        """Calls `f` before the metrics are read, to set the gauges it keeps"""
+        self._collectors.append(f)
+        return f
+
+    def snapshot(self) -> dict:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as err:
+                logging.warning(f'failed to collect metrics: {err}')
+
+        snapshot = dict()
+        for name, m in list(self.metrics.items()):
+            snapshot[name] = dict(
+                kind=m.kind,
+                help=m.documentation,
+                labels=list(m.labels),
+                buckets=list(getattr(m, 'buckets', ())),
+                samples=m.samples(),
+            )
+
+        return snapshot
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f'{FILE_PREFIX}{pid}.json')
+
+    def _write(self):
+        self._flushed_at = time.monotonic()
+        path = self._path(os.getpid())
+        # renamed in place, so other processes never read a partial file
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f'{path}.tmp', path)
+
+    def flush(self):
+        """Writes the metrics of the process to its file of the directory"""
+        if self.directory is None:
+            return
+
+        with self._flush_lock:
+            self._write()
+
+    def maybe_flush(self, force: bool = False):
+        if self.directory is None:
+            return
+
+        if not force and time.monotonic() - self._flushed_at < self.flush_seconds:
+            return
+
+        # skipped while being written, including by the gauges set by the collectors
+        if not self._flush_lock.acquire(blocking=False):
+            return
+
+        try:
+            self._write()
+        except OSError as err:
+            logging.warning(f'failed to write the metrics to {self.directory}: {err}')
+        finally:
+            self._flush_lock.release()
+
+    def collect(self) -> dict:
+        """Returns the metrics of every process writing to the directory, merged"""
+        if self.directory is None:
+            return self.snapshot()
+
+        self.flush()
+        merged = dict()
+        for entry in sorted(os.listdir(self.directory)):
+            if not entry.startswith(FILE_PREFIX) or not entry.endswith('.json'):
+                continue
+
+            try:
+                pid = int(entry[len(FILE_PREFIX) : -len('.json')])
+                with open(os.path.join(self.directory, entry)) as f:
+                    snapshot = json.load(f)
+            except (ValueError, OSError):
+                continue
+
+            _merge(merged, snapshot, alive=_is_alive(pid))
+
+        return merged
+
+    def render(self) -> str:
+        return render_snapshot(self.collect())
+
+
+def _is_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _merge(merged: dict, snapshot: dict, alive: bool):
+    for name, metric in snapshot.items():
+        # the gauges of the dead processes no longer hold
+        if metric['kind'] == 'gauge' and not alive:
+            continue
+
+        target = merged.setdefault(name, dict(metric, samples=[]))
+        series = {tuple(k): v for k, v in target['samples']}
+        for k, v in metric['samples']:
+            k = tuple(k)
+            if k not in series:
+                series[k] = v
+            elif metric['kind'] == 'histogram':
+                counts = [a + b for a, b in zip(series[k][0], v[0])]
+                series[k] = [counts, series[k][1] + v[1]]
+            else:
+                series[k] = series[k] + v
+
+        target['samples'] = [[list(k), v] for k, v in series.items()]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+
+    pairs = ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+def render_snapshot(snapshot: dict) -> str:
+    """Renders metrics, as returned by `Registry.collect`, in the text format"""
+    lines = []
+    for name, metric in sorted(snapshot.items()):
+        kind, names = metric['kind'], metric['labels']
+        lines.append(f'# HELP {name} {_escape(metric["help"])}')
+        lines.append(f'# TYPE {name} {kind}')
+
+        samples = sorted(metric['samples'])
+        if not samples and not names and kind != 'histogram':
+            samples = [[[], 0]]
+
+        for values, value in samples:
+            if kind != 'histogram':
+                lines.append(f'{name}{_labels(names, values)} {_number(value)}')
+                continue
+
+            counts, total = value
+            cumulative = 0
+            bounds = [*metric['buckets'], math.inf]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                le = _labels([*names, 'le'], [*values, _number(bound)])
+                lines.append(f'{name}_bucket{le} {cumulative}')
+
+            lines.append(f'{name}_sum{_labels(names, values)} {_number(total)}')
+            lines.append(f'{name}_count{_labels(names, values)} {cumulative}')
+
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry(
+    os.environ.get('METRICS_DIR', None) or None,
+    float(os.environ.get('METRICS_FLUSH_SECONDS', '5')),
+)
+"""Registry of the metrics of the app"""
+
+atexit.register(REGISTRY.maybe_flush, force=True)
+
+
+def counter(name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def gauge(name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labels))
+
+
+def histogram(
+    name: str,
+    documentation: str,
+    labels: Sequence[str] = (),
+    buckets: Sequence[float] = DEFAULT_BUCKETS,
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets=buckets))
+
+
+def on_collect(f: Callable[[], None]) -> Callable[[], None]:
+    return REGISTRY.on_collect(f)
+
+
+def render() -> str:
+    """The metrics of the app, in the Prometheus text format"""
+    return REGISTRY.render()
@@ -0,0 +1,40 @@
+"""create sync push log
+
+Revision ID: a4d7e3c1f9b2
+Revises: e5b81d4c92a7
+Create Date: 2026-10-19 12:24:53.190447
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d7e3c1f9b2'
+down_revision = 'e5b81d4c92a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE TABLE sync_push_log (
+            fingerprint varchar(128) PRIMARY KEY,
+            body_hash varchar(64) NOT NULL,
+            status varchar(16) NOT NULL DEFAULT 'pending',
+            response JSONB DEFAULT NULL,
+            created_at timestamp with time zone NOT NULL DEFAULT now(),
+            completed_at timestamp with time zone DEFAULT NULL
+        );
+        """
+    )
+
+    # used when pruning the entries past the retention window
+    op.execute('CREATE INDEX sync_push_log_created_ix ON sync_push_log (created_at);')
+
+
+def downgrade():
+    op.execute('DROP INDEX sync_push_log_created_ix;')
+    op.execute('DROP TABLE sync_push_log;')
@@ -0,0 +1,52 @@
+"""create sync sessions
+
+Revision ID: b8c2f5a07d13
+Revises: a4d7e3c1f9b2
+Create Date: 2026-10-19 13:40:08.512916
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8c2f5a07d13'
+down_revision = 'a4d7e3c1f9b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE TABLE sync_sessions (
+            user_id uuid NOT NULL,
+            device_id varchar(128) NOT NULL,
+            user_agent TEXT DEFAULT NULL,
+            last_pull_at timestamp with time zone DEFAULT NULL,
+            pulled_until timestamp with time zone DEFAULT NULL,
+            pulled_change_seq bigint DEFAULT NULL,
+            last_pull_bytes bigint DEFAULT NULL,
+            last_pull_ms integer DEFAULT NULL,
+            pull_count integer NOT NULL DEFAULT 0,
+            last_push_at timestamp with time zone DEFAULT NULL,
+            pushed_last_pulled_at timestamp with time zone DEFAULT NULL,
+            last_push_bytes bigint DEFAULT NULL,
+            last_push_ms integer DEFAULT NULL,
+            push_count integer NOT NULL DEFAULT 0,
+            created_at timestamp with time zone NOT NULL DEFAULT now(),
+            PRIMARY KEY (user_id, device_id)
+        );
+        """
+    )
+
+    # pushes are matched to the session by the device alone
+    op.execute('CREATE INDEX sync_sessions_device_ix ON sync_sessions (device_id);')
+    op.execute('CREATE INDEX sync_sessions_last_pull_ix ON sync_sessions (last_pull_at);')
+
+
+def downgrade():
+    op.execute('DROP INDEX sync_sessions_last_pull_ix;')
+    op.execute('DROP INDEX sync_sessions_device_ix;')
+    op.execute('DROP TABLE sync_sessions;')
@@ -0,0 +1,63 @@
+"""create jobs table
+
+Revision ID: c3a9f1e2b7d4
+Revises: 18edc29dd7fd
+Create Date: 2026-10-19 09:12:41.318207
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a9f1e2b7d4'
+down_revision = '18edc29dd7fd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE TABLE jobs (
+            id uuid PRIMARY KEY,
+            kind varchar(64) NOT NULL,
+            status varchar(16) NOT NULL DEFAULT 'queued',
+            params JSONB NOT NULL DEFAULT '{}',
+            progress JSONB NOT NULL DEFAULT '{}',
+            result JSONB DEFAULT NULL,
+            error TEXT DEFAULT NULL,
+            attempts integer NOT NULL DEFAULT 0,
+            max_attempts integer NOT NULL DEFAULT 1,
+            created_by uuid DEFAULT NULL,
+            worker_id TEXT DEFAULT NULL,
+            run_after timestamp with time zone NOT NULL DEFAULT now(),
+            heartbeat_at timestamp with time zone DEFAULT NULL,
+            started_at timestamp with time zone DEFAULT NULL,
+            finished_at timestamp with time zone DEFAULT NULL,
+            created_at timestamp with time zone NOT NULL DEFAULT now(),
+            updated_at timestamp with time zone NOT NULL DEFAULT now()
+        );
+        """
+    )
+
+    # only the queued jobs are scanned when claiming
+    op.execute(
+        """
+        CREATE INDEX jobs_queued_ix ON jobs (run_after, created_at)
+        WHERE status = 'queued';
+        """
+    )
+    op.execute(
+        """
+        CREATE INDEX jobs_running_ix ON jobs (heartbeat_at)
+        WHERE status = 'running';
+        """
+    )
+
+
+def downgrade():
+    op.execute('DROP INDEX jobs_running_ix;')
+    op.execute('DROP INDEX jobs_queued_ix;')
+    op.execute('DROP TABLE jobs;')
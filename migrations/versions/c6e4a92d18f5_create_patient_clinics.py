@@ -0,0 +1,144 @@
+"""create patient clinics for scoped sync
+
+Revision ID: c6e4a92d18f5
+Revises: b8c2f5a07d13
+Create Date: 2026-10-19 15:12:44.208113
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6e4a92d18f5'
+down_revision = 'b8c2f5a07d13'
+branch_labels = None
+depends_on = None
+
+
+# tables linking a patient to a clinic, with the column holding the clinic
+CLINIC_COLUMNS = (
+    ('visits', 'clinic_id'),
+    ('appointments', 'clinic_id'),
+    ('prescriptions', 'pickup_clinic_id'),
+)
+
+# tables filtered by `patient_id` on a scoped pull, that aren't indexed on it yet
+PATIENT_ID_INDEXES = ('visits', 'events', 'appointments')
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE TABLE patient_clinics (
+            patient_id uuid NOT NULL REFERENCES patients(id) ON DELETE CASCADE,
+            clinic_id uuid NOT NULL REFERENCES clinics(id) ON DELETE CASCADE,
+            first_seen_at timestamp with time zone NOT NULL DEFAULT now(),
+            last_seen_at timestamp with time zone NOT NULL DEFAULT now(),
+            previous_seen_at timestamp with time zone DEFAULT NULL,
+            change_seq bigint DEFAULT NULL,
+            PRIMARY KEY (patient_id, clinic_id)
+        );
+        """
+    )
+
+    # `change_seq` is only set when the patient is first seen at the clinic, so that
+    # scoped pulls can send the whole record of a patient new to the clinic. later
+    # visits move `last_seen_at`, at most once a day.
+    # the link is looked up first, and only locked by the update of the day: an
+    # `ON CONFLICT DO UPDATE` would lock it on every write of the patient's records,
+    # serializing the pushes of a patient
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION track_patient_clinic() RETURNS trigger AS $$
+        DECLARE
+            clinic uuid := (to_jsonb(NEW) ->> TG_ARGV[0])::uuid;
+        BEGIN
+            IF clinic IS NULL OR NEW.patient_id IS NULL THEN
+                RETURN NULL;
+            END IF;
+
+            PERFORM 1 FROM patient_clinics
+            WHERE patient_id = NEW.patient_id AND clinic_id = clinic;
+
+            IF NOT FOUND THEN
+                INSERT INTO patient_clinics (patient_id, clinic_id, first_seen_at, last_seen_at, change_seq)
+                VALUES (NEW.patient_id, clinic, now(), now(), txid_current())
+                ON CONFLICT (patient_id, clinic_id) DO NOTHING;
+
+                IF FOUND THEN
+                    RETURN NULL;
+                END IF;
+            END IF;
+
+            UPDATE patient_clinics
+            SET previous_seen_at = last_seen_at,
+                last_seen_at = now()
+            WHERE patient_id = NEW.patient_id
+                AND clinic_id = clinic
+                AND last_seen_at < now() - interval '1 day';
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+
+    for table, column in CLINIC_COLUMNS:
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_patient_clinic_trg
+            AFTER INSERT OR UPDATE OF patient_id, {column} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION track_patient_clinic('{column}');
+            """
+        )
+
+    # existing links are left without a `change_seq`. they predate any cursor handed
+    # to a client
+    links = ' UNION ALL '.join(
+        f'SELECT patient_id, {column} AS clinic_id, coalesce(server_created_at, created_at, now()) AS seen_at FROM {table}'
+        for table, column in CLINIC_COLUMNS
+    )
+    op.execute(
+        f"""
+        INSERT INTO patient_clinics (patient_id, clinic_id, first_seen_at, last_seen_at)
+        SELECT patient_id, clinic_id, min(seen_at), max(seen_at)
+        FROM ({links}) links
+        WHERE patient_id IS NOT NULL AND clinic_id IS NOT NULL
+        GROUP BY patient_id, clinic_id
+        ON CONFLICT DO NOTHING;
+        """
+    )
+
+    op.execute(
+        'CREATE INDEX patient_clinics_clinic_ix ON patient_clinics (clinic_id, patient_id);'
+    )
+    op.execute(
+        'CREATE INDEX patient_clinics_last_seen_ix ON patient_clinics (clinic_id, last_seen_at);'
+    )
+    op.execute(
+        """
+        CREATE INDEX patient_clinics_change_seq_ix ON patient_clinics (change_seq)
+        WHERE change_seq IS NOT NULL;
+        """
+    )
+
+    # built without locking the tables against writes
+    with op.get_context().autocommit_block():
+        for table in PATIENT_ID_INDEXES:
+            op.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_patient_id_ix ON {table} (patient_id);'
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in PATIENT_ID_INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {table}_patient_id_ix;')
+
+    for table, _ in CLINIC_COLUMNS:
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_patient_clinic_trg ON {table};')
+
+    op.execute('DROP FUNCTION IF EXISTS track_patient_clinic();')
+    op.execute('DROP TABLE patient_clinics;')
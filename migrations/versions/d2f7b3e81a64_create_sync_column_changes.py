@@ -0,0 +1,131 @@
+"""create sync column changes
+
+Revision ID: d2f7b3e81a64
+Revises: c6e4a92d18f5
+Create Date: 2026-10-19 16:31:05.730214
+
+"""
+
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f7b3e81a64'
+down_revision = 'c6e4a92d18f5'
+branch_labels = None
+depends_on = None
+
+
+# tables whose updates can be sent to the mobile app as patches
+PATCHED_TABLES = (
+    'patients',
+    'patient_additional_attributes',
+    'events',
+    'visits',
+    'appointments',
+    'prescriptions',
+)
+
+# columns left out of the log. they're sent with every patch
+IGNORED_COLUMNS = ('change_seq', 'last_modified', 'updated_at')
+
+
+def upgrade():
+    # a row per write, with the columns it changed. inserts have no columns, as the whole
+    # row is new
+    op.execute(
+        """
+        CREATE TABLE sync_column_changes (
+            table_name TEXT NOT NULL,
+            row_id TEXT NOT NULL,
+            columns TEXT[] DEFAULT NULL,
+            change_seq bigint NOT NULL,
+            changed_at timestamp with time zone NOT NULL DEFAULT now()
+        );
+        """
+    )
+    op.execute(
+        """
+        CREATE INDEX sync_column_changes_row_ix
+        ON sync_column_changes (table_name, row_id, change_seq);
+        """
+    )
+    op.execute(
+        'CREATE INDEX sync_column_changes_changed_at_ix ON sync_column_changes (changed_at);'
+    )
+
+    # every write from the horizon on is in the log. it starts when the triggers are
+    # enabled, moves forward as the log is pruned, and is removed while they're disabled
+    op.execute(
+        """
+        CREATE TABLE sync_column_changes_horizon (
+            id boolean PRIMARY KEY DEFAULT true CHECK (id),
+            change_seq bigint NOT NULL,
+            changed_at timestamp with time zone NOT NULL
+        );
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION log_column_changes() RETURNS trigger AS $$
+        DECLARE
+            changed TEXT[] := NULL;
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                SELECT array_agg(n.key ORDER BY n.key) INTO changed
+                FROM jsonb_each(to_jsonb(NEW)) n
+                JOIN jsonb_each(to_jsonb(OLD)) o ON o.key = n.key
+                WHERE n.value IS DISTINCT FROM o.value
+                  AND n.key <> ALL (TG_ARGV);
+
+                IF changed IS NULL THEN
+                    RETURN NULL;
+                END IF;
+            END IF;
+
+            INSERT INTO sync_column_changes (table_name, row_id, columns, change_seq)
+            VALUES (TG_TABLE_NAME, NEW.id::text, changed, txid_current());
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+
+    # the triggers only fire while the patches are enabled, by
+    # SYNC_PATCH_MIN_SCHEMA_VERSION. they're enabled or disabled later by the
+    # `set_sync_column_changes` job, see `column_changes.set_logging`
+    enabled = bool(os.environ.get('SYNC_PATCH_MIN_SCHEMA_VERSION', ''))
+    ignored = ', '.join(f"'{column}'" for column in IGNORED_COLUMNS)
+    for table in PATCHED_TABLES:
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_column_changes_trg
+            AFTER INSERT OR UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION log_column_changes({ignored});
+            """
+        )
+        if not enabled:
+            op.execute(
+                f'ALTER TABLE {table} DISABLE TRIGGER {table}_column_changes_trg;'
+            )
+
+    if enabled:
+        op.execute(
+            """
+            INSERT INTO sync_column_changes_horizon (change_seq, changed_at)
+            VALUES (txid_current(), now());
+            """
+        )
+
+
+def downgrade():
+    for table in PATCHED_TABLES:
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_column_changes_trg ON {table};')
+
+    op.execute('DROP FUNCTION IF EXISTS log_column_changes();')
+    op.execute('DROP TABLE sync_column_changes_horizon;')
+    op.execute('DROP TABLE sync_column_changes;')
@@ -0,0 +1,106 @@
+"""add sync indexes and change sequence
+
+Revision ID: e5b81d4c92a7
+Revises: c3a9f1e2b7d4
+Create Date: 2026-10-19 11:02:17.604113
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b81d4c92a7'
+down_revision = 'c3a9f1e2b7d4'
+branch_labels = None
+depends_on = None
+
+
+# tables sent to the mobile app on a sync pull
+SYNCED_TABLES = (
+    'patients',
+    'patient_additional_attributes',
+    'clinics',
+    'visits',
+    'events',
+    'event_forms',
+    'patient_registration_forms',
+    'string_ids',
+    'string_content',
+    'appointments',
+    'prescriptions',
+)
+
+
+def upgrade():
+    # `change_seq` is the id of the last transaction that wrote the row. transaction ids
+    # only go up, and anything below the `xmin` of a snapshot is committed (or aborted), so
+    # the `xmin` makes a cursor that can't skip over rows committed late
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION set_change_seq() RETURNS trigger AS $$
+        BEGIN
+            NEW.change_seq := txid_current();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+
+    for table in SYNCED_TABLES:
+        # existing rows are left as NULL, to avoid rewriting the tables. they predate any
+        # cursor handed to a client
+        op.execute(f'ALTER TABLE {table} ADD COLUMN change_seq bigint DEFAULT NULL;')
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_change_seq_trg
+            BEFORE INSERT OR UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION set_change_seq();
+            """
+        )
+
+    # built without locking the tables against writes
+    with op.get_context().autocommit_block():
+        for table in SYNCED_TABLES:
+            op.execute(
+                f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_sync_created_ix
+                ON {table} (server_created_at)
+                WHERE deleted_at IS NULL AND is_deleted = false;
+                """
+            )
+            op.execute(
+                f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_sync_updated_ix
+                ON {table} (last_modified)
+                WHERE deleted_at IS NULL AND is_deleted = false;
+                """
+            )
+            op.execute(
+                f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_sync_deleted_ix
+                ON {table} (deleted_at)
+                WHERE is_deleted = true;
+                """
+            )
+            op.execute(
+                f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_change_seq_ix
+                ON {table} (change_seq)
+                WHERE change_seq IS NOT NULL;
+                """
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in SYNCED_TABLES:
+            for suffix in ('change_seq_ix', 'sync_deleted_ix', 'sync_updated_ix', 'sync_created_ix'):
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {table}_{suffix};')
+
+    for table in SYNCED_TABLES:
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_change_seq_trg ON {table};')
+        op.execute(f'ALTER TABLE {table} DROP COLUMN change_seq;')
+
+    op.execute('DROP FUNCTION IF EXISTS set_change_seq();')
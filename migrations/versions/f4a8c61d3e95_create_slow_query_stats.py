@@ -0,0 +1,43 @@
+"""create slow query stats
+
+Revision ID: f4a8c61d3e95
+Revises: d2f7b3e81a64
+Create Date: 2026-10-19 21:12:47.305118
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a8c61d3e95'
+down_revision = 'd2f7b3e81a64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a row per statement fingerprint, aggregated over its slow executions. the values of
+    # the parameters aren't kept, only their types
+    op.execute(
+        """
+        CREATE TABLE slow_query_stats (
+            fingerprint varchar(32) PRIMARY KEY,
+            query TEXT NOT NULL,
+            calls bigint NOT NULL DEFAULT 0,
+            total_ms double precision NOT NULL DEFAULT 0,
+            max_ms double precision NOT NULL DEFAULT 0,
+            param_shapes JSONB DEFAULT NULL,
+            plan JSONB DEFAULT NULL,
+            plan_ms double precision DEFAULT NULL,
+            plan_captured_at timestamp with time zone DEFAULT NULL,
+            first_seen_at timestamp with time zone NOT NULL DEFAULT now(),
+            last_seen_at timestamp with time zone NOT NULL DEFAULT now()
+        );
+        """
+    )
+
+
+def downgrade():
+    op.execute('DROP TABLE slow_query_stats;')
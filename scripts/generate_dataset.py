@@ -0,0 +1,704 @@
+"""Generates a synthetic dataset for load and scale testing, and loads it with COPY.
+
+Creates clinics with their providers and event forms, then the patients of each clinic
+with their attributes, visits, events, appointments, prescriptions and photo resources,
+in the schema of the current migrations. The same seed and arguments generate the same
+records; timestamps are relative to `--until`.
+
+    python scripts/generate_dataset.py --dsn postgresql://... --patients 1000000 \\
+        --clinics 20 --clinic-weights zipf --seed 7 --pushes pushes.jsonl
+
+`--pushes` also writes tablet push payloads matching the dataset, one JSON object per
+line: `{"last_pulled_at": <ms>, "changes": {...}}`. They update some of the records
+loaded and create new patients, and are replayed by posting `changes` to
+`/v1/api/sync?last_pulled_at=<last_pulled_at>`.
+
+The database must be migrated to the head. The triggers of the tables (`change_seq`,
+`patient_clinics`, `sync_column_changes`) run on the rows copied."""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import os
+import random
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Iterable
+
+import bcrypt
+import psycopg
+from psycopg.types.json import Jsonb
+
+DAY_MS = 24 * 3600 * 1000
+
+# columns copied into each table, in the order they're loaded. rows are generated as the
+# tablet pushes them, and converted with `to_copy_row`
+TABLES: dict[str, tuple[str, ...]] = {
+    'clinics': ('id', 'name', 'attributes', 'address', 'created_at', 'updated_at'),
+    'users': ('id', 'name', 'role', 'email', 'hashed_password', 'clinic_id'),
+    'event_forms': (
+        'id',
+        'name',
+        'description',
+        'language',
+        'form_fields',
+        'metadata',
+        'created_at',
+        'updated_at',
+    ),
+    'patients': (
+        'id',
+        'given_name',
+        'surname',
+        'date_of_birth',
+        'citizenship',
+        'hometown',
+        'phone',
+        'sex',
+        'camp',
+        'government_id',
+        'external_patient_id',
+        'additional_data',
+        'image_timestamp',
+        'photo_url',
+        'created_at',
+        'updated_at',
+    ),
+    'patient_additional_attributes': (
+        'id',
+        'patient_id',
+        'attribute_id',
+        'attribute',
+        'number_value',
+        'string_value',
+        'date_value',
+        'boolean_value',
+        'metadata',
+        'is_deleted',
+        'created_at',
+        'updated_at',
+        'last_modified',
+        'server_created_at',
+    ),
+    'visits': (
+        'id',
+        'patient_id',
+        'clinic_id',
+        'provider_id',
+        'provider_name',
+        'check_in_timestamp',
+        'metadata',
+        'created_at',
+        'updated_at',
+    ),
+    'events': (
+        'id',
+        'patient_id',
+        'visit_id',
+        'form_id',
+        'event_type',
+        'form_data',
+        'metadata',
+        'created_at',
+        'updated_at',
+    ),
+    'appointments': (
+        'id',
+        'patient_id',
+        'clinic_id',
+        'provider_id',
+        'user_id',
+        'current_visit_id',
+        'fulfilled_visit_id',
+        'timestamp',
+        'duration',
+        'reason',
+        'notes',
+        'status',
+        'metadata',
+        'is_deleted',
+        'created_at',
+        'updated_at',
+        'last_modified',
+        'server_created_at',
+    ),
+    'prescriptions': (
+        'id',
+        'patient_id',
+        'provider_id',
+        'filled_by',
+        'pickup_clinic_id',
+        'visit_id',
+        'priority',
+        'expiration_date',
+        'prescribed_at',
+        'filled_at',
+        'status',
+        'items',
+        'notes',
+        'metadata',
+        'created_at',
+        'updated_at',
+    ),
+    'resources': (
+        'id',
+        'description',
+        'store',
+        'store_version',
+        'uri',
+        'mimetype',
+        'created_at',
+        'updated_at',
+    ),
+}
+
+# tables pushed by the tablets
+PUSHED_TABLES = (
+    'patients',
+    'patient_additional_attributes',
+    'visits',
+    'events',
+    'appointments',
+    'prescriptions',
+)
+
+# timestamps are sent by the tablets as unix milliseconds
+TIMESTAMP_COLUMNS = frozenset([
+    'created_at',
+    'updated_at',
+    'image_timestamp',
+    'check_in_timestamp',
+    'date_value',
+    'timestamp',
+    'expiration_date',
+    'prescribed_at',
+    'filled_at',
+])
+JSON_COLUMNS = frozenset([
+    'additional_data',
+    'metadata',
+    'form_data',
+    'form_fields',
+    'items',
+])
+# not null columns without a server default
+SERVER_COLUMNS = ('is_deleted', 'last_modified', 'server_created_at')
+
+GIVEN_NAMES = ('Amina', 'Omar', 'Lina', 'Yusuf', 'Sara', 'Zaynab', 'Salman', 'Layla')
+SURNAMES = ('Haddad', 'Khalil', 'Nasser', 'Saleh', 'Mahmoud', 'Ali', 'Noor', 'Adam')
+HOMETOWNS = ('North', 'South', 'East camp', 'West camp', 'Old city')
+REGISTRATION_FIELDS = (
+    ('height', 'number'),
+    ('weight', 'number'),
+    ('blood type', 'string'),
+    ('allergies', 'string'),
+    ('chronic illness', 'boolean'),
+    ('pregnant', 'boolean'),
+    ('arrival date', 'date'),
+    ('household size', 'number'),
+    ('occupation', 'string'),
+    ('disability', 'boolean'),
+    ('smoker', 'boolean'),
+    ('guardian', 'string'),
+)
+FORM_FIELDS = (
+    ('temperature', 'number'),
+    ('pulse', 'number'),
+    ('blood pressure', 'text'),
+    ('respiratory rate', 'number'),
+    ('complaint', 'text'),
+    ('diagnosis', 'text'),
+    ('notes', 'text'),
+    ('follow up', 'select'),
+)
+EVENT_TYPES = ('vitals', 'consultation', 'lab results', 'dental', 'physiotherapy')
+MEDICATIONS = ('amoxicillin', 'paracetamol', 'ibuprofen', 'metformin', 'salbutamol')
+
+
+def to_copy_row(table: str, row: dict, loaded_at: datetime.datetime) -> tuple:
+    """Returns the values copied for a row generated as the tablet pushes it"""
+    values = []
+    for column in TABLES[table]:
+        value = row.get(column, None)
+        if column in SERVER_COLUMNS and value is None:
+            value = False if column == 'is_deleted' else loaded_at
+        elif value is not None and column in TIMESTAMP_COLUMNS:
+            value = datetime.datetime.fromtimestamp(value / 1000, datetime.UTC)
+        elif value is not None and column in JSON_COLUMNS:
+            value = Jsonb(value)
+        values.append(value)
+
+    return tuple(values)
+
+
+def clinic_weights(spec: str, count: int) -> list[float]:
+    """Share of the patients of each clinic: `uniform`, `zipf`, or comma separated
+    weights, repeated over the clinics"""
+    if spec == 'uniform':
+        return [1.0] * count
+    if spec == 'zipf':
+        return [1 / (rank + 1) ** 1.1 for rank in range(count)]
+
+    weights = [float(weight) for weight in spec.split(',')]
+    return [weights[index % len(weights)] for index in range(count)]
+
+
+class Generator:
+    """Generates the records of the dataset. Every random choice comes from the seed."""
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.until = int(args.until.timestamp() * 1000)
+        self.clinics: list[dict] = []
+        self.providers: dict[str, list[dict]] = dict()
+        self.forms: list[dict] = []
+        self.registration_fields = [
+            (self.uuid(), name, kind) for name, kind in REGISTRATION_FIELDS
+        ]
+        self.password_hash = bcrypt.hashpw(
+            args.password.encode(), bcrypt.gensalt(rounds=4)
+        ).decode()
+
+    def uuid(self) -> str:
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+    def timestamp(self, after: int | None = None) -> int:
+        """Returns a time within the span of the dataset, after `after` if given"""
+        start = self.until - self.args.days * DAY_MS
+        return self.random.randrange(max(start, after or start), self.until)
+
+    def setup(self) -> dict[str, list[dict]]:
+        """Returns the clinics, their providers and the event forms"""
+        records = defaultdict(list)
+        created = self.until - self.args.days * DAY_MS
+        for index in range(self.args.clinics):
+            clinic = dict(
+                id=self.uuid(),
+                name=f'{self.args.tag} clinic {index}',
+                attributes=[],
+                address=self.random.choice(HOMETOWNS),
+                created_at=created,
+                updated_at=created,
+            )
+            self.clinics.append(clinic)
+            records['clinics'].append(clinic)
+
+            self.providers[clinic['id']] = []
+            for provider in range(self.args.providers):
+                user = dict(
+                    id=self.uuid(),
+                    name=f'Provider {index}.{provider}',
+                    role='provider',
+                    email=f'{self.args.tag}-c{index}-p{provider}@dataset.local',
+                    hashed_password=self.password_hash,
+                    clinic_id=clinic['id'],
+                )
+                self.providers[clinic['id']].append(user)
+                records['users'].append(user)
+
+        for event_type in EVENT_TYPES:
+            form = dict(
+                id=self.uuid(),
+                name=event_type.title(),
+                description=f'{event_type} form',
+                language='en',
+                form_fields=[
+                    dict(id=str(i), name=name, fieldType=kind)
+                    for i, (name, kind) in enumerate(FORM_FIELDS)
+                ],
+                metadata={},
+                created_at=created,
+                updated_at=created,
+            )
+            self.forms.append(form)
+            records['event_forms'].append(form)
+
+        return records
+
+    def patient(self, records: dict[str, list[dict]], clinic: dict):
+        """Adds a patient registered at the clinic, with the records of its visits"""
+        args = self.args
+        registered = self.timestamp()
+        patient = dict(
+            id=self.uuid(),
+            given_name=self.random.choice(GIVEN_NAMES),
+            surname=self.random.choice(SURNAMES),
+            date_of_birth=(
+                datetime.date(1940, 1, 1)
+                + datetime.timedelta(self.random.randrange(80 * 365))
+            ).isoformat(),
+            citizenship='',
+            hometown=self.random.choice(HOMETOWNS),
+            phone=str(self.random.randrange(10**9, 10**10)),
+            sex=self.random.choice(['male', 'female']),
+            camp=self.random.choice(['', 'Camp 1', 'Camp 4']),
+            government_id='',
+            external_patient_id=str(self.random.randrange(10**8)),
+            additional_data=dict(registered_at=clinic['name']),
+            image_timestamp=None,
+            photo_url='',
+            created_at=registered,
+            updated_at=registered,
+        )
+        records['patients'].append(patient)
+
+        if self.random.random() < args.resource_rate:
+            resource_id = self.uuid()
+            patient['image_timestamp'] = registered
+            records['resources'].append(
+                dict(
+                    id=resource_id,
+                    description=f'photo of {patient["id"]}',
+                    store=args.store,
+                    store_version=args.store_version,
+                    uri=f'patients/{patient["id"]}/{resource_id}.jpg',
+                    mimetype='image/jpeg',
+                    created_at=registered,
+                    updated_at=registered,
+                )
+            )
+
+        fields = self.random.sample(
+            self.registration_fields,
+            min(
+                len(self.registration_fields),
+                self.random.randint(0, 2 * args.attributes),
+            ),
+        )
+        for attribute_id, name, kind in fields:
+            values: dict[str, Any] = dict.fromkeys(
+                ('number_value', 'string_value', 'date_value', 'boolean_value')
+            )
+            if kind == 'number':
+                values['number_value'] = round(self.random.uniform(1, 200), 1)
+            elif kind == 'string':
+                values['string_value'] = 'x' * self.random.randint(3, 30)
+            elif kind == 'date':
+                values['date_value'] = self.timestamp()
+            else:
+                values['boolean_value'] = self.random.random() < 0.3
+
+            records['patient_additional_attributes'].append(
+                dict(
+                    id=self.uuid(),
+                    patient_id=patient['id'],
+                    attribute_id=attribute_id,
+                    attribute=name,
+                    metadata={},
+                    created_at=registered,
+                    updated_at=registered,
+                    **values,
+                )
+            )
+
+        for _ in range(self.random.randint(1, 2 * args.visits)):
+            at = clinic
+            if len(self.clinics) > 1 and self.random.random() < args.travel:
+                at = self.random.choice(self.clinics)
+            self.visit(records, patient, at, self.timestamp(after=registered))
+
+    def visit(self, records, patient: dict, clinic: dict, checked_in: int):
+        args = self.args
+        provider = self.random.choice(self.providers[clinic['id']])
+        visit = dict(
+            id=self.uuid(),
+            patient_id=patient['id'],
+            clinic_id=clinic['id'],
+            provider_id=provider['id'],
+            provider_name=provider['name'],
+            check_in_timestamp=checked_in,
+            metadata={},
+            created_at=checked_in,
+            updated_at=checked_in,
+        )
+        records['visits'].append(visit)
+
+        for _ in range(self.random.randint(1, 2 * args.events)):
+            form = self.random.choice(self.forms)
+            records['events'].append(
+                dict(
+                    id=self.uuid(),
+                    patient_id=patient['id'],
+                    visit_id=visit['id'],
+                    form_id=form['id'],
+                    event_type=form['name'],
+                    form_data=[
+                        dict(
+                            fieldId=field['id'],
+                            name=field['name'],
+                            fieldType=field['fieldType'],
+                            value=(
+                                round(self.random.uniform(30, 200), 1)
+                                if field['fieldType'] == 'number'
+                                else 'x' * self.random.randint(0, args.text_length)
+                            ),
+                        )
+                        for field in self.random.sample(
+                            form['form_fields'],
+                            self.random.randint(1, len(form['form_fields'])),
+                        )
+                    ],
+                    metadata={},
+                    created_at=checked_in,
+                    updated_at=checked_in,
+                )
+            )
+
+        if self.random.random() < args.appointment_rate:
+            at = checked_in + self.random.randint(7, 90) * DAY_MS
+            records['appointments'].append(
+                dict(
+                    id=self.uuid(),
+                    patient_id=patient['id'],
+                    clinic_id=clinic['id'],
+                    provider_id=provider['id'],
+                    user_id=provider['id'],
+                    current_visit_id=visit['id'],
+                    fulfilled_visit_id=None,
+                    timestamp=at,
+                    duration=self.random.choice([15, 30, 60]),
+                    reason='follow up',
+                    notes='',
+                    status='pending' if at > self.until else 'completed',
+                    metadata={},
+                    created_at=checked_in,
+                    updated_at=checked_in,
+                )
+            )
+
+        if self.random.random() < args.prescription_rate:
+            records['prescriptions'].append(
+                dict(
+                    id=self.uuid(),
+                    patient_id=patient['id'],
+                    provider_id=provider['id'],
+                    filled_by=None,
+                    pickup_clinic_id=clinic['id'],
+                    visit_id=visit['id'],
+                    priority=self.random.choice(['normal', 'high']),
+                    expiration_date=checked_in + 30 * DAY_MS,
+                    prescribed_at=checked_in,
+                    filled_at=None,
+                    status='pending',
+                    items=[
+                        dict(
+                            name=self.random.choice(MEDICATIONS),
+                            dose=f'{self.random.choice([250, 500])}mg',
+                            frequency='twice a day',
+                            quantity=self.random.randint(5, 30),
+                        )
+                        for _ in range(self.random.randint(1, 4))
+                    ],
+                    notes='',
+                    metadata={},
+                    created_at=checked_in,
+                    updated_at=checked_in,
+                )
+            )
+
+    def pick_clinic(self, weights: list[float]) -> dict:
+        return self.random.choices(self.clinics, weights)[0]
+
+
+class PushWriter:
+    """Writes the tablet pushes matching the dataset, `batch` patients per push. Its
+    choices come from their own seed, so they don't change the records loaded."""
+
+    def __init__(self, path: str, args, last_pulled_at: int):
+        self.file = open(path, 'w')
+        self.args = args
+        self.random = random.Random(args.seed + 1)
+        self.last_pulled_at = last_pulled_at
+        self.pending: dict[str, dict[str, list]] = self._empty()
+        self.patients = 0
+        self.count = 0
+
+    @staticmethod
+    def _empty() -> dict[str, dict[str, list]]:
+        return {key: dict(created=[], updated=[], deleted=[]) for key in PUSHED_TABLES}
+
+    def add_updates(self, records: dict[str, list[dict]]):
+        """Updates a share of the patients of the records, and one of their visits"""
+        visits = defaultdict(list)
+        for visit in records['visits']:
+            visits[visit['patient_id']].append(visit)
+
+        updated_at = self.last_pulled_at + DAY_MS
+        for patient in records['patients']:
+            if self.random.random() >= self.args.push_updates:
+                continue
+
+            phone = str(self.random.randrange(10**9, 10**10))
+            self.pending['patients']['updated'].append(
+                dict(patient, phone=phone, updated_at=updated_at)
+            )
+            visit = self.random.choice(visits[patient['id']])
+            self.pending['visits']['updated'].append(
+                dict(visit, metadata=dict(edited=True), updated_at=updated_at)
+            )
+            self._count_patient()
+
+    def add_created(self, records: dict[str, list[dict]]):
+        """Creates the records of a patient"""
+        for key in PUSHED_TABLES:
+            self.pending[key]['created'].extend(records[key])
+        self._count_patient()
+
+    def _count_patient(self):
+        self.patients += 1
+        if self.patients >= self.args.push_batch:
+            self.flush()
+
+    def flush(self):
+        if self.patients == 0:
+            return
+
+        line = dict(last_pulled_at=self.last_pulled_at, changes=self.pending)
+        self.file.write(json.dumps(line, separators=(',', ':')) + '\n')
+        self.pending = self._empty()
+        self.patients = 0
+        self.count += 1
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def copy_records(
+    conn: psycopg.Connection, records: dict[str, list[dict]]
+) -> dict[str, int]:
+    """Copies the records into their tables, in a single transaction. Returns the number
+    of rows of each table"""
+    loaded_at = datetime.datetime.now(datetime.UTC)
+    counts = dict()
+    with conn.cursor() as cur:
+        for table, columns in TABLES.items():
+            rows = records.get(table, [])
+            if not rows:
+                continue
+
+            with cur.copy(f'COPY {table} ({", ".join(columns)}) FROM STDIN') as copy:
+                for row in rows:
+                    copy.write_row(to_copy_row(table, row, loaded_at))
+            counts[table] = len(rows)
+    conn.commit()
+    return counts
+
+
+def _add_counts(total: dict[str, int], records: dict[str, list[Any]]):
+    for table, rows in records.items():
+        total[table] = total.get(table, 0) + len(rows)
+
+
+def _chunks(total: int, size: int) -> Iterable[int]:
+    for start in range(0, total, size):
+        yield min(size, total - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--dry-run', action='store_true', help="don't load the records")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tag', default=None, help='names the clinics and users')
+    parser.add_argument(
+        '--until',
+        type=datetime.datetime.fromisoformat,
+        default=datetime.datetime.now(datetime.UTC).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        ),
+        help='end of the span of the records, an ISO date. defaults to today',
+    )
+    parser.add_argument('--days', type=int, default=365, help='span of the records')
+    parser.add_argument('--patients', type=int, default=10_000)
+    parser.add_argument('--clinics', type=int, default=5)
+    parser.add_argument(
+        '--clinic-weights',
+        default='uniform',
+        help='share of the patients of each clinic: uniform, zipf, or weights (1,3,5)',
+    )
+    parser.add_argument('--providers', type=int, default=3, help='per clinic')
+    parser.add_argument('--travel', type=float, default=0.05, help='visits elsewhere')
+    parser.add_argument('--attributes', type=int, default=4, help='mean per patient')
+    parser.add_argument('--visits', type=int, default=3, help='mean per patient')
+    parser.add_argument('--events', type=int, default=2, help='mean per visit')
+    parser.add_argument('--text-length', type=int, default=120, help='max per field')
+    parser.add_argument('--appointment-rate', type=float, default=0.3, help='per visit')
+    parser.add_argument(
+        '--prescription-rate', type=float, default=0.5, help='per visit'
+    )
+    parser.add_argument('--resource-rate', type=float, default=0.2, help='per patient')
+    parser.add_argument('--store', default='gcp')
+    parser.add_argument('--store-version', default='202503.01')
+    parser.add_argument('--password', default='password', help='of every provider')
+    parser.add_argument('--chunk', type=int, default=5_000, help='patients per COPY')
+    parser.add_argument('--pushes', default=None, help='file of the push payloads')
+    parser.add_argument('--push-batch', type=int, default=50, help='patients per push')
+    parser.add_argument('--push-updates', type=float, default=0.01, help='per patient')
+    parser.add_argument('--push-patients', type=int, default=1_000, help='new patients')
+    args = parser.parse_args()
+
+    if args.until.tzinfo is None:
+        args.until = args.until.replace(tzinfo=datetime.UTC)
+    if args.tag is None:
+        args.tag = f'dataset-{args.seed}'
+    if args.dsn is None and not args.dry_run:
+        parser.error('missing --dsn (or DATABASE_URL)')
+
+    generator = Generator(args)
+    weights = clinic_weights(args.clinic_weights, args.clinics)
+    pushes = None
+    if args.pushes is not None:
+        pushes = PushWriter(args.pushes, args, generator.until)
+
+    conn = None if args.dry_run else psycopg.connect(args.dsn)
+    totals: dict[str, int] = dict()
+    started = time.monotonic()
+    try:
+        setup = generator.setup()
+        _add_counts(totals, setup)
+        if conn is not None:
+            copy_records(conn, setup)
+
+        done = 0
+        for size in _chunks(args.patients, args.chunk):
+            records = defaultdict(list)
+            for _ in range(size):
+                generator.patient(records, generator.pick_clinic(weights))
+
+            if conn is not None:
+                copy_records(conn, records)
+            if pushes is not None:
+                pushes.add_updates(records)
+
+            _add_counts(totals, records)
+            done += size
+            rows = sum(totals.values())
+            elapsed = time.monotonic() - started
+            print(
+                f'{done:,}/{args.patients:,} patients, {rows:,} rows, '
+                f'{rows / elapsed:,.0f} rows/s'
+            )
+
+        if pushes is not None:
+            # patients created on the tablets, after the dataset
+            for _ in range(args.push_patients):
+                records = defaultdict(list)
+                generator.patient(records, generator.pick_clinic(weights))
+                pushes.add_created(records)
+            pushes.close()
+            print(f'wrote {pushes.count:,} pushes to {args.pushes}')
+    finally:
+        if conn is not None:
+            conn.close()
+
+    for table, count in totals.items():
+        print(f'{table:<32}{count:>12,}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,522 @@
+"""Throughput benchmark of the sync pulls and pushes, against a local Postgres.
+
+Seeds the database with a synthetic clinic by pushing it through `sync_v2_push`, in
+batches, then pulls it back through `sync_v2_pull`, all with the Flask test client. Each
+scenario reports the p50/p95/p99 latency, the rows synced per second, the queries per
+request and the peak RSS of the process, compared against a stored baseline. Not
+collected by pytest. Run it from the project root with:
+
+    python -m tests.benchmarks.sync_bench [--patients 2000] [--save-baseline]
+
+The database is the one of the app settings (`DB_HOST`, `DB_NAME`, ...), migrated to the
+head. The rows seeded are deleted at the end, unless `--keep`. Exits with 1 when a
+scenario regressed past the tolerance of the baseline."""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import contextlib
+import datetime
+import json
+import math
+import random
+import resource
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable
+
+import bcrypt
+import psycopg
+
+from hikmahealth.server.client import db
+from hikmahealth.server.helpers import delta_cache, sync_bundle, sync_sessions
+from hikmahealth.server.server import app
+
+BASELINE = Path(__file__).with_name('sync_baseline.json')
+
+PASSWORD = 'sync-bench'
+
+# metrics that regress when they go up, and the ones that regress when they go down
+HIGHER_IS_WORSE = ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request', 'peak_rss_mb')
+LOWER_IS_WORSE = ('rows_per_s',)
+
+# arguments the baseline is only comparable with
+PARAMS = (
+    'patients',
+    'batch',
+    'attributes',
+    'visits',
+    'events',
+    'form_fields',
+    'pulls',
+    'seed',
+    'warm',
+)
+
+FIELDS = ('weight', 'height', 'temperature', 'pulse', 'notes', 'complaint', 'diagnosis')
+MEDICATIONS = ('amoxicillin', 'paracetamol', 'ibuprofen', 'metformin', 'salbutamol')
+
+
+class QueryCounter:
+    """Counts the statements executed by psycopg cursors, from any thread"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def patch(self):
+        originals = psycopg.Cursor.execute, psycopg.Cursor.executemany
+
+        def execute(cur, *args, **kwargs):
+            with self._lock:
+                self.count += 1
+            return originals[0](cur, *args, **kwargs)
+
+        def executemany(cur, query, params_seq, *args, **kwargs):
+            params_seq = list(params_seq)
+            with self._lock:
+                self.count += len(params_seq)
+            return originals[1](cur, query, params_seq, *args, **kwargs)
+
+        psycopg.Cursor.execute, psycopg.Cursor.executemany = execute, executemany
+        try:
+            yield self
+        finally:
+            psycopg.Cursor.execute, psycopg.Cursor.executemany = originals
+
+
+class Dataset:
+    """Generates the rows a tablet pushes for a clinic, deterministically"""
+
+    def __init__(self, seed: int, clinic_id: str, user_id: str, args):
+        self.random = random.Random(seed)
+        self.clinic_id = clinic_id
+        self.user_id = user_id
+        self.args = args
+        self.patient_ids: list[str] = []
+
+    def uuid(self) -> str:
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+    def timestamp(self) -> int:
+        # within the last year, in milliseconds
+        now = int(time.time() * 1000)
+        return now - self.random.randrange(365 * 24 * 3600 * 1000)
+
+    def date_of_birth(self) -> str:
+        days = self.random.randrange(80 * 365)
+        return (datetime.date(1940, 1, 1) + datetime.timedelta(days)).isoformat()
+
+    def patient(self, id: str) -> dict:
+        ts = self.timestamp()
+        return dict(
+            id=id,
+            given_name=self.random.choice(['Amina', 'Omar', 'Lina', 'Yusuf', 'Sara']),
+            surname=self.random.choice(['Haddad', 'Khalil', 'Nasser', 'Saleh']),
+            date_of_birth=self.date_of_birth(),
+            citizenship='',
+            hometown=self.random.choice(['North', 'South', 'Camp 4']),
+            phone=str(self.random.randrange(10**9, 10**10)),
+            sex=self.random.choice(['male', 'female']),
+            camp='',
+            government_id='',
+            external_patient_id='',
+            additional_data=dict(
+                village='North', notes='x' * self.random.randint(0, 200)
+            ),
+            image_timestamp=None,
+            created_at=ts,
+            updated_at=ts,
+        )
+
+    def attribute(self, patient_id: str) -> dict:
+        ts = self.timestamp()
+        return dict(
+            id=self.uuid(),
+            patient_id=patient_id,
+            attribute_id=self.uuid(),
+            attribute=self.random.choice(FIELDS),
+            number_value=self.random.uniform(1, 200),
+            string_value=None,
+            date_value=None,
+            boolean_value=None,
+            metadata={},
+            created_at=ts,
+            updated_at=ts,
+        )
+
+    def visit(self, patient_id: str) -> dict:
+        ts = self.timestamp()
+        return dict(
+            id=self.uuid(),
+            patient_id=patient_id,
+            clinic_id=self.clinic_id,
+            provider_id=self.user_id,
+            provider_name='Sync Bench',
+            check_in_timestamp=ts,
+            metadata={},
+            created_at=ts,
+            updated_at=ts,
+        )
+
+    def event(self, patient_id: str, visit_id: str) -> dict:
+        ts = self.timestamp()
+        fields = self.random.randint(5, self.args.form_fields)
+        return dict(
+            id=self.uuid(),
+            patient_id=patient_id,
+            visit_id=visit_id,
+            form_id=None,
+            event_type=self.random.choice(['vitals', 'consultation', 'lab results']),
+            form_data=[
+                dict(
+                    fieldId=str(i),
+                    name=self.random.choice(FIELDS),
+                    inputType='text',
+                    value=self.random.choice([self.random.uniform(0, 200), 'x' * 40]),
+                )
+                for i in range(fields)
+            ],
+            metadata={},
+            created_at=ts,
+            updated_at=ts,
+        )
+
+    def appointment(self, patient_id: str, visit_id: str) -> dict:
+        ts = self.timestamp()
+        return dict(
+            id=self.uuid(),
+            patient_id=patient_id,
+            clinic_id=self.clinic_id,
+            provider_id=self.user_id,
+            user_id=self.user_id,
+            current_visit_id=visit_id,
+            fulfilled_visit_id=None,
+            timestamp=ts + 7 * 24 * 3600 * 1000,
+            duration=30,
+            reason='follow up',
+            notes='',
+            status='pending',
+            metadata={},
+            is_deleted=False,
+            deleted_at=None,
+            created_at=ts,
+            updated_at=ts,
+        )
+
+    def prescription(self, patient_id: str, visit_id: str) -> dict:
+        ts = self.timestamp()
+        return dict(
+            id=self.uuid(),
+            patient_id=patient_id,
+            provider_id=self.user_id,
+            filled_by=None,
+            pickup_clinic_id=self.clinic_id,
+            visit_id=visit_id,
+            priority='normal',
+            expiration_date=ts + 30 * 24 * 3600 * 1000,
+            prescribed_at=ts,
+            filled_at=None,
+            status='pending',
+            items=[
+                dict(name=self.random.choice(MEDICATIONS), dose='500mg', quantity=20)
+                for _ in range(self.random.randint(1, 4))
+            ],
+            notes='',
+            metadata={},
+            is_deleted=False,
+            deleted_at=None,
+            created_at=ts,
+            updated_at=ts,
+        )
+
+    def push_batch(self, patients: int) -> dict:
+        """Returns the body of a push creating the patients, with their records"""
+        changes = {
+            key: dict(created=[], updated=[], deleted=[])
+            for key in (
+                'patients',
+                'patient_additional_attributes',
+                'visits',
+                'events',
+                'appointments',
+                'prescriptions',
+            )
+        }
+        for _ in range(patients):
+            patient_id = self.uuid()
+            self.patient_ids.append(patient_id)
+            changes['patients']['created'].append(self.patient(patient_id))
+            for _ in range(self.random.randint(0, 2 * self.args.attributes)):
+                changes['patient_additional_attributes']['created'].append(
+                    self.attribute(patient_id)
+                )
+
+            for _ in range(self.random.randint(1, 2 * self.args.visits)):
+                visit = self.visit(patient_id)
+                changes['visits']['created'].append(visit)
+                for _ in range(self.random.randint(1, 2 * self.args.events)):
+                    changes['events']['created'].append(
+                        self.event(patient_id, visit['id'])
+                    )
+                if self.random.random() < 0.3:
+                    changes['appointments']['created'].append(
+                        self.appointment(patient_id, visit['id'])
+                    )
+                if self.random.random() < 0.5:
+                    changes['prescriptions']['created'].append(
+                        self.prescription(patient_id, visit['id'])
+                    )
+
+        return changes
+
+    def update_batch(self, body: dict, fraction: float) -> dict:
+        """Returns the body of a push updating a fraction of the records of `body`"""
+        changes = dict()
+        for key, delta in body.items():
+            rows = delta['created']
+            picked = self.random.sample(rows, int(len(rows) * fraction))
+            updated = [dict(row, updated_at=int(time.time() * 1000)) for row in picked]
+            changes[key] = dict(created=[], updated=updated, deleted=[])
+
+        return changes
+
+
+def count_rows(changes: dict) -> int:
+    return sum(
+        len(delta.get(part, []))
+        for delta in changes.values()
+        for part in ('created', 'updated', 'deleted', 'patched')
+    )
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    # nearest rank
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_scenario(request: Callable[[], int], repeat: int, cold: bool) -> dict:
+    """Runs the request `repeat` times. `request` returns the number of rows synced."""
+    latencies, rows = [], 0
+    counter = QueryCounter()
+    with counter.patch():
+        for _ in range(repeat):
+            if cold:
+                sync_bundle.cache.clear()
+                delta_cache.cache.clear()
+
+            started = time.perf_counter()
+            rows += request()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    return dict(
+        requests=repeat,
+        p50_ms=percentile(latencies, 50),
+        p95_ms=percentile(latencies, 95),
+        p99_ms=percentile(latencies, 99),
+        rows_per_s=rows / (sum(latencies) / 1000),
+        queries_per_request=counter.count / repeat,
+        # kilobytes on linux
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    )
+
+
+def create_clinic(conn: psycopg.Connection, run_id: str) -> tuple[str, str, str]:
+    """Creates the clinic and user of the run. Returns their ids, and the user email"""
+    clinic_id, user_id = str(uuid.uuid4()), str(uuid.uuid4())
+    email = f'sync-bench-{run_id}@example.com'
+    # few rounds, so the timings are the sync's
+    hashed = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds=4)).decode()
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO clinics
+            (id, name, is_deleted, created_at, updated_at, last_modified)
+            VALUES
+            (%s, %s, false, current_timestamp, current_timestamp, current_timestamp)
+            """,
+            [clinic_id, f'Sync bench {run_id}'],
+        )
+        cur.execute(
+            """
+            INSERT INTO users (id, name, role, email, clinic_id, hashed_password)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            """,
+            [user_id, 'Sync Bench', 'provider', email, clinic_id, hashed],
+        )
+    conn.commit()
+    return clinic_id, user_id, email
+
+
+def delete_clinic(conn: psycopg.Connection, clinic_id, user_id, patient_ids):
+    with conn.cursor() as cur:
+        for table in (
+            'events',
+            'appointments',
+            'prescriptions',
+            'visits',
+            'patient_additional_attributes',
+        ):
+            cur.execute(
+                f'DELETE FROM {table} WHERE patient_id = ANY(%s::uuid[])', [patient_ids]
+            )
+        cur.execute('DELETE FROM patients WHERE id = ANY(%s::uuid[])', [patient_ids])
+        cur.execute('DELETE FROM users WHERE id = %s', [user_id])
+        cur.execute('DELETE FROM clinics WHERE id = %s', [clinic_id])
+    conn.commit()
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Returns the metrics that regressed past the tolerance"""
+    regressions = []
+    print(f'\n{"scenario":<20}{"metric":<22}{"baseline":>12}{"now":>12}{"change":>9}')
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(scenario, dict()).get(metric, None)
+            if not base or metric == 'requests':
+                continue
+
+            change = (value - base) / base
+            worse = (metric in HIGHER_IS_WORSE and change > tolerance) or (
+                metric in LOWER_IS_WORSE and change < -tolerance
+            )
+            flag = '  !' if worse else ''
+            print(
+                f'{scenario:<20}{metric:<22}{base:>12,.1f}{value:>12,.1f}'
+                f'{change:>+9.1%}{flag}'
+            )
+            if worse:
+                regressions.append(f'{scenario}.{metric}')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--patients', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=100, help='patients per push')
+    parser.add_argument('--attributes', type=int, default=6, help='mean per patient')
+    parser.add_argument('--visits', type=int, default=2, help='mean per patient')
+    parser.add_argument('--events', type=int, default=2, help='mean per visit')
+    parser.add_argument('--form-fields', type=int, default=30, help='max per event')
+    parser.add_argument('--pulls', type=int, default=20, help='requests per pull')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--warm', action='store_true', help='keep the pull caches')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--keep', action='store_true', help="keep the rows seeded")
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    with db.get_connection() as conn:
+        clinic_id, user_id, email = create_clinic(conn, run_id)
+
+    dataset = Dataset(args.seed, clinic_id, user_id, args)
+    client = app.test_client()
+    credentials = base64.b64encode(f'{email}:{PASSWORD}'.encode()).decode()
+    headers = {
+        'Authorization': f'Basic {credentials}',
+        sync_sessions.DEVICE_ID_HEADER: f'sync-bench-{run_id}',
+    }
+    started_at = int(time.time() * 1000)
+
+    batches = max(1, args.patients // args.batch)
+    pushes = [dataset.push_batch(args.batch) for _ in range(batches)]
+    pending = list(pushes)
+
+    def push(body: dict) -> int:
+        response = client.post(
+            f'/v1/api/sync?last_pulled_at={started_at}', json=body, headers=headers
+        )
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return count_rows(body)
+
+    def pull(query: str) -> Callable[[], int]:
+        def request() -> int:
+            response = client.get(f'/v1/api/sync?{query}', headers=headers)
+            assert response.status_code == 200, response.get_data(as_text=True)
+            state['pulled'] = response.json
+            return count_rows(response.json['changes'])
+
+        return request
+
+    state: dict = dict()
+    results = dict()
+    try:
+        results['push_create'] = run_scenario(
+            lambda: push(pending.pop(0)), len(pushes), cold=False
+        )
+        results['pull_first'] = run_scenario(
+            pull('last_pulled_at=0'), args.pulls, cold=not args.warm
+        )
+        pulled_at = state['pulled']['timestamp']
+        change_seq = state['pulled']['change_seq']
+
+        updates = [dataset.update_batch(body, 0.05) for body in pushes]
+        pending = list(updates)
+        results['push_update'] = run_scenario(
+            lambda: push(pending.pop(0)), len(updates), cold=False
+        )
+        results['pull_since_time'] = run_scenario(
+            pull(f'last_pulled_at={int(pulled_at)}'), args.pulls, cold=not args.warm
+        )
+        results['pull_since_change'] = run_scenario(
+            pull(f'last_pulled_at={int(pulled_at)}&last_change_seq={change_seq}'),
+            args.pulls,
+            cold=not args.warm,
+        )
+    finally:
+        if not args.keep:
+            with db.get_connection() as conn:
+                delete_clinic(conn, clinic_id, user_id, dataset.patient_ids)
+
+    print(
+        f'{"scenario":<20}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}'
+        f'{"rows/s":>12}{"queries":>10}{"rss MB":>9}'
+    )
+    for scenario, m in results.items():
+        print(
+            f'{scenario:<20}{m["p50_ms"]:>10.1f}{m["p95_ms"]:>10.1f}'
+            f'{m["p99_ms"]:>10.1f}{m["rows_per_s"]:>12,.0f}'
+            f'{m["queries_per_request"]:>10.1f}{m["peak_rss_mb"]:>9.0f}'
+        )
+
+    params = {key: getattr(args, key) for key in PARAMS}
+    if args.save_baseline:
+        args.baseline.write_text(
+            json.dumps(
+                dict(
+                    params=params,
+                    recorded_at=datetime.datetime.now(datetime.UTC).isoformat(),
+                    results=results,
+                ),
+                indent=2,
+            )
+            + '\n'
+        )
+        print(f'\nsaved the baseline to {args.baseline}')
+        return
+
+    if not args.baseline.exists():
+        print(f'\nno baseline at {args.baseline}, record one with --save-baseline')
+        return
+
+    baseline = json.loads(args.baseline.read_text())
+    if baseline['params'] != params:
+        print(f'\nthe baseline was recorded with other arguments: {baseline["params"]}')
+
+    regressions = compare(results, baseline['results'], args.tolerance)
+    if regressions:
+        print(f'\nregressed past {args.tolerance:.0%}: {", ".join(regressions)}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Micro-benchmark of the transforms of the pushed rows.
+
+Reports the rows converted per second by the generated transform of each entity, next to
+an interpreter of the same columns, as the conversions used to run. Not collected by
+pytest. Run it from the project root with:
+
+    python -m tests.benchmarks.transform_bench [--rows 20000]
+
+Importing the entities needs the database settings (`DB_HOST`, ...) in the environment,
+but no database."""
+
+from __future__ import annotations
+
+import argparse
+import time
+import uuid
+
+from hikmahealth.entity import hh, transform
+
+NOW_MS = 1_700_000_000_000
+
+
+def interpret(columns, action, data):
+    """Converts a row by walking the columns, the way a generic transform would"""
+    row = dict(data)
+    for spec in columns:
+        if action not in spec.actions:
+            continue
+
+        if isinstance(spec, transform.Computed):
+            row[spec.name] = spec.value() if callable(spec.value) else spec.value
+            continue
+
+        missing = spec.name not in data
+        value = data.get(spec.name, None)
+        if spec.required and value is None:
+            raise ValueError(f'missing {spec.name!r} from the pushed row')
+
+        if value is None and (missing or not spec.nullable):
+            if spec.default_factory is not None:
+                row[spec.name] = spec.default_factory()
+            else:
+                row[spec.name] = spec.default
+        elif value is not None and spec.convert is not None:
+            row[spec.name] = spec.convert(value)
+
+    return row
+
+
+def _id():
+    return str(uuid.uuid4())
+
+
+SAMPLES = {
+    'patients': (
+        hh.Patient,
+        lambda: dict(
+            id=_id(),
+            given_name='Amina',
+            surname='Haddad',
+            date_of_birth='1990-02-11',
+            sex='female',
+            additional_data={'village': 'North', 'notes': 'x' * 80},
+            created_at=NOW_MS,
+            updated_at=NOW_MS,
+            image_timestamp=None,
+        ),
+    ),
+    'patient_additional_attributes': (
+        hh.PatientAttribute,
+        lambda: dict(
+            id=_id(),
+            patient_id=_id(),
+            attribute_id=_id(),
+            attribute='height',
+            number_value=172.5,
+            date_value=None,
+            metadata={},
+            created_at=NOW_MS,
+            updated_at=NOW_MS,
+        ),
+    ),
+    'events': (
+        hh.Event,
+        lambda: dict(
+            id=_id(),
+            patient_id=_id(),
+            visit_id=_id(),
+            form_id=_id(),
+            event_type='vitals',
+            form_data=[{'name': f'field {i}', 'value': i} for i in range(20)],
+            metadata={},
+            created_at=NOW_MS,
+            updated_at=NOW_MS,
+        ),
+    ),
+    'visits': (
+        hh.Visit,
+        lambda: dict(
+            id=_id(),
+            patient_id=_id(),
+            clinic_id=_id(),
+            provider_id=_id(),
+            provider_name='Dr. Salim',
+            check_in_timestamp=NOW_MS,
+            metadata={},
+            created_at=NOW_MS,
+            updated_at=NOW_MS,
+        ),
+    ),
+    'appointments': (
+        hh.Appointment,
+        lambda: dict(
+            id=_id(),
+            patient_id=_id(),
+            clinic_id=_id(),
+            provider_id=_id(),
+            user_id=_id(),
+            current_visit_id=_id(),
+            timestamp=NOW_MS,
+            duration=30,
+            status='pending',
+            metadata={},
+            created_at=NOW_MS,
+            updated_at=NOW_MS,
+        ),
+    ),
+    'prescriptions': (
+        hh.Prescription,
+        lambda: dict(
+            id=_id(),
+            patient_id=_id(),
+            provider_id=_id(),
+            pickup_clinic_id=_id(),
+            items=[{'name': 'amoxicillin', 'dose': '500mg'}],
+            prescribed_at=NOW_MS,
+            metadata={},
+            created_at=NOW_MS,
+            updated_at=NOW_MS,
+        ),
+    ),
+}
+
+
+def _rate(fn, rows) -> float:
+    started = time.perf_counter()
+    for row in rows:
+        fn(row)
+    return len(rows) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(f'{"entity":<32}{"generated rows/s":>18}{"interpreted rows/s":>20}{"x":>7}')
+    for key, (entity, sample) in SAMPLES.items():
+        rows = [sample() for _ in range(args.rows)]
+        generated = entity._push_transforms['UPDATE']
+        interpreted = _rate(lambda row: interpret(entity.PUSH_COLUMNS, 'UPDATE', row), rows)
+        rate = _rate(generated, rows)
+        print(f'{key:<32}{rate:>18,.0f}{interpreted:>20,.0f}{rate / interpreted:>7.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import io
+import json
+import tarfile
+import zipfile
+
+import pytest
+
+from hikmahealth.dump import export
+
+
+def _entries():
+    yield 'patients.ndjson', (b'{"id": "1"}\n', b'{"id": "2"}\n')
+    yield 'visits.ndjson', iter(())
+    yield export.MANIFEST_NAME, (json.dumps({'schema_version': '2.0'}).encode(),)
+
+
+def test_write_zip_archive():
+    data = b''.join(export.write_archive(_entries(), export.ARCHIVE_ZIP, chunk_size=8))
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == ['patients.ndjson', 'visits.ndjson', 'manifest.json']
+        assert zf.read('patients.ndjson') == b'{"id": "1"}\n{"id": "2"}\n'
+        assert zf.read('visits.ndjson') == b''
+        assert json.loads(zf.read('manifest.json')) == {'schema_version': '2.0'}
+
+
+def test_write_tar_archive():
+    data = b''.join(export.write_archive(_entries(), export.ARCHIVE_TAR, chunk_size=8))
+
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tf:
+        assert tf.getnames() == ['patients.ndjson', 'visits.ndjson', 'manifest.json']
+        assert tf.extractfile('patients.ndjson').read() == b'{"id": "1"}\n{"id": "2"}\n'
+        assert tf.extractfile('visits.ndjson').read() == b''
+
+
+def test_write_archive_is_lazy():
+    consumed = []
+
+    def entries():
+        for name in ('a', 'b'):
+            consumed.append(name)
+            yield name, (name.encode() * 1024,)
+
+    stream = export.write_archive(entries(), export.ARCHIVE_ZIP, chunk_size=1)
+    next(stream)
+    assert consumed == ['a']
+
+
+def test_write_archive_rejects_unknown_archive():
+    with pytest.raises(ValueError):
+        b''.join(export.write_archive(_entries(), 'rar'))
+
+
+def test_build_copy_query_rejects_unknown_format():
+    with pytest.raises(ValueError):
+        export.build_copy_query('patients', 'xml')
+
+
+def test_archive_filename():
+    assert (
+        export.archive_filename(export.ARCHIVE_TAR, '2024-01-01T00:00:00Z')
+        == 'hikma-export-2024-01-01T000000Z.tar.gz'
+    )
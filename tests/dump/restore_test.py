@@ -0,0 +1,108 @@
+import io
+import json
+
+import pytest
+
+from hikmahealth.dump import export, restore
+
+
+def _archive(kind, manifest=None):
+    manifest = manifest or {
+        'export_id': 'abc',
+        'format': export.FORMAT_NDJSON,
+        'tables': [
+            {'name': 'clinics', 'filename': 'clinics.ndjson', 'columns': ['id', 'name']}
+        ],
+    }
+
+    entries = [
+        ('clinics.ndjson', (b'{"id": "1", "name": "a"}\n',)),
+        (export.MANIFEST_NAME, (json.dumps(manifest).encode(),)),
+    ]
+    return io.BytesIO(b''.join(export.write_archive(entries, kind)))
+
+
+@pytest.mark.parametrize('kind', [export.ARCHIVE_ZIP, export.ARCHIVE_TAR])
+def test_archive_reader(kind):
+    with restore.ArchiveReader(_archive(kind)) as reader:
+        assert reader.manifest['export_id'] == 'abc'
+        with reader.open('clinics.ndjson') as f:
+            assert f.read() == b'{"id": "1", "name": "a"}\n'
+
+
+def test_archive_reader_rejects_other_files():
+    with pytest.raises(restore.ArchiveError):
+        restore.ArchiveReader(io.BytesIO(b'{"data": {}}'))
+
+
+def test_archive_reader_rejects_unknown_format():
+    manifest = {'export_id': 'abc', 'format': 'xml', 'tables': []}
+    with pytest.raises(restore.ArchiveError):
+        restore.ArchiveReader(_archive(export.ARCHIVE_ZIP, manifest))
+
+
+def test_spool_stream_limits_size():
+    with pytest.raises(restore.ArchiveError):
+        restore.spool_stream(io.BytesIO(b'x' * 10), io.BytesIO(), max_size=5)
+
+
+def test_build_upsert_query():
+    query = restore.build_upsert_query(
+        'string_content', 's', ['id', 'language', 'content'], export.FORMAT_NDJSON
+    ).as_string(None)
+
+    assert 'jsonb_populate_record(NULL::"string_content", s.doc)' in query
+    assert 'ON CONFLICT ("id", "language") DO UPDATE SET "content" = EXCLUDED."content"' in query
+
+
+def test_build_upsert_query_without_updates():
+    query = restore.build_upsert_query(
+        'patient_additional_attributes',
+        's',
+        ['patient_id', 'attribute_id'],
+        export.FORMAT_CSV,
+    ).as_string(None)
+
+    assert query.endswith('DO NOTHING')
+
+
+def test_restore_skips_completed_tables():
+    reader = restore.ArchiveReader(_archive(export.ARCHIVE_ZIP))
+    progress = restore.new_progress(reader.manifest)
+    progress['tables']['clinics']['done'] = True
+
+    class Conn:
+        autocommit = False
+
+    reports = []
+    result = restore.restore_archive(Conn(), reader, progress, reports.append)
+
+    assert result['status'] == restore.STATUS_COMPLETED
+    assert reports[-1] is result
+
+
+def test_staging_tables_are_not_shared():
+    executed = []
+
+    class Cursor:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def execute(self, query):
+            executed.append(query.as_string(None))
+
+    class Conn:
+        def cursor(self):
+            return Cursor()
+
+    first, second = (
+        restore._create_staging_table(Conn(), 'clinics', export.FORMAT_NDJSON, [], {})
+        for _ in range(2)
+    )
+
+    assert first != second
+    assert first.startswith('_hh_restore_clinics_')
+    assert f'CREATE UNLOGGED TABLE "{first}" (doc jsonb)' in executed
@@ -0,0 +1,95 @@
+import datetime
+
+import pytest
+
+from hikmahealth.dump import export, watermarks
+
+
+class FakeKeeper:
+    def __init__(self):
+        self.values = dict()
+
+    def get(self, key):
+        return self.values.get(key.lower())
+
+    def set_json(self, key, value):
+        self.values[key.lower()] = value
+
+
+def _manifest(**values):
+    return {
+        'export_id': 'abc',
+        'mode': export.MODE_INCREMENTAL,
+        'target': 'nightly',
+        'since': '2024-01-01T00:00:00+00:00',
+        'until': '2024-01-02T00:00:00+00:00',
+        **values,
+    }
+
+
+def test_first_incremental_export_is_full():
+    kp = FakeKeeper()
+    assert watermarks.resolve_export_since(kp, export.MODE_INCREMENTAL, target='nightly') is None
+
+
+def test_incremental_export_starts_before_watermark():
+    kp = FakeKeeper()
+    watermarks.save_export_watermark(
+        kp,
+        export.ExportManifest(
+            export_id='abc',
+            format=export.FORMAT_NDJSON,
+            exported_at='',
+            target='nightly',
+            until='2024-01-02T00:00:00+00:00',
+        ),
+    )
+
+    since = watermarks.resolve_export_since(kp, export.MODE_INCREMENTAL, target='nightly')
+    assert since == datetime.datetime(
+        2024, 1, 2, tzinfo=datetime.UTC
+    ) - watermarks.INCREMENTAL_OVERLAP
+
+
+@pytest.mark.parametrize(
+    'mode, since, target',
+    [('partial', None, None), (export.MODE_INCREMENTAL, None, None)],
+)
+def test_resolve_export_since_rejects_options(mode, since, target):
+    with pytest.raises(ValueError):
+        watermarks.resolve_export_since(FakeKeeper(), mode, since, target)
+
+
+def test_invalid_target():
+    with pytest.raises(ValueError):
+        watermarks.export_key('../nightly')
+
+
+def test_full_archive_can_always_be_applied():
+    watermarks.check_can_apply(_manifest(mode=export.MODE_FULL), None)
+
+
+def test_incremental_archive_needs_previous_archive():
+    with pytest.raises(watermarks.IncrementalGapError):
+        watermarks.check_can_apply(_manifest(), None)
+
+    watermarks.check_can_apply(_manifest(), None, force=True)
+
+
+def test_incremental_archive_with_gap():
+    applied = {'until': '2023-12-31T23:00:00+00:00'}
+    with pytest.raises(watermarks.IncrementalGapError):
+        watermarks.check_can_apply(_manifest(), applied)
+
+    applied = {'until': '2024-01-01T00:05:00+00:00'}
+    watermarks.check_can_apply(_manifest(), applied)
+
+
+def test_import_watermark_only_moves_forward():
+    kp = FakeKeeper()
+    watermarks.save_import_watermark(kp, _manifest(export_id='new'))
+    watermarks.save_import_watermark(
+        kp, _manifest(export_id='old', until='2024-01-01T12:00:00+00:00')
+    )
+
+    assert kp.get(watermarks.import_key('nightly'))['export_id'] == 'new'
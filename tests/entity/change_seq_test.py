@@ -0,0 +1,66 @@
+"""Testing suite for the `change_seq` based sync pull"""
+
+import datetime
+
+from hikmahealth.entity import hh
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params):
+        self.executed.append((query, params))
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.cur = FakeCursor(rows)
+
+    def cursor(self, row_factory=None):
+        return self.cur
+
+
+def _row(id, created, is_deleted=False, deleted_at=None):
+    return dict(
+        id=id,
+        server_created_at=created,
+        is_deleted=is_deleted,
+        deleted_at=deleted_at,
+        change_seq=10,
+    )
+
+
+def test_delta_records_since_change():
+    last_sync = datetime.datetime(2024, 1, 2, tzinfo=datetime.UTC)
+    before = last_sync - datetime.timedelta(days=1)
+    after = last_sync + datetime.timedelta(days=1)
+
+    conn = FakeConnection([
+        _row('new', after),
+        _row('old', before),
+        _row('unknown', None),
+        _row('deleted', before, is_deleted=True, deleted_at=after),
+        _row('inconsistent', before, deleted_at=after),
+    ])
+
+    delta = hh.Patient.get_delta_records_since_change(10, last_sync, conn)
+
+    assert [r['id'] for r in delta.created] == ['new']
+    assert [r['id'] for r in delta.updated] == ['old', 'unknown']
+    assert delta.deleted == ['deleted']
+
+    # a single query for all the changes
+    assert len(conn.cur.executed) == 1
+    assert conn.cur.executed[0][1] == (10,)
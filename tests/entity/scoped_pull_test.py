@@ -0,0 +1,116 @@
+"""Testing suite for the scoped sync pull"""
+
+import datetime
+
+from hikmahealth.entity import hh
+from hikmahealth.sync.scope import UNSCOPED, SyncScope
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params):
+        self.executed.append((query, params))
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.cur = FakeCursor(rows)
+
+    def cursor(self, row_factory=None):
+        return self.cur
+
+
+def _row(id, created, is_deleted=False):
+    return dict(
+        id=id,
+        server_created_at=created,
+        is_deleted=is_deleted,
+        deleted_at=created if is_deleted else None,
+        change_seq=10,
+    )
+
+
+LAST_SYNC = datetime.datetime(2024, 1, 2, tzinfo=datetime.UTC)
+EPOCH = datetime.datetime.fromtimestamp(0, tz=datetime.UTC)
+
+
+def _executed_sql(conn):
+    query, params = conn.cur.executed[0]
+    return ' '.join(query.as_string(None).split()), params
+
+
+def test_scoped_pull_is_a_single_query():
+    before = LAST_SYNC - datetime.timedelta(days=1)
+    after = LAST_SYNC + datetime.timedelta(days=1)
+    conn = FakeConnection([
+        _row('new', after),
+        # unchanged, but its patient joined the clinic
+        _row('joined', before),
+        _row('deleted', after, is_deleted=True),
+    ])
+
+    delta = hh.Visit.get_scoped_delta_records(SyncScope(('c1',)), LAST_SYNC, 10, conn)
+
+    assert [r['id'] for r in delta.created] == ['new']
+    assert [r['id'] for r in delta.updated] == ['joined']
+    assert delta.deleted == ['deleted']
+
+    assert len(conn.cur.executed) == 1
+    query, params = _executed_sql(conn)
+    assert query.startswith('SELECT t.* FROM "visits" t WHERE')
+    assert 'pc.patient_id = "t"."patient_id"' in query
+    assert 'pc.change_seq >= %(last_change_seq)s' in query
+    assert params['clinic_ids'] == ['c1']
+    assert params['last_change_seq'] == 10
+
+
+def test_patients_are_scoped_by_id():
+    conn = FakeConnection([])
+    hh.Patient.get_scoped_delta_records(SyncScope(('c1',)), LAST_SYNC, None, conn)
+
+    query, _ = _executed_sql(conn)
+    assert 'pc.patient_id = "t"."id"' in query
+    assert 'pc.first_seen_at > %(since)s' in query
+
+
+def test_first_sync_is_limited_to_recent_patients():
+    conn = FakeConnection([])
+    scope = SyncScope(('c1',), datetime.timedelta(days=30))
+    hh.Event.get_scoped_delta_records(scope, EPOCH, None, conn)
+
+    query, params = _executed_sql(conn)
+    assert 'pc.last_seen_at >= now() - %(recency)s' in query
+    # no need to look for patients joining the scope
+    assert 'first_seen_at' not in query
+    assert params['recency'] == datetime.timedelta(days=30)
+
+
+def test_recency_resends_returning_patients():
+    conn = FakeConnection([])
+    scope = SyncScope(None, datetime.timedelta(days=30))
+    hh.Event.get_scoped_delta_records(scope, LAST_SYNC, None, conn)
+
+    query, params = _executed_sql(conn)
+    assert 'pc.previous_seen_at < pc.last_seen_at - %(recency)s' in query
+    assert 'clinic_ids' not in params
+
+
+def test_unscoped_entities_and_pulls_use_the_usual_queries():
+    conn = FakeConnection([])
+    hh.Clinic.get_scoped_delta_records(SyncScope(('c1',)), LAST_SYNC, 10, conn)
+    hh.Visit.get_scoped_delta_records(UNSCOPED, LAST_SYNC, 10, conn)
+
+    assert [params for _, params in conn.cur.executed] == [(10,), (10,)]
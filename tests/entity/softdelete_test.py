@@ -0,0 +1,85 @@
+"""Testing suite for the cascading soft deletes"""
+
+import contextlib
+import datetime
+
+from hikmahealth.entity import hh, softdelete
+from hikmahealth.sync.data import DeltaData
+
+
+class FakeCursor:
+    rowcount = 1
+
+    def __init__(self):
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        text = query if isinstance(query, str) else query.as_string(None)
+        self.executed.append((' '.join(text.split()), params))
+        return self
+
+
+class FakeConnection:
+    def __init__(self):
+        self.cur = FakeCursor()
+        self.commits = 0
+
+    def cursor(self, row_factory=None):
+        return self.cur
+
+    @contextlib.contextmanager
+    def transaction(self):
+        yield
+        self.commits += 1
+
+
+def test_soft_delete_patients_runs_one_statement_per_table():
+    cur = FakeCursor()
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.UTC)
+
+    counts = softdelete.soft_delete_patients(cur, ['p1', 'p2', 'p3'], now)
+
+    assert len(cur.executed) == 1 + len(softdelete.PATIENT_CHILD_TABLES)
+    assert set(counts) == {'patients', *softdelete.PATIENT_CHILD_TABLES}
+    assert any('UPDATE "prescriptions"' in q for q, _ in cur.executed)
+    for _, params in cur.executed:
+        assert params[:3] == [now, now, now]
+        assert params[3] == ['p1', 'p2', 'p3']
+
+
+def test_soft_delete_nothing():
+    cur = FakeCursor()
+    assert softdelete.soft_delete_visits(cur, []) == dict()
+    assert cur.executed == []
+
+
+def test_patient_push_deletes_in_bulk():
+    conn = FakeConnection()
+    ids = [f'00000000-0000-0000-0000-00000000000{i}' for i in range(5)]
+
+    hh.Patient.apply_delta_changes(
+        DeltaData(deleted=ids), datetime.datetime.now(tz=datetime.UTC), conn
+    )
+
+    statements = conn.cur.executed
+    assert len(statements) == 1 + len(softdelete.PATIENT_CHILD_TABLES)
+    assert statements[0][0].startswith('INSERT INTO patients')
+    assert statements[0][1]['ids'] == ids
+    assert conn.commits == 1
+
+
+def test_visit_push_deletes_in_bulk():
+    conn = FakeConnection()
+
+    hh.Visit.apply_delta_changes(
+        DeltaData(deleted=['v1', 'v2']), datetime.datetime.now(tz=datetime.UTC), conn
+    )
+
+    tables = [q.split('"')[1] for q, _ in conn.cur.executed]
+    assert tables == ['visits', 'events', 'appointments', 'prescriptions']
@@ -0,0 +1,157 @@
+"""Testing suite for the transforms of the pushed rows, generated from the entity columns"""
+
+import datetime
+import json
+
+import pytest
+
+from hikmahealth.entity import hh, transform
+from hikmahealth.sync.errors import SyncPushError
+
+NOW_MS = 1_700_000_000_000
+NOW = datetime.datetime.fromtimestamp(NOW_MS / 1000, tz=datetime.UTC)
+UUID = '0a8b0e5c-95de-4a64-a4b2-4ea4d9b2e6c1'
+
+
+def test_generated_conversions():
+    columns = (
+        transform.Column('id', required=True),
+        transform.Column('created_at', transform.timestamp),
+        transform.Column('metadata', transform.json_text, default='{}'),
+        transform.Column('notes', nullable=True, default=''),
+        transform.Column('items', default=[]),
+        transform.Computed('photo_url', ''),
+        transform.Computed('flag', True, actions=('CREATE',)),
+    )
+    transforms = transform.compile_transform(columns, 'thing')
+
+    data = dict(id='a', created_at=NOW_MS, metadata=None, other=1)
+    row = transforms['CREATE'](data)
+
+    assert row == dict(
+        id='a',
+        created_at=NOW,
+        metadata='{}',
+        notes='',
+        items=[],
+        photo_url='',
+        flag=True,
+        other=1,
+    )
+    # the row sent is left as is
+    assert data == dict(id='a', created_at=NOW_MS, metadata=None, other=1)
+
+    # nulls sent to nullable columns are kept
+    assert transforms['UPDATE'](dict(id='a', notes=None))['notes'] is None
+    assert 'flag' not in transforms['UPDATE'](dict(id='a'))
+
+
+def test_required_columns():
+    transforms = transform.compile_transform((transform.Column('id', required=True),))
+    with pytest.raises(ValueError, match="missing 'id'"):
+        transforms['CREATE'](dict(id=None))
+
+
+def test_generated_source_binds_helpers_as_locals():
+    source, namespace = transform.generate_source(
+        (transform.Column('created_at', transform.timestamp),), 'CREATE', 'fn'
+    )
+    assert source.startswith('def fn(data, _MISSING=_MISSING, _c0=_c0):')
+    assert namespace['_c0'] is transform.timestamp
+
+
+def test_uuid_or_none():
+    assert transform.uuid_or_none(UUID) == UUID
+    assert transform.uuid_or_none('') is None
+    assert transform.uuid_or_none('not-a-uuid') is None
+
+
+def test_deletes_are_not_transformed():
+    assert hh.Visit.transform_delta(None, 'DELETE', UUID) is None
+
+
+def test_patient_transform():
+    row = hh.Patient.transform_delta(
+        None,
+        'CREATE',
+        dict(id='p', given_name='Ada', additional_data={'x': 1}, created_at=NOW_MS),
+    )
+
+    assert row['given_name'] == 'Ada'
+    assert json.loads(row['additional_data']) == {'x': 1}
+    assert row['created_at'] == NOW
+    assert row['updated_at'] is None
+    assert row['photo_url'] == ''
+    assert isinstance(row['last_modified'], datetime.datetime)
+
+    for invalid in (None, '', '{not json'):
+        row = hh.Patient.transform_delta(None, 'UPDATE', dict(id='p', additional_data=invalid))
+        assert row['additional_data'] == '{}'
+
+
+def test_event_transform():
+    row = hh.Event.transform_delta(None, 'CREATE', dict(id='e', form_data={'a': 1}))
+
+    assert row['form_data'] == '{"a": 1}'
+    assert row['metadata'] == '{}'
+    assert row['visit_id'] is None and row['patient_id'] is None
+    assert isinstance(row['last_modified'], datetime.datetime)
+
+
+def test_appointment_transform():
+    create = hh.Appointment.transform_delta(
+        None,
+        'CREATE',
+        dict(id='a', patient_id=UUID, provider_id='nope', timestamp=NOW_MS),
+    )
+
+    assert create['patient_id'] == UUID
+    assert create['provider_id'] is None
+    assert create['current_visit_id'] is None
+    assert create['timestamp'] == NOW
+    assert (create['notes'], create['reason'], create['is_deleted']) == ('', '', False)
+    assert create['metadata'] == 'null'
+    assert isinstance(create['created_at'], datetime.datetime)
+    assert isinstance(create['server_created_at'], datetime.datetime)
+
+    # the server creation time sent back on an update is kept
+    update = hh.Appointment.transform_delta(
+        None, 'UPDATE', dict(id='a', server_created_at=NOW, timestamp=None)
+    )
+    assert update['server_created_at'] == NOW
+    assert update['timestamp'] is None
+
+
+def test_prescription_transform():
+    create = hh.Prescription.transform_delta(
+        None, 'CREATE', dict(id='p', items=[{'name': 'x'}], server_created_at=NOW_MS)
+    )
+    assert create['items'] == '[{"name": "x"}]'
+    assert create['status'] == 'pending'
+    assert create['server_created_at'] == NOW
+
+    update = hh.Prescription.transform_delta(None, 'UPDATE', dict(id='p', status=None))
+    assert update['status'] is None
+    assert 'server_created_at' not in update
+
+
+def test_rows_without_id_fail_the_push():
+    class FakeConnection:
+        def transaction(self):
+            return self
+
+        def cursor(self):
+            return self
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    with pytest.raises(SyncPushError):
+        hh.PatientAttribute.apply_delta_changes(
+            hh.sync.DeltaData(created=[dict(attribute_id='x')]),
+            NOW,
+            FakeConnection(),
+        )
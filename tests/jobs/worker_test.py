@@ -0,0 +1,103 @@
+import contextlib
+
+import pytest
+
+from hikmahealth.jobs import queue, registry, worker
+
+
+class FakeConnection:
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+    jobs = []
+
+    class Job:
+        id = 'job-1'
+        kind = 'test_job'
+        params = {'value': 2}
+
+    jobs.append(Job())
+
+    monkeypatch.setattr(
+        worker.db, 'get_connection', lambda: contextlib.nullcontext(FakeConnection())
+    )
+    monkeypatch.setattr(queue, 'requeue_stale', lambda conn: 0)
+    monkeypatch.setattr(
+        queue, 'claim', lambda conn, worker_id, kinds: jobs.pop() if jobs else None
+    )
+    def heartbeat(conn, job_id, worker_id, progress):
+        calls.append(('heartbeat', progress))
+        return not any(call == ('reclaimed',) for call in calls)
+
+    monkeypatch.setattr(queue, 'heartbeat', heartbeat)
+
+    def complete(conn, job_id, worker_id, result):
+        calls.append(('complete', result))
+        return True
+
+    def fail(conn, job_id, worker_id, error):
+        calls.append(('fail', error))
+        return not any(call == ('reclaimed',) for call in calls)
+
+    monkeypatch.setattr(queue, 'complete', complete)
+    monkeypatch.setattr(queue, 'fail', fail)
+    monkeypatch.setattr(registry, '_handlers', dict())
+
+    return calls
+
+
+def test_register_twice_fails(calls):
+    registry.register('test_job')(lambda ctx: None)
+    with pytest.raises(ValueError):
+        registry.register('test_job')(lambda ctx: None)
+
+
+def test_run_once_completes_job(calls):
+    @registry.register('test_job')
+    def handler(ctx: registry.JobContext):
+        ctx.update_progress(stage='halfway')
+        return {'double': ctx.params['value'] * 2}
+
+    w = worker.Worker(heartbeat_interval=60)
+    assert w.run_once() is True
+    assert w.run_once() is False
+
+    assert ('heartbeat', {'stage': 'halfway'}) in calls
+    assert calls[-1] == ('complete', {'double': 4})
+
+
+def test_run_once_fails_job(calls):
+    @registry.register('test_job')
+    def handler(ctx: registry.JobContext):
+        raise RuntimeError('boom')
+
+    w = worker.Worker(heartbeat_interval=60)
+    assert w.run_once() is True
+
+    name, error = calls[-1]
+    assert name == 'fail'
+    assert 'boom' in error
+
+
+def test_job_taken_from_the_worker_is_cancelled(calls):
+    @registry.register('test_job')
+    def handler(ctx: registry.JobContext):
+        # given back to the queue as abandoned, and claimed by another worker
+        calls.append(('reclaimed',))
+        ctx.update_progress(stage='halfway')
+        assert ctx.cancelled.wait(5)
+
+        ctx.update_progress(stage='done')
+        calls.append(('kept running',))
+
+    w = worker.Worker(heartbeat_interval=60)
+    assert w.run_once() is True
+
+    assert ('kept running',) not in calls
+    name, error = calls[-1]
+    assert name == 'fail'
+    assert 'JobCancelled' in error
@@ -0,0 +1,156 @@
+import asyncio
+import base64
+import json
+
+from flask import Flask, jsonify, request
+
+from hikmahealth.server import asgi
+
+
+def make_scope(method, path, query=b'', headers=()):
+    return {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'root_path': '',
+        'query_string': query,
+        'headers': [(k.encode(), v.encode()) for k, v in headers],
+        'http_version': '1.1',
+        'scheme': 'http',
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 5000),
+    }
+
+
+def call(app, scope, body=b''):
+    messages = [
+        {'type': 'http.request', 'body': body[:3], 'more_body': True},
+        {'type': 'http.request', 'body': body[3:], 'more_body': False},
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+
+def make_flask_app():
+    app = Flask(__name__)
+
+    @app.route('/echo/<name>', methods=['POST'])
+    def echo(name):
+        return jsonify({
+            'name': name,
+            'body': request.get_json(),
+            'query': request.args.get('q'),
+            'agent': request.headers.get('User-Agent'),
+        }), 201
+
+    return app
+
+
+def test_bridge_serves_the_flask_app():
+    app = asgi.App(make_flask_app(), threads=2)
+    sent = call(
+        app,
+        make_scope(
+            'POST',
+            '/echo/ab',
+            b'q=1',
+            [('Content-Type', 'application/json'), ('User-Agent', 'tablet')],
+        ),
+        json.dumps({'a': 1}).encode(),
+    )
+
+    assert sent[0]['type'] == 'http.response.start'
+    assert sent[0]['status'] == 201
+    assert (b'content-type', b'application/json') in sent[0]['headers']
+    assert sent[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
+
+    body = b''.join(m['body'] for m in sent[1:])
+    assert json.loads(body) == {
+        'name': 'ab',
+        'body': {'a': 1},
+        'query': '1',
+        'agent': 'tablet',
+    }
+
+
+JSON_HEADERS = [('Content-Type', 'application/json')]
+
+
+def test_bridge_turns_away_large_bodies():
+    app = asgi.App(make_flask_app(), threads=2, max_body_size=4)
+    scope = make_scope('POST', '/echo/ab', headers=JSON_HEADERS)
+
+    # chunked, read up to the limit
+    sent = call(app, scope, b'[1, 2, 3]')
+    assert sent[0]['status'] == 413
+    assert 'larger than 4 bytes' in json.loads(sent[1]['body'])['message']
+
+    # by its length, without reading it
+    scope['headers'].append((b'content-length', b'9'))
+    assert call(app, scope, b'[1, 2, 3]')[0]['status'] == 413
+
+    scope = make_scope('POST', '/echo/ab', headers=JSON_HEADERS)
+    assert call(app, scope, b'[1]')[0]['status'] == 201
+
+
+def test_build_environ():
+    scope = make_scope(
+        'GET', '/v1/admin/x', b'a=b', [('X-Device-Id', 'd'), ('Content-Length', '0')]
+    )
+    environ = asgi.build_environ(scope, None)
+
+    assert environ['PATH_INFO'] == '/v1/admin/x'
+    assert environ['QUERY_STRING'] == 'a=b'
+    assert environ['HTTP_X_DEVICE_ID'] == 'd'
+    assert environ['CONTENT_LENGTH'] == '0'
+    assert environ['SERVER_PORT'] == '80'
+
+
+def test_pulls_are_served_natively():
+    assert asgi.App.is_native('/v1/api/sync')
+    assert asgi.App.is_native('/api/v2/sync/')
+    assert not asgi.App.is_native('/v1/api/sync/resources')
+
+
+def test_pull_errors_are_json():
+    # the missing `last_pulled_at` is caught before reaching the database
+    credentials = base64.b64encode(b'user@example.com:secret').decode()
+    app = asgi.App(make_flask_app(), threads=1)
+    sent = call(
+        app,
+        make_scope(
+            'GET',
+            '/v1/api/sync',
+            headers=[('Authorization', f'Basic {credentials}'), ('Origin', 'x')],
+        ),
+    )
+
+    assert sent[0]['status'] == 400
+    assert (b'access-control-allow-origin', b'*') in sent[0]['headers']
+    assert 'last_pulled_at' in json.loads(sent[1]['body'])['message']
+
+
+def test_lifespan():
+    app = asgi.App(make_flask_app(), threads=1)
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app({'type': 'lifespan'}, receive, send))
+    assert [m['type'] for m in sent] == [
+        'lifespan.startup.complete',
+        'lifespan.shutdown.complete',
+    ]
@@ -0,0 +1,81 @@
+import pytest
+from flask import Flask, jsonify
+from psycopg import pq
+
+from hikmahealth.server.client import instrument
+
+
+class FakeResult:
+    status = pq.ExecStatus.TUPLES_OK
+
+    def __init__(self, rows, fields, length):
+        self.ntuples = rows
+        self.nfields = fields
+        self.length = length
+
+    def get_length(self, row, field):
+        return self.length
+
+
+def make_app(statements):
+    app = Flask(__name__)
+    instrument.register_instrumentation(app)
+
+    @app.route('/work')
+    def work():
+        stats = instrument.get_stats()
+        for _ in range(statements):
+            stats.record(0.002, result=FakeResult(2, 3, 4))
+        return jsonify({'ok': True})
+
+    return app
+
+
+def test_record():
+    stats = instrument.QueryStats()
+    stats.record(0.010, result=FakeResult(2, 3, 4))
+    stats.record(0.030, statements=5)
+
+    assert stats.statements == 6
+    assert stats.max_time == 0.030
+    assert stats.rows == 2
+    assert stats.bytes == 24
+    assert stats.server_timing() == 'db;dur=40.0;desc="6 queries", db-max;dur=30.0'
+
+
+def test_size_of_large_results_is_sampled():
+    rows = instrument.SIZE_SAMPLE * 10
+    assert instrument._measure(FakeResult(rows, 2, 5)) == (rows, rows * 2 * 5)
+
+
+def test_query_budget():
+    with instrument.query_budget(2) as stats:
+        instrument.get_stats().record(0.001)
+        instrument.get_stats().record(0.001)
+    assert stats.statements == 2
+    assert instrument.get_stats() is None
+
+    with pytest.raises(instrument.QueryBudgetExceeded):
+        with instrument.query_budget(1):
+            instrument.get_stats().record(0.001)
+            instrument.get_stats().record(0.001)
+
+
+def test_requests_send_their_stats():
+    response = make_app(3).test_client().get('/work')
+
+    assert response.status_code == 200
+    assert response.headers['Server-Timing'].startswith('db;dur=6.0;desc="3 queries"')
+    assert instrument.get_stats() is None
+
+
+def test_testing_requests_over_budget_fail(monkeypatch):
+    monkeypatch.setitem(instrument.BUDGETS, 'work', 2)
+    app = make_app(3)
+    app.config.update(TESTING=True)
+
+    with pytest.raises(instrument.QueryBudgetExceeded):
+        app.test_client().get('/work')
+
+    app.config.update(TESTING=False)
+    assert app.test_client().get('/work').status_code == 200
@@ -0,0 +1,77 @@
+import pytest
+
+from hikmahealth.server.helpers import patient_chart
+
+
+def test_parse_fields():
+    assert patient_chart.parse_fields(None) is None
+    assert patient_chart.parse_fields(
+        'patient.surname,patient.given_name,visits,visits.id'
+    ) == {
+        'patient': ['given_name', 'surname'],
+        'visits': None,
+    }
+
+
+@pytest.mark.parametrize('fields', ['doctors', 'patient.given_name;drop', 'events.Id'])
+def test_parse_fields_rejects_invalid(fields):
+    with pytest.raises(ValueError):
+        patient_chart.parse_fields(fields)
+
+
+@pytest.mark.parametrize('patient_id', ['not-a-uuid', '1', "x' OR 1=1"])
+def test_invalid_ids_have_no_chart(patient_id, monkeypatch):
+    def connect():
+        raise AssertionError('the database is not read')
+
+    monkeypatch.setattr(patient_chart.db, 'get_connection', connect)
+    assert patient_chart.get_patient_chart(patient_id) is None
+
+
+def test_cache_invalidation():
+    cache = patient_chart.PatientChartCache()
+    loads = []
+
+    def load():
+        loads.append(1)
+        return '{}'
+
+    cache.get_or_load('p1', None, load)
+    cache.get_or_load('p1', None, load)
+    cache.get_or_load('p1', {'visits': None}, load)
+    assert len(loads) == 2
+
+    cache.invalidate(['p1'])
+    cache.get_or_load('p1', None, load)
+    assert len(loads) == 3
+
+
+def test_cache_skips_charts_read_before_invalidation():
+    cache = patient_chart.PatientChartCache()
+
+    def load():
+        # a push lands while the chart is being read
+        cache.invalidate(['p2'])
+        return '{"stale": true}'
+
+    assert cache.get_or_load('p1', None, load) == '{"stale": true}'
+    assert cache.get_or_load('p1', None, lambda: '{}') == '{}'
+
+
+def test_get_pushed_patient_ids():
+    body = {
+        'patients': {'created': [{'id': 'p1'}], 'updated': [], 'deleted': ['p2']},
+        'visits': {'created': [], 'updated': [{'id': 'v1', 'patient_id': 'p3'}]},
+        'clinics': {'created': [{'id': 'c1'}]},
+    }
+
+    assert patient_chart.get_pushed_patient_ids(body) == {'p1', 'p2', 'p3'}
+
+
+def test_has_deleted_records():
+    # the deleted patients are their own ids
+    body = {'patients': {'deleted': ['p1']}, 'visits': {'created': [], 'deleted': []}}
+    assert not patient_chart.has_deleted_records(body)
+
+    body['visits']['deleted'] = ['v1']
+    assert patient_chart.has_deleted_records(body)
@@ -0,0 +1,60 @@
+import time
+
+from flask import Flask, jsonify
+
+from hikmahealth.server.client import instrument, profiler
+
+
+def wait_for_it():
+    time.sleep(0.1)
+
+
+def make_app(directory, sample_rate, slow_ms=0):
+    app = Flask(__name__)
+    instrument.register_instrumentation(app)
+    profiler.register_profiler(app, sample_rate, slow_ms, str(directory))
+
+    @app.route('/slow')
+    def slow():
+        instrument.get_stats().record(0.002, query='SELECT 1')
+        wait_for_it()
+        return jsonify({'ok': True})
+
+    return app
+
+
+def test_sampled_requests_are_saved(tmp_path):
+    app = make_app(tmp_path, sample_rate=1)
+    assert app.test_client().get('/slow').status_code == 200
+
+    (summary,) = profiler.list_profiles(str(tmp_path))
+    assert summary['path'] == '/slow'
+    assert summary['reason'] == 'sampled'
+    assert summary['queries']['statements'] == 1
+    assert 'collapsed' not in summary
+
+    profile = profiler.get_profile(str(tmp_path), summary['id'])
+    assert profile['statements'] == [
+        {'sql': 'SELECT 1', 'ms': 2.0, 'statements': 1, 'rows': 0}
+    ]
+    assert profile['samples'] > 0
+    assert 'profiler_test:wait_for_it' in profile['collapsed']
+
+
+def test_only_slow_requests_are_saved(tmp_path):
+    make_app(tmp_path, sample_rate=0, slow_ms=10_000).test_client().get('/slow')
+    assert profiler.list_profiles(str(tmp_path)) == []
+
+    make_app(tmp_path, sample_rate=0, slow_ms=50).test_client().get('/slow')
+    (summary,) = profiler.list_profiles(str(tmp_path))
+    assert summary['reason'] == 'slow'
+
+
+def test_profiles_are_pruned(tmp_path):
+    for _ in range(3):
+        profiler.save_profile(
+            str(tmp_path), profiler.Profile(0), {'started_at': ''}, keep=2
+        )
+
+    assert len(profiler.list_profiles(str(tmp_path))) == 2
+    assert profiler.get_profile(str(tmp_path), '../secrets') is None
@@ -0,0 +1,80 @@
+import io
+import json
+
+import pytest
+
+from hikmahealth.server.helpers import push_body, push_log, sync_push
+from hikmahealth.sync.operation import Sink
+from hikmahealth.utils.errors import WebError
+
+PUSH = {
+    'patients': {
+        'created': [{'id': f'p{i}', 'given_name': 'Amal'} for i in range(5)],
+        'updated': [{'id': 'p9', 'given_name': 'Sami'}],
+        'deleted': ['p8'],
+    },
+    'visits': {
+        'created': [{'id': 'v1', 'patient_id': 'p1', 'notes': 'x' * 100}],
+        'updated': None,
+    },
+}
+
+
+def spool(document, max_size=1_000_000):
+    raw = json.dumps(document).encode()
+    return push_body.spool(io.BytesIO(raw), b'last_pulled_at=0', max_size), raw
+
+
+def test_push_is_read_in_batches():
+    spooled, raw = spool(PUSH)
+    with spooled:
+        assert spooled.size == len(raw)
+        assert spooled.body_hash == push_log.hash_body(b'last_pulled_at=0', raw)
+
+        push = push_body.scan(spooled, max_records=100, batch_size=2)
+        assert push.records == 8
+        assert push.counts['patients'] == {'created': 5, 'updated': 1, 'deleted': 1}
+        assert push.summary['visits'] == {'created': [{'patient_id': 'p1'}]}
+        assert push.summary['patients']['deleted'] == ['p8']
+
+        batches = [b.to_dict() for b in push.deltas['patients'].batches()]
+        assert [len(b['created']) for b in batches] == [2, 2, 1, 0, 0]
+        assert batches[3]['updated'] == PUSH['patients']['updated']
+        assert batches[4]['deleted'] == ['p8']
+
+
+def test_batches_are_pushed_in_order():
+    applied = []
+    sink = Sink()
+    sink.add('patients', lambda delta, at, conn: applied.append(delta.to_dict()))
+
+    spooled, _ = spool(PUSH)
+    with spooled:
+        push = push_body.scan(spooled, max_records=100, batch_size=4)
+        sync_push.push_changes(sink, 'patients', push.deltas['patients'], None, None)
+
+    assert [r['id'] for b in applied for r in b['created']] == [
+        f'p{i}' for i in range(5)
+    ]
+    assert len(applied) == 4
+
+
+def test_limits():
+    with pytest.raises(WebError) as err:
+        spool(PUSH, max_size=100)
+    assert err.value.status_code == 413
+
+    spooled, _ = spool(PUSH)
+    with spooled, pytest.raises(WebError) as err:
+        push_body.scan(spooled, max_records=7, batch_size=10)
+    assert err.value.status_code == 413
+
+
+@pytest.mark.parametrize(
+    'document', [[], {'patients': []}, {'patients': {'created': {}}}]
+)
+def test_invalid_pushes(document):
+    spooled, _ = spool(document)
+    with spooled, pytest.raises(WebError) as err:
+        push_body.scan(spooled, max_records=10, batch_size=10)
+    assert err.value.status_code == 400
@@ -0,0 +1,77 @@
+import pytest
+
+from hikmahealth.server.helpers import push_log
+from hikmahealth.utils.errors import WebError
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+        return self
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+
+class FakeConnection:
+    def __init__(self, *rows):
+        self.cur = FakeCursor(rows)
+
+    def cursor(self):
+        return self.cur
+
+    def commit(self):
+        pass
+
+
+def test_fingerprint():
+    query = b'last_pulled_at=1700000000000'
+
+    fingerprint, body_hash = push_log.get_fingerprint(query, b'{"patients": {}}')
+    assert fingerprint == f'sha256:{body_hash}'
+    # the same push, retried
+    assert push_log.get_fingerprint(query, b'{"patients": {}}')[0] == fingerprint
+    assert push_log.get_fingerprint(b'last_pulled_at=0', b'{"patients": {}}')[0] != fingerprint
+
+    keyed, keyed_hash = push_log.get_fingerprint(query, b'{}', 'abc')
+    assert keyed == 'key:abc'
+    assert keyed_hash == push_log.hash_body(query, b'{}')
+
+    with pytest.raises(WebError):
+        push_log.get_fingerprint(query, b'{}', 'x' * 101)
+
+
+def test_claim_new_push():
+    claim = push_log.claim(FakeConnection(('fp',)), 'fp', 'h')
+    assert claim.owned and not claim.in_progress
+
+
+def test_claim_replayed_push():
+    response = {'ok': True, 'timestamp': '2024-01-01T00:00:00+00:00'}
+    conn = FakeConnection(None, ('h', push_log.STATUS_DONE, response))
+
+    claim = push_log.claim(conn, 'fp', 'h')
+    assert not claim.owned
+    assert claim.response == response
+
+
+def test_claim_push_in_progress():
+    claim = push_log.claim(FakeConnection(None, ('h', push_log.STATUS_PENDING, None)), 'fp', 'h')
+    assert claim.in_progress
+
+
+def test_claim_reused_key():
+    with pytest.raises(WebError) as err:
+        push_log.claim(FakeConnection(None, ('other', push_log.STATUS_DONE, {})), 'key:k', 'h')
+
+    assert err.value.status_code == 422
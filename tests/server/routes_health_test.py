@@ -0,0 +1,87 @@
+import threading
+
+from flask import Flask
+
+from hikmahealth.server import routes_health
+
+
+def make_client():
+    app = Flask(__name__)
+    app.register_blueprint(routes_health.api, url_prefix='/health')
+    return app.test_client()
+
+
+def test_live():
+    assert make_client().get('/health/live').status_code == 200
+
+
+def test_schema_heads():
+    # a single head, or the migrations have diverged
+    assert len(routes_health.get_schema_heads()) == 1
+
+
+def test_schema_state():
+    known = frozenset(['a', 'b', 'c'])
+    heads = ('c',)
+
+    assert routes_health.get_schema_state(['c'], heads, known) == 'current'
+    assert routes_health.get_schema_state(['b'], heads, known) == 'behind'
+    assert routes_health.get_schema_state([], heads, known) == 'behind'
+    # migrated by the next release, while this one still runs
+    assert routes_health.get_schema_state(['d'], heads, known) == 'ahead'
+
+    # a database at one of two heads is behind the other
+    heads = ('b', 'c')
+    assert routes_health.get_schema_state(['c'], heads, known) == 'behind'
+    assert routes_health.get_schema_state(['b', 'c'], heads, known) == 'current'
+
+
+def test_not_ready_until_warmed_up(monkeypatch):
+    started = []
+    monkeypatch.setattr(routes_health, '_warmed_up', False)
+    monkeypatch.setattr(routes_health, '_warm_up_state', 'failed')
+    monkeypatch.setattr(routes_health, 'start_warm_up', lambda: started.append(1))
+
+    response = make_client().get('/health/ready')
+    assert response.status_code == 503
+    assert response.get_json()['checks'] == {'warm_up': {'ok': False, 'state': 'failed'}}
+    # tried again in the background
+    assert started == [1]
+
+
+def test_warm_up_runs_in_the_background(monkeypatch):
+    release = threading.Event()
+    runs = []
+
+    def warm_up():
+        runs.append(1)
+        release.wait(5)
+
+    monkeypatch.setattr(routes_health, '_warmed_up', False)
+    monkeypatch.setattr(routes_health, '_warm_up_thread', None)
+    monkeypatch.setattr(routes_health, 'warm_up', warm_up)
+
+    # the probes answer while the warm-up runs, and don't start it again
+    for _ in range(3):
+        assert make_client().get('/health/ready').status_code == 503
+
+    release.set()
+    routes_health._warm_up_thread.join(5)
+    assert runs == [1]
+
+
+def test_ready(monkeypatch):
+    database = {'ok': True, 'pool': {}, 'schema': {}}
+    monkeypatch.setattr(routes_health, '_warmed_up', True)
+    monkeypatch.setattr(routes_health, '_check_database', lambda: database)
+    monkeypatch.setattr(routes_health, 'get_resource_manager_state', lambda: 'error')
+
+    response = make_client().get('/health/ready')
+    assert response.status_code == 200
+    assert response.get_json()['checks'] == {
+        'database': database,
+        'storage': {'ok': True, 'state': 'error'},
+    }
+
+    database['ok'] = False
+    assert make_client().get('/health/ready').status_code == 503
@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+from hikmahealth.server.client import slow_queries
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    submitted = []
+    monkeypatch.setattr(slow_queries, '_pending', {})
+    monkeypatch.setattr(slow_queries, '_explained_at', {})
+    monkeypatch.setattr(slow_queries, 'EXPLAIN_RATE', 1.0)
+    monkeypatch.setattr(slow_queries, '_flusher_pid', None)
+    monkeypatch.setattr(
+        slow_queries, '_start_flusher', lambda: submitted.append(('flusher', ()))
+    )
+    monkeypatch.setattr(
+        slow_queries._executor, 'submit', lambda f, *args: submitted.append((f, args))
+    )
+    return submitted
+
+
+def test_fingerprint():
+    key, normalized = slow_queries.fingerprint(
+        "SELECT * FROM patients -- filtered\n"
+        "WHERE  sex = 'female' AND age > 30 AND clinic_id IN (%s, %s, %s) LIMIT 10"
+    )
+    assert normalized == (
+        'SELECT * FROM patients WHERE sex = ? AND age > ? AND clinic_id IN (...) LIMIT ?'
+    )
+
+    other, _ = slow_queries.fingerprint(
+        "SELECT * FROM patients WHERE sex = 'male' AND age > 5 "
+        'AND clinic_id IN (%s, %s) LIMIT 20'
+    )
+    assert key == other
+
+
+def test_param_shapes():
+    assert slow_queries.param_shapes(None) is None
+    assert slow_queries.param_shapes(['a', 1, None, [1, 2]]) == [
+        'str',
+        'int',
+        'null',
+        'list[2]',
+    ]
+    assert slow_queries.param_shapes({'ids': ('a',)}) == {'ids': 'tuple[1]'}
+
+
+def test_only_reads_are_explained():
+    assert slow_queries.is_explainable('  select 1')
+    assert slow_queries.is_explainable('WITH p AS (SELECT 1) SELECT * FROM p')
+    assert not slow_queries.is_explainable('SELECT * FROM jobs FOR UPDATE')
+    assert not slow_queries.is_explainable('WITH d AS (DELETE FROM x) SELECT 1')
+    assert not slow_queries.is_explainable('UPDATE patients SET sex = %s')
+
+
+def test_capture(recorder):
+    slow_queries.capture('SELECT * FROM visits WHERE id = %s', ['a'], 1.5)
+    slow_queries.capture('SELECT * FROM visits WHERE id = %s', ['b'], 0.5)
+    slow_queries.capture('UPDATE visits SET deleted_at = now()', None, 2.0)
+
+    select, update = slow_queries._pending.values()
+    assert (select.calls, select.total_ms, select.max_ms) == (2, 2000.0, 1500.0)
+    assert select.param_shapes == ['str']
+    assert update.calls == 1
+
+    # the flushes are started once, the select is explained once, and the update never
+    assert recorder == [
+        ('flusher', ()),
+        (slow_queries._explain, ('SELECT * FROM visits WHERE id = %s', ['a'])),
+    ]
+
+
+def test_recorded_statements_are_flushed_periodically(monkeypatch):
+    stopped = threading.Event()
+    flushes = []
+
+    def flush():
+        flushes.append(1)
+        if len(flushes) == 3:
+            stopped.set()
+
+    monkeypatch.setattr(slow_queries, 'flush', flush)
+    slow_queries._flush_every(0, stopped)
+    assert len(flushes) == 3
@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+
+from hikmahealth.server import config, startup
+from hikmahealth.server.client import resources
+
+
+@pytest.fixture
+def created(monkeypatch):
+    results = []
+    calls = []
+
+    def create():
+        calls.append(1)
+        return results.pop(0)
+
+    monkeypatch.setattr(resources, '_try_create_resource_manager', create)
+    resources.reset_resource_manager()
+    yield results, calls
+    resources.reset_resource_manager()
+
+
+def test_resource_manager_is_shared(created):
+    results, calls = created
+    manager = object()
+    results.append((manager, None))
+
+    assert resources.get_resource_manager() is manager
+    assert resources.get_resource_manager() is manager
+    assert len(calls) == 1
+
+
+def test_failed_initialization_is_retried(created, monkeypatch):
+    results, calls = created
+    manager = object()
+    results.extend([(None, resources.ResourceManagerInitError('no store')), (manager, None)])
+
+    with pytest.raises(resources.ResourceManagerInitError):
+        resources.get_resource_manager()
+    with pytest.raises(resources.ResourceManagerInitError):
+        resources.get_resource_manager()
+    assert len(calls) == 1
+
+    monkeypatch.setattr(resources, 'RETRY_SECONDS', 0)
+    assert resources.get_resource_manager() is manager
+
+
+def test_failed_refresh_keeps_the_manager(created, monkeypatch):
+    results, calls = created
+    manager, refreshed = object(), object()
+    results.extend([
+        (manager, None),
+        (None, resources.ResourceManagerInitError('store unreachable')),
+        (refreshed, None),
+    ])
+
+    assert resources.get_resource_manager() is manager
+
+    monkeypatch.setattr(resources, 'REFRESH_SECONDS', 0)
+    assert resources.get_resource_manager() is manager
+    assert resources.get_resource_manager_state() == 'ready'
+
+    # tried again after `RETRY_SECONDS`
+    monkeypatch.setattr(resources, 'RETRY_SECONDS', 0)
+    assert resources.get_resource_manager() is refreshed
+    assert len(calls) == 3
+
+
+def test_concurrent_requests_initialize_once(created):
+    results, calls = created
+    manager = object()
+    results.append((manager, None))
+
+    found = []
+    threads = [
+        threading.Thread(target=lambda: found.append(resources.get_resource_manager()))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert found == [manager] * 8
+    assert len(calls) == 1
+
+
+def test_startup_modes(monkeypatch):
+    calls = []
+
+    monkeypatch.setattr(config, 'HH_STARTUP_MODE', 'lazy')
+    startup.start({'store': lambda: calls.append('store')})
+    assert calls == []
+    assert 'import' in startup.TIMINGS
+
+    monkeypatch.setattr(config, 'HH_STARTUP_MODE', 'eager')
+    startup.start({'store': lambda: calls.append('store')})
+    assert calls == ['store']
+    assert 'store' in startup.TIMINGS
@@ -0,0 +1,210 @@
+import asyncio
+import base64
+import threading
+
+import pytest
+from flask import Flask, jsonify
+
+from hikmahealth.server.helpers import sync_admission
+from hikmahealth.server.helpers.sync_admission import Gate, Rejected
+
+
+def make_gate(limit=1, queue_size=4, timeout=5.0, per_client=2):
+    return Gate('test', limit, queue_size, timeout, per_client)
+
+
+def wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError('timed out')
+
+
+class Holder:
+    """Holds a place at the gate on a thread, until released"""
+
+    def __init__(self, gate, client, entered_log=None):
+        self.release = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.run, args=(gate, client, entered_log)
+        )
+        self.thread.start()
+
+    def run(self, gate, client, entered_log):
+        try:
+            with gate.admit(client):
+                if entered_log is not None:
+                    entered_log.append(client)
+                self.release.wait(5)
+        except Rejected as err:
+            self.error = err
+
+    def done(self):
+        self.release.set()
+        self.thread.join(5)
+
+
+def test_requests_over_the_limit_wait_their_turn():
+    gate = make_gate()
+    entered = []
+    first = Holder(gate, 'a', entered)
+    wait_for(lambda: gate.running == 1)
+
+    second = Holder(gate, 'b', entered)
+    wait_for(lambda: gate.waiting == 1)
+    assert entered == ['a']
+
+    first.done()
+    wait_for(lambda: entered == ['a', 'b'])
+    second.done()
+    assert gate.running == 0 and gate.waiting == 0
+    assert first.error is None and second.error is None
+
+
+def test_a_client_is_limited():
+    gate = make_gate(limit=4, per_client=1)
+    holder = Holder(gate, 'device:a')
+    wait_for(lambda: gate.running == 1)
+
+    with pytest.raises(Rejected) as err:
+        with gate.admit('device:a'):
+            pass
+    assert err.value.status_code == 429
+    assert err.value.retry_after >= 1
+
+    # the other clients aren't
+    with gate.admit('device:b'):
+        pass
+
+    holder.done()
+
+
+def test_full_queue_is_shed_with_retry_after():
+    gate = make_gate(limit=1, queue_size=1)
+    holders = [Holder(gate, 'a')]
+    wait_for(lambda: gate.running == 1)
+    holders.append(Holder(gate, 'b'))
+    wait_for(lambda: gate.waiting == 1)
+
+    with pytest.raises(Rejected) as err:
+        with gate.admit('c'):
+            pass
+    assert err.value.status_code == 503
+    assert err.value.reason == 'queue_full'
+    # two requests ahead, of about a second each
+    assert 2 <= err.value.retry_after <= 3
+
+    for holder in holders:
+        holder.done()
+
+
+def test_waits_longer_than_the_timeout_are_shed():
+    gate = make_gate(limit=1, queue_size=10, timeout=0.05)
+    holder = Holder(gate, 'a')
+    wait_for(lambda: gate.running == 1)
+
+    # the requests are expected to take a second, longer than the timeout
+    with pytest.raises(Rejected) as err:
+        with gate.admit('b'):
+            pass
+    assert err.value.reason == 'overloaded'
+
+    holder.done()
+
+
+def test_waiting_times_out():
+    gate = make_gate(limit=1, timeout=0.05)
+    gate._mean_seconds = 0.01
+    holder = Holder(gate, 'a')
+    wait_for(lambda: gate.running == 1)
+
+    with pytest.raises(Rejected) as err:
+        with gate.admit('b'):
+            pass
+    assert err.value.reason == 'timeout'
+    assert gate.waiting == 0
+
+    holder.done()
+    assert gate.running == 0
+
+
+def test_places_go_to_the_clients_with_fewest_requests_running():
+    gate = make_gate(limit=2, queue_size=10, per_client=3)
+    entered = []
+    holders = [Holder(gate, 'busy', entered), Holder(gate, 'calm', entered)]
+    wait_for(lambda: gate.running == 2)
+
+    # the retries of `busy` queue first
+    holders.append(Holder(gate, 'busy', entered))
+    wait_for(lambda: gate.waiting == 1)
+    holders.append(Holder(gate, 'other', entered))
+    wait_for(lambda: gate.waiting == 2)
+
+    # a place freed by `calm` goes to `other`, while `busy` still has one running
+    holders[1].done()
+    wait_for(lambda: len(entered) == 3)
+    assert entered[2] == 'other'
+
+    for holder in holders:
+        holder.done()
+    assert gate.running == 0 and gate.waiting == 0
+
+
+def test_async_requests_wait_their_turn():
+    gate = make_gate()
+    entered = []
+
+    async def pull(client, hold):
+        async with gate.admit_async(client):
+            entered.append(client)
+            await asyncio.sleep(hold)
+
+    async def main():
+        first = asyncio.create_task(pull('a', 0.05))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(pull('b', 0))
+        await asyncio.sleep(0.01)
+        assert gate.waiting == 1
+        await asyncio.gather(first, second)
+
+    asyncio.run(main())
+    assert entered == ['a', 'b']
+    assert gate.running == 0 and gate.waiting == 0
+
+
+def test_client_of_a_request():
+    credentials = base64.b64encode(b'Nurse@clinic.org:secret').decode()
+    authorization = {'Authorization': f'Basic {credentials}'}
+
+    assert sync_admission.get_client({'X-Device-Id': 'tab-1'}, '10.0.0.1') == (
+        'device:tab-1'
+    )
+    assert sync_admission.get_client(authorization, '10.0.0.1') == (
+        'user:nurse@clinic.org'
+    )
+    assert sync_admission.get_client({}, '10.0.0.1') == 'addr:10.0.0.1'
+
+
+def test_route_answers_rejections():
+    gate = make_gate(limit=1, queue_size=0)
+    app = Flask(__name__)
+
+    @app.route('/sync')
+    @sync_admission.admitted(gate)
+    def sync():
+        return jsonify({'ok': True})
+
+    client = app.test_client()
+    assert client.get('/sync').status_code == 200
+
+    holder = Holder(gate, 'addr:other')
+    wait_for(lambda: gate.running == 1)
+
+    response = client.get('/sync')
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    assert response.get_json()['reason'] == 'queue_full'
+
+    holder.done()
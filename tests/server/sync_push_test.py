@@ -0,0 +1,113 @@
+import contextlib
+import datetime
+import uuid
+
+import pytest
+
+from hikmahealth.server import routes_mobile
+from hikmahealth.server.helpers import sync_push
+from hikmahealth.sync.data import DeltaData
+from hikmahealth.sync.errors import SyncPushError
+
+
+class FakeConnection:
+    def __init__(self, log: list, name: str):
+        self.log = log
+        self.name = name
+
+    @contextlib.contextmanager
+    def transaction(self):
+        try:
+            yield
+        except BaseException:
+            self.log.append(('rollback', self.name))
+            raise
+        self.log.append(('commit', self.name))
+
+
+def _connector(log):
+    count = 0
+
+    @contextlib.contextmanager
+    def connect():
+        nonlocal count
+        count += 1
+        yield FakeConnection(log, f'c{count}')
+
+    return connect
+
+
+def _record(applied, key, fail=None):
+    def apply(deltadata, lastat, conn):
+        if key == fail:
+            raise Exception('failed')
+        applied.append((key, conn.name))
+
+    return apply
+
+
+def _full_push():
+    patient_id, visit_id, clinic_id = (str(uuid.uuid4()) for _ in range(3))
+    record = {'id': str(uuid.uuid4()), 'patient_id': patient_id}
+    return {
+        'patients': DeltaData(created=[{'id': patient_id}]),
+        'patient_additional_attributes': DeltaData(created=[record]),
+        'visits': DeltaData(
+            created=[{**record, 'id': visit_id, 'clinic_id': clinic_id}]
+        ),
+        'events': DeltaData(created=[{**record, 'visit_id': visit_id}]),
+        'appointments': DeltaData(
+            created=[{**record, 'visit_id': visit_id, 'clinic_id': clinic_id}]
+        ),
+        'prescriptions': DeltaData(
+            created=[{**record, 'visit_id': visit_id, 'pickup_clinic_id': clinic_id}]
+        ),
+    }
+
+
+@pytest.fixture
+def recorded_sink(monkeypatch):
+    """The sink of the push route, recording the tables applied"""
+    log, applied = [], []
+    sink = routes_mobile.sink
+    for key in list(sink._ops):
+        monkeypatch.setitem(sink._ops, key, _record(applied, key))
+    monkeypatch.setattr(sync_push.db, 'get_pooled_connection', _connector(log))
+    return sink, log, applied
+
+
+def test_full_push_stages():
+    stages = routes_mobile.sink.get_stages(_full_push().keys())
+    assert [sorted(stage) for stage in stages] == [
+        ['patients'],
+        ['patient_additional_attributes', 'visits'],
+        ['appointments', 'events', 'prescriptions'],
+    ]
+
+
+def test_full_push_is_applied_in_one_transaction(recorded_sink):
+    sink, log, applied = recorded_sink
+    deltas = _full_push()
+
+    sync_push.apply_push(sink, deltas, datetime.datetime.now())
+
+    # every table references the patients, so they're all applied on one connection,
+    # the patients then the visits first
+    assert {conn for _, conn in applied} == {'c1'}
+    keys = [key for key, _ in applied]
+    assert sorted(keys) == sorted(deltas)
+    assert keys.index('patients') < keys.index('visits') < keys.index('events')
+    assert log == [('commit', 'c1')]
+
+
+def test_failed_table_rolls_back_the_push(recorded_sink, monkeypatch):
+    sink, log, applied = recorded_sink
+    monkeypatch.setitem(sink._ops, 'events', _record(applied, 'events', 'events'))
+    committed = []
+    monkeypatch.setattr(sink, '_listeners', [committed.append])
+
+    with pytest.raises(SyncPushError):
+        sync_push.apply_push(sink, _full_push(), datetime.datetime.now())
+
+    assert log == [('rollback', 'c1')]
+    assert committed == []
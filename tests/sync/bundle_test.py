@@ -0,0 +1,88 @@
+import datetime
+import threading
+
+from hikmahealth.server.helpers.sync_bundle import BundleCache
+from hikmahealth.sync.bundle import Bundle, filter_since_change, filter_since_time
+
+T0 = datetime.datetime(2024, 1, 1, tzinfo=datetime.UTC)
+
+
+def _at(hours):
+    return T0 + datetime.timedelta(hours=hours)
+
+
+def _row(id, created, modified, deleted_at=None, is_deleted=False, change_seq=None):
+    return dict(
+        id=id,
+        server_created_at=created,
+        last_modified=modified,
+        deleted_at=deleted_at,
+        is_deleted=is_deleted,
+        change_seq=change_seq,
+    )
+
+
+ROWS = [
+    _row('old-updated', _at(0), _at(5), change_seq=12),
+    _row('new', _at(4), _at(4), change_seq=11),
+    _row('old-unchanged', _at(0), _at(1), change_seq=2),
+    _row('deleted', _at(0), _at(6), deleted_at=_at(6), is_deleted=True, change_seq=13),
+    _row('deleted-before', _at(0), _at(1), deleted_at=_at(1), is_deleted=True, change_seq=3),
+    _row('inconsistent', _at(0), _at(5), deleted_at=_at(5), change_seq=12),
+]
+
+
+def test_filter_since_time():
+    delta = filter_since_time(ROWS, _at(3))
+
+    assert [r['id'] for r in delta.created] == ['new']
+    assert [r['id'] for r in delta.updated] == ['old-updated']
+    assert delta.deleted == ['deleted']
+
+
+def test_filter_since_change():
+    delta = filter_since_change(ROWS, 11, _at(3))
+
+    assert [r['id'] for r in delta.created] == ['new']
+    assert [r['id'] for r in delta.updated] == ['old-updated']
+    assert delta.deleted == ['deleted']
+
+
+def test_bundle_covers():
+    bundle = Bundle(since=_at(2), since_change_seq=10, timestamp=_at(7), change_seq=14)
+
+    assert bundle.covers(_at(3))
+    assert not bundle.covers(_at(1))
+    assert bundle.covers(_at(1), last_change_seq=10)
+    assert not bundle.covers(_at(3), last_change_seq=9)
+
+    bundle.since_change_seq = None
+    assert not bundle.covers(_at(3), last_change_seq=20)
+
+
+def test_bundle_cache_builds_once():
+    cache = BundleCache(ttl=60)
+    bundle = Bundle(since=_at(2), since_change_seq=None, timestamp=_at(7), change_seq=14)
+    builds = []
+    started = threading.Event()
+
+    def build():
+        builds.append(1)
+        started.wait(1)
+        return bundle
+
+    threads = [
+        threading.Thread(target=cache.get_or_build, args=(build,)) for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    started.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(builds) == 1
+    assert cache.get_or_build(build) is bundle
+
+    cache.clear()
+    cache.get_or_build(build)
+    assert len(builds) == 2
@@ -0,0 +1,184 @@
+import asyncio
+import datetime
+import threading
+
+import pytest
+
+from hikmahealth.entity import hh
+from hikmahealth.server.helpers import delta_cache
+from hikmahealth.sync.cache import DeltaCache
+
+
+def test_concurrent_loads_are_coalesced():
+    cache = DeltaCache(maxsize=10, ttl=60)
+    loads = []
+    release = threading.Event()
+
+    def load():
+        loads.append(1)
+        release.wait(1)
+        return ['row']
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_or_load(('patients', 1), load))
+        )
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1
+    assert results == [['row']] * 5
+
+
+def test_invalidation_drops_loads_in_progress():
+    cache = DeltaCache(maxsize=10, ttl=60)
+
+    def load():
+        # a push commits while the records are read
+        cache.invalidate(['patients'])
+        return 'stale'
+
+    assert cache.get_or_load(('patients', 1), load) == 'stale'
+    assert cache.get_or_load(('patients', 1), lambda: 'fresh') == 'fresh'
+    assert cache.get_or_load(('patients', 1), lambda: 'again') == 'fresh'
+
+    cache.get_or_load(('visits', 1), lambda: 'visits')
+    cache.invalidate(['patients'])
+    assert cache.get_or_load(('visits', 1), lambda: 'other') == 'visits'
+    assert cache.get_or_load(('patients', 1), lambda: 'new') == 'new'
+
+
+def test_failed_loads_are_not_cached():
+    cache = DeltaCache(maxsize=10, ttl=60)
+
+    def fail():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        cache.get_or_load(('patients', 1), fail)
+
+    assert cache.get_or_load(('patients', 1), lambda: 'ok') == 'ok'
+
+
+def test_size_is_bounded():
+    cache = DeltaCache(maxsize=5, ttl=60, getsizeof=len)
+
+    cache.get_or_load(('patients', 1), lambda: [1, 2, 3])
+    cache.get_or_load(('visits', 1), lambda: [1, 2, 3])
+    # the least recently used entry was evicted
+    assert cache.get_or_load(('patients', 1), lambda: ['reloaded']) == ['reloaded']
+
+    # too large to be kept at all
+    assert cache.get_or_load(('events', 1), lambda: list(range(10))) == list(range(10))
+    assert cache.get_or_load(('events', 1), lambda: []) == []
+
+
+def test_pulls_share_buckets():
+    at = datetime.datetime(2024, 1, 1, 8, 1, 30, tzinfo=datetime.UTC)
+    mode, start = delta_cache.get_bucket(at)
+    assert mode == delta_cache.MODE_TIME
+    assert start <= at
+    assert delta_cache.get_bucket(at + datetime.timedelta(seconds=10)) == (mode, start)
+
+    assert delta_cache.get_bucket(at, 123456) == (delta_cache.MODE_CHANGE_SEQ, 123000)
+
+
+def test_async_loads_join_the_loads_in_progress():
+    cache = DeltaCache(maxsize=10, ttl=60)
+    loads = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def load():
+        loads.append('thread')
+        started.set()
+        release.wait(1)
+        return ['row']
+
+    thread = threading.Thread(target=cache.get_or_load, args=(('patients', 1), load))
+    thread.start()
+    started.wait(1)
+
+    async def load_async():
+        loads.append('async')
+        return ['other']
+
+    async def main():
+        pulls = [cache.get_or_load_async(('patients', 1), load_async) for _ in range(3)]
+        waiting = asyncio.gather(*pulls)
+        await asyncio.sleep(0.01)
+        release.set()
+        return await waiting
+
+    assert asyncio.run(main()) == [['row']] * 3
+    thread.join()
+    assert loads == ['thread']
+
+    # the entries are shared too
+    assert asyncio.run(cache.get_or_load_async(('patients', 1), load_async)) == ['row']
+
+    async def fail():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        asyncio.run(cache.get_or_load_async(('visits', 1), fail))
+    assert cache.get_or_load(('visits', 1), lambda: 'ok') == 'ok'
+
+
+class FakeAsyncCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, query, params=None):
+        self.conn.executed.append(query)
+        self.result = self.conn.results.pop(0)
+
+    async def fetchone(self):
+        return self.result
+
+    async def fetchall(self):
+        return self.result
+
+
+class FakeAsyncConnection:
+    def __init__(self, results):
+        self.results = results
+        self.executed = []
+
+    def cursor(self, row_factory=None):
+        return FakeAsyncCursor(self)
+
+
+def test_async_deltas_are_read_once_per_window(monkeypatch):
+    monkeypatch.setattr(delta_cache, 'cache', DeltaCache(maxsize=10, ttl=60))
+    entities = {'patients': hh.Patient}
+    at = datetime.datetime(2024, 1, 1, 8, 1, 30, tzinfo=datetime.UTC)
+
+    # the highest change_seq, the cursor, then the records
+    conn = FakeAsyncConnection([(7,), (40,), []])
+    changes, _, change_seq = asyncio.run(
+        delta_cache.get_deltas_async(conn, entities, at)
+    )
+    assert change_seq == 40
+    assert changes['patients'] == {'created': [], 'updated': [], 'deleted': []}
+    assert len(conn.executed) == 3
+
+    # a pull of the same window, with the table unchanged, only reads its change_seq
+    conn = FakeAsyncConnection([(7,)])
+    asyncio.run(
+        delta_cache.get_deltas_async(conn, entities, at + datetime.timedelta(seconds=5))
+    )
+    assert len(conn.executed) == 1
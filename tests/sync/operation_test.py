@@ -62,3 +62,87 @@ def test_sync_operations():
 
     with pytest.raises(SyncPushError):
         sinkdata.push('value', DeltaData(), now, 13232)
+
+
+def _noop(*args):
+    pass
+
+
+def test_sync_stages_follow_dependencies():
+    sinkdata = Sink()
+    sinkdata.add('patients', _noop)
+    sinkdata.add('attributes', _noop, depends_on=['patients'])
+    sinkdata.add('visits', _noop, depends_on=['patients'])
+    sinkdata.add('events', _noop, depends_on=['patients', 'visits'])
+    sinkdata.add('prescriptions', _noop, depends_on=['visits'])
+
+    stages = sinkdata.get_stages(
+        ['events', 'prescriptions', 'visits', 'attributes', 'patients', 'unknown']
+    )
+    assert [sorted(stage) for stage in stages] == [
+        ['patients'],
+        ['attributes', 'visits'],
+        ['events', 'prescriptions'],
+    ]
+
+    # dependencies missing from the push don't hold anything back
+    assert [sorted(stage) for stage in sinkdata.get_stages(['events', 'attributes'])] == [
+        ['attributes', 'events']
+    ]
+    assert sinkdata.get_stages([]) == []
+
+
+def test_sync_dependencies_must_be_added_first():
+    sinkdata = Sink()
+
+    with pytest.raises(AssertionError):
+        sinkdata.add('visits', _noop, depends_on=['patients'])
+
+    sinkdata.add('patients', _noop)
+    sinkdata.add('visits', _noop, depends_on=['patients'])
+    sinkdata.remove('patients')
+
+    # removes the operations depending on it too
+    assert sinkdata.get_stages(['visits']) == []
+
+
+def test_sync_push_all_in_order():
+    sinkdata = Sink()
+    now = datetime.datetime.now()
+    applied = []
+
+    def record(key):
+        return lambda deltadata, lastat, val: applied.append(key)
+
+    sinkdata.add('patients', record('patients'))
+    sinkdata.add('visits', record('visits'), depends_on=['patients'])
+    sinkdata.add('events', record('events'), depends_on=['visits'])
+
+    sinkdata.push_all(
+        {'events': DeltaData(), 'visits': DeltaData(), 'patients': DeltaData()}, now, 1
+    )
+    assert applied == ['patients', 'visits', 'events']
+
+
+def test_sync_listeners_get_written_keys():
+    sinkdata = Sink()
+    sinkdata.add('patients', _noop)
+    sinkdata.add('visits', _noop, depends_on=['patients'])
+    sinkdata.add('events', _noop, depends_on=['visits'])
+    sinkdata.add('clinics', _noop)
+
+    notified = []
+    sinkdata.add_listener(notified.append)
+
+    def fail(keys):
+        raise Exception('failed')
+
+    # a failing listener doesn't stop the others
+    sinkdata.add_listener(fail)
+    sinkdata.add_listener(notified.append)
+
+    sinkdata.committed(['events', 'unknown'])
+    assert notified == [{'events', 'visits', 'patients'}] * 2
+
+    sinkdata.committed([])
+    assert len(notified) == 2
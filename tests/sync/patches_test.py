@@ -0,0 +1,153 @@
+"""Testing suite for sending updated records as column patches"""
+
+import datetime
+
+from hikmahealth.server.helpers import column_changes
+from hikmahealth.sync.patches import apply_patches, make_patch
+
+LAST_MODIFIED = datetime.datetime(2024, 1, 2, tzinfo=datetime.UTC)
+
+
+def _row(id, **values):
+    return dict(
+        id=id,
+        status='pending',
+        metadata={'notes': 'x' * 100},
+        change_seq=12,
+        last_modified=LAST_MODIFIED,
+        **values,
+    )
+
+
+def test_make_patch():
+    patch = make_patch(_row('a'), ['status', 'missing'])
+    assert patch == dict(
+        id='a', status='pending', change_seq=12, last_modified=LAST_MODIFIED
+    )
+
+
+def test_apply_patches():
+    changes = dict(
+        created=[_row('new')],
+        updated=[_row('changed'), _row('inserted'), _row('unknown')],
+        deleted=['gone'],
+    )
+
+    patched = apply_patches(
+        changes, {'changed': frozenset(['status']), 'inserted': None}
+    )
+
+    assert patched['created'] == changes['created']
+    assert patched['deleted'] == ['gone']
+    # rows inserted since, or without logged changes, are sent whole
+    assert [row['id'] for row in patched['updated']] == ['inserted', 'unknown']
+    assert patched['patched'] == [
+        dict(id='changed', status='pending', change_seq=12, last_modified=LAST_MODIFIED)
+    ]
+
+
+def test_supports_patches(monkeypatch):
+    monkeypatch.setattr(column_changes, 'MIN_SCHEMA_VERSION', None)
+    assert not column_changes.supports_patches('10')
+
+    monkeypatch.setattr(column_changes, 'MIN_SCHEMA_VERSION', 8)
+    assert column_changes.supports_patches('8')
+    assert not column_changes.supports_patches('7')
+    assert not column_changes.supports_patches('v8')
+    assert not column_changes.supports_patches(None)
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.cur = FakeCursor(rows)
+        self.committed = False
+
+    def cursor(self, row_factory=None):
+        return self.cur
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+def test_changed_columns_in_a_single_query():
+    conn = FakeConnection([
+        ('visits', 'v1', False, ['metadata']),
+        ('visits', 'v2', True, None),
+        ('events', 'e1', False, ['form_data', 'metadata']),
+    ])
+
+    changed = column_changes.get_changed_columns(
+        conn, {'visits': ['v1', 'v2'], 'events': ['e1']}, 40
+    )
+
+    assert changed == {
+        'visits': {'v1': frozenset(['metadata']), 'v2': None},
+        'events': {'e1': frozenset(['form_data', 'metadata'])},
+    }
+
+    assert len(conn.cur.executed) == 1
+    query, params = conn.cur.executed[0]
+    assert 'c.change_seq >= %(last_change_seq)s' in query
+    assert params['tables'] == ['visits', 'visits', 'events']
+    assert params['ids'] == ['v1', 'v2', 'e1']
+
+
+def test_no_query_without_updated_rows():
+    conn = FakeConnection([])
+    assert column_changes.get_changed_columns(conn, {'visits': []}, 40) == {}
+    assert conn.cur.executed == []
+
+
+def test_no_patches_for_pulls_by_timestamp():
+    """A transaction committed after a pull by timestamp may have its columns logged
+    before it: its rows are sent whole, which heals the earlier pull"""
+    conn = FakeConnection([])
+    changes = {'visits': {'updated': [_row('v1')]}}
+
+    patched = column_changes.patch_changes(
+        conn, {'visits': object}, changes, last_change_seq=None
+    )
+    assert patched is changes
+    assert conn.cur.executed == []
+
+
+def test_triggers_follow_the_setting():
+    conn = FakeConnection([('visits', 'D'), ('events', 'O')])
+    assert column_changes.set_logging(conn, True) == ['visits']
+    assert conn.committed
+
+    queries = [str(query) for query, _ in conn.cur.executed]
+    assert any('ENABLE' in query and 'visits' in query for query in queries)
+    assert 'sync_column_changes_horizon' in queries[-1]
+
+    # without the writes logged from here on, no patch is sent until enabled again
+    conn = FakeConnection([('visits', 'D'), ('events', 'O')])
+    assert column_changes.set_logging(conn, False) == ['events']
+    queries = [str(query) for query, _ in conn.cur.executed]
+    assert queries[-1] == 'DELETE FROM sync_column_changes_horizon'
+
+    conn = FakeConnection([('visits', 'D')])
+    assert column_changes.set_logging(conn, False) == []
+    assert len(conn.cur.executed) == 1 and not conn.committed
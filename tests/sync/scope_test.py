@@ -0,0 +1,76 @@
+"""Testing suite for resolving the scope of the sync pulls"""
+
+import datetime
+
+import pytest
+
+from hikmahealth.sync.scope import (
+    UNSCOPED,
+    SyncScope,
+    get_group_clinic_ids,
+    is_first_sync,
+    resolve,
+)
+
+
+def test_unconfigured_is_unscoped():
+    assert resolve(None, 'provider', 'c1') == UNSCOPED
+    assert resolve(dict(), 'provider', 'c1') == UNSCOPED
+    assert resolve(dict(mode='all'), 'provider', 'c1').is_unscoped
+
+
+def test_clinic_mode():
+    assert resolve(dict(mode='clinic'), 'provider', 'c1') == SyncScope(('c1',))
+
+
+def test_unscoped_roles():
+    config = dict(mode='clinic')
+    assert resolve(config, 'super_admin', 'c1') == UNSCOPED
+
+    config['unscoped_roles'] = ['admin']
+    assert resolve(config, 'admin', 'c1') == UNSCOPED
+    assert resolve(config, 'super_admin', 'c1') == SyncScope(('c1',))
+
+
+def test_user_without_clinic_is_not_scoped_to_one():
+    config = dict(mode='clinic', recency_days=30)
+    assert resolve(config, 'provider', None) == SyncScope(
+        None, datetime.timedelta(days=30)
+    )
+
+
+def test_clinic_group_mode():
+    config = dict(
+        mode='clinic_group',
+        clinic_groups=dict(north=['c1', 'c2'], east=['c2', 'c3'], south=['c4']),
+    )
+
+    assert resolve(config, 'provider', 'c1') == SyncScope(('c1', 'c2'))
+    assert resolve(config, 'provider', 'c2') == SyncScope(('c1', 'c2', 'c3'))
+    # a clinic in no group only gets its own patients
+    assert resolve(config, 'provider', 'c5') == SyncScope(('c5',))
+
+
+def test_group_clinic_ids_are_strings():
+    assert get_group_clinic_ids({'a': [1, 2]}, 1) == ('1', '2')
+
+
+@pytest.mark.parametrize(
+    'config',
+    [
+        dict(mode='region'),
+        dict(mode='clinic', recency_days=0),
+        dict(mode='clinic', recency_days='90'),
+        dict(mode='clinic_group', clinic_groups=['c1']),
+    ],
+)
+def test_invalid_config(config):
+    with pytest.raises(ValueError):
+        resolve(config, 'provider', 'c1')
+
+
+def test_first_sync():
+    epoch = datetime.datetime.fromtimestamp(0, tz=datetime.UTC)
+    assert is_first_sync(epoch)
+    assert not is_first_sync(epoch, 0)
+    assert not is_first_sync(datetime.datetime(2024, 1, 1, tzinfo=datetime.UTC))
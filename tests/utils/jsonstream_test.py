@@ -0,0 +1,93 @@
+import io
+import json
+
+import pytest
+
+from hikmahealth.utils.jsonstream import JSONStreamError, Reader
+
+DOCUMENT = {
+    'patients': {
+        'created': [
+            {
+                'id': str(i),
+                'weight': i * 1.5,
+                'name': 'Zoë ✓' * i,
+                'tags': [1, None, True, False],
+            }
+            for i in range(50)
+        ],
+        'updated': [],
+        'deleted': ['a', 'b'],
+    },
+    'visits': {'created': None},
+    'seq': 12345678901234567890,
+}
+
+
+def read_document(reader):
+    document = {}
+    for key in reader.iter_object():
+        if reader.peek() != '{':
+            document[key] = reader.read_value()
+            continue
+
+        document[key] = {}
+        for change in reader.iter_object():
+            if reader.peek() == '[':
+                document[key][change] = list(reader.iter_array())
+            else:
+                document[key][change] = reader.read_value()
+
+    reader.end()
+    return document
+
+
+@pytest.mark.parametrize('ensure_ascii', [False, True])
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_reads_across_chunks(chunk_size, ensure_ascii):
+    raw = json.dumps(DOCUMENT, ensure_ascii=ensure_ascii).encode()
+    assert read_document(Reader(io.BytesIO(raw).read, chunk_size)) == DOCUMENT
+
+
+def test_values_are_read_again_from_their_offset():
+    raw = json.dumps(DOCUMENT, ensure_ascii=False).encode()
+    reader = Reader(io.BytesIO(raw).read, 16)
+    offsets = {}
+    for key in reader.iter_object():
+        offsets[key] = reader.tell()
+        reader.skip_value()
+    reader.end()
+
+    file = io.BytesIO(raw)
+    file.seek(offsets['patients'])
+    assert Reader(file.read, 16).read_value() == DOCUMENT['patients']
+
+
+@pytest.mark.parametrize(
+    'raw',
+    [b'{"a": [1, 2', b'{"a" 1}', b'[1 2]', b'{"a": 1} x', b'\xff', b'', b'{"a": tru}'],
+)
+def test_invalid_documents(raw):
+    with pytest.raises(JSONStreamError):
+        reader = Reader(io.BytesIO(raw).read, 2)
+        reader.skip_value()
+        reader.end()
+
+
+def test_errors_are_raised_without_reading_on():
+    raw = b'[1, {"a": x}, ' + b'2, ' * 100_000 + b'3]'
+    file = io.BytesIO(raw)
+    with pytest.raises(JSONStreamError):
+        list(Reader(file.read, 64).iter_array())
+
+    assert file.tell() < 1024
+
+
+def test_values_are_bounded():
+    raw = json.dumps(['x' * 1000, 'y' * 10]).encode()
+    with pytest.raises(JSONStreamError, match='larger than'):
+        list(Reader(io.BytesIO(raw).read, 64, max_value_size=256).iter_array())
+
+    raw = json.dumps(['x' * 100, 'y' * 10]).encode()
+    reader = Reader(io.BytesIO(raw).read, 64, max_value_size=256)
+    assert list(reader.iter_array()) == ['x' * 100, 'y' * 10]
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+from hikmahealth.utils import metrics
+
+
+def make_registry(directory=None):
+    registry = metrics.Registry(directory, flush_seconds=3600)
+    pulled = registry.register(
+        metrics.Counter('pulled_total', 'Records pulled', ['entity'])
+    )
+    pools = registry.register(metrics.Gauge('pool_size', 'Size of the pool'))
+    seconds = registry.register(
+        metrics.Histogram('push_seconds', 'Push time', buckets=(0.1, 1.0))
+    )
+    return registry, pulled, pools, seconds
+
+
+def test_render():
+    registry, pulled, pools, seconds = make_registry()
+    pulled.inc(3, entity='patients')
+    pulled.inc(entity='patients')
+    pulled.inc(2, entity='say "hi"')
+    pools.set(4)
+    seconds.observe(0.05)
+    seconds.observe(0.1)
+    seconds.observe(5)
+
+    assert registry.render() == '\n'.join([
+        '# HELP pool_size Size of the pool',
+        '# TYPE pool_size gauge',
+        'pool_size 4',
+        '# HELP pulled_total Records pulled',
+        '# TYPE pulled_total counter',
+        'pulled_total{entity="patients"} 4',
+        'pulled_total{entity="say \\"hi\\""} 2',
+        '# HELP push_seconds Push time',
+        '# TYPE push_seconds histogram',
+        'push_seconds_bucket{le="0.1"} 2',
+        'push_seconds_bucket{le="1"} 2',
+        'push_seconds_bucket{le="+Inf"} 3',
+        'push_seconds_sum 5.15',
+        'push_seconds_count 3',
+        '',
+    ])
+
+
+def test_labels_are_checked():
+    _, pulled, _, _ = make_registry()
+
+    with pytest.raises(ValueError):
+        pulled.inc()
+    with pytest.raises(ValueError):
+        pulled.inc(entity='patients', table='patients')
+    with pytest.raises(ValueError):
+        pulled.inc(-1, entity='patients')
+
+
+def test_collectors_run_before_reading():
+    registry, _, pools, _ = make_registry()
+    registry.on_collect(lambda: pools.set(7))
+
+    assert 'pool_size 7\n' in registry.render()
+
+
+def test_processes_are_merged(tmp_path, monkeypatch):
+    registry, pulled, pools, seconds = make_registry(str(tmp_path))
+    pulled.inc(2, entity='patients')
+    pools.set(3)
+    seconds.observe(0.5)
+    registry.flush()
+
+    # another worker, with the same metrics. the first one is now gone
+    os.rename(tmp_path / f'metrics-{os.getpid()}.json', tmp_path / 'metrics-1.json')
+    monkeypatch.setattr(metrics, '_is_alive', lambda pid: pid == os.getpid())
+
+    other, pulled, pools, seconds = make_registry(str(tmp_path))
+    pulled.inc(5, entity='patients')
+    pulled.inc(1, entity='visits')
+    pools.set(4)
+    seconds.observe(0.05)
+
+    rendered = other.render()
+    assert 'pulled_total{entity="patients"} 7\n' in rendered
+    assert 'pulled_total{entity="visits"} 1\n' in rendered
+    # the gauges of the processes gone are left out
+    assert 'pool_size 4\n' in rendered
+    assert 'push_seconds_bucket{le="0.1"} 1\n' in rendered
+    assert 'push_seconds_bucket{le="1"} 2\n' in rendered
+    assert 'push_seconds_count 2\n' in rendered
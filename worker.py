@@ -0,0 +1,27 @@
+import argparse
+import logging
+import signal
+
+# registers the job handlers
+from hikmahealth.jobs import handlers  # noqa: F401
+from hikmahealth.jobs.worker import Worker
+from hikmahealth.server import config
+
+parser = argparse.ArgumentParser(description='Runs the queued background jobs')
+parser.add_argument('--kind', action='append', help='only run jobs of this kind')
+parser.add_argument('--poll-interval', type=float, default=2.0)
+parser.add_argument('--once', action='store_true', help='run a single job and exit')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+print('running as', config.APP_ENV)
+
+worker = Worker(kinds=args.kind, poll_interval=args.poll_interval)
+
+if args.once:
+	worker.run_once()
+else:
+	# finishes the running job before exiting
+	signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+	signal.signal(signal.SIGINT, lambda *_: worker.stop())
+	worker.run_forever()